@@ -0,0 +1,479 @@
+"""
+Follow-up Engine - Refinos do resultado anterior executados localmente
+=====================================================================
+
+Perguntas como "agora só motos", "top 5 desses" ou "ordene por valor" não
+precisam de RAG → Gemini → BigQuery: o resultado que elas refinam já está
+em memória. O motor carrega as linhas da interação anterior numa tabela
+DuckDB em memória (`anterior`) e executa uma SQL pequena sobre ela.
+
+A SQL vem de um conjunto de regras (filtro por valor/número, ordenação,
+top-N, reagregação) e, se as regras não resolverem, do Gemini - que só pode
+devolver um SELECT sobre `anterior` (validado antes de executar, sem acesso
+a arquivos). O modelo só é consultado quando a pergunta começa com um refino
+explícito (grupo "transform"). Pergunta que não é classificada como refino
+(gráfico e exportação incluídos), ou que as regras/modelo não conseguem
+expressar, segue o fluxo normal.
+
+Configuração (variáveis de ambiente):
+- FOLLOWUP_ENABLED (padrão: true)
+- FOLLOWUP_MODEL_ENABLED (fallback via Gemini, padrão: true)
+- FOLLOWUP_MAX_ROWS (resultados anteriores maiores seguem o fluxo normal, padrão: 50000)
+"""
+
+import os
+import re
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Any, Tuple
+
+import duckdb
+import pandas as pd
+
+from utils.intent_classifier import classify_intent, INTENT_FOLLOWUP
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import SqlglotError
+    _HAS_SQLGLOT = True
+except ImportError:
+    _HAS_SQLGLOT = False
+
+FOLLOWUP_ENABLED = os.getenv("FOLLOWUP_ENABLED", "true").lower() == "true"
+FOLLOWUP_MODEL_ENABLED = os.getenv("FOLLOWUP_MODEL_ENABLED", "true").lower() == "true"
+FOLLOWUP_MAX_ROWS = int(os.getenv("FOLLOWUP_MAX_ROWS", "50000"))
+
+LOCAL_TABLE = "anterior"
+ORDER_COLUMN = "__ordem"  # posição da linha no resultado anterior (preserva a ordem)
+MAX_DISTINCT_VALUES = 500
+
+_FILTER_MARKER_RE = re.compile(r"\b(so|apenas|somente|filtr\w*|exceto|sem|tirando|excluindo|exclua|remova|tire|tira)\b")
+_NEGATION_RE = re.compile(r"\b(exceto|sem|tirando|excluindo|exclua|remova|tire|tira|menos(?!\s+de\s+\d))\b")
+_SORT_RE = re.compile(r"\b(?:orden\w*|reorden\w*|classifi\w*|organiz\w*)\b(?:\s+\w+){0,3}?\s+(?:por|pel[oa]s?)\s+([\w\s]+)")
+_AGGREGATE_RE = re.compile(r"\b(agrup\w*|totaliz\w*|some|soma|somar|total|media|consolid\w*)\b(?:\s+\w+){0,3}?\s+por\s+([\w\s]+)")
+_TOP_RES = [
+    re.compile(r"\btop\s*(\d+)"),
+    re.compile(r"\b(\d+)\s+(primeir|maior|menor|principa|melhor|pior|ultim)\w*"),
+    re.compile(r"\b(primeir|maior|menor|principa|melhor|pior|ultim)\w*\s+(\d+)\b"),
+]
+_NUMERIC_FILTER_RE = re.compile(
+    r"(acima de|maior(?:es)? que|mais de|superior(?:es)? a|acima|>=|>|"
+    r"abaixo de|menor(?:es)? que|menos de|inferior(?:es)? a|abaixo|<=|<)\s*(?:r\$\s*)?"
+    r"(\d[\d\.,]*)\s*(mil|milhao|milhoes|mi|bi|bilhao|bilhoes)?\b"
+)
+_MULTIPLIERS = {"mil": 1e3, "milhao": 1e6, "milhoes": 1e6, "mi": 1e6, "bi": 1e9, "bilhao": 1e9, "bilhoes": 1e9}
+
+# Colunas que não são métrica (não servem de critério padrão para top-N)
+_NON_METRIC_RE = re.compile(r"^(id|cod|codigo|posicao|rank|ranking|ano|mes|dia|semana|trimestre)(_|$)|_id$")
+# Colunas preferidas como métrica padrão
+_PREFERRED_METRIC_RE = re.compile(r"valor|val_|vend|total|fatur|receita|quant|qtd|score|freq")
+# Palavra da pergunta -> fragmentos de nome de coluna equivalentes
+COLUMN_SYNONYMS = {
+    "valor": ["val", "valor", "vl", "total", "vendido", "faturamento", "receita"],
+    "faturamento": ["faturamento", "receita", "valor", "val"],
+    "quantidade": ["qtd", "qtde", "quantidade", "veiculos", "count"],
+    "vendas": ["vendas", "vendido", "venda"],
+    "crescimento": ["crescimento", "variacao"],
+    "variacao": ["variacao", "crescimento"],
+}
+_STOPWORDS = {
+    "de", "do", "da", "dos", "das", "e", "o", "a", "os", "as", "em", "no", "na", "nos", "nas", "por",
+    "para", "com", "so", "top", "um", "uma", "que", "mais", "menos", "agora", "apenas", "somente",
+}
+
+
+def _normalize(text: str) -> str:
+    """Minúsculas sem acentos"""
+    text = unicodedata.normalize("NFKD", str(text))
+    return "".join(c for c in text if not unicodedata.combining(c)).lower().strip()
+
+
+def _word_forms(word: str) -> set:
+    """Palavra e formas sem plural ("motos" -> "moto", "valores" -> "valor")"""
+    forms = {word}
+    if len(word) > 3 and word.endswith("s"):
+        forms.add(word[:-1])
+        if word.endswith("es"):
+            forms.add(word[:-2])
+    return forms
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w+", _normalize(text))
+
+
+def _column_tokens(column: str) -> List[str]:
+    column = re.sub(r"([a-z])([A-Z])", r"\1_\2", column)
+    return [t for t in re.split(r"[_\W]+", _normalize(column)) if t]
+
+
+def _quote(identifier: str) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def _parse_number(raw: str, unit: Optional[str]) -> Optional[float]:
+    """Número no formato brasileiro ("1.500,5", "2,5 mil")"""
+    raw = raw.rstrip(".,")
+    if "," in raw:
+        raw = raw.replace(".", "").replace(",", ".")
+    elif re.fullmatch(r"\d{1,3}(\.\d{3})+", raw):
+        raw = raw.replace(".", "")
+    try:
+        value = float(raw)
+    except ValueError:
+        return None
+    return value * _MULTIPLIERS.get(unit or "", 1)
+
+
+@dataclass
+class FollowUpPlan:
+    """SQL sobre a tabela local `anterior` e como foi obtida"""
+    sql: str
+    params: List[Any] = field(default_factory=list)
+    rule: str = "rules"
+    steps: List[str] = field(default_factory=list)
+
+    @property
+    def description(self) -> str:
+        return ", ".join(self.steps) if self.steps else "transformação local"
+
+
+class FollowUpEngine:
+    """Planeja e executa refinos sobre o resultado anterior em um DuckDB em memória"""
+
+    def __init__(self, use_model: bool = FOLLOWUP_MODEL_ENABLED, max_rows: int = FOLLOWUP_MAX_ROWS):
+        self.use_model = use_model
+        self.max_rows = max_rows
+        self._local = threading.local()
+        self._stats: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def is_followup(question: str) -> bool:
+        """A pergunta é um refino do resultado anterior? (utils/intent_classifier.py)"""
+        return classify_intent(question).intent == INTENT_FOLLOWUP
+
+    def answer(self, question: str, rows: List[Dict], model=None) -> Optional[Tuple[FollowUpPlan, List[Dict]]]:
+        """Plano + linhas resultantes, ou None se a pergunta deve seguir o fluxo normal"""
+        if not rows or not isinstance(rows, list) or not isinstance(rows[0], dict) or len(rows) > self.max_rows:
+            return None
+        if not self.is_followup(question):
+            return None
+
+        df = self._frame(rows)
+        plan = self.plan_with_rules(question, df)
+        if (plan is None and model is not None and self.use_model
+                and classify_intent(question).has("transform")):
+            plan = self.plan_with_model(question, df, model)
+        if plan is None:
+            self._count("unresolved")
+            return None
+
+        try:
+            result = self.run(df, plan)
+        except Exception as e:
+            print(f"[FollowUp] ⚠️  SQL local falhou ({plan.rule}): {e}")
+            self._count("failed")
+            return None
+        self._count(plan.rule)
+        return plan, result
+
+    def run(self, df: pd.DataFrame, plan: FollowUpPlan) -> List[Dict]:
+        """Executa o plano sobre `df` registrado como `anterior`"""
+        conn = self._connection()
+        conn.register(LOCAL_TABLE, df)
+        try:
+            cursor = conn.execute(plan.sql, plan.params)
+            columns = [d[0] for d in cursor.description]
+            records = cursor.fetchall()
+        finally:
+            conn.unregister(LOCAL_TABLE)
+        keep = [i for i, col in enumerate(columns) if col != ORDER_COLUMN]
+        return [{columns[i]: row[i] for i in keep} for row in records]
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+    # ------------------------------------------------------------------
+    # Regras
+    # ------------------------------------------------------------------
+
+    def plan_with_rules(self, question: str, df: pd.DataFrame) -> Optional[FollowUpPlan]:
+        """
+        Filtro + reagregação + ordenação + top-N numa única SELECT.
+        Qualquer intenção detectada e não resolvida (coluna/valor inexistente)
+        invalida o plano: melhor o fluxo completo que uma resposta parcial.
+        """
+        normalized = _normalize(question)
+        words = _words(question)
+        numeric_cols, text_cols = self._column_types(df)
+
+        where: List[str] = []
+        params: List[Any] = []
+        steps: List[str] = []
+
+        # 1. Filtro numérico ("acima de 1000", "menos de 2 mil")
+        for match in _NUMERIC_FILTER_RE.finditer(normalized):
+            column = self._match_column(_words(normalized[:match.start()]), numeric_cols) \
+                or self._default_metric(numeric_cols)
+            value = _parse_number(match.group(2), match.group(3))
+            if column is None or value is None:
+                return None
+            op = ">" if match.group(1).startswith(("acima", "maior", "mais", "superior", ">")) else "<"
+            where.append(f"{_quote(column)} {op} ?")
+            params.append(value)
+            steps.append(f"{column} {op} {value:g}")
+        consumed = [m.span() for m in _NUMERIC_FILTER_RE.finditer(normalized)]
+
+        # 2. Filtro por valor de coluna texto ("só motos", "exceto Ceará")
+        if _FILTER_MARKER_RE.search(normalized):
+            matches = self._match_values(words, df, text_cols)
+            if matches:
+                negate = bool(_NEGATION_RE.search(normalized))
+                for column, values in matches.items():
+                    placeholders = ", ".join(["?"] * len(values))
+                    where.append(f"{_quote(column)} {'NOT IN' if negate else 'IN'} ({placeholders})")
+                    params.extend(values)
+                    steps.append(f"{column} {'fora de' if negate else 'em'} {', '.join(map(str, values))}")
+            elif not consumed:
+                return None
+
+        # 3. Reagregação ("agrupe por estado", "total por modelo")
+        select = "*"
+        group_by = ""
+        default_order = _quote(ORDER_COLUMN)
+        aggregate = _AGGREGATE_RE.search(normalized)
+        if aggregate:
+            group_col = self._match_column(aggregate.group(2).split()[:3], text_cols + numeric_cols)
+            if group_col is None:
+                return None
+            measures = [c for c in numeric_cols if c != group_col and not _NON_METRIC_RE.search(_normalize(c))]
+            if not measures:
+                return None
+            func = "AVG" if aggregate.group(1) == "media" else "SUM"
+            select = ", ".join(
+                [_quote(group_col)] + [f"{func}({_quote(c)}) AS {_quote(c)}" for c in measures]
+            )
+            group_by = f" GROUP BY {_quote(group_col)}"
+            default_order = f"{_quote(measures[0])} DESC"
+            numeric_cols = measures
+            steps.append(f"{'média' if func == 'AVG' else 'soma'} por {group_col}")
+
+        # 4. Ordenação explícita ("ordene por valor", "do menor para o maior")
+        order = None
+        sort = _SORT_RE.search(normalized)
+        if sort:
+            sort_col = self._match_column(sort.group(1).split()[:3], numeric_cols + text_cols)
+            if sort_col is None:
+                return None
+            ascending = bool(re.search(r"\b(crescente|ascendente|menor para o maior|do menor)\b", normalized)) or (
+                sort_col in text_cols and not re.search(r"\b(decrescente|descendente|maior para o menor|do maior)\b", normalized)
+            )
+            order = f"{_quote(sort_col)} {'ASC' if ascending else 'DESC'}"
+            steps.append(f"ordenado por {sort_col} ({'crescente' if ascending else 'decrescente'})")
+
+        # 5. Top-N ("top 5 desses", "os 3 menores")
+        limit = None
+        for pattern in _TOP_RES:
+            top = pattern.search(normalized)
+            if top:
+                number, kind = (top.group(1), "top") if pattern is _TOP_RES[0] else (
+                    (top.group(1), top.group(2)) if top.group(1).isdigit() else (top.group(2), top.group(1))
+                )
+                limit = int(number)
+                consumed.append(top.span())
+                break
+        if limit is not None:
+            if limit <= 0:
+                return None
+            if order is None and kind not in ("primeir", "ultim"):
+                metric = self._match_column(words, numeric_cols) or self._default_metric(numeric_cols)
+                if metric is not None:
+                    ascending = kind in ("menor", "pior")
+                    order = f"{_quote(metric)} {'ASC' if ascending else 'DESC'}"
+                    steps.append(f"{'menores' if ascending else 'maiores'} por {metric}")
+            elif order is None and kind == "ultim" and not group_by:
+                order = f"{_quote(ORDER_COLUMN)} DESC"
+            steps.append(f"top {limit}")
+
+        if not steps:
+            return None
+        # Número que nenhuma regra usou ("motos de 2023"): o resultado anterior não responde
+        for number in re.finditer(r"\d+", normalized):
+            if not any(start <= number.start() < end for start, end in consumed):
+                return None
+
+        sql = f"SELECT {select} FROM {LOCAL_TABLE}"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += group_by
+        sql += f" ORDER BY {order or default_order}"
+        if limit is not None:
+            sql += f" LIMIT {limit}"
+        return FollowUpPlan(sql=sql, params=params, rule="rules", steps=steps)
+
+    @staticmethod
+    def _column_types(df: pd.DataFrame) -> Tuple[List[str], List[str]]:
+        numeric, text = [], []
+        for column in df.columns:
+            if column == ORDER_COLUMN:
+                continue
+            if pd.api.types.is_bool_dtype(df[column]):
+                continue
+            if pd.api.types.is_numeric_dtype(df[column]):
+                numeric.append(column)
+            elif pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+                text.append(column)
+        return numeric, text
+
+    @staticmethod
+    def _default_metric(numeric_cols: List[str]) -> Optional[str]:
+        metrics = [c for c in numeric_cols if not _NON_METRIC_RE.search(_normalize(c))]
+        preferred = [c for c in metrics if _PREFERRED_METRIC_RE.search(_normalize(c))]
+        return (preferred or metrics or [None])[0]
+
+    @staticmethod
+    def _match_column(words: List[str], columns: List[str]) -> Optional[str]:
+        """Coluna mais citada pelas palavras (nome, plural ou sinônimo)"""
+        forms = set()
+        for word in words:
+            if word not in _STOPWORDS:
+                forms |= _word_forms(_normalize(word))
+        if not forms:
+            return None
+        best, best_score = None, 0
+        for column in columns:
+            tokens = _column_tokens(column)
+            score = 2 * sum(1 for t in tokens if t in forms)
+            for word in forms:
+                if any(syn in t for syn in COLUMN_SYNONYMS.get(word, []) for t in tokens):
+                    score += 1
+            if score > best_score:
+                best, best_score = column, score
+        return best
+
+    @staticmethod
+    def _match_values(words: List[str], df: pd.DataFrame, text_cols: List[str]) -> Dict[str, List[Any]]:
+        """Valores das colunas texto citados na pergunta ("motos" casa com "Moto")"""
+        question_forms = [_word_forms(w) for w in words]
+        matches: Dict[str, List[Any]] = {}
+        for column in text_cols:
+            values = df[column].dropna().unique()
+            if len(values) > MAX_DISTINCT_VALUES:
+                continue
+            for value in values:
+                if not isinstance(value, str):
+                    continue
+                value_words = _words(value)
+                if not value_words or all(w in _STOPWORDS or w.isdigit() for w in value_words):
+                    continue
+                size = len(value_words)
+                for start in range(len(question_forms) - size + 1):
+                    if all(question_forms[start + i] & _word_forms(value_words[i]) for i in range(size)):
+                        matches.setdefault(column, []).append(value)
+                        break
+        return matches
+
+    # ------------------------------------------------------------------
+    # Fallback: Gemini escreve a SELECT
+    # ------------------------------------------------------------------
+
+    def plan_with_model(self, question: str, df: pd.DataFrame, model) -> Optional[FollowUpPlan]:
+        """Pede ao Gemini uma SELECT sobre `anterior`; descarta qualquer coisa além disso"""
+        from utils.gemini_quota import governed_generate, GeminiQuotaExceeded
+
+        columns = [c for c in df.columns if c != ORDER_COLUMN]
+        schema = ", ".join(f"{c} ({df[c].dtype})" for c in columns)
+        sample = df[columns].head(5).to_dict(orient="records")
+        prompt = (
+            f"A tabela DuckDB `{LOCAL_TABLE}` contém o resultado anterior mostrado ao usuário.\n"
+            f"Colunas: {schema}\n"
+            f"Amostra: {sample}\n"
+            f"Pedido do usuário: {question}\n\n"
+            f"Se o pedido for um filtro, ordenação, top-N ou reagregação desses dados, responda APENAS "
+            f"com uma consulta SELECT (DuckDB) sobre `{LOCAL_TABLE}`. Se precisar de dados que não estão "
+            f"na tabela, responda apenas NAO."
+        )
+        try:
+            response = governed_generate(model, prompt, kind="followup")
+            text = response.text if hasattr(response, "text") else str(response)
+        except GeminiQuotaExceeded:
+            return None
+        except Exception as e:
+            print(f"[FollowUp] ⚠️  Falha ao gerar SQL local via Gemini: {e}")
+            return None
+
+        sql = re.sub(r"^```(?:sql)?|```$", "", (text or "").strip(), flags=re.IGNORECASE).strip().rstrip(";")
+        if not self._is_safe_select(sql):
+            return None
+        return FollowUpPlan(sql=sql, rule="model", steps=["transformação gerada pelo Gemini"])
+
+    @staticmethod
+    def _is_safe_select(sql: str) -> bool:
+        """Uma única SELECT que só lê `anterior` (sem funções de leitura de arquivo)"""
+        if not re.match(r"^\s*select\b", sql, re.IGNORECASE) or ";" in sql:
+            return False
+        if re.search(r"\b(read_\w+|glob|copy|attach|install|load|pragma|insert|update|delete|create|drop)\b",
+                     sql, re.IGNORECASE):
+            return False
+        if not _HAS_SQLGLOT:
+            return bool(re.search(rf"\bfrom\s+{LOCAL_TABLE}\b", sql, re.IGNORECASE))
+        try:
+            tree = sqlglot.parse_one(sql, read="duckdb")
+        except SqlglotError:
+            return False
+        if not isinstance(tree, exp.Select):
+            return False
+        tables = {table.name.lower() for table in tree.find_all(exp.Table)}
+        return tables == {LOCAL_TABLE}
+
+    # ------------------------------------------------------------------
+    # DuckDB em memória
+    # ------------------------------------------------------------------
+
+    def _connection(self) -> "duckdb.DuckDBPyConnection":
+        """Conexão em memória da thread (sem acesso a arquivos/extensões)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = duckdb.connect(":memory:", config={"enable_external_access": False, "threads": 1})
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _frame(rows: List[Dict]) -> pd.DataFrame:
+        df = pd.DataFrame(rows)
+        # NUMERIC do BigQuery chega como Decimal (ou string após safe_serialize_data)
+        for column in df.columns:
+            if pd.api.types.is_object_dtype(df[column]) or pd.api.types.is_string_dtype(df[column]):
+                values = df[column].dropna()
+                if values.empty or values.map(lambda v: isinstance(v, bool)).any():
+                    continue
+                converted = pd.to_numeric(values, errors="coerce")
+                if converted.notna().all():
+                    df[column] = pd.to_numeric(df[column], errors="coerce")
+        df[ORDER_COLUMN] = range(len(df))
+        return df
+
+    def _count(self, outcome: str) -> None:
+        with self._lock:
+            self._stats[outcome] = self._stats.get(outcome, 0) + 1
+
+
+_engine_instance: Optional[FollowUpEngine] = None
+
+
+def get_followup_engine() -> Optional[FollowUpEngine]:
+    """Retorna instância singleton do motor de refinos (None se desabilitado)"""
+    global _engine_instance
+    if not FOLLOWUP_ENABLED:
+        return None
+    if _engine_instance is None:
+        _engine_instance = FollowUpEngine()
+    return _engine_instance
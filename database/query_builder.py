@@ -5,8 +5,21 @@ import ast
 import re
 import sqlparse
 import pandas as pd
+from typing import Dict, Optional
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import SqlglotError, ParseError
+except ImportError:
+    pass
 from config.settings import TABLES_CONFIG
 from database.validator import QueryValidator, validate_and_build_query
+from database.sql_ast_validator import get_ast_validator, DIALECT, _HAS_SQLGLOT
+from database.validation_cache import get_validation_cache, STAGE_VALIDATE_SQL, STAGE_HYPHEN
+from database.result_cache import get_result_cache
+from utils.stage_metrics import STAGE_VALIDATION, STAGE_BIGQUERY
+from utils.tracing import get_tracer
 
 # Função para remover comentários SQL
 def remove_sql_comments(query: str) -> str:
@@ -17,6 +30,12 @@ def remove_sql_comments(query: str) -> str:
     return query
 
 client = bigquery.Client()
+
+# Campos temporais usados para inferir ORDER BY
+TEMPORAL_FIELD_PATTERN = re.compile(r"data|mes|ano|dia|hora", re.IGNORECASE)
+
+# Hífen fora de nomes de tabela/alias (erro de concatenação)
+HYPHEN_PATTERN = re.compile(r"`-[\w\-\.]+`")
 query_validator = QueryValidator(max_retries=2)
 
 def sort_results_by_columns(results):
@@ -95,8 +114,6 @@ def _parse_list_param(param, param_name="param"):
     if not param:
         return []
     
-    print(f"DEBUG - {param_name} inicial: {param} (tipo: {type(param)})")
-    
     if isinstance(param, str):
         # Tenta avaliar como lista Python válida (caso venha como string de lista)
         try:
@@ -116,22 +133,49 @@ def _parse_list_param(param, param_name="param"):
     # Filtra apenas elementos completamente vazios (mantém strings com conteúdo)
     result = [item for item in result if item and str(item).strip()]
     
-    print(f"DEBUG - {param_name} processado: {result}")
     return result
 
 
 def validate_sql_query(query: str) -> dict:
-    """Valida sintaxe SQL usando sqlparse."""
-    try:
-        parsed = sqlparse.parse(query)
-        if not parsed or not parsed[0].tokens:
-            return {"valid": False, "error": "Query vazia ou inválida."}
-        # Pode adicionar mais regras de validação aqui
-        return {"valid": True}
-    except Exception as e:
-        return {"valid": False, "error": str(e)}
-
-def execute_query(query: str, user_question: str = "", gemini_model = None, validate: bool = True):
+    """
+    Valida SQL localmente.
+    
+    Com sqlglot disponível usa o validador AST (colunas, tabelas, CTEs) e aplica
+    correções determinísticas; senão, apenas verifica se o sqlparse consegue parsear.
+    """
+    validation_cache = get_validation_cache()
+    cached = validation_cache.get(query, STAGE_VALIDATE_SQL)
+    if cached is not None:
+        return cached
+
+    ast_validator = get_ast_validator()
+    if ast_validator:
+        fixed_query, ast_result, applied = ast_validator.validate_and_fix(query)
+        result = {
+            "valid": ast_result.is_valid,
+            "error": "; ".join(ast_result.error_messages()) if not ast_result.is_valid else None,
+            "query": fixed_query,
+            "diagnostics": [d.to_dict() for d in ast_result.diagnostics],
+            "applied_fixes": [d.to_dict() for d in applied]
+        }
+        if ast_result.is_valid and fixed_query != query:
+            validation_cache.put(fixed_query, STAGE_VALIDATE_SQL, {**result, "applied_fixes": []})
+    else:
+        try:
+            parsed = sqlparse.parse(query)
+            if not parsed or not parsed[0].tokens:
+                result = {"valid": False, "error": "Query vazia ou inválida."}
+            else:
+                # Pode adicionar mais regras de validação aqui
+                result = {"valid": True}
+        except Exception as e:
+            result = {"valid": False, "error": str(e)}
+
+    validation_cache.put(query, STAGE_VALIDATE_SQL, result)
+    return result
+
+def execute_query(query: str, user_question: str = "", gemini_model = None, validate: bool = True,
+                  user_id: str = "", permission_scope: Optional[Dict] = None, use_cache: bool = True):
     """
     Executa query SQL no BigQuery com VALIDAÇÃO + RETRY AUTOMÁTICO.
     
@@ -146,6 +190,10 @@ def execute_query(query: str, user_question: str = "", gemini_model = None, vali
     - user_question: pergunta original do usuário (para refino)
     - gemini_model: modelo Gemini para refino automático
     - validate: se True, faz validação + retry; se False, executa direto
+    - user_id: usuário que pediu (métrica de hit rate do cache de resultados)
+    - permission_scope: atributos de permissão por linha do usuário; só compartilha
+      resultado com quem tem o mesmo escopo (database/result_cache.py)
+    - use_cache: se False, sempre executa no BigQuery
     
     Retorna: lista de resultados ou dict com erro
     """
@@ -158,77 +206,125 @@ def execute_query(query: str, user_question: str = "", gemini_model = None, vali
     if original_query != corrected_query:
         log_sql_correction(original_query, corrected_query, "execute_query")
     
-    # STEP 2: VALIDAÇÃO + RETRY (novo pipeline)
-    if validate and gemini_model:
-        print("\n" + "="*70)
-        print("[PIPELINE] VALIDAÇÃO + RETRY AUTOMÁTICO INICIADO")
-        print("="*70)
+    tracer = get_tracer()
+    with tracer.span("sql.validation", stage=STAGE_VALIDATION) as validation_span:
+        # STEP 2: VALIDAÇÃO + RETRY (novo pipeline)
+        if validate and gemini_model:
+            print("\n" + "="*70)
+            print("[PIPELINE] VALIDAÇÃO + RETRY AUTOMÁTICO INICIADO")
+            print("="*70)
         
-        validation_result = query_validator.validate_and_refine(
-            corrected_query,
-            user_question,
-            gemini_model
-        )
+            validation_result = query_validator.validate_and_refine(
+                corrected_query,
+                user_question,
+                gemini_model
+            )
+            validation_span.set_attribute("retry_count", validation_result.get("retry_count", 0))
         
-        if validation_result["is_valid"]:
-            corrected_query = validation_result["query"]
-            print(f"\n✅ [PIPELINE] Query validada e pronta para BigQuery")
-            print(f"   Tentativas: {validation_result['retry_count'] + 1}")
+            if validation_result["is_valid"]:
+                corrected_query = validation_result["query"]
+                print(f"\n✅ [PIPELINE] Query validada e pronta para BigQuery")
+                print(f"   Tentativas: {validation_result['retry_count'] + 1}")
+            else:
+                print(f"\n❌ [PIPELINE] {validation_result.get('error_message', 'Erro desconhecido')}")
+                print(f"   Erros finais: {validation_result.get('final_errors', [])}")
+                return {
+                    "error": validation_result.get('error_message', 'Query não validada'),
+                    "query": corrected_query,
+                    "validation_history": validation_result.get('history', [])
+                }
         else:
-            print(f"\n❌ [PIPELINE] {validation_result.get('error_message', 'Erro desconhecido')}")
-            print(f"   Erros finais: {validation_result.get('final_errors', [])}")
-            return {
-                "error": validation_result.get('error_message', 'Query não validada'),
-                "query": corrected_query,
-                "validation_history": validation_result.get('history', [])
-            }
-    else:
-        # Se validate=False, apenas faz validação básica (backward compatibility)
-        validation = validate_sql_query(corrected_query)
-        if not validation["valid"]:
-            print(f"ERRO SINTAXE SQL: {validation['error']}")
-            print(f"SQL gerado com erro:\n{corrected_query}")
-            raise ValueError(f"Erro de sintaxe SQL: {validation['error']}\nSQL: {corrected_query}")
+            # Se validate=False, apenas faz validação básica (backward compatibility)
+            validation = validate_sql_query(corrected_query)
+            if validation.get("query"):
+                corrected_query = validation["query"]
+            if not validation["valid"] and validation.get("diagnostics"):
+                # Erro determinístico detectado localmente: devolve no mesmo formato de erro
+                # do BigQuery (sem gastar uma execução) para que o fluxo de refino trate
+                print(f"❌ [VALIDATION] Erro detectado localmente: {validation['error']}")
+                return {
+                    "error": validation["error"],
+                    "query": corrected_query,
+                    "diagnostics": validation["diagnostics"]
+                }
+            if not validation["valid"]:
+                print(f"ERRO SINTAXE SQL: {validation['error']}")
+                print(f"SQL gerado com erro:\n{corrected_query}")
+                raise ValueError(f"Erro de sintaxe SQL: {validation['error']}\nSQL: {corrected_query}")
     
-    # STEP 3: Validação extra: hífen fora de nomes de tabela/alias
-    hyphen_pattern = r"`-[\w\-\.]+`"
-    if re.search(hyphen_pattern, corrected_query):
-        print(f"ERRO DE CONCATENAÇÃO: hífen '-' fora de nomes de tabela/alias detectado.")
-        print(f"SQL gerado com erro:\n{corrected_query}")
-        raise ValueError(f"Erro de concatenação: hífen '-' fora de nomes de tabela/alias detectado.\nSQL: {corrected_query}")
-
-    # STEP 4: Executa no BigQuery
-    try:
-        print(f"\n[BIGQUERY] Executando query no BigQuery...")
-        job_config = bigquery.QueryJobConfig(
-            maximum_bytes_billed=100_000_000,
-            job_timeout_ms=30000  # 30 segundos timeout
-        )
-        query_job = client.query(corrected_query, job_config=job_config)
-
-        # Executa e converte resultados
-        results = []
-        for row in query_job.result(timeout=30):
-            results.append(dict(row))
-
-        print(f"✅ [BIGQUERY] Query executada com sucesso. {len(results)} linhas retornadas.")
+        # STEP 3: Validação extra: hífen fora de nomes de tabela/alias
+        validation_cache = get_validation_cache()
+        if not validation_cache.has_passed(corrected_query, STAGE_HYPHEN):
+            if HYPHEN_PATTERN.search(corrected_query):
+                print(f"ERRO DE CONCATENAÇÃO: hífen '-' fora de nomes de tabela/alias detectado.")
+                print(f"SQL gerado com erro:\n{corrected_query}")
+                raise ValueError(f"Erro de concatenação: hífen '-' fora de nomes de tabela/alias detectado.\nSQL: {corrected_query}")
+            validation_cache.mark_passed(corrected_query, STAGE_HYPHEN)
+
+    # STEP 3.5: Resultado já obtido por outro usuário do tenant com o mesmo escopo
+    result_cache = get_result_cache() if use_cache else None
+    if result_cache is not None:
+        with tracer.span("result_cache.lookup") as cache_span:
+            cached = result_cache.get(corrected_query, permission_scope, user_id=user_id)
+            cache_span.set_attribute("hit", cached is not None)
+        if cached is not None:
+            print(f"♻️  [RESULT_CACHE] Resultado compartilhado reutilizado ({len(cached)} linhas)")
+            return cached
+
+    with tracer.span("bigquery.execute", stage=STAGE_BIGQUERY) as bigquery_span:
+        # STEP 4: Executa no BigQuery
+        try:
+            print(f"\n[BIGQUERY] Executando query no BigQuery...")
+            job_config = bigquery.QueryJobConfig(
+                maximum_bytes_billed=100_000_000,
+                job_timeout_ms=30000  # 30 segundos timeout
+            )
+            query_job = client.query(corrected_query, job_config=job_config)
+
+            # Executa e converte resultados
+            results = []
+            for row in query_job.result(timeout=30):
+                results.append(dict(row))
+
+            print(f"✅ [BIGQUERY] Query executada com sucesso. {len(results)} linhas retornadas.")
+            bigquery_span.set_attributes(
+                bytes_processed=getattr(query_job, "total_bytes_processed", None),
+                cache_hit=getattr(query_job, "cache_hit", None),
+                rows=len(results)
+            )
+            validation_cache.record_dry_run(corrected_query, {
+                "total_bytes_processed": getattr(query_job, "total_bytes_processed", None),
+                "cache_hit": getattr(query_job, "cache_hit", None),
+                "row_count": len(results)
+            })
         
-        # 🔥 ORDENA RESULTADOS SEMPRE (importante para gráficos com datas)
-        results = sort_results_by_columns(results)
+            # 🔥 ORDENA RESULTADOS SEMPRE (importante para gráficos com datas)
+            results = sort_results_by_columns(results)
+            if result_cache is not None:
+                result_cache.put(corrected_query, results, permission_scope)
         
-        return results
+            return results
 
-    except Exception as e:
-        print(f"❌ [BIGQUERY] ERRO: {str(e)}")
-        print(f"SQL com erro:\n{corrected_query}")
-        return {
-            "error": str(e),
-            "query": corrected_query
-        }
+        except Exception as e:
+            print(f"❌ [BIGQUERY] ERRO: {str(e)}")
+            bigquery_span.record_error(e)
+            print(f"SQL com erro:\n{corrected_query}")
+            return {
+                "error": str(e),
+                "query": corrected_query
+            }
 
 
 def build_query(params: dict) -> str:
-    # Apenas constrói a query fielmente conforme os parâmetros recebidos
+    """
+    Monta a SQL final a partir dos parâmetros da function_call.
+
+    Com sqlglot, CTE e cláusulas são parseadas uma única vez; correção de
+    referências de tabela e ORDER BY são aplicados como transformações na
+    árvore e a saída é a SQL canônica (também usada como chave dos caches de
+    validação e de resultados). Sem sqlglot, ou se o parse falhar, usa a
+    montagem por texto.
+    """
     original_params = params.copy()
     corrected_params = fix_function_params(params)
 
@@ -236,9 +332,145 @@ def build_query(params: dict) -> str:
     if original_params != corrected_params:
         print(f"PARAM_CORRECTION: {original_params} -> {corrected_params}")
 
-    # Debug: log dos parâmetros corrigidos
-    print(f"DEBUG - Parâmetros recebidos no build_query: {corrected_params}")
+    if _HAS_SQLGLOT:
+        try:
+            return _build_query_ast(corrected_params)
+        except SqlglotError as e:
+            print(f"⚠️  [BUILD_QUERY] Parse da CTE/cláusulas falhou, usando montagem por texto: {e}")
+    return _build_query_legacy(corrected_params)
+
+
+def _default_table_ref() -> str:
+    return f"`{PROJECT_ID}.{DATASET_ID}.{list(TABLES_CONFIG.keys())[0]}`"
+
 
+def _parse_cte_param(cte: str):
+    """
+    Parseia o parâmetro 'cte'.
+
+    Retorna (query_completa, ctes): query_completa é a árvore quando a CTE já
+    traz o SELECT final; senão ctes é a lista de exp.CTE a anexar ao SELECT montado.
+    """
+    if not cte:
+        return None, []
+    if cte.upper().startswith("SELECT"):
+        return sqlglot.parse_one(cte, read=DIALECT), []
+
+    body = cte if cte.upper().startswith("WITH") else f"WITH {cte}"
+    try:
+        return sqlglot.parse_one(body, read=DIALECT), []
+    except ParseError:
+        # Só o bloco WITH: parseia com um SELECT sonda para extrair as CTEs
+        probe = sqlglot.parse_one(f"{body} SELECT 1", read=DIALECT)
+        return None, list(probe.ctes)
+
+
+def _final_select_items(select: list) -> list:
+    """
+    Itens do SELECT final: agregações já calculadas na CTE viram referência ao
+    alias (SUM(x) AS total -> total); agregações sem alias são descartadas.
+    """
+    items = []
+    for item in select:
+        node = sqlglot.parse_one(item, read=DIALECT)
+        if node.find(exp.AggFunc):
+            if isinstance(node, exp.Alias):
+                items.append(exp.column(node.alias))
+            continue
+        items.append(node)
+    return items or [exp.Star()]
+
+
+def _infer_temporal_order(select_items: list, order_by: list) -> list:
+    """Acrescenta ao ORDER BY os campos temporais do SELECT ainda não ordenados"""
+    seen = {o.sql(dialect=DIALECT).lower() for o in order_by}
+    for item in select_items:
+        if isinstance(item, exp.Star) or not TEMPORAL_FIELD_PATTERN.search(item.sql(dialect=DIALECT)):
+            continue
+        key = exp.column(item.alias) if isinstance(item, exp.Alias) else item.copy()
+        if key.sql(dialect=DIALECT).lower() not in seen:
+            seen.add(key.sql(dialect=DIALECT).lower())
+            order_by.append(key)
+    return order_by
+
+
+def _qualify_config_tables(tree) -> None:
+    """Referências parciais a tabelas do tables_config viram o nome completo (projeto.dataset.tabela)"""
+    ast_validator = get_ast_validator()
+    if ast_validator is None:
+        return
+    cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+    for table in list(tree.find_all(exp.Table)):
+        if not table.name or (table.catalog and table.db):
+            continue
+        if not table.db and table.name.lower() in cte_names:
+            continue
+        config_key = ast_validator.resolve_table(table)
+        if not config_key:
+            continue
+        bigquery_table = TABLES_CONFIG[config_key].get('metadata', {}).get('bigquery_table', '')
+        parts = bigquery_table.replace('`', '').split('.')
+        if len(parts) != 3:
+            parts = [PROJECT_ID, DATASET_ID, config_key]
+        if not all(parts):
+            continue
+        table.set("catalog", exp.to_identifier(parts[0]))
+        table.set("db", exp.to_identifier(parts[1]))
+        table.set("this", exp.to_identifier(parts[2]))
+
+
+def _build_query_ast(corrected_params: dict) -> str:
+    """Montagem por AST: parse único, transformações na árvore, SQL canônica"""
+    cte = remove_sql_comments(corrected_params.get("cte", "") or "").strip()
+    select = _parse_list_param(corrected_params.get("select", ["*"]), "select") or ["*"]
+    order_by = [
+        sqlglot.parse_one(o, into=exp.Ordered, read=DIALECT)
+        for o in _parse_list_param(corrected_params.get("order_by"), "order_by")
+    ]
+    from_table = (corrected_params.get("from_table", "") or "").strip()
+
+    full_query, ctes = _parse_cte_param(cte)
+
+    if full_query is not None:
+        # CTE já é a query completa: só acrescenta ORDER BY pedido se não houver
+        tree = full_query
+        if order_by and not tree.args.get("order"):
+            tree = tree.order_by(*order_by, copy=False)
+    else:
+        if ctes and not from_table:
+            raise ValueError("O parâmetro 'from_table' deve ser o alias de uma CTE gerada pelo modelo ou expressão de JOIN. Nenhum valor foi fornecido.")
+        if not from_table:
+            from_table = _default_table_ref()
+        elif ctes and "." in from_table and not re.search(r"\s", from_table):
+            # Modelo às vezes qualifica o alias da CTE (proj.ds.base): no BigQuery é só `base`
+            alias = from_table.replace("`", "").split(".")[-1].strip()
+            if alias.lower() in {cte_node.alias.lower() for cte_node in ctes}:
+                from_table = alias
+
+        select_items = _final_select_items(select)
+        order_by = _infer_temporal_order(select_items, order_by)
+
+        tree = exp.select(*select_items).from_(from_table, dialect=DIALECT, copy=False)
+
+        where = corrected_params.get("where")
+        if where:
+            tree = tree.where(where, dialect=DIALECT, copy=False)
+        ranking_filter = corrected_params.get("ranking_filter")
+        if ranking_filter and not (where and "ranking <= " in where):
+            tree = tree.where(ranking_filter, dialect=DIALECT, copy=False)
+        if order_by:
+            tree = tree.order_by(*order_by, copy=False)
+        if corrected_params.get("limit"):
+            tree = tree.limit(int(corrected_params["limit"]), copy=False)
+        for cte_node in ctes:
+            tree = tree.with_(cte_node.alias, as_=cte_node.this, copy=False)
+
+    _qualify_config_tables(tree)
+    return tree.sql(dialect=DIALECT, comments=False)
+
+
+def _build_query_legacy(corrected_params: dict) -> str:
+    """Montagem por texto (fallback quando sqlglot não está disponível ou o parse falha)"""
     cte = corrected_params.get("cte", "").strip()
     select = _parse_list_param(corrected_params.get("select", ["*"]), "select")
     order_by = _parse_list_param(corrected_params.get("order_by"), "order_by")
@@ -260,7 +492,6 @@ def build_query(params: dict) -> str:
         
         # Se tem apenas 1 SELECT, é uma query incompleta
         if select_count < 2:
-            print(f"DEBUG - is_complete_query: Apenas {select_count} SELECT encontrado(s) - INCOMPLETA")
             return False
         
         # Verificação alternativa: procura pelo padrão "SELECT ... FROM"
@@ -272,20 +503,16 @@ def build_query(params: dict) -> str:
         )
         
         is_complete = pattern_final_select is not None
-        print(f"DEBUG - is_complete_query: pattern_final_select={pattern_final_select is not None} - {'COMPLETA' if is_complete else 'INCOMPLETA'}")
         return is_complete
 
     # SE a CTE já for uma query completa, usa ela diretamente
     if cte and is_complete_query(cte):
-        print("DEBUG - CTE identificada como query completa, usando diretamente")
         query_clean = re.sub(r'[\n\t]+', ' ', cte)
         query_clean = re.sub(r' +', ' ', query_clean).strip()
         query_no_comments = remove_sql_comments(query_clean)
-        print(f"DEBUG - Query completa retornada:\n{query_no_comments}")
         return query_no_comments
 
     # SE NÃO for query completa, faz a montagem padrão
-    print("DEBUG - CTE não é query completa, fazendo montagem padrão")
     
     # Resto do código original para montagem padrão...
     def extract_table_from_cte(cte):
@@ -352,7 +579,6 @@ def build_query(params: dict) -> str:
                 if "ORDER BY" not in query_clean.upper():
                     query_clean = query_clean.strip()
                     query_clean += order_by_clause
-            print(f"DEBUG - Query construída:\n{query_clean}")
             return query_clean.strip()
         else:
             with_clause = f"WITH {cte_clean}\n"
@@ -405,5 +631,4 @@ def build_query(params: dict) -> str:
     query_clean = re.sub(r' +', ' ', query_clean)
 
     query_no_comments = remove_sql_comments(query_clean.strip())
-    print(f"DEBUG - Query construída:\n{query_no_comments}")
     return query_no_comments
\ No newline at end of file
@@ -0,0 +1,227 @@
+"""
+Result Cache - Resultados de SQL compartilhados entre usuários
+=============================================================
+
+O reuso de interações (find_reusable / _check_reuse_opportunity) só olha o
+histórico do próprio usuário: dois analistas do mesmo cliente fazendo a mesma
+pergunta pagam, cada um, uma execução completa no BigQuery. Este cache guarda
+o resultado de `execute_query` por SQL canônica e o entrega a qualquer
+usuário do mesmo tenant com o mesmo escopo de permissão.
+
+Chave = tenant (CLIENTE_NAME + projeto/dataset) + SQL canônica (sqlglot,
+ou fingerprint textual sem sqlglot) + escopo de permissão por linha (ex.:
+{"filial": "SP"}) + data do dia quando a SQL usa CURRENT_DATE. Usuários com
+escopos diferentes nunca compartilham entradas. SQL não determinística
+(RAND, CURRENT_TIMESTAMP...) não é cacheada.
+
+Dois níveis:
+- memória (LRU com TTL, por processo)
+- tabela shared_query_results do cache (utils/cache.py), visível às demais
+  réplicas quando a store usa SQLite/PostgreSQL (utils/storage.py)
+
+Hit rate: contadores `cache_hits`/`cache_misses` (cache="shared_result") em
+utils.stage_metrics, métrica CACHE_HIT_RATE por usuário em utils.metrics e
+`get_stats()`.
+
+Configuração (variáveis de ambiente):
+- RESULT_CACHE_ENABLED (padrão: true)
+- RESULT_CACHE_TTL (segundos, padrão: 900)
+- RESULT_CACHE_MAX_ENTRIES (memória, padrão: 256)
+- RESULT_CACHE_MAX_ROWS (resultados maiores não são cacheados, padrão: 5000)
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Any
+
+from config.settings import CLIENTE_NAME, PROJECT_ID, DATASET_ID
+from database.validation_cache import sql_fingerprint
+from utils.stage_metrics import get_stage_metrics
+
+try:
+    import sqlglot
+    from sqlglot.errors import SqlglotError
+    _HAS_SQLGLOT = True
+except ImportError:
+    _HAS_SQLGLOT = False
+
+RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "900"))
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "256"))
+RESULT_CACHE_MAX_ROWS = int(os.getenv("RESULT_CACHE_MAX_ROWS", "5000"))
+
+SQL_DIALECT = "bigquery"
+TENANT = f"{CLIENTE_NAME}|{PROJECT_ID}.{DATASET_ID}"
+
+# Resultado muda a cada execução: nunca cachear
+_VOLATILE_RE = re.compile(
+    r"\b(RAND|GENERATE_UUID|CURRENT_TIMESTAMP|CURRENT_DATETIME|CURRENT_TIME|SESSION_USER)\b",
+    re.IGNORECASE,
+)
+# Resultado muda por dia: a data entra na chave
+_DAILY_RE = re.compile(r"\bCURRENT_DATE\b", re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def canonical_sql(sql: str) -> str:
+    """
+    SQL canônica (formatação, funções e comentários normalizados pelo sqlglot)
+    ou fingerprint por tokens. Identificadores mantêm a caixa: nomes de
+    tabela no BigQuery diferenciam maiúsculas.
+    """
+    if _HAS_SQLGLOT:
+        try:
+            tree = sqlglot.parse_one(sql, read=SQL_DIALECT)
+            if tree is not None:
+                return tree.sql(dialect=SQL_DIALECT, normalize_functions="upper", comments=False)
+        except SqlglotError:
+            pass
+    return sql_fingerprint(sql)
+
+
+def is_cacheable(sql: str) -> bool:
+    return bool(sql) and not _VOLATILE_RE.search(sql)
+
+
+def result_cache_key(sql: str, scope: Optional[Dict[str, Any]] = None) -> str:
+    """Chave do resultado: tenant + SQL canônica + escopo de permissão (+ dia, se CURRENT_DATE)"""
+    parts = [TENANT, canonical_sql(sql), json.dumps(scope or {}, sort_keys=True, default=str)]
+    if _DAILY_RE.search(sql):
+        parts.append(datetime.now().strftime("%Y-%m-%d"))
+    return hashlib.sha1("\x1f".join(parts).encode("utf-8", errors="ignore")).hexdigest()
+
+
+class SharedResultCache:
+    """Cache de resultados por SQL canônica, compartilhado no tenant (memória + cache.db)"""
+
+    def __init__(
+        self,
+        ttl: float = RESULT_CACHE_TTL,
+        max_entries: int = RESULT_CACHE_MAX_ENTRIES,
+        max_rows: int = RESULT_CACHE_MAX_ROWS,
+        shared_store: bool = True
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.shared_store = shared_store
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits_memory": 0, "hits_store": 0, "misses": 0, "stores": 0, "skipped": 0}
+
+    def get(self, sql: str, scope: Optional[Dict[str, Any]] = None, user_id: str = "") -> Optional[List[Dict]]:
+        """Resultado cacheado (cópia rasa das linhas) ou None"""
+        if not is_cacheable(sql):
+            return None
+        key = result_cache_key(sql, scope)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits_memory"] += 1
+        if entry is not None:
+            self._record(True, "memory", user_id)
+            return [dict(row) for row in entry[1]]
+
+        rows = self._load_shared(key)
+        if rows is not None:
+            with self._lock:
+                self._remember(key, rows, now)
+                self._stats["hits_store"] += 1
+            self._record(True, "store", user_id)
+            return [dict(row) for row in rows]
+
+        with self._lock:
+            self._stats["misses"] += 1
+        self._record(False, None, user_id)
+        return None
+
+    def put(self, sql: str, results: List[Dict], scope: Optional[Dict[str, Any]] = None) -> bool:
+        """Guarda o resultado de uma execução bem-sucedida; False se não cacheável"""
+        if not isinstance(results, list) or not is_cacheable(sql) or len(results) > self.max_rows:
+            with self._lock:
+                self._stats["skipped"] += 1
+            return False
+        key = result_cache_key(sql, scope)
+        rows = [dict(row) for row in results]
+        with self._lock:
+            self._remember(key, rows, time.monotonic())
+            self._stats["stores"] += 1
+        if self.shared_store:
+            try:
+                from utils.cache import save_shared_result
+                save_shared_result(key, TENANT, sql, rows, self.ttl)
+            except Exception as e:
+                print(f"[ResultCache] ⚠️  Falha ao publicar resultado compartilhado: {e}")
+        return True
+
+    def _remember(self, key: str, rows: List[Dict], now: float) -> None:
+        """Insere no LRU (chamar com _lock)"""
+        self._entries[key] = (now + self.ttl, rows)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _load_shared(self, key: str) -> Optional[List[Dict]]:
+        if not self.shared_store:
+            return None
+        try:
+            from utils.cache import get_shared_result
+            shared = get_shared_result(key)
+        except Exception as e:
+            print(f"[ResultCache] ⚠️  Falha ao ler resultado compartilhado: {e}")
+            return None
+        return shared["data"] if shared else None
+
+    @staticmethod
+    def _record(hit: bool, source: Optional[str], user_id: str) -> None:
+        if hit:
+            get_stage_metrics().increment("cache_hits", cache="shared_result", source=source)
+        else:
+            get_stage_metrics().increment("cache_misses", cache="shared_result")
+        if user_id:
+            try:
+                from utils.metrics import ai_metrics
+                ai_metrics.record_cache_hit(session_id="", user_id=user_id, hit=hit, cache_type="shared_result")
+            except Exception:
+                pass
+
+    def invalidate(self) -> None:
+        """Descarta a camada em memória (a tabela expira pelo TTL / compactação)"""
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        hits = stats["hits_memory"] + stats["hits_store"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        stats["ttl"] = self.ttl
+        return stats
+
+
+_cache_instance: Optional[SharedResultCache] = None
+
+
+def get_result_cache() -> Optional[SharedResultCache]:
+    """Retorna instância singleton do cache de resultados (None se desabilitado)"""
+    global _cache_instance
+    if not RESULT_CACHE_ENABLED:
+        return None
+    if _cache_instance is None:
+        _cache_instance = SharedResultCache()
+    return _cache_instance
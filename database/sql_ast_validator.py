@@ -0,0 +1,453 @@
+"""
+SQL AST Validator - Validação offline de SQL BigQuery
+=====================================================
+
+Validador determinístico baseado em parser SQL real (sqlglot, dialeto BigQuery).
+Substitui as checagens por regex/sqlparse e evita chamadas ao Gemini para erros
+que podem ser detectados localmente:
+
+1. Erros de parse (com linha/coluna)
+2. CTEs com SELECT final ausente (auto-corrigível)
+3. Tabelas físicas fora do tables_config.json
+4. Colunas desconhecidas, resolvidas por escopo (CTEs, aliases, subqueries)
+
+Cada problema vira um `SQLDiagnostic` com código estável e, quando possível,
+uma correção aplicável por máquina (`apply_fixes`).
+"""
+
+import difflib
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Any, Optional, Set, Tuple
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ParseError
+    from sqlglot.optimizer.scope import Scope, traverse_scope
+    _HAS_SQLGLOT = True
+except ImportError:
+    _HAS_SQLGLOT = False
+
+from config.settings import TABLES_CONFIG
+
+DIALECT = "bigquery"
+
+# Códigos de diagnóstico (estáveis, usados pelo auto-fixer e pelos logs)
+PARSE_ERROR = "PARSE_ERROR"
+MISSING_FINAL_SELECT = "MISSING_FINAL_SELECT"
+UNKNOWN_TABLE = "UNKNOWN_TABLE"
+UNKNOWN_COLUMN = "UNKNOWN_COLUMN"
+UNKNOWN_QUALIFIER = "UNKNOWN_QUALIFIER"
+
+# Similaridade mínima para sugerir renomeação automática de coluna
+RENAME_CUTOFF = 0.85
+
+
+@dataclass
+class SQLDiagnostic:
+    """Diagnóstico preciso de um problema na SQL"""
+    code: str
+    message: str
+    severity: str = "error"
+    identifier: Optional[str] = None
+    scope: Optional[str] = None
+    suggestions: List[str] = field(default_factory=list)
+    fix: Optional[Dict[str, Any]] = None
+    line: Optional[int] = None
+    col: Optional[int] = None
+
+    @property
+    def fixable(self) -> bool:
+        return self.fix is not None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "code": self.code,
+            "message": self.message,
+            "severity": self.severity,
+            "identifier": self.identifier,
+            "scope": self.scope,
+            "suggestions": self.suggestions,
+            "fix": self.fix,
+            "line": self.line,
+            "col": self.col,
+        }
+
+
+@dataclass
+class ASTValidationResult:
+    """Resultado da validação por AST"""
+    is_valid: bool
+    diagnostics: List[SQLDiagnostic] = field(default_factory=list)
+    tables: List[str] = field(default_factory=list)
+    ctes: List[str] = field(default_factory=list)
+    canonical_sql: Optional[str] = None
+    elapsed_ms: float = 0.0
+
+    @property
+    def errors(self) -> List[SQLDiagnostic]:
+        return [d for d in self.diagnostics if d.severity == "error"]
+
+    @property
+    def all_fixable(self) -> bool:
+        """True se todos os erros têm correção determinística"""
+        return bool(self.errors) and all(d.fixable for d in self.errors)
+
+    def error_messages(self) -> List[str]:
+        return [d.message for d in self.errors]
+
+
+class SQLASTValidator:
+    """Valida SQL BigQuery contra o tables_config.json usando AST"""
+
+    def __init__(self, tables_config: Dict[str, Any] = None):
+        self.config = tables_config if tables_config is not None else TABLES_CONFIG
+        self.table_columns = self._build_table_columns()
+        self.table_aliases = self._build_table_aliases()
+
+    def _build_table_columns(self) -> Dict[str, Dict[str, str]]:
+        """Mapa tabela -> {nome_lower: nome_original} com todos os campos configurados"""
+        table_columns = {}
+        for table_name, table_config in self.config.items():
+            if not isinstance(table_config, dict):
+                continue
+            columns = {}
+            for field_list in table_config.get('fields', {}).values():
+                if not isinstance(field_list, list):
+                    continue
+                for field_info in field_list:
+                    if isinstance(field_info, dict) and field_info.get('name'):
+                        columns[field_info['name'].lower()] = field_info['name']
+            table_columns[table_name] = columns
+        return table_columns
+
+    def _build_table_aliases(self) -> Dict[str, str]:
+        """Mapa de nomes aceitos (lower) -> chave do tables_config"""
+        aliases = {}
+        for table_name, table_config in self.config.items():
+            if not isinstance(table_config, dict):
+                continue
+            aliases[table_name.lower()] = table_name
+            bigquery_table = table_config.get('metadata', {}).get('bigquery_table', '')
+            if bigquery_table:
+                aliases[bigquery_table.replace('`', '').lower()] = table_name
+                aliases[bigquery_table.replace('`', '').split('.')[-1].lower()] = table_name
+        return aliases
+
+    # ------------------------------------------------------------------
+    # Parse
+    # ------------------------------------------------------------------
+
+    def parse(self, sql: str):
+        """Parseia SQL no dialeto BigQuery (levanta ParseError)"""
+        return sqlglot.parse_one(sql, read=DIALECT)
+
+    def complete_final_select(self, sql: str) -> Optional[str]:
+        """Se a SQL é só um bloco WITH, devolve a versão com SELECT * FROM <última CTE>"""
+        stripped = sql.strip().rstrip(';')
+        if not stripped.upper().startswith('WITH'):
+            return None
+        try:
+            probe = sqlglot.parse_one(f"{stripped} SELECT 1", read=DIALECT)
+        except ParseError:
+            return None
+        with_clause = probe.args.get('with') or probe.args.get('with_')
+        if not with_clause or not with_clause.expressions:
+            return None
+        last_cte = with_clause.expressions[-1].alias_or_name
+        return f"{stripped} SELECT * FROM {last_cte}"
+
+    # ------------------------------------------------------------------
+    # Validação
+    # ------------------------------------------------------------------
+
+    def validate(self, sql: str) -> ASTValidationResult:
+        """Valida a SQL e retorna diagnósticos precisos"""
+        start = time.perf_counter()
+        result = ASTValidationResult(is_valid=True)
+
+        if not sql or not sql.strip():
+            result.is_valid = False
+            result.diagnostics.append(SQLDiagnostic(PARSE_ERROR, "SQL vazia"))
+            return result
+
+        try:
+            tree = self.parse(sql)
+        except ParseError as e:
+            completed = self.complete_final_select(sql)
+            if completed:
+                result.diagnostics.append(SQLDiagnostic(
+                    MISSING_FINAL_SELECT,
+                    "Query tem CTEs mas falta SELECT final.",
+                    fix={"action": "replace_sql", "sql": completed}
+                ))
+            else:
+                first = e.errors[0] if getattr(e, 'errors', None) else {}
+                result.diagnostics.append(SQLDiagnostic(
+                    PARSE_ERROR,
+                    f"Erro de sintaxe: {first.get('description', str(e))}",
+                    line=first.get('line'),
+                    col=first.get('col')
+                ))
+            result.is_valid = False
+            result.elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+            return result
+
+        if tree is None:
+            result.is_valid = False
+            result.diagnostics.append(SQLDiagnostic(PARSE_ERROR, "Nenhum statement SQL encontrado"))
+            return result
+
+        result.ctes = [cte.alias_or_name for cte in tree.find_all(exp.CTE)]
+        try:
+            scopes = traverse_scope(tree)
+        except Exception as e:
+            # Escopos inválidos (ex: CTE referenciando alias inexistente) - reporta e segue
+            result.diagnostics.append(SQLDiagnostic(
+                PARSE_ERROR, f"Não foi possível resolver escopos: {e}", severity="warning"
+            ))
+            scopes = []
+
+        tables: Set[str] = set()
+        for scope in scopes:
+            self._check_scope(scope, result, tables)
+
+        result.tables = sorted(tables)
+        result.canonical_sql = tree.sql(dialect=DIALECT)
+        result.is_valid = not result.errors
+        result.elapsed_ms = round((time.perf_counter() - start) * 1000, 3)
+        return result
+
+    def _scope_name(self, scope: "Scope") -> str:
+        if scope.is_cte:
+            parent = scope.expression.parent
+            if isinstance(parent, exp.CTE):
+                return parent.alias_or_name
+        return "root" if scope.parent is None else "subquery"
+
+    def resolve_table(self, table: "exp.Table") -> Optional[str]:
+        """Resolve uma referência de tabela física para a chave do tables_config"""
+        full_name = ".".join(p for p in (table.catalog, table.db, table.name) if p).lower()
+        return self.table_aliases.get(full_name) or self.table_aliases.get(table.name.lower())
+
+    def _source_columns(self, source) -> Optional[Set[str]]:
+        """Colunas (lower) expostas por uma fonte; None = desconhecido (não valida)"""
+        if isinstance(source, exp.Table):
+            config_key = self.resolve_table(source)
+            columns = self.table_columns.get(config_key) if config_key else None
+            return set(columns) if columns else None
+        if _HAS_SQLGLOT and isinstance(source, Scope):
+            expression = source.expression
+            if isinstance(expression, (exp.Union, exp.Intersect, exp.Except)):
+                # UNION etc: usa a primeira projeção
+                selects = expression.named_selects
+                return {s.lower() for s in selects} if selects else None
+            if not isinstance(expression, exp.Select):
+                # UNNEST, VALUES, funções de tabela: colunas/campos não são conhecidos
+                return None
+            if expression.is_star or any(isinstance(s, exp.Star) or (isinstance(s, exp.Column) and s.is_star)
+                                         for s in expression.expressions):
+                return None
+            return {name.lower() for name in expression.named_selects}
+        return None
+
+    def _check_scope(self, scope: "Scope", result: ASTValidationResult, tables: Set[str]) -> None:
+        scope_name = self._scope_name(scope)
+
+        # Tabelas físicas
+        for source in scope.sources.values():
+            if isinstance(source, exp.Table) and source.name:
+                config_key = self.resolve_table(source)
+                if config_key:
+                    tables.add(config_key)
+                elif self.config:
+                    result.diagnostics.append(SQLDiagnostic(
+                        UNKNOWN_TABLE,
+                        f"Tabela '{source.sql(dialect=DIALECT)}' não está no tables_config.json",
+                        identifier=source.name,
+                        scope=scope_name,
+                        suggestions=difflib.get_close_matches(source.name, list(self.config.keys()), n=3)
+                    ))
+
+        select_aliases = set()
+        if isinstance(scope.expression, exp.Select):
+            select_aliases = {
+                s.alias.lower() for s in scope.expression.expressions if isinstance(s, exp.Alias)
+            }
+
+        for column in scope.columns:
+            name = column.name
+            if not name or name.startswith('_'):
+                continue  # pseudo-colunas (_PARTITIONTIME, _TABLE_SUFFIX)
+            qualifier = column.table
+
+            if qualifier:
+                source = scope.sources.get(qualifier)
+                if source is None:
+                    source = self._find_in_parents(scope, qualifier)
+                if source is None and self._resolve_struct_path(scope, column):
+                    continue
+                if source is None:
+                    result.diagnostics.append(SQLDiagnostic(
+                        UNKNOWN_QUALIFIER,
+                        f"Alias '{qualifier}' não definido no escopo '{scope_name}'",
+                        identifier=qualifier,
+                        scope=scope_name,
+                        suggestions=difflib.get_close_matches(qualifier, list(scope.sources.keys()), n=3)
+                    ))
+                    continue
+                known = self._source_columns(source)
+                if known is None or name.lower() in known:
+                    continue
+                self._report_unknown_column(result, column, scope_name, known)
+                continue
+
+            # Coluna sem qualificador: alias do SELECT (fora do WHERE) é válido em GROUP BY/ORDER BY
+            if name.lower() in select_aliases and not column.find_ancestor(exp.Where):
+                continue
+
+            resolved, candidates = self._resolve_unqualified(scope, name)
+            if not resolved:
+                self._report_unknown_column(result, column, scope_name, candidates)
+
+    def _resolve_unqualified(self, scope: "Scope", name: str) -> Tuple[bool, Set[str]]:
+        """Procura a coluna nas fontes do escopo; retorna (resolvida, colunas conhecidas)"""
+        candidates: Set[str] = set()
+        current = scope
+        while current is not None:
+            for source in current.sources.values():
+                known = self._source_columns(source)
+                if known is None or name.lower() in known:
+                    return True, candidates
+                candidates |= known
+            # Só subqueries correlacionadas enxergam o escopo externo
+            current = current.parent if current.is_subquery else None
+        return False, candidates
+
+    def _resolve_struct_path(self, scope: "Scope", column: "exp.Column") -> bool:
+        """
+        Qualificador que não é fonte: acesso a campo de STRUCT (`cliente.nome`,
+        `t.cliente.nome`). Válido se o primeiro nome após o alias (ou o primeiro
+        nome, sem alias) for uma coluna das fontes; os campos não são validados.
+        """
+        parts = [part.name for part in column.parts]
+        source = scope.sources.get(parts[0]) or self._find_in_parents(scope, parts[0])
+        if source is not None and len(parts) > 2:
+            known = self._source_columns(source)
+            return known is None or parts[1].lower() in known
+        return self._resolve_unqualified(scope, parts[0])[0]
+
+    def _find_in_parents(self, scope: "Scope", qualifier: str):
+        current = scope
+        while current.is_subquery and current.parent is not None:
+            current = current.parent
+            if qualifier in current.sources:
+                return current.sources[qualifier]
+        return None
+
+    def _report_unknown_column(self, result: ASTValidationResult, column: "exp.Column",
+                               scope_name: str, known: Set[str]) -> None:
+        name = column.name
+        scored = sorted(
+            ((difflib.SequenceMatcher(None, name.lower(), k).ratio(), k) for k in known),
+            reverse=True
+        )
+        suggestions = [k for ratio, k in scored[:3] if ratio >= 0.6]
+        fix = None
+        best = [k for ratio, k in scored if ratio >= RENAME_CUTOFF]
+        if len(best) == 1:
+            fix = {"action": "rename_column", "from": name, "to": self._original_case(best[0]),
+                   "scope": scope_name, "qualifier": column.table}
+
+        # Evita diagnósticos duplicados para a mesma coluna (e qualificador) no mesmo escopo
+        for existing in result.diagnostics:
+            if (existing.code == UNKNOWN_COLUMN and existing.identifier == name and existing.scope == scope_name
+                    and (existing.fix or {}).get("qualifier", column.table) == column.table):
+                return
+        result.diagnostics.append(SQLDiagnostic(
+            UNKNOWN_COLUMN,
+            f"Coluna desconhecida '{name}' no escopo '{scope_name}'"
+            + (f" (sugestão: {', '.join(suggestions)})" if suggestions else ""),
+            identifier=name,
+            scope=scope_name,
+            suggestions=suggestions,
+            fix=fix
+        ))
+
+    def _original_case(self, lower_name: str) -> str:
+        for columns in self.table_columns.values():
+            if lower_name in columns:
+                return columns[lower_name]
+        return lower_name
+
+    # ------------------------------------------------------------------
+    # Correções determinísticas
+    # ------------------------------------------------------------------
+
+    def apply_fixes(self, sql: str, diagnostics: List[SQLDiagnostic]) -> Tuple[str, List[SQLDiagnostic]]:
+        """
+        Aplica as correções determinísticas dos diagnósticos.
+
+        Retorna (sql_corrigida, diagnósticos_aplicados).
+        """
+        applied = []
+        current_sql = sql
+
+        for diag in diagnostics:
+            if diag.fix and diag.fix.get("action") == "replace_sql":
+                current_sql = diag.fix["sql"]
+                applied.append(diag)
+
+        renames = [d for d in diagnostics if d.fix and d.fix.get("action") == "rename_column"]
+        if renames:
+            try:
+                tree = self.parse(current_sql)
+            except ParseError:
+                return current_sql, applied
+            # Renomeia só no escopo/qualificador do diagnóstico: a mesma coluna
+            # pode existir com esse nome em outra fonte ou CTE
+            mapping = {(d.fix.get("scope"), d.fix.get("qualifier", ""), d.fix["from"]): d.fix["to"] for d in renames}
+            for scope in traverse_scope(tree):
+                scope_name = self._scope_name(scope)
+                for column in scope.columns:
+                    target = mapping.get((scope_name, column.table, column.name))
+                    if target:
+                        column.set("this", exp.to_identifier(target))
+            current_sql = tree.sql(dialect=DIALECT)
+            applied.extend(renames)
+
+        return current_sql, applied
+
+    def validate_and_fix(self, sql: str, max_passes: int = 2) -> Tuple[str, ASTValidationResult, List[SQLDiagnostic]]:
+        """
+        Valida e aplica correções determinísticas até a SQL ficar válida
+        (ou não restar nada corrigível).
+
+        Retorna (sql_final, resultado_final, correções_aplicadas).
+        """
+        applied_total = []
+        result = self.validate(sql)
+        for _ in range(max_passes):
+            fixable = [d for d in result.errors if d.fixable]
+            if not fixable:
+                break
+            sql, applied = self.apply_fixes(sql, fixable)
+            if not applied:
+                break
+            applied_total.extend(applied)
+            result = self.validate(sql)
+        return sql, result, applied_total
+
+
+_validator_instance: Optional[SQLASTValidator] = None
+
+
+def get_ast_validator() -> Optional[SQLASTValidator]:
+    """Retorna instância singleton do validador (None se sqlglot indisponível)"""
+    global _validator_instance
+    if not _HAS_SQLGLOT:
+        return None
+    if _validator_instance is None:
+        _validator_instance = SQLASTValidator()
+    return _validator_instance
@@ -0,0 +1,382 @@
+"""
+SQL Auto-Fixer - Correção determinística de erros do BigQuery
+=============================================================
+
+Motor de regras que corrige localmente as falhas mais comuns da SQL gerada,
+antes de recorrer ao `refine_sql_with_error` (chamada extra ao Gemini).
+
+Cada regra é disparada por uma biblioteca de assinaturas de erro (regex sobre
+a mensagem do BigQuery) e reescreve a SQL via AST (sqlglot):
+
+1. PARSE_TIMESTAMP      - campo temporal STRING usado sem SAFE.PARSE_TIMESTAMP
+2. TABLE_REFERENCE      - tabela inexistente / sem dataset
+3. MISSING_FINAL_SELECT - bloco WITH sem SELECT final
+4. GROUP_BY_MISMATCH    - coluna não agrupada / alias divergente no GROUP BY
+5. LITERAL_CASE         - filtro por literal com caixa diferente (resultado vazio)
+6. COLUMN_RENAME        - nome de coluna quase correto
+
+As taxas de acerto por regra ficam em memória (`get_stats`) e são enviadas
+para o coletor de métricas pelo MessageHandler.
+"""
+
+import difflib
+import re
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Any, Optional, Callable
+
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ParseError
+    _HAS_SQLGLOT = True
+except ImportError:
+    _HAS_SQLGLOT = False
+
+from config.settings import TABLES_CONFIG
+from database.sql_ast_validator import (
+    DIALECT,
+    UNKNOWN_COLUMN,
+    SQLASTValidator,
+)
+
+# Pseudo-assinatura usada quando a query executa mas retorna 0 linhas
+EMPTY_RESULT = "EMPTY_RESULT"
+
+DEFAULT_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Funções que esperam DATE (o restante das temporais espera TIMESTAMP)
+_DATE_FUNCTIONS = {"DATE_TRUNC", "FORMAT_DATE", "DATE_DIFF", "DATE_ADD", "DATE_SUB", "LAST_DAY"}
+_TEMPORAL_NAME_RE = re.compile(r"data|date|dt_|hora|time", re.IGNORECASE)
+
+
+@dataclass
+class AutoFixRule:
+    """Regra de correção: assinaturas de erro + função de reescrita"""
+    name: str
+    description: str
+    signatures: List["re.Pattern"]
+    fixer: Optional[Callable[["exp.Expression", "re.Match"], bool]]
+
+
+@dataclass
+class AutoFixResult:
+    """SQL corrigida e a regra responsável"""
+    sql: str
+    rule: str
+    error_message: str
+    details: Dict[str, Any] = field(default_factory=dict)
+
+
+class SQLAutoFixer:
+    """Aplica a primeira regra cuja assinatura casa com o erro e que consegue reescrever a SQL"""
+
+    def __init__(self, tables_config: Dict[str, Any] = None):
+        self.config = tables_config if tables_config is not None else TABLES_CONFIG
+        self.validator = SQLASTValidator(self.config)
+        self.string_temporal_fields = self._build_string_temporal_fields()
+        self.string_fields = self._build_string_fields()
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self.rules = self._build_rules()
+
+    # ------------------------------------------------------------------
+    # Metadados
+    # ------------------------------------------------------------------
+
+    def _iter_fields(self):
+        for table_config in self.config.values():
+            if not isinstance(table_config, dict):
+                continue
+            for category, field_list in table_config.get('fields', {}).items():
+                if not isinstance(field_list, list):
+                    continue
+                for field_info in field_list:
+                    if isinstance(field_info, dict) and field_info.get('name'):
+                        yield category, field_info
+
+    def _build_string_temporal_fields(self) -> Dict[str, str]:
+        """Campos temporais armazenados como STRING -> formato de parse"""
+        fields = {}
+        for category, field_info in self._iter_fields():
+            if str(field_info.get('type', '')).upper() != 'STRING':
+                continue
+            if category == 'temporal_fields' or _TEMPORAL_NAME_RE.search(field_info['name']):
+                fields[field_info['name'].lower()] = field_info.get('format') or DEFAULT_TIMESTAMP_FORMAT
+        return fields
+
+    def _build_string_fields(self) -> set:
+        return {
+            field_info['name'].lower()
+            for _, field_info in self._iter_fields()
+            if str(field_info.get('type', 'STRING')).upper() == 'STRING'
+        }
+
+    def _build_rules(self) -> List[AutoFixRule]:
+        def sig(*patterns):
+            return [re.compile(p, re.IGNORECASE) for p in patterns]
+
+        return [
+            AutoFixRule(
+                "MISSING_FINAL_SELECT",
+                "Completa bloco WITH com SELECT * FROM <última CTE>",
+                sig(r"Expected .*SELECT.* but got end of (?:input|script|statement)",
+                    r"Unexpected end of (?:input|script|statement)"),
+                None,
+            ),
+            AutoFixRule(
+                "PARSE_TIMESTAMP",
+                "Envolve campos temporais STRING em SAFE.PARSE_TIMESTAMP",
+                sig(r"No matching signature for (?:aggregate |analytic )?(?:function|operator) (?P<func>\S+) for argument types?: (?P<args>.*STRING.*)",
+                    r"Could not cast literal .* to type (?:DATE|TIMESTAMP)",
+                    r"Invalid (?:timestamp|date) string"),
+                self._fix_parse_timestamp,
+            ),
+            AutoFixRule(
+                "TABLE_REFERENCE",
+                "Substitui referência de tabela pelo nome completo do tables_config",
+                sig(r"Not found: Table (?P<table>[\w\-.:`]+)",
+                    r"Table name \"(?P<table>[^\"]+)\" missing dataset",
+                    r"Not found: Dataset (?P<table>[\w\-.:`]+)"),
+                self._fix_table_reference,
+            ),
+            AutoFixRule(
+                "GROUP_BY_MISMATCH",
+                "Adiciona coluna faltante ao GROUP BY / corrige alias divergente",
+                sig(r"(?:SELECT list|ORDER BY clause|HAVING clause) expression references (?:column )?(?P<column>[\w.]+) which is neither grouped nor aggregated",
+                    r"Unrecognized name: (?P<name>\w+)"),
+                self._fix_group_by,
+            ),
+            AutoFixRule(
+                "COLUMN_RENAME",
+                "Renomeia coluna quase correta para o nome do tables_config",
+                sig(r"Unrecognized name: (?P<name>\w+)",
+                    r"Name (?P<name>\w+) not found inside"),
+                self._fix_column_rename,
+            ),
+            AutoFixRule(
+                "LITERAL_CASE",
+                "Compara literais de texto sem diferenciar maiúsculas/minúsculas",
+                sig(rf"^{EMPTY_RESULT}$"),
+                self._fix_literal_case,
+            ),
+        ]
+
+    # ------------------------------------------------------------------
+    # Motor
+    # ------------------------------------------------------------------
+
+    def repair(self, sql: str, error_message: str) -> Optional[AutoFixResult]:
+        """
+        Tenta corrigir a SQL a partir da mensagem de erro do BigQuery.
+
+        Retorna AutoFixResult com a SQL reescrita ou None se nenhuma regra se aplica.
+        """
+        if not sql or not error_message:
+            return None
+
+        for rule in self.rules:
+            for signature in rule.signatures:
+                match = signature.search(error_message)
+                if not match:
+                    continue
+                self._count(rule.name, "matched")
+
+                if rule.fixer is None:
+                    # SQL incompleta não parseia: completa pelo texto
+                    fixed_sql = self.validator.complete_final_select(sql)
+                else:
+                    try:
+                        tree = sqlglot.parse_one(sql, read=DIALECT)
+                    except ParseError:
+                        break
+                    if tree is None or not rule.fixer(tree, match):
+                        break
+                    fixed_sql = tree.sql(dialect=DIALECT)
+
+                if not fixed_sql or fixed_sql.strip() == sql.strip():
+                    break
+
+                self._count(rule.name, "fixed")
+                print(f"🔧 [AUTOFIX] Regra {rule.name} aplicada localmente")
+                return AutoFixResult(
+                    sql=fixed_sql,
+                    rule=rule.name,
+                    error_message=error_message,
+                    details={"signature": signature.pattern}
+                )
+        return None
+
+    def record_outcome(self, rule: str, success: bool) -> None:
+        """Registra se a SQL corrigida pela regra executou com sucesso"""
+        self._count(rule, "succeeded" if success else "failed")
+
+    def _count(self, rule: str, key: str) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(rule, {"matched": 0, "fixed": 0, "succeeded": 0, "failed": 0})
+            stats[key] += 1
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Contadores e taxa de acerto (sucesso / assinatura casada) por regra"""
+        with self._lock:
+            stats = {rule: dict(values) for rule, values in self._stats.items()}
+        for values in stats.values():
+            values["hit_rate"] = round(values["succeeded"] / values["matched"], 3) if values["matched"] else 0.0
+        return stats
+
+    # ------------------------------------------------------------------
+    # Regras
+    # ------------------------------------------------------------------
+
+    def _fix_parse_timestamp(self, tree, match) -> bool:
+        if not self.string_temporal_fields:
+            return False
+
+        func = (match.groupdict().get('func') or '').upper().strip()
+        args = (match.groupdict().get('args') or '').upper()
+        as_date = func in _DATE_FUNCTIONS or ('DATE' in args and 'TIMESTAMP' not in args)
+
+        changed = False
+        for column in list(tree.find_all(exp.Column)):
+            fmt = self.string_temporal_fields.get(column.name.lower())
+            if not fmt:
+                continue
+            # Já convertido, projeção direta ou checagem de NULL: mantém
+            if column.find_ancestor(exp.StrToTime, exp.StrToDate, exp.Is):
+                continue
+            if isinstance(column.parent, (exp.Select, exp.Group, exp.Ordered)):
+                continue
+            if isinstance(column.parent, exp.Alias) and isinstance(column.parent.parent, exp.Select):
+                continue
+
+            target = "DATE" if as_date else "TIMESTAMP"
+            replacement = sqlglot.parse_one(
+                f"CAST(SAFE.PARSE_TIMESTAMP('{fmt}', {column.sql(dialect=DIALECT)}) AS {target})",
+                read=DIALECT
+            )
+            column.replace(replacement)
+            changed = True
+        return changed
+
+    def _fix_table_reference(self, tree, match) -> bool:
+        changed = False
+        for table in tree.find_all(exp.Table):
+            if not table.name:
+                continue
+            config_key = self.validator.resolve_table(table)
+            if not config_key:
+                close = difflib.get_close_matches(table.name, list(self.config.keys()), n=1, cutoff=0.75)
+                if not close:
+                    continue
+                config_key = close[0]
+
+            bigquery_table = self.config[config_key].get('metadata', {}).get('bigquery_table', '')
+            parts = bigquery_table.replace('`', '').split('.')
+            if len(parts) != 3:
+                continue
+            current = [table.catalog, table.db, table.name]
+            if [p.lower() for p in current] == [p.lower() for p in parts]:
+                continue
+
+            table.set("catalog", exp.to_identifier(parts[0]))
+            table.set("db", exp.to_identifier(parts[1]))
+            table.set("this", exp.to_identifier(parts[2]))
+            changed = True
+        return changed
+
+    def _fix_group_by(self, tree, match) -> bool:
+        groups = match.groupdict()
+
+        # Coluna usada no SELECT mas ausente do GROUP BY
+        if groups.get('column'):
+            column_name = groups['column'].split('.')[-1].lower()
+            for select in tree.find_all(exp.Select):
+                group = select.args.get('group')
+                if not group:
+                    continue
+                for column in select.find_all(exp.Column):
+                    if column.name.lower() != column_name or column.find_ancestor(exp.AggFunc):
+                        continue
+                    if column.find_ancestor(exp.Select) is not select:
+                        continue
+                    grouped = {e.sql(dialect=DIALECT).lower() for e in group.expressions}
+                    if column.sql(dialect=DIALECT).lower() not in grouped:
+                        group.append("expressions", column.copy())
+                        return True
+            return False
+
+        # Alias referenciado no GROUP BY / ORDER BY que não existe no SELECT
+        name = (groups.get('name') or '').lower()
+        for select in tree.find_all(exp.Select):
+            aliases = {s.alias.lower(): s.alias for s in select.expressions if isinstance(s, exp.Alias)}
+            if not aliases or name in aliases:
+                continue
+            close = difflib.get_close_matches(name, list(aliases.keys()), n=1, cutoff=0.75)
+            if not close:
+                continue
+            changed = False
+            for clause_key in ('group', 'order'):
+                clause = select.args.get(clause_key)
+                if not clause:
+                    continue
+                for column in clause.find_all(exp.Column):
+                    if column.name.lower() == name and not column.table:
+                        column.set("this", exp.to_identifier(aliases[close[0]]))
+                        changed = True
+            if changed:
+                return True
+        return False
+
+    def _fix_column_rename(self, tree, match) -> bool:
+        name = (match.groupdict().get('name') or '').lower()
+        result = self.validator.validate(tree.sql(dialect=DIALECT))
+        mapping = {
+            d.fix["from"]: d.fix["to"]
+            for d in result.errors
+            if d.code == UNKNOWN_COLUMN and d.fix and d.identifier and d.identifier.lower() == name
+        }
+        if not mapping:
+            return False
+        for column in tree.find_all(exp.Column):
+            if column.name in mapping:
+                column.set("this", exp.to_identifier(mapping[column.name]))
+        return True
+
+    def _fix_literal_case(self, tree, match) -> bool:
+        changed = False
+        for predicate in list(tree.find_all(exp.EQ, exp.In)):
+            column = predicate.this if isinstance(predicate.this, exp.Column) else None
+            if column is None and isinstance(predicate, exp.EQ) and isinstance(predicate.expression, exp.Column):
+                column = predicate.expression
+            if column is None or column.name.lower() not in self.string_fields:
+                continue
+            if column.name.lower() in self.string_temporal_fields:
+                continue
+
+            if isinstance(predicate, exp.In):
+                literals = predicate.expressions
+            else:
+                literals = [predicate.expression if predicate.this is column else predicate.this]
+            if not literals or not all(isinstance(l, exp.Literal) and l.is_string for l in literals):
+                continue
+            if not any(any(c.isalpha() for c in l.this) for l in literals):
+                continue
+
+            column.replace(exp.Upper(this=column.copy()))
+            for literal in literals:
+                literal.replace(exp.Literal.string(literal.this.upper()))
+            changed = True
+        return changed
+
+
+_autofixer_instance: Optional[SQLAutoFixer] = None
+
+
+def get_sql_autofixer() -> Optional[SQLAutoFixer]:
+    """Retorna instância singleton do auto-fixer (None se sqlglot indisponível)"""
+    global _autofixer_instance
+    if not _HAS_SQLGLOT:
+        return None
+    if _autofixer_instance is None:
+        _autofixer_instance = SQLAutoFixer()
+    return _autofixer_instance
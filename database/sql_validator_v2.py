@@ -12,9 +12,12 @@ Valida:
 
 import re
 import json
+import hashlib
+from collections import OrderedDict
 from typing import Dict, List, Any, Tuple, Optional
 from dataclasses import dataclass, field
 import os
+import threading
 
 try:
     import sqlparse
@@ -22,6 +25,24 @@ try:
 except ImportError:
     _HAS_SQLPARSE = False
 
+from database.sql_ast_validator import SQLASTValidator, UNKNOWN_COLUMN, _HAS_SQLGLOT
+
+if _HAS_SQLGLOT:
+    from sqlglot import exp
+    from sqlglot.errors import SqlglotError
+
+# Scores de detecção de tabela (mantidos da versão por regex)
+SCORE_FROM = 0.95
+SCORE_BACKTICK = 0.90
+SCORE_JOIN = 0.80
+SCORE_MENTION = 0.70
+
+# Tamanho do cache de detecção (por hash da SQL)
+DETECTION_CACHE_SIZE = 512
+
+# Referências após FROM/JOIN: `proj.ds.tabela`, proj.ds.tabela, "tabela" ...
+_TABLE_REF_RE = re.compile(r"\b(FROM|JOIN)\s+[`\"']?([\w\-.]+)[`\"']?", re.IGNORECASE)
+
 
 @dataclass
 class ValidationResult:
@@ -39,6 +60,10 @@ class SQLValidatorv2:
         self.config_path = tables_config_path
         self.config = self._load_config()
         self.table_field_map = self._build_field_map()
+        self.ast_validator = SQLASTValidator(self.config) if _HAS_SQLGLOT else None
+        self._table_lookup, self._table_mention_re = self._build_table_matcher()
+        self._detection_cache: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self._detection_lock = threading.Lock()
         
         if _HAS_SQLPARSE:
             print("[SQLValidator] sqlparse disponível ✅")
@@ -77,6 +102,30 @@ class SQLValidatorv2:
         
         return field_map
     
+    def _build_table_matcher(self):
+        """
+        Compila UMA vez por versão da config:
+        - lookup nome (lower) -> tabela da config (chave e bigquery_table, completo e último segmento)
+        - regex única com todos os nomes (menções soltas, score mais baixo)
+        """
+        lookup = {}
+        for table_name, table_config in self.config.items():
+            if not isinstance(table_config, dict) or 'metadata' not in table_config:
+                continue
+            lookup.setdefault(table_name.lower(), table_name)
+            bigquery_table = table_config['metadata'].get('bigquery_table', '').replace('`', '')
+            if bigquery_table:
+                lookup.setdefault(bigquery_table.lower(), table_name)
+                lookup.setdefault(bigquery_table.split('.')[-1].lower(), table_name)
+        
+        if not lookup:
+            return lookup, None
+        
+        # Nomes mais longos primeiro para a alternância preferir o match mais específico
+        names = sorted(lookup.keys(), key=len, reverse=True)
+        mention_re = re.compile("|".join(re.escape(n) for n in names), re.IGNORECASE)
+        return lookup, mention_re
+    
     def validate_sql(
         self,
         sql: str,
@@ -200,51 +249,82 @@ class SQLValidatorv2:
         """
         Detecta qual tabela é usada na SQL
         
+        Usa as referências de tabela da AST (sqlglot) quando disponível; senão,
+        o matcher pré-compilado. Resultado cacheado por hash da SQL.
+        
         Retorna (table_name, confidence_score)
         """
-        sql_upper = sql.upper()
+        cache_key = hashlib.sha1(sql.encode('utf-8', errors='ignore')).hexdigest()
+        with self._detection_lock:
+            cached = self._detection_cache.get(cache_key)
+            if cached is not None:
+                self._detection_cache.move_to_end(cache_key)
+                return cached
+        
+        scores = self._detect_tables_ast(sql)
+        if scores is None:
+            scores = self._detect_tables_regex(sql)
         
         best_match = None
         best_score = 0
-        
-        # Tentar detectar por FROM ou JOIN
+        # Empate: mantém a ordem da config (mesmo critério da versão anterior)
         for table_name in self.config.keys():
-            if 'metadata' not in self.config[table_name]:
-                continue
-            
-            bigquery_table = self.config[table_name]['metadata'].get('bigquery_table', '')
-            
-            # Padrões de detecção
-            patterns = [
-                f"FROM.*{table_name}",
-                f"FROM.*{bigquery_table}",
-                f"JOIN.*{table_name}",
-                f"JOIN.*{bigquery_table}",
-                f"`{bigquery_table}`",
-                f"\"{table_name}\"",
-                f"'{table_name}'",
-                table_name,  # Match simples
-            ]
-            
-            score = 0
-            for pattern in patterns:
-                if re.search(pattern, sql_upper, re.IGNORECASE):
-                    # Aumentar score por match mais específico
-                    if 'FROM' in pattern:
-                        score = 0.95
-                    elif 'JOIN' in pattern:
-                        score = 0.80
-                    elif '`' in pattern:
-                        score = 0.90
-                    else:
-                        score = 0.70
-                    break
-            
+            score = scores.get(table_name, 0)
             if score > best_score:
                 best_score = score
                 best_match = table_name
         
-        return best_match, best_score
+        result = (best_match, best_score)
+        with self._detection_lock:
+            self._detection_cache[cache_key] = result
+            self._detection_cache.move_to_end(cache_key)
+            if len(self._detection_cache) > DETECTION_CACHE_SIZE:
+                self._detection_cache.popitem(last=False)
+        return result
+    
+    def _detect_tables_ast(self, sql: str) -> Optional[Dict[str, float]]:
+        """Scores por tabela a partir das referências da AST (None se não parsear)"""
+        if self.ast_validator is None:
+            return None
+        try:
+            tree = self.ast_validator.parse(sql)
+        except SqlglotError:
+            return None
+        if tree is None:
+            return None
+        
+        cte_names = {cte.alias_or_name.lower() for cte in tree.find_all(exp.CTE)}
+        scores: Dict[str, float] = {}
+        for table in tree.find_all(exp.Table):
+            if not table.name or (not table.db and table.name.lower() in cte_names):
+                continue
+            config_key = self.ast_validator.resolve_table(table)
+            if not config_key:
+                continue
+            score = SCORE_JOIN if isinstance(table.parent, exp.Join) else SCORE_FROM
+            scores[config_key] = max(scores.get(config_key, 0), score)
+        return scores
+    
+    def _detect_tables_regex(self, sql: str) -> Dict[str, float]:
+        """Scores por tabela com regex pré-compiladas (custo linear, sem backtracking)"""
+        scores: Dict[str, float] = {}
+        
+        def bump(table_name: Optional[str], score: float):
+            if table_name:
+                scores[table_name] = max(scores.get(table_name, 0), score)
+        
+        for keyword, ref in _TABLE_REF_RE.findall(sql):
+            ref = ref.lower()
+            table_name = self._table_lookup.get(ref) or self._table_lookup.get(ref.split('.')[-1])
+            bump(table_name, SCORE_FROM if keyword.upper() == 'FROM' else SCORE_JOIN)
+        
+        if self._table_mention_re is not None:
+            for match in self._table_mention_re.finditer(sql):
+                start = match.start()
+                quoted = start > 0 and sql[start - 1] == '`'
+                bump(self._table_lookup.get(match.group(0).lower()), SCORE_BACKTICK if quoted else SCORE_MENTION)
+        
+        return scores
     
     def _validate_table(
         self,
@@ -279,6 +359,19 @@ class SQLValidatorv2:
         if table_name not in self.table_field_map:
             return {'valid': True, 'messages': []}
         
+        # Com parser BigQuery: resolve colunas por escopo (CTEs/aliases) em vez de regex
+        if self.ast_validator:
+            ast_result = self.ast_validator.validate(sql)
+            unknown = [d.identifier for d in ast_result.errors if d.code == UNKNOWN_COLUMN]
+            if unknown:
+                return {
+                    'valid': False,
+                    'messages': [d.message for d in ast_result.errors if d.code == UNKNOWN_COLUMN][:5],
+                    'unknown_fields': unknown[:10],
+                    'diagnostics': [d.to_dict() for d in ast_result.diagnostics]
+                }
+            return {'valid': True, 'messages': []}
+        
         valid_fields = set(self.table_field_map[table_name])
         
         # Extrair campos usados (padrão: UPPERCASE palavras após SELECT, FROM, WHERE, etc)
@@ -0,0 +1,216 @@
+"""
+Validation Cache - Cache de validação por fingerprint de SQL
+===========================================================
+
+A mesma SQL gerada é validada várias vezes por requisição (QueryValidator,
+validate_sql_query, checagem de hífen) e novamente em retries/perguntas
+repetidas. Este cache guarda, por fingerprint da SQL:
+
+- o resultado de cada etapa de validação já executada (veredito + diagnósticos)
+- metadados da execução/dry-run no BigQuery (bytes processados etc.)
+
+O fingerprint vem dos tokens da SQL (sqlglot, ou um scanner que respeita
+literais sem sqlglot): comentários e espaços fora de literais são ignorados,
+mas o conteúdo de strings e identificadores entre crases faz parte da chave.
+Um resultado com "query" só é devolvido para o mesmo texto de SQL.
+
+Eviction LRU com tamanho máximo fixo. Thread-safe.
+"""
+
+import copy
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+from utils.stage_metrics import get_stage_metrics
+
+try:
+    from sqlglot.dialects.dialect import Dialect
+    from sqlglot.errors import SqlglotError
+    _HAS_SQLGLOT = True
+except ImportError:
+    _HAS_SQLGLOT = False
+
+# Etapas de validação cacheadas
+STAGE_VALIDATE_QUERY = "validate_query"
+STAGE_VALIDATE_SQL = "validate_sql_query"
+STAGE_HYPHEN = "hyphen_check"
+
+DEFAULT_MAX_ENTRIES = 1024
+
+SQL_DIALECT = "bigquery"
+_QUOTES = ("'", '"', "`")
+
+
+def _sqlglot_tokens(sql: str) -> Optional[str]:
+    """Tokens (tipo + texto) via sqlglot; comentários ficam fora, literais entram inteiros"""
+    try:
+        tokens = Dialect.get_or_raise(SQL_DIALECT).tokenize(sql)
+    except (SqlglotError, ValueError):
+        return None
+    while tokens and tokens[-1].token_type.name == "SEMICOLON":
+        tokens.pop()
+    return "\x1f".join(f"{t.token_type.name}:{t.text}" for t in tokens)
+
+
+def _scan_tokens(sql: str) -> str:
+    """
+    Fallback sem sqlglot: remove comentários (--, #, /* */) e colapsa espaços
+    apenas fora de literais ('...', "...", `...`), que são copiados literalmente.
+    """
+    out = []
+    i, n = 0, len(sql)
+    pending_space = False
+    while i < n:
+        c = sql[i]
+        if c in _QUOTES:
+            j = i + 1
+            while j < n and sql[j] != c:
+                j += 2 if sql[j] == "\\" else 1
+            token = sql[i:j + 1]
+            i = j + 1
+        elif sql.startswith("--", i) or c == "#":
+            j = sql.find("\n", i)
+            i = n if j < 0 else j
+            pending_space = True
+            continue
+        elif sql.startswith("/*", i):
+            j = sql.find("*/", i + 2)
+            i = n if j < 0 else j + 2
+            pending_space = True
+            continue
+        elif c.isspace():
+            i += 1
+            pending_space = True
+            continue
+        else:
+            token = c
+            i += 1
+        if pending_space and out:
+            out.append(" ")
+        pending_space = False
+        out.append(token)
+    return "".join(out).rstrip(";").rstrip()
+
+
+def sql_fingerprint(sql: str) -> str:
+    """
+    Fingerprint da SQL a partir dos tokens: ignora comentários, espaços e ';'
+    final, preservando o conteúdo dos literais. Não monta a AST.
+    """
+    normalized = _sqlglot_tokens(sql or "") if _HAS_SQLGLOT else None
+    if normalized is None:
+        normalized = _scan_tokens(sql or "")
+    return hashlib.sha1(normalized.encode("utf-8", errors="ignore")).hexdigest()
+
+
+class ValidationCache:
+    """Cache LRU de resultados de validação por fingerprint de SQL"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _touch(self, key: str) -> Dict[str, Any]:
+        """Retorna (criando se necessário) a entrada e marca como usada recentemente"""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = {"stages": {}, "dry_run": None, "created_at": time.time()}
+            self._entries[key] = entry
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(key)
+        return entry
+
+    def get(self, sql: str, stage: str) -> Optional[Any]:
+        """Resultado cacheado da etapa para esta SQL (cópia) ou None"""
+        key = sql_fingerprint(sql)
+        with self._lock:
+            entry = self._entries.get(key)
+            cached = entry["stages"].get(stage) if entry is not None else None
+            result = self._for_sql(cached, sql) if cached is not None else None
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            result = copy.deepcopy(result)
+        get_stage_metrics().increment("cache_hits", cache="validation", stage=stage)
+        return result
+
+    def put(self, sql: str, stage: str, result: Any) -> None:
+        """Armazena o resultado da etapa para esta SQL"""
+        key = sql_fingerprint(sql)
+        with self._lock:
+            self._touch(key)["stages"][stage] = (sql, copy.deepcopy(result))
+
+    @staticmethod
+    def _for_sql(cached: tuple, sql: str) -> Optional[Any]:
+        """
+        Resultado aplicável a `sql`. Para outro texto com o mesmo fingerprint
+        (só comentários/espaços diferentes) a "query" cacheada nunca é
+        devolvida: sem correção aplicada ela passa a ser a própria `sql`;
+        com correção, é miss (a correção foi feita sobre outro texto).
+        """
+        cached_sql, result = cached
+        if cached_sql == sql or not isinstance(result, dict) or "query" not in result:
+            return result
+        if result["query"] != cached_sql:
+            return None
+        return {**result, "query": sql}
+
+    def has_passed(self, sql: str, stage: str) -> bool:
+        """True se a SQL já passou nesta etapa (resultado truthy ou dict válido)"""
+        result = self.get(sql, stage)
+        if isinstance(result, dict):
+            return bool(result.get("is_valid", result.get("valid", False)))
+        return bool(result)
+
+    def mark_passed(self, sql: str, stage: str) -> None:
+        self.put(sql, stage, True)
+
+    def get_dry_run(self, sql: str) -> Optional[Dict[str, Any]]:
+        key = sql_fingerprint(sql)
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry["dry_run"]) if entry and entry["dry_run"] else None
+
+    def record_dry_run(self, sql: str, metadata: Dict[str, Any]) -> None:
+        """Guarda metadados do BigQuery (dry-run ou execução) para a SQL"""
+        key = sql_fingerprint(sql)
+        with self._lock:
+            self._touch(key)["dry_run"] = dict(metadata)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
+
+
+_cache_instance: Optional[ValidationCache] = None
+
+
+def get_validation_cache() -> ValidationCache:
+    """Retorna instância singleton do cache de validação"""
+    global _cache_instance
+    if _cache_instance is None:
+        _cache_instance = ValidationCache()
+    return _cache_instance
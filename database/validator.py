@@ -3,9 +3,11 @@ Query Validator com Retry Automático
 ====================================
 
 Pipeline de validação de queries SQL geradas pelo Gemini:
-1. Valida sintaxe com sqlparse
-2. Se falhar, envia para Gemini refinar (até 2 tentativas)
-3. Só retorna query completa e válida
+1. Valida com parser BigQuery (AST) contra o tables_config.json
+   (fallback: sqlparse quando sqlglot não está instalado)
+2. Aplica correções determinísticas locais (SELECT final, nomes de colunas)
+3. Só se restarem erros, envia para Gemini refinar (até 2 tentativas)
+4. Só retorna query completa e válida
 """
 
 import sqlparse
@@ -15,6 +17,10 @@ from typing import Dict, Tuple, Optional
 import google.generativeai as genai
 from config.settings import MODEL_NAME
 from llm_handlers.prompt_rules import get_sql_refinement_instruction
+from database.sql_ast_validator import get_ast_validator
+from database.validation_cache import get_validation_cache, STAGE_VALIDATE_QUERY
+from utils.stage_metrics import get_stage_metrics
+from utils.gemini_quota import governed_generate, PRIORITY_HIGH
 
 class QueryValidator:
     """Valida e refina queries SQL com retry automático"""
@@ -123,7 +129,28 @@ class QueryValidator:
         - query (str): query validada/corrigida
         - errors (list): lista de erros encontrados
         - auto_completed (bool): se foi auto-completada
+        - diagnostics (list): diagnósticos do validador AST (quando disponível)
         """
+        validation_cache = get_validation_cache()
+        cached = validation_cache.get(query, STAGE_VALIDATE_QUERY)
+        if cached is not None:
+            print(f"[VALIDATION] ♻️  Resultado em cache (válida: {cached['is_valid']})")
+            return cached
+
+        ast_validator = get_ast_validator()
+        if ast_validator:
+            result = self._validate_query_ast(query, ast_validator)
+        else:
+            result = self._validate_query_sqlparse(query)
+
+        validation_cache.put(query, STAGE_VALIDATE_QUERY, result)
+        if result["is_valid"] and result["query"] != query:
+            # A versão corrigida também já está validada
+            validation_cache.put(result["query"], STAGE_VALIDATE_QUERY, {**result, "auto_completed": False, "applied_fixes": []})
+        return result
+
+    def _validate_query_sqlparse(self, query: str) -> Dict:
+        """Validação de fallback (sem sqlglot): SELECT final + sintaxe via sqlparse"""
         result = {
             "is_valid": False,
             "query": query,
@@ -163,6 +190,35 @@ class QueryValidator:
         
         return result
     
+    def _validate_query_ast(self, query: str, ast_validator) -> Dict:
+        """
+        Validação offline por AST: resolve CTEs, aliases e colunas contra o
+        tables_config.json e aplica correções determinísticas sem chamar o Gemini.
+        """
+        fixed_query, ast_result, applied = ast_validator.validate_and_fix(query)
+        
+        for diag in applied:
+            print(f"[AUTO-FIX] ✅ {diag.code}: {diag.message}")
+        
+        result = {
+            "is_valid": ast_result.is_valid,
+            "query": fixed_query,
+            "errors": ast_result.error_messages(),
+            "auto_completed": bool(applied),
+            "validation_step": "passed" if ast_result.is_valid else "ast_check",
+            "diagnostics": [d.to_dict() for d in ast_result.diagnostics],
+            "applied_fixes": [d.to_dict() for d in applied],
+            "tables": ast_result.tables,
+            "elapsed_ms": ast_result.elapsed_ms
+        }
+        
+        if ast_result.is_valid:
+            print(f"[VALIDATION] ✅ SQL válida (AST, {ast_result.elapsed_ms}ms)")
+        else:
+            print(f"[VALIDATION] ❌ Erros AST: {result['errors']}")
+        
+        return result
+    
     def refine_with_gemini(self, 
                           query: str, 
                           error_message: str,
@@ -209,7 +265,7 @@ QUERY CORRIGIDA:
 """
         
         try:
-            response = self.model.generate_content(refinement_prompt)
+            response = governed_generate(self.model, refinement_prompt, priority=PRIORITY_HIGH, kind="sql_refine")
             
             if hasattr(response, 'text') and response.text:
                 refined_query = response.text.strip()
@@ -272,6 +328,7 @@ QUERY CORRIGIDA:
             
             # Se falhou e temos tentativas restantes, pede refino ao Gemini
             if attempt < self.max_retries:
+                get_stage_metrics().increment("retries", kind="validator_refine")
                 error_msg = "; ".join(validation["errors"])
                 refined = self.refine_with_gemini(
                     current_query,
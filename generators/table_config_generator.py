@@ -22,6 +22,7 @@ from typing import Dict, List, Any, Tuple
 from google.cloud import bigquery
 import google.generativeai as genai
 from config.settings import PROJECT_ID, DATASET_ID, MODEL_NAME
+from utils.gemini_quota import governed_generate, PRIORITY_BATCH
 from pathlib import Path
 
 
@@ -353,7 +354,7 @@ Retorne APENAS JSON válido, sem markdown.
 """
         
         try:
-            response = self.model.generate_content(prompt)
+            response = governed_generate(self.model, prompt, priority=PRIORITY_BATCH, kind="table_config_generator")
             response_text = response.text
             
             # Remove markdown code blocks se houver
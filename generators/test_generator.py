@@ -14,6 +14,7 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import google.generativeai as genai
 from google.cloud import bigquery
 from config.settings import PROJECT_ID, DATASET_ID, TABLES_CONFIG
+from utils.gemini_quota import governed_generate, PRIORITY_BATCH
 
 
 class CompleteTableConfigGenerator:
@@ -132,7 +133,7 @@ RETORNE APENAS JSON, SEM EXPLICACOES.
 """
         
         try:
-            response = self.model.generate_content(prompt)
+            response = governed_generate(self.model, prompt, priority=PRIORITY_BATCH, kind="test_generator")
             response_text = response.text
             
             import re
@@ -217,7 +218,7 @@ RETORNE APENAS JSON, SEM EXPLICACOES.
 """
         
         try:
-            response = self.model.generate_content(prompt)
+            response = governed_generate(self.model, prompt, priority=PRIORITY_BATCH, kind="test_generator")
             response_text = response.text
             
             import re
@@ -20,6 +20,10 @@ import streamlit as st
 # Sistema RAG obrigatório
 from rag_system.business_metadata_rag import get_business_rag_instance, get_optimized_business_context
 from utils.metrics import ai_metrics
+from utils.stage_metrics import get_stage_metrics, STAGE_RAG, STAGE_GEMINI_NL_SQL
+from utils.tracing import get_tracer
+from utils.gemini_quota import governed_generate, PRIORITY_CRITICAL, PRIORITY_HIGH
+from utils.intent_classifier import classify_intent
 from llm_handlers.prompt_rules import get_sql_functioncall_instruction, build_tables_fields_instruction, get_refine_analysis_instruction
 
 def initialize_model():
@@ -113,6 +117,8 @@ def refine_with_gemini_rag(model, user_question: str, user_id: str = "default"):
     start_time = time.time()
     # Inicia sessão de métricas
     session_id = ai_metrics.start_session(user_id)
+    tracer = get_tracer()
+    rag_span = tracer.start_span("rag.context")
     try:
         # Obtém contexto otimizado do RAG de negócios usando v3 (melhor)
         try:
@@ -120,6 +126,7 @@ def refine_with_gemini_rag(model, user_question: str, user_id: str = "default"):
             rag_v3 = BusinessMetadataRAGv3()
             best_table = rag_v3.get_best_table(user_question, debug=False)
             top_tables = rag_v3.get_top_3_tables(user_question, debug=False)
+            rag_span.set_attributes(table=best_table, top_tables=", ".join(top_tables or []))
             
             if best_table:
                 rag_context = f"📊 Tabela identificada: {best_table}\nTabelas alternativas: {', '.join(top_tables)}\n\nUtilize a tabela identificada para construir a consulta SQL."
@@ -263,9 +270,14 @@ REGRAS PARA COMPARAÇÕES TEMPORAIS:
         print("[DEBUG][RAG_CONTEXT] Contexto RAG injetado:\n" + str(rag_context))
         print("[DEBUG][SQL_GUIDANCE] Orientações SQL injetadas:\n" + str(sql_guidance))
 
+        rag_span.set_attribute("rag_context_length", tech_details["rag_context_length"])
+        tracer.end_span(rag_span)
+        get_stage_metrics().observe(STAGE_RAG, (time.time() - start_time) * 1000)
+
         # Processa com Gemini
         try:
-            response = model.generate_content(optimized_prompt)
+            with tracer.span("gemini.nl_to_sql", stage=STAGE_GEMINI_NL_SQL, model=MODEL_NAME) as gemini_span:
+                response = governed_generate(model, optimized_prompt, priority=PRIORITY_CRITICAL, kind="nl_to_sql")
         except Exception as e:
             print(f"ERRO GEMINI: {e}")
             return f"Erro ao processar consulta: {str(e)}", None
@@ -298,6 +310,7 @@ REGRAS PARA COMPARAÇÕES TEMPORAIS:
                         tech_details["prompt_tokens"] = prompt_tokens
                         tech_details["completion_tokens"] = completion_tokens
                         tech_details["total_tokens"] = total_tokens
+                        gemini_span.set_attributes(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
                         return response_text, tech_details
                     # Se não tem texto, verifica function call
                     elif hasattr(part, 'function_call') and part.function_call:
@@ -320,6 +333,7 @@ REGRAS PARA COMPARAÇÕES TEMPORAIS:
                         tech_details["prompt_tokens"] = prompt_tokens
                         tech_details["completion_tokens"] = completion_tokens
                         tech_details["total_tokens"] = total_tokens
+                        gemini_span.set_attributes(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
                         tech_details["function_call_name"] = function_call.name if hasattr(function_call, 'name') else None
                         tech_details["model_used"] = MODEL_NAME
                         tech_details["prompt_type"] = "rag_optimized_with_sql"
@@ -346,6 +360,7 @@ REGRAS PARA COMPARAÇÕES TEMPORAIS:
                 tech_details["prompt_tokens"] = prompt_tokens
                 tech_details["completion_tokens"] = completion_tokens
                 tech_details["total_tokens"] = total_tokens
+                gemini_span.set_attributes(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
                 tech_details["model_used"] = MODEL_NAME
                 tech_details["prompt_type"] = "rag_optimized_with_sql"
                 tech_details["optimization_applied"] = True
@@ -365,6 +380,8 @@ REGRAS PARA COMPARAÇÕES TEMPORAIS:
         print(f"Erro interno: {e}")
         return f"Erro interno: {str(e)}", None
     finally:
+        # Idempotente: só fecha se uma exceção interrompeu a etapa de RAG
+        tracer.end_span(rag_span)
         ai_metrics.end_session(session_id)
 
 def refine_sql_with_error(model, user_question: str, error_message: str, previous_sql: str, table_name: str, best_table_score: float = None) -> tuple:
@@ -422,7 +439,7 @@ GERE UMA NOVA PROPOSTA DE SQL/CTE CORRIGIDA:
 """
         
         # Chama Gemini para refinamento
-        response = model.generate_content(refine_prompt)
+        response = governed_generate(model, refine_prompt, priority=PRIORITY_HIGH, kind="sql_fix")
         
         if hasattr(response, 'candidates') and response.candidates:
             candidate = response.candidates[0]
@@ -596,7 +613,7 @@ def analyze_data_with_gemini(prompt: str, data: list, function_params: dict = No
         analysis_prompt_tokens = len(analysis_prompt.split())
         for attempt in range(max_retries):
             try:
-                response = model.generate_content(analysis_prompt)
+                response = governed_generate(model, analysis_prompt, priority=PRIORITY_HIGH, kind="analysis")
                 # Verifica se a resposta foi bloqueada
                 if response.candidates and len(response.candidates) > 0:
                     candidate = response.candidates[0]
@@ -612,7 +629,7 @@ def analyze_data_with_gemini(prompt: str, data: list, function_params: dict = No
                             Dados: {json.dumps(data[:3], default=str)}... (amostra)
                             Tarefa: Gere análise empresarial dos dados fornecidos.
                             """
-                            response = model.generate_content(business_prompt)
+                            response = governed_generate(model, business_prompt, priority=PRIORITY_HIGH, kind="analysis")
                             if response and response.text:
                                 break
                             continue
@@ -895,13 +912,6 @@ def initialize_rag_system():
         print(f"[Gemini Handler] ❌ ERRO ao inicializar RAG: {e}")
         raise
 
-def should_reuse_data(current_prompt, user_history):
-    """
-    Função simples que sempre retorna False para forçar nova consulta
-    (compatibilidade durante limpeza do sistema)
-    """
-    return {"should_reuse": False, "reason": "Nova consulta necessária"}
-
 def should_reuse_data(model, current_prompt: str, user_history: list = None) -> dict:
     """
     VERSÃO OTIMIZADA: Prioriza dados mais recentes para casos como 'agora gere um gráfico desse dado'
@@ -909,29 +919,13 @@ def should_reuse_data(model, current_prompt: str, user_history: list = None) ->
     if not user_history:
         return {"should_reuse": False, "reason": "Nenhum histórico disponível"}
     
-    prompt_lower = current_prompt.lower()
-    
-    # DETECÇÃO AUTOMÁTICA DE CONTINUIDADE (casos como "agora gere um gráfico desse dado")
-    continuity_indicators = [
-        "agora", "desse", "destes", "dessa", "dessas", "do resultado", "dos dados",
-        "da consulta", "da tabela", "deste", "desta"
-    ]
-    
-    visualization_requests = [
-        "gráfico", "grafico", "chart", "visualização", "visualizacao", 
-        "plotar", "plot", "curva", "linha", "barra"
-    ]
-    
-    export_requests = [
-        "exportar", "excel", "planilha", "csv", "baixar", "download"
-    ]
+    intent = classify_intent(current_prompt)
     
-    # CASO 1: CONTINUIDADE CLARA - usa dados mais recentes automaticamente
-    has_continuity = any(ind in prompt_lower for ind in continuity_indicators)
-    has_visualization = any(vis in prompt_lower for vis in visualization_requests)
-    has_export = any(exp in prompt_lower for exp in export_requests)
+    # CONTINUIDADE CLARA ou gráfico sem especificação de novos dados - usa dados mais recentes
+    has_continuity = intent.has("continuity", "reference")
+    has_visualization = intent.has("visualization")
     
-    if has_continuity or (has_visualization and not any(word in prompt_lower for word in ["vendas", "produtos", "clientes", "top", "2024", "2025"])):
+    if has_continuity or (has_visualization and not intent.has("new_query")):
         # Usa dados mais recentes
         most_recent = next((item for item in user_history if item.get('raw_data_count', 0) > 0), None)
         if most_recent:
@@ -939,10 +933,11 @@ def should_reuse_data(model, current_prompt: str, user_history: list = None) ->
                 "should_reuse": True,
                 "reason": "Continuidade detectada - usando dados mais recentes",
                 "interaction_id": most_recent.get('id'),
-                "auto_selected": True
+                "auto_selected": True,
+                "intent": intent.to_dict()
             }
     
-    return {"should_reuse": False, "reason": "Nova consulta necessária"}
+    return {"should_reuse": False, "reason": "Nova consulta necessária", "intent": intent.to_dict()}
 
 
 def generate_chart(data, chart_type, x_axis, y_axis, color=None):
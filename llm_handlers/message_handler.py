@@ -6,14 +6,23 @@ Fluxo: pergunta → verificar reuso → SQL → query DB → processar resposta
 import streamlit as st
 import traceback
 import json
+import os
+import threading
 import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Dict, Optional, Any
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
-from utils.cache import get_user_history, get_interaction_full_data, save_interaction, log_error
+from utils.cache import (
+    get_user_history, get_interaction_full_data, get_most_recent_data_interaction, save_interaction, log_error
+)
 from llm_handlers.gemini_handler import should_reuse_data, refine_with_gemini_rag, initialize_rag_system
 from database.query_builder import build_query, execute_query
+from database.sql_autofix import get_sql_autofixer, EMPTY_RESULT
+from database.followup_engine import get_followup_engine
 from utils.helpers import (
     safe_serialize_gemini_params, 
     safe_serialize_data, 
@@ -28,12 +37,92 @@ from llm_handlers.prompt_rules import get_adaptation_prompt
 # Sistema RAG obrigatório
 from rag_system.business_metadata_rag import get_business_rag_instance
 from utils.metrics import ai_metrics
+from utils.stage_metrics import get_stage_metrics, HANDLER_STEP_STAGES, STAGE_GEMINI_ADAPTATION
+from utils.tracing import get_tracer
+from utils.profiler import SamplingProfiler, profile_trigger
+from utils.gemini_quota import governed_generate, GeminiQuotaExceeded, PRIORITY_LOW
+from utils.intent_classifier import classify_intent, get_intent_classifier, normalize_text, INTENT_NEW_QUERY
 from conversational_analytics_handler import ConversationalAnalyticsHandler
 
+# Adaptação da pergunta ao histórico (_process_new_query_flow)
+# - RAG/NL→SQL especulativo sobre a pergunta original, em paralelo à adaptação
+# - histórico "relevante" = última pergunta dentro da janela (minutos)
+# - cache das reescritas por (última pergunta, pergunta)
+ADAPTATION_SPECULATIVE = os.getenv("ADAPTATION_SPECULATIVE", "true").lower() == "true"
+ADAPTATION_HISTORY_WINDOW_MIN = float(os.getenv("ADAPTATION_HISTORY_WINDOW_MIN", "60"))
+ADAPTATION_CACHE_SIZE = int(os.getenv("ADAPTATION_CACHE_SIZE", "512"))
+SPECULATIVE_RAG_WORKERS = int(os.getenv("SPECULATIVE_RAG_WORKERS", "4"))
+
+_adaptation_cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+_adaptation_cache_lock = threading.Lock()
+_speculation_executor: Optional[ThreadPoolExecutor] = None
+_speculation_executor_lock = threading.Lock()
+
+
+def _get_speculation_executor() -> ThreadPoolExecutor:
+    """Pool compartilhado das execuções especulativas do RAG (criado sob demanda)"""
+    global _speculation_executor
+    with _speculation_executor_lock:
+        if _speculation_executor is None:
+            _speculation_executor = ThreadPoolExecutor(
+                max_workers=SPECULATIVE_RAG_WORKERS, thread_name_prefix="rag-especulativo"
+            )
+    return _speculation_executor
+
+
+def _adaptation_key(last_question: str, question: str) -> Tuple[str, str]:
+    return normalize_text(last_question), normalize_text(question)
+
+
+def get_cached_adaptation(last_question: str, question: str) -> Optional[str]:
+    """Reescrita já obtida para o mesmo par (última pergunta, pergunta)"""
+    key = _adaptation_key(last_question, question)
+    with _adaptation_cache_lock:
+        adapted = _adaptation_cache.get(key)
+        if adapted is not None:
+            _adaptation_cache.move_to_end(key)
+    return adapted
+
+
+def cache_adaptation(last_question: str, question: str, adapted: str) -> None:
+    key = _adaptation_key(last_question, question)
+    with _adaptation_cache_lock:
+        _adaptation_cache[key] = adapted
+        _adaptation_cache.move_to_end(key)
+        while len(_adaptation_cache) > ADAPTATION_CACHE_SIZE:
+            _adaptation_cache.popitem(last=False)
+
+
+def is_nearly_unchanged(original: str, adapted: str) -> bool:
+    """
+    A reescrita manteve a pergunta: texto igual após normalização ou mesmas
+    palavras e números (só a ordem mudou). Qualquer troca de ano, filtro ou
+    métrica invalida o resultado especulativo.
+    """
+    a, b = normalize_text(original), normalize_text(adapted)
+    return a == b or Counter(a.split()) == Counter(b.split())
+
+
+def _is_recent_interaction(timestamp: Any) -> bool:
+    """Interação dentro da janela de histórico relevante (timestamp ausente/ilegível conta como recente)"""
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.fromisoformat(timestamp)
+        except ValueError:
+            return True
+    if not isinstance(timestamp, datetime):
+        return True
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone().replace(tzinfo=None)
+    return datetime.now() - timestamp <= timedelta(minutes=ADAPTATION_HISTORY_WINDOW_MIN)
+
 
 class MessageHandler:
     """Classe responsável pelo fluxo completo de processamento de mensagens"""
     
+    # Máximo de correções locais encadeadas antes de recorrer ao Gemini
+    MAX_LOCAL_FIX_ATTEMPTS = 2
+    
     def _start_timing(self, step_name: str, typing_placeholder=None) -> None:
         """Inicia medição de tempo para uma etapa e atualiza indicador visual"""
         current_time = time.time()
@@ -46,6 +135,7 @@ class MessageHandler:
             'duration': None,
             'timestamp': datetime.fromtimestamp(current_time).strftime('%H:%M:%S.%f')[:-3]
         }
+        self._spans[step_name] = get_tracer().start_span(step_name)
         
         # Atualiza indicador visual se placeholder fornecido
         if typing_placeholder:
@@ -58,6 +148,11 @@ class MessageHandler:
             self.timing_info[step_name]['end'] = end_time
             duration = end_time - self.timing_info[step_name]['start']
             self.timing_info[step_name]['duration'] = round(duration * 1000, 2)  # em ms
+            # Acumula no histograma do processo (p50/p95/p99 por etapa)
+            stage = HANDLER_STEP_STAGES.get(step_name)
+            if stage:
+                get_stage_metrics().observe(stage, duration * 1000)
+            get_tracer().end_span(self._spans.pop(step_name, None))
     
     def _get_total_duration(self) -> float:
         """Calcula duração total do processamento"""
@@ -79,14 +174,57 @@ class MessageHandler:
         self.user_id = user_id
         self.flow_path = []  # Para rastrear o caminho seguido
         self.timing_info = {}  # Para rastrear timing de cada etapa
+        self._spans = {}  # Spans de tracing abertos por etapa
+        self.interaction_id = None  # Última interação salva (vincula o perfil)
+        self.profile_id = None
         self.start_time = None
         
-    def process_message(self, prompt: str, typing_placeholder) -> None:
+    def process_message(self, prompt: str, typing_placeholder, profile_requested: bool = False,
+                        admin_profiling: bool = False) -> None:
         """
         Processa uma mensagem SEMPRE via Conversational Analytics.
         Fluxo único: prompt → CA API → graph + table
         Armazena resposta em st.session_state.temp_response e temp_tech_details.
+        
+        Com `?profile=1` (profile_requested), toggle de admin ou amostragem 1-em-N,
+        a execução é perfilada e as pilhas vão para request_profiles (cache.db).
         """
+        trigger = profile_trigger(query_param=profile_requested, admin_toggle=admin_profiling)
+        profiler = SamplingProfiler().start() if trigger else None
+        
+        # Span raiz da requisição: etapas (_start_timing) e funções chamadas viram filhos
+        with get_tracer().span("message", user_id=self.user_id, prompt_length=len(prompt)) as span:
+            try:
+                self._process_message(prompt, typing_placeholder)
+            finally:
+                if profiler:
+                    self._save_profile(profiler.stop(), prompt, trigger)
+                    span.set_attribute("profile_id", self.profile_id)
+            span.set_attribute("flow_path", " → ".join(self.flow_path))
+
+    def _save_profile(self, profiler: SamplingProfiler, prompt: str, trigger: str) -> None:
+        """Grava as pilhas amostradas vinculadas à interação (se houve uma)"""
+        try:
+            from utils.cache import save_profile
+            self.profile_id = save_profile(
+                profile_id=str(uuid.uuid4()),
+                user_id=self.user_id,
+                question=prompt,
+                trigger=trigger,
+                duration_ms=profiler.duration_ms,
+                interval_ms=profiler.interval * 1000,
+                sample_count=profiler.sample_count,
+                stacks=profiler.collapsed(),
+                interaction_id=self.interaction_id
+            )
+            tech = st.session_state.get("temp_tech_details")
+            if isinstance(tech, dict):
+                tech["profile_id"] = self.profile_id
+            print(f"🔬 [PROFILER] Perfil {self.profile_id} ({trigger}): {profiler.sample_count} amostras em {profiler.duration_ms}ms")
+        except Exception as e:
+            print(f"⚠️ [PROFILER] Falha ao salvar perfil: {e}")
+
+    def _process_message(self, prompt: str, typing_placeholder) -> None:
         try:
             self.flow_path = ["início", "conversational_analytics"]
             self._start_timing("processo_completo", typing_placeholder)
@@ -94,6 +232,12 @@ class MessageHandler:
             print(f"\n{'='*80}")
             print(f"🔄 [MESSAGE_HANDLER] Processando pergunta: {prompt}")
             print(f"{'='*80}")
+            # Refino do resultado anterior ("agora só motos", "top 5 desses"): DuckDB local, sem BigQuery
+            if self._try_local_followup(typing_placeholder, prompt):
+                self._end_timing("processo_completo")
+                print(f"✅ [CONCLUÍDO] Pergunta respondida sobre o resultado anterior\n")
+                return
+            
             print(f"📋 [STEP 0] CA PADRÃO - Processando toda pergunta via Conversational Analytics")
             
             try:
@@ -124,68 +268,11 @@ class MessageHandler:
 
     def _should_use_conversational_analytics(self, prompt: str) -> bool:
         """Detecta se deve usar Conversational Analytics (pergunta sobre glinhares/análises)."""
-        prompt_lower = prompt.lower()
-        
-        # Padrões que indicam Conversational Analytics para projeto glinhares
-        ca_keywords = [
-            # Projeto específico
-            'glinhares',
-            
-            # Dados/Entidades do projeto
-            'veículo', 'veiculo', 'vehicles', 'cars', 'carros',
-            'consórcio', 'consorcio', 'consortium', 'consortium',
-            'cota', 'cotas',
-            'plano', 'planos', 'plan', 'plans',
-            'moto', 'motos', 'motorcycle', 'motorcycles',
-            'carro', 'carro', 'car',
-            'modelo', 'modelos', 'model',
-            'fandi', 'FANDI',
-            'vendedor', 'vendedores',
-            'loja', 'lojas',
-            'ceara', 'ceará', 'state', 'estado', 'região', 'regiao',
-            'qualidade',
-            
-            # Ações/Análises sobre dados
-            'venda', 'vendas', 'vend',
-            'vendido', 'vendidos',
-            'total',
-            'demonstr', # demonstre, demonstra, etc
-            'mostre', 'mostrar', 'mostrando',
-            'analise', 'análise', 'analyzer', 'analyzing',
-            'relat', # relatório, relatório
-            'dados', 'data',
-            'desempenho', 'performance',
-            'tendência', 'tendencia', 'trend',
-            'crescimento', 'growth',
-            'redução', 'reducao',
-            'aumento',
-            'diminuição', 'diminuicao',
-            'comparação', 'comparacao', 'compare', 'comparing',
-            'evolução', 'evolucao', 'evolution',
-            'histórico', 'historico', 'history',
-            'série temporal', 'serie temporal', 'time series',
-            'gráfico', 'grafico', 'chart', 'graph',
-            'visualização', 'visualizacao', 'visualization',
-            
-            # Métricas/Quantidades
-            'top', 'maiores', 'menores',
-            'ranking', 'rank',
-            'distribuição', 'distribuicao', 'distribution',
-            'quantidade', 'quantity',
-            'valor', 'values', 'amount',
-            'média', 'media', 'average',
-            'percentual', 'percentage', 'pct',
-            'segmentação', 'segmentacao',
-            'por região', 'por estado',
-            'mês a mês', 'mes a mes', 'monthly',
-            'ano a ano', 'ano a ano', 'yearly',
-            'entre', 'between'
-        ]
-        
-        result = any(keyword in prompt_lower for keyword in ca_keywords)
+        # Termos do projeto glinhares, entidades e análises: grupo "ca_domain" de config/intents.json
+        result = classify_intent(prompt).has("ca_domain")
         
         # Debug
-        matched = [kw for kw in ca_keywords if kw in prompt_lower]
+        matched = get_intent_classifier().matched_terms(prompt, "ca_domain")
         print(f"🔍 [CA_DETECT] Pergunta: {prompt[:50]}...")
         print(f"🔍 [CA_DETECT] Detectado CA: {result}")
         if matched:
@@ -250,83 +337,108 @@ class MessageHandler:
             print(f"❌ [CA_PROCESS] Erro armazenado em session_state")
             print(f"{'='*80}\n")
 
+    def _previous_result(self) -> Optional[Dict]:
+        """Última tabela mostrada ao usuário: histórico da sessão ou, em sessão nova, o cache"""
+        for message in reversed(st.session_state.get("chat_history", [])):
+            tech = message.get("tech_details") if message.get("role") == "assistant" else None
+            rows = tech.get("raw_data") if isinstance(tech, dict) else None
+            if isinstance(rows, list) and rows and isinstance(rows[0], dict):
+                return {"rows": rows, "query": tech.get("query"), "question": None}
+        
+        interaction = get_most_recent_data_interaction(self.user_id)
+        rows = interaction.get("raw_data") if interaction else None
+        if isinstance(rows, list) and rows and isinstance(rows[0], dict):
+            return {"rows": rows, "query": interaction.get("query_sql"), "question": interaction.get("question")}
+        return None
+
+    def _try_local_followup(self, typing_placeholder, prompt: str) -> bool:
+        """
+        Responde refinos (filtro, ordenação, top-N, reagregação) executando uma SQL
+        pequena sobre o resultado anterior em DuckDB local (database/followup_engine.py).
+        Retorna False quando a pergunta deve seguir o fluxo normal.
+        """
+        engine = get_followup_engine()
+        if engine is None or not engine.is_followup(prompt):
+            return False
+        base = self._previous_result()
+        if not base:
+            return False
+        
+        self._start_timing("refino_local", typing_placeholder)
+        outcome = engine.answer(prompt, base["rows"], model=self.model)
+        self._end_timing("refino_local")
+        if outcome is None:
+            self.flow_path.append("refino_local_nao_resolvido")
+            get_stage_metrics().increment("cache_misses", cache="followup_local")
+            return False
+        
+        plan, rows = outcome
+        self.flow_path.append("refino_local")
+        get_stage_metrics().increment("cache_hits", cache="followup_local", rule=plan.rule)
+        print(f"🔎 [FOLLOWUP] {plan.description} -> {len(rows)} linhas ({plan.sql})")
+        
+        serializable_data = safe_serialize_data(rows)
+        response_text = (
+            f"🔎 Refinei o resultado anterior ({plan.description}): {len(rows)} linha(s), "
+            f"sem nova consulta ao banco."
+        )
+        tech_details = {
+            "query": base.get("query"),
+            "raw_data": serializable_data,
+            "aggrid_data": serializable_data,
+            "followup": {
+                "rule": plan.rule,
+                "local_sql": plan.sql,
+                "params": plan.params,
+                "steps": plan.steps,
+                "base_rows": len(base["rows"])
+            },
+            "response_type": "followup_local",
+            "flow_path": " → ".join(self.flow_path),
+            "timing_info": self.timing_info.copy(),
+            "total_duration": self._get_total_duration()
+        }
+        self._finalize_response(typing_placeholder, response_text, tech_details)
+        
+        try:
+            self.interaction_id = save_interaction(
+                user_id=self.user_id,
+                question=prompt,
+                function_params={"followup": plan.rule, "steps": plan.steps},
+                query_sql=base.get("query"),
+                raw_data=serializable_data,
+                refined_response=response_text,
+                tech_details=safe_serialize_tech_details(tech_details),
+                status="OK",
+                reused_from=base.get("question") or "resultado_anterior"
+            )
+        except Exception as e:
+            print(f"Erro ao salvar refino local: {e}")
+        return True
+
     def _check_reuse_opportunity(self, prompt: str) -> Tuple[bool, Dict]:
         """Etapa 1: Verificar se pode reutilizar dados anteriores - OTIMIZADO COM DETECÇÃO INTELIGENTE"""
         self.flow_path.append("verificando_reuso")
         
         try:
             # 🚀 OTIMIZAÇÃO CRÍTICA: Verificação inteligente antes de consultar Gemini
+            # (classificador único compilado de config/intents.json)
+            intent = classify_intent(prompt)
             
-            # Palavras-chave que SEMPRE indicam reuso (referências explícitas)
-            EXPLICIT_REUSE_KEYWORDS = [
-                'mesmos dados', 'dados anteriores', 'última consulta', 'último resultado', 
-                'consulta anterior', 'resultado anterior', 'tabela anterior',
-                'anterior', 'ultimo', 'última', 'mesmo', 'mesma',
-                'agora', 'agr', 'então', 'entao', 'e agora', 'e agr',
-                'com isso', 'com esse', 'com esses', 'com os dados'
-            ]
-            
-            # Palavras-chave que podem indicar reuso MAS precisam de contexto
-            POTENTIAL_REUSE_KEYWORDS = [
-                'gráfico', 'grafico', 'chart', 'visualização', 'visualizacao', 
-                'plotar', 'plot', 'curva', 'linha',
-                'exportar', 'excel', 'planilha', 'csv', 'baixar', 'download'
-            ]
-            
-            prompt_lower = prompt.lower()
-            
-            # Verifica reuso explícito (sempre procede com verificação)
-            has_explicit_reuse = any(keyword in prompt_lower for keyword in EXPLICIT_REUSE_KEYWORDS)
-            
-            if has_explicit_reuse:
+            if intent.has("reference", "continuity"):
+                # Referência explícita (sempre procede com verificação completa)
                 self.flow_path.append("reuso_explicito_detectado")
-                # Procede com verificação completa
+            elif intent.has("visualization", "export"):
+                # Gráfico/export MAS com especificação de dados (vendas, 2024, top...) = nova consulta
+                if intent.intent == INTENT_NEW_QUERY:
+                    self.flow_path.append("nova_consulta_com_grafico_detectada")
+                    return False, {"reason": "Nova consulta completa detectada (inclui especificação de dados + visualização)"}
+                # Pode ser reuso - palavra gráfico/export sem especificação de dados
+                self.flow_path.append("possivel_reuso_detectado")
             else:
-                # Verifica se é pedido de gráfico/export MAS com nova consulta completa
-                has_potential_reuse = any(keyword in prompt_lower for keyword in POTENTIAL_REUSE_KEYWORDS)
-                
-                if has_potential_reuse:
-                    # ANÁLISE INTELIGENTE: verifica se é reuso real ou nova consulta com gráfico
-                    
-                    # Indicadores de NOVA CONSULTA (mesmo com palavra gráfico/export):
-                    # - Menciona dados específicos (vendas, produtos, etc.)
-                    # - Menciona filtros temporais (2024, janeiro, etc.)
-                    # - Menciona agregações (top 5, total, soma, etc.)
-                    # - Menciona dimensões (por região, por produto, etc.)
-                    
-                    NEW_QUERY_INDICATORS = [
-                        # Dados/métricas específicas
-                        'vendas', 'receita', 'faturamento', 'lucro', 'margem',
-                        'produtos', 'clientes', 'pedidos', 'transações',
-                        
-                        # Filtros temporais
-                        '2024', '2025', '2023', 'janeiro', 'fevereiro', 'março', 'abril', 'maio', 'junho',
-                        'julho', 'agosto', 'setembro', 'outubro', 'novembro', 'dezembro',
-                        'trimestre', 'semestre', 'ano', 'mês', 'semana',
-                        
-                        # Agregações
-                        'top', 'maior', 'menor', 'total', 'soma', 'média', 'contagem',
-                        'ranking', 'melhor', 'pior', 'máximo', 'mínimo',
-                        
-                        # Dimensões
-                        'por região', 'por estado', 'por cidade', 'por produto', 'por categoria',
-                        'por vendedor', 'por cliente', 'por canal', 'por loja'
-                    ]
-                    
-                    has_new_query_indicators = any(indicator in prompt_lower for indicator in NEW_QUERY_INDICATORS)
-                    
-                    if has_new_query_indicators:
-                        # É uma nova consulta completa que inclui gráfico/export
-                        self.flow_path.append("nova_consulta_com_grafico_detectada")
-                        return False, {"reason": "Nova consulta completa detectada (inclui especificação de dados + visualização)"}
-                    else:
-                        # Pode ser reuso - palavra gráfico/export sem especificação de dados
-                        self.flow_path.append("possivel_reuso_detectado")
-                        # Procede com verificação
-                else:
-                    # Sem palavras-chave de reuso - claramente nova consulta
-                    self.flow_path.append("nova_consulta_detectada")
-                    return False, {"reason": "Nova consulta detectada - sem indicadores de reutilização"}
+                # Sem palavras-chave de reuso - claramente nova consulta
+                self.flow_path.append("nova_consulta_detectada")
+                return False, {"reason": "Nova consulta detectada - sem indicadores de reutilização"}
             
             # Se chegou aqui, há indicadores válidos - procede com verificação completa
             user_history = get_user_history(self.user_id)
@@ -373,10 +485,8 @@ class MessageHandler:
     def _is_chart_request_incompatible(self, prompt: str, user_history: list) -> bool:
         """Verifica se é um pedido de gráfico com dados em formato incompatível"""
         # Detecta se é pedido de gráfico
-        chart_keywords = ['gráfico', 'grafico', 'chart', 'visualização', 'visualizacao', 'plotar', 'linha']
-        is_chart_request = any(keyword in prompt.lower() for keyword in chart_keywords)
-        
-        if not is_chart_request:
+        intent = classify_intent(prompt)
+        if not intent.has("visualization"):
             return False
         
         # Verifica se os dados mais recentes estão em formato wide (incompatível)
@@ -405,7 +515,7 @@ class MessageHandler:
                             return True
                             
                         # Se tem formato temporal (YYYY-MM) mas é comparação de anos, também é incompatível
-                        if temporal_columns and any(word in prompt.lower() for word in ['comparar', 'comparação', 'versus', 'vs']):
+                        if temporal_columns and intent.has("comparison"):
                             print(f"🔍 Detectado formato temporal inadequado para comparação: {columns}")
                             return True
                             
@@ -420,6 +530,7 @@ class MessageHandler:
         Armazena resposta em st.session_state.temp_response e temp_tech_details.
         """
         self.flow_path.append("processando_reuso")
+        get_stage_metrics().increment("cache_hits", cache="interaction_reuse")
         
         try:
             self._start_timing("exibindo_feedback_reuso", typing_placeholder)
@@ -488,43 +599,60 @@ class MessageHandler:
             # Garante que pega a última pergunta do usuário correto e que não deu erro
             for interaction in user_history:
                 if interaction.get('status', 'OK') == 'OK' and interaction.get('question'):
-                    last_question = interaction.get('question')
+                    if _is_recent_interaction(interaction.get('timestamp')):
+                        last_question = interaction.get('question')
+                    else:
+                        # Última pergunta fora da janela: histórico não é relevante
+                        self.flow_path.append("adaptacao_pulada_historico_antigo")
                     break
 
-        # Importa o prompt de adaptação do prompt_rules
-        
-        adaptation_prompt_template = get_adaptation_prompt()
+        # Pergunta claramente nova (não depende do histórico): dispensa a adaptação via Gemini
+        intent = classify_intent(prompt)
+        if last_question and intent.is_fresh_question:
+            print(f"[INTENT] Pergunta nova ({intent.confidence:.2f}, {intent.source}) - adaptação pulada")
+            self.flow_path.append("adaptacao_pulada_pergunta_nova")
+            last_question = None
 
-        # Monta prompt para Gemini adaptar/refinar
+        adapted_prompt = prompt
+        speculative = None
         if last_question:
-            adaptation_prompt = adaptation_prompt_template.format(
-                last_question=last_question,
-                nova_pergunta=prompt
-            )
-            # Usa Gemini para adaptar/refinar
-            model = getattr(st.session_state, "model", None)
-            try:
-                response = model.generate_content(adaptation_prompt)
-                # Extrai texto da resposta
-                adapted_prompt = prompt  # fallback
-                if hasattr(response, 'candidates') and response.candidates:
-                    candidate = response.candidates[0]
-                    if hasattr(candidate, 'content') and candidate.content:
-                        if hasattr(candidate.content, 'parts') and candidate.content.parts:
-                            part = candidate.content.parts[0]
-                            if hasattr(part, 'text') and part.text and part.text.strip():
-                                adapted_prompt = part.text.strip()
-                print(f"[DEBUG] Adapted query: {adapted_prompt}")
-            except Exception as e:
-                print(f"[ERROR] Falha ao adaptar prompt via Gemini: {e}")
-                adapted_prompt = prompt
-        else:
-            adapted_prompt = prompt
+            cached = get_cached_adaptation(last_question, prompt)
+            if cached is not None:
+                get_stage_metrics().increment("cache_hits", cache="adaptation")
+                self.flow_path.append("adaptacao_cache")
+                adapted_prompt = cached
+            else:
+                get_stage_metrics().increment("cache_misses", cache="adaptation")
+                # Sem referência/refino explícito a reescrita tende a devolver a própria pergunta:
+                # RAG + NL→SQL começam já, em paralelo à chamada de adaptação
+                if ADAPTATION_SPECULATIVE and not intent.has("reference", "continuity", "transform"):
+                    speculative = get_tracer().submit(
+                        _get_speculation_executor(), refine_with_gemini_rag, self.model, prompt, self.user_id
+                    )
+                    self.flow_path.append("rag_especulativo_iniciado")
+                adapted_prompt = self._adapt_question(last_question, prompt)
 
         # Usa sistema RAG diretamente com a pergunta adaptada
         self._start_timing("processamento_rag", typing_placeholder)
         self.flow_path.append("usando_sistema_rag")
-        response = refine_with_gemini_rag(self.model, adapted_prompt, self.user_id)
+        response = None
+        if speculative is not None:
+            if is_nearly_unchanged(prompt, adapted_prompt):
+                try:
+                    response = speculative.result()
+                    adapted_prompt = prompt  # SQL gerada a partir da pergunta original
+                    self.flow_path.append("rag_especulativo_aproveitado")
+                    get_stage_metrics().increment("speculation", outcome="used")
+                except Exception as e:
+                    print(f"[ERROR] Falha no RAG especulativo: {e}")
+                    get_stage_metrics().increment("speculation", outcome="failed")
+            else:
+                # Reescrita mudou a pergunta: resultado especulativo descartado
+                speculative.cancel()
+                self.flow_path.append("rag_especulativo_descartado")
+                get_stage_metrics().increment("speculation", outcome="discarded")
+        if response is None:
+            response = refine_with_gemini_rag(self.model, adapted_prompt, self.user_id)
         if isinstance(response, tuple) and len(response) == 2:
             _, tech_details = response
             self._last_rag_tech_details = tech_details
@@ -535,7 +663,7 @@ class MessageHandler:
         # Salva a interação apenas se não houve erro
         if self._last_rag_tech_details and self._last_rag_tech_details.get('response_type', '') != 'error':
             from utils.cache import save_interaction
-            save_interaction(
+            self.interaction_id = save_interaction(
                 user_id=self.user_id,
                 question=adapted_prompt,
                 function_params=None,
@@ -547,6 +675,35 @@ class MessageHandler:
                 status="OK"
             )
 
+    def _adapt_question(self, last_question: str, prompt: str) -> str:
+        """Reescreve a pergunta à luz da última pergunta via Gemini (fallback: pergunta original)"""
+        adaptation_prompt = get_adaptation_prompt().format(
+            last_question=last_question,
+            nova_pergunta=prompt
+        )
+        model = getattr(st.session_state, "model", None)
+        adapted_prompt = prompt  # fallback
+        try:
+            with get_tracer().span("gemini.adaptation", stage=STAGE_GEMINI_ADAPTATION):
+                # Reescrita de baixo valor: primeira a ser descartada perto da cota
+                response = governed_generate(model, adaptation_prompt, priority=PRIORITY_LOW, kind="adaptation")
+            # Extrai texto da resposta
+            if hasattr(response, 'candidates') and response.candidates:
+                candidate = response.candidates[0]
+                if hasattr(candidate, 'content') and candidate.content:
+                    if hasattr(candidate.content, 'parts') and candidate.content.parts:
+                        part = candidate.content.parts[0]
+                        if hasattr(part, 'text') and part.text and part.text.strip():
+                            adapted_prompt = part.text.strip()
+            print(f"[DEBUG] Adapted query: {adapted_prompt}")
+            cache_adaptation(last_question, prompt, adapted_prompt)
+        except GeminiQuotaExceeded:
+            print("[QUOTA] Cota do Gemini próxima do limite - adaptação pulada, usando a pergunta original")
+            self.flow_path.append("adaptacao_descartada_cota")
+        except Exception as e:
+            print(f"[ERROR] Falha ao adaptar prompt via Gemini: {e}")
+        return adapted_prompt
+
     def _handle_gemini_response(self, typing_placeholder, prompt: str, response) -> None:
     # Loga o objeto de retorno e seu tipo para diagnóstico
         """Etapa 3: Processar resposta do Gemini"""
@@ -663,13 +820,16 @@ class MessageHandler:
 
             self.flow_path.append("executando_query")
             self._start_timing("execucao_sql", typing_placeholder)
-            raw_data = execute_query(query)
+            raw_data = execute_query(query, user_id=self.user_id)
             self._end_timing("execucao_sql")
 
             if isinstance(raw_data, dict) and "error" in raw_data:
                 self._handle_query_error(typing_placeholder, prompt, raw_data, query, serializable_params)
                 return
 
+            if isinstance(raw_data, list) and not raw_data:
+                query, raw_data = self._retry_empty_result(typing_placeholder, query, raw_data)
+
             self.flow_path.append("processando_dados")
 
             # Converte os dados para formato serializável
@@ -747,9 +907,14 @@ class MessageHandler:
         print(f"\n❌ Erro SQL detectado: {error_message}")
         print(f"📋 Query que falhou: {failed_query}")
         
+        # CORREÇÃO DETERMINÍSTICA LOCAL (sem LLM) ANTES DO GEMINI
+        if self._try_local_autofix(typing_placeholder, prompt, error_message, failed_query):
+            return
+        
         # TENTA REFINAR COM GEMINI ANTES DE FALHAR
         print(f"🔄 [REFINAMENTO] Tentando refinar SQL com Gemini...")
         self.flow_path.append("tentando_refinar_erro_sql")
+        get_stage_metrics().increment("retries", kind="gemini_sql_refine")
         self._start_timing("refinamento_erro_gemini", typing_placeholder)
         
         try:
@@ -776,7 +941,7 @@ class MessageHandler:
                     from database.query_builder import build_query, execute_query
                     
                     refined_query = build_query(refined_result)
-                    raw_data_retry = execute_query(refined_query)
+                    raw_data_retry = execute_query(refined_query, user_id=self.user_id)
                     
                     self._end_timing("execucao_sql_refinada")
                     
@@ -784,27 +949,15 @@ class MessageHandler:
                         print(f"✅ SQL refinada PASSOU! Continuando com resultado...")
                         self.flow_path.append("sucesso_sql_refinada")
                         
-                        # Converte dados para formato serializável
-                        serializable_data = safe_serialize_data(raw_data_retry)
-                        
-                        # Refina resposta com Gemini
-                        from llm_handlers.gemini_handler import analyze_data_with_gemini
-                        refined_response, tech_details = analyze_data_with_gemini(
-                            prompt=prompt,
-                            data=serializable_data,
-                            function_params=refined_result,
-                            query=refined_query
-                        )
-                        
                         # Adiciona info de refinamento aos tech_details
-                        if refined_tech_details:
-                            tech_details.update(refined_tech_details)
-                        tech_details["retry_successful"] = True
-                        tech_details["original_error"] = error_message
-                        tech_details["original_query"] = failed_query
+                        extra_tech_details = dict(refined_tech_details or {})
+                        extra_tech_details["retry_successful"] = True
+                        extra_tech_details["original_error"] = error_message
+                        extra_tech_details["original_query"] = failed_query
                         
-                        self._finalize_response(typing_placeholder, refined_response, tech_details)
-                        self._save_new_interaction(prompt, refined_result, refined_query, serializable_data, refined_response, tech_details)
+                        self._complete_with_recovered_data(
+                            typing_placeholder, prompt, raw_data_retry, refined_result, refined_query, extra_tech_details
+                        )
                         return
                     else:
                         # SQL refinada também falhou
@@ -858,6 +1011,130 @@ class MessageHandler:
         })
         st.rerun()
 
+    def _try_local_autofix(self, typing_placeholder, prompt: str, error_message: str, failed_query: str) -> bool:
+        """
+        Corrige a SQL com regras determinísticas (database/sql_autofix.py) e reexecuta.
+        Retorna True se a consulta foi recuperada e a resposta finalizada.
+        """
+        autofixer = get_sql_autofixer()
+        if autofixer is None or not failed_query or failed_query == 'N/A':
+            return False
+        
+        self.flow_path.append("tentando_autofix_local")
+        self._start_timing("autofix_local", typing_placeholder)
+        
+        current_query = failed_query
+        current_error = error_message
+        applied_rules = []
+        raw_data_retry = None
+        success = False
+        
+        for _ in range(self.MAX_LOCAL_FIX_ATTEMPTS):
+            fix = autofixer.repair(current_query, current_error)
+            if fix is None:
+                break
+            
+            applied_rules.append(fix.rule)
+            self.flow_path.append(f"autofix_{fix.rule.lower()}")
+            current_query = fix.sql
+            
+            try:
+                raw_data_retry = execute_query(current_query, user_id=self.user_id)
+            except Exception as e:
+                raw_data_retry = {"error": str(e), "query": current_query}
+            
+            success = not (isinstance(raw_data_retry, dict) and "error" in raw_data_retry)
+            self._record_autofix_outcome(autofixer, fix.rule, success)
+            if success:
+                break
+            current_error = raw_data_retry.get("error", "")
+            print(f"⚠️  [AUTOFIX] SQL corrigida ainda falhou: {current_error}")
+        
+        get_tracer().set_attributes(
+            retry_count=len(applied_rules),
+            autofix_rules=", ".join(applied_rules),
+            success=success
+        )
+        self._end_timing("autofix_local")
+        
+        if not success:
+            return False
+        
+        print(f"✅ [AUTOFIX] SQL corrigida localmente ({', '.join(applied_rules)}) - sem chamada ao Gemini")
+        self.flow_path.append("sucesso_autofix_local")
+        self._complete_with_recovered_data(
+            typing_placeholder, prompt, raw_data_retry, {}, current_query,
+            {
+                "retry_successful": True,
+                "autofix_rules": applied_rules,
+                "original_error": error_message,
+                "original_query": failed_query,
+            }
+        )
+        return True
+
+    def _retry_empty_result(self, typing_placeholder, query: str, raw_data):
+        """Resultado vazio: tenta regras locais (ex: caixa de literais) antes de seguir"""
+        autofixer = get_sql_autofixer()
+        if autofixer is None:
+            return query, raw_data
+        
+        fix = autofixer.repair(query, EMPTY_RESULT)
+        if fix is None:
+            return query, raw_data
+        
+        self.flow_path.append(f"autofix_{fix.rule.lower()}")
+        self._start_timing("autofix_resultado_vazio", typing_placeholder)
+        try:
+            retry_data = execute_query(fix.sql, user_id=self.user_id)
+        except Exception as e:
+            print(f"⚠️  [AUTOFIX] Erro ao reexecutar SQL corrigida: {e}")
+            retry_data = None
+        self._end_timing("autofix_resultado_vazio")
+        
+        success = isinstance(retry_data, list) and len(retry_data) > 0
+        self._record_autofix_outcome(autofixer, fix.rule, success)
+        if success:
+            print(f"✅ [AUTOFIX] {fix.rule}: consulta corrigida retornou {len(retry_data)} linhas")
+            return fix.sql, retry_data
+        return query, raw_data
+
+    def _record_autofix_outcome(self, autofixer, rule: str, success: bool) -> None:
+        """Atualiza taxa de acerto da regra (memória + métricas)"""
+        autofixer.record_outcome(rule, success)
+        get_stage_metrics().increment("retries", kind="autofix", rule=rule, success=success)
+        try:
+            ai_metrics.record_autofix(
+                session_id="",
+                user_id=self.user_id,
+                rule=rule,
+                success=success
+            )
+        except Exception as e:
+            print(f"⚠️  [AUTOFIX] Falha ao registrar métrica: {e}")
+
+    def _complete_with_recovered_data(self, typing_placeholder, prompt: str, raw_data, function_params: Dict,
+                                      query: str, extra_tech_details: Dict) -> None:
+        """Finaliza a resposta com dados obtidos após recuperação de erro (autofix ou refino)"""
+        # Converte dados para formato serializável
+        serializable_data = safe_serialize_data(raw_data)
+        
+        # Refina resposta com Gemini
+        from llm_handlers.gemini_handler import analyze_data_with_gemini
+        refined_response, tech_details = analyze_data_with_gemini(
+            prompt=prompt,
+            data=serializable_data,
+            function_params=function_params,
+            query=query
+        )
+        
+        if tech_details is None:
+            tech_details = {}
+        tech_details.update(extra_tech_details)
+        
+        self._finalize_response(typing_placeholder, refined_response, tech_details)
+        self._save_new_interaction(prompt, function_params, query, serializable_data, refined_response, tech_details)
+
     def _process_direct_response(self, typing_placeholder, response, tech_details=None) -> None:
         """Processa resposta direta sem função"""
         self.flow_path.append("extraindo_texto_resposta")
@@ -898,7 +1175,7 @@ class MessageHandler:
             # Garantir serialização final antes de salvar
             final_params = safe_serialize_gemini_params(serializable_params)
             
-            save_interaction(
+            self.interaction_id = save_interaction(
                 user_id=self.user_id,
                 question=prompt,
                 function_params=final_params,
@@ -922,7 +1199,7 @@ class MessageHandler:
     def _save_reuse_interaction(self, prompt: str, reused_params: Dict, reused_query: str, refined_response: str, tech_details: Dict, reused_interaction: Dict) -> None:
         """Salva interação de reutilização no cache"""
         try:
-            save_interaction(
+            self.interaction_id = save_interaction(
                 user_id=self.user_id,
                 question=prompt,
                 function_params=safe_serialize_gemini_params(reused_params),
@@ -1066,7 +1343,7 @@ class MessageHandler:
         try:
             typing_placeholder.empty()
             td = tech_details if tech_details is not None else {"response_type": "text_only", "flow_path": " → ".join(self.flow_path)}
-            save_interaction(
+            self.interaction_id = save_interaction(
                 user_id=self.user_id,
                 question=prompt,
                 function_params=None,
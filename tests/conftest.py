@@ -0,0 +1,86 @@
+"""
+Configuração comum dos testes.
+
+- Spools, traces e stores locais apontam para um diretório temporário:
+  os testes nunca tocam os arquivos da raiz do projeto.
+- Sem credenciais do Google Cloud, `bigquery.Client` vira um cliente offline
+  (consultas sem linhas, inserts aceitos) para que os módulos que criam o
+  cliente na importação (utils/logger.py, database/query_builder.py) possam
+  ser importados. Com credenciais, o cliente real é mantido.
+- `cache_store`: utils.cache sobre um DuckDB temporário por teste.
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+_TEST_DIR = tempfile.mkdtemp(prefix="gl_sqllm_tests_")
+
+for _name, _value in {
+    "CACHE_COMPACTION_INTERVAL": "0",
+    "WRITE_BEHIND_SPOOL_PATH": os.path.join(_TEST_DIR, "write_behind_spool.jsonl"),
+    "WRITE_BEHIND_ENABLED": "false",
+    "LOG_SHIPPER_SPOOL_PATH": os.path.join(_TEST_DIR, "log_shipper_spool.jsonl"),
+    "TRACE_EXPORT_PATH": os.path.join(_TEST_DIR, "traces.json"),
+    "RATE_LIMIT_DB_PATH": os.path.join(_TEST_DIR, "rate_limit.db"),
+    "GEMINI_QUOTA_DB_PATH": os.path.join(_TEST_DIR, "rate_limit.db"),
+    "CACHE_DB_URL": os.path.join(_TEST_DIR, "cache.db"),
+    "METRICS_DB_URL": os.path.join(_TEST_DIR, "ai_metrics.db"),
+    "USERS_DB_URL": os.path.join(_TEST_DIR, "users_new.db"),
+}.items():
+    os.environ.setdefault(_name, _value)
+
+
+def _install_offline_bigquery_client():
+    try:
+        import google.auth
+        from google.auth.exceptions import DefaultCredentialsError
+        from google.cloud import bigquery
+    except ImportError:
+        return
+    try:
+        google.auth.default()
+        return
+    except DefaultCredentialsError:
+        pass
+
+    class _OfflineJob:
+        total_bytes_processed = 0
+        cache_hit = False
+
+        def result(self, timeout=None):
+            return []
+
+    class _OfflineClient:
+        def __init__(self, *args, **kwargs):
+            self.inserted = []
+
+        def query(self, sql, job_config=None, **kwargs):
+            return _OfflineJob()
+
+        def insert_rows_json(self, table, rows, row_ids=None, **kwargs):
+            self.inserted.extend(rows)
+            return []
+
+    bigquery.Client = _OfflineClient
+
+
+_install_offline_bigquery_client()
+
+
+@pytest.fixture
+def cache_store(tmp_path, monkeypatch):
+    """utils.cache sobre um arquivo DuckDB temporário (vazio a cada teste)"""
+    from utils import cache
+    from utils.db_pool import get_duckdb_manager
+
+    store = get_duckdb_manager(str(tmp_path / "cache.db"))
+    store.statements.update(cache._db.statements)
+    monkeypatch.setattr(cache, "_db", store)
+    cache.init_cache_db()
+    return cache
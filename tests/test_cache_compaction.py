@@ -0,0 +1,48 @@
+"""
+Testes da compactação em background do cache (utils/cache.py: run_cache_compaction).
+"""
+
+import os
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+RETENTION = 3
+
+
+def test_poda_historico_e_payloads_orfaos(cache_store, monkeypatch):
+    monkeypatch.setattr(cache_store, "HISTORY_RETENTION_BY_PLAN", {"free": RETENTION})
+    monkeypatch.setattr(cache_store, "DEFAULT_HISTORY_RETENTION", RETENTION)
+    monkeypatch.setattr(cache_store, "_get_history_retention", lambda user_id: RETENTION)
+    user_id, other_id = str(uuid.uuid4()), str(uuid.uuid4())
+    ids = [cache_store.save_interaction(user_id, f"pergunta {n}", raw_data=[{"n": n}]) for n in range(6)]
+    cache_store.save_interaction(user_id, "falhou", status="ERROR")
+    cache_store.save_interaction(other_id, "pergunta", raw_data=[{"n": 0}])
+
+    stats = cache_store.run_cache_compaction()
+
+    assert stats["users_trimmed"] == 1
+    assert stats["interactions_deleted"] == 4
+    assert stats["payloads_deleted"] == 3
+    assert [h["id"] for h in cache_store.get_user_history(user_id)] == ids[:-RETENTION - 1:-1]
+    assert cache_store.get_interaction_full_data(ids[0]) is None
+    assert len(cache_store.get_user_history(other_id)) == 1
+
+    # Segunda passada não tem o que remover
+    assert cache_store.run_cache_compaction()["interactions_deleted"] == 0
+
+
+def test_remove_erros_antigos(cache_store):
+    user_id = str(uuid.uuid4())
+    old = datetime.now() - timedelta(days=cache_store.ERROR_LOG_RETENTION_DAYS + 1)
+    with cache_store.get_connection() as conn:
+        conn.execute("""
+            INSERT INTO log_erros (id, user_id, timestamp, error_type, error_message)
+            VALUES (?, ?, ?, 'X', 'antigo')
+        """, (str(uuid.uuid4()), user_id, old))
+    cache_store.log_error(user_id, "X", "recente")
+
+    assert cache_store.run_cache_compaction()["errors_deleted"] == 1
+    assert [e["error_message"] for e in cache_store.get_recent_errors(user_id, hours=24 * 365)] == ["recente"]
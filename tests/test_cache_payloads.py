@@ -0,0 +1,47 @@
+"""
+Testes da tabela de payloads do cache (utils/cache.py: interaction_payloads).
+"""
+
+import os
+import sys
+import json
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ROWS = [{"estado": f"UF{n}", "total": n} for n in range(20)]
+
+
+def test_historico_le_so_a_amostra(cache_store):
+    user_id = str(uuid.uuid4())
+    interaction_id = cache_store.save_interaction(user_id, "vendas por estado", raw_data=ROWS)
+
+    [entry] = cache_store.get_user_history(user_id)
+    assert entry["id"] == interaction_id
+    assert entry["raw_data_count"] == len(ROWS)
+    assert entry["raw_data_sample"] == ROWS[:cache_store.SAMPLE_ROWS]
+    assert cache_store.get_interaction_full_data(interaction_id) == ROWS
+    assert cache_store.get_most_recent_data_interaction(user_id)["raw_data"] == ROWS
+
+
+def test_interacao_sem_dados_nao_tem_payload(cache_store):
+    user_id = str(uuid.uuid4())
+    interaction_id = cache_store.save_interaction(user_id, "oi")
+    assert cache_store.get_user_history(user_id)[0]["raw_data_count"] == 0
+    assert cache_store.get_interaction_full_data(interaction_id) is None
+    assert cache_store.get_most_recent_data_interaction(user_id) is None
+
+
+def test_resultado_inline_antigo_e_migrado(cache_store):
+    user_id = str(uuid.uuid4())
+    with cache_store.get_connection() as conn:
+        conn.execute("""
+            INSERT INTO user_interactions (id, user_id, question, raw_data, status)
+            VALUES ('antiga', ?, 'pergunta antiga', ?, 'OK')
+        """, (user_id, json.dumps(ROWS)))
+
+    cache_store.init_cache_db()
+    assert cache_store.get_interaction_full_data("antiga") == ROWS
+    assert cache_store.get_user_history(user_id)[0]["raw_data_count"] == len(ROWS)
+    with cache_store.get_connection() as conn:
+        assert conn.execute("SELECT raw_data FROM user_interactions WHERE id = 'antiga'").fetchone()[0] is None
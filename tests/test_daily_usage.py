@@ -0,0 +1,66 @@
+"""
+Testes do limite diário (utils/user_database.py: try_consume_daily_usage)
+sobre um arquivo DuckDB temporário.
+"""
+
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.user_database import UserDatabase, USAGE_SYNC_MARGIN  # noqa: E402
+from utils.write_behind import write_behind  # noqa: E402
+
+LIMIT = USAGE_SYNC_MARGIN + 3
+
+
+@pytest.fixture
+def db(tmp_path):
+    return UserDatabase(str(tmp_path / "users.db"))
+
+
+def _stored(db, user_id):
+    row = db.conn.execute("SELECT MAX(query_count) FROM daily_usage WHERE user_id = ?", [user_id]).fetchone()
+    return row[0] or 0
+
+
+def test_limite_na_fronteira(db):
+    user_id = str(uuid.uuid4())
+    results = [db.try_consume_daily_usage(user_id, LIMIT) for _ in range(LIMIT + 2)]
+    assert [allowed for allowed, _ in results] == [True] * LIMIT + [False, False]
+    assert results[-1][1] == LIMIT
+
+
+def test_perto_do_limite_grava_sem_esperar_a_fila(db):
+    user_id = str(uuid.uuid4())
+    for _ in range(LIMIT - USAGE_SYNC_MARGIN):
+        db.try_consume_daily_usage(user_id, LIMIT)
+    # Nenhum flush: a contagem já está no banco (um crash agora não perde o uso)
+    assert _stored(db, user_id) == LIMIT - USAGE_SYNC_MARGIN
+
+    # Processo reiniciado: recarrega do banco e continua negando no limite
+    for _ in range(USAGE_SYNC_MARGIN):
+        db.try_consume_daily_usage(user_id, LIMIT)
+    db._usage.clear()
+    assert db.try_consume_daily_usage(user_id, LIMIT) == (False, LIMIT)
+
+
+def test_reset_nao_e_sobrescrito_por_contagem_na_fila(db):
+    user_id = str(uuid.uuid4())
+    for _ in range(3):
+        db.increment_daily_usage(user_id)
+    db.reset_daily_usage(user_id)
+    assert write_behind.flush()
+    assert _stored(db, user_id) == 0
+    assert db.get_daily_usage(user_id) == 0
+
+
+def test_releitura_da_mesma_contagem_nao_soma(db):
+    user_id = str(uuid.uuid4())
+    payload = {"user_id": user_id, "usage_date": "2026-01-02", "count": 4, "updated_at": "2026-01-02T10:00:00"}
+    db._write_usage_batch([payload])
+    db._write_usage_batch([payload, dict(payload, count=2)])
+    assert _stored(db, user_id) == 4
@@ -0,0 +1,53 @@
+"""
+Testes do handle DuckDB compartilhado (utils/db_pool.py).
+"""
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.db_pool import get_duckdb_manager  # noqa: E402
+
+
+def test_um_gerenciador_por_arquivo(tmp_path):
+    path = str(tmp_path / "pool.db")
+    assert get_duckdb_manager(path) is get_duckdb_manager(os.path.join(str(tmp_path), ".", "pool.db"))
+    assert get_duckdb_manager(path) is not get_duckdb_manager(str(tmp_path / "outro.db"))
+
+
+def test_cursor_por_thread_sobre_o_mesmo_handle(tmp_path):
+    manager = get_duckdb_manager(str(tmp_path / "pool.db"))
+    assert manager.cursor() is manager.cursor()
+    with manager.connection() as conn:
+        conn.execute("CREATE TABLE t (n INTEGER)")
+
+    cursors = []
+
+    def insert(n):
+        cursor = manager.cursor()
+        cursors.append(cursor)
+        cursor.execute("INSERT INTO t VALUES (?)", [n])
+
+    threads = [threading.Thread(target=insert, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len({id(c) for c in cursors}) == 4
+    # Gravações de outras threads são visíveis: mesmo handle, não arquivos reabertos
+    assert manager.cursor().execute("SELECT COUNT(*) FROM t").fetchone()[0] == 4
+
+
+def test_consulta_registrada_e_reabertura_apos_close(tmp_path):
+    manager = get_duckdb_manager(str(tmp_path / "pool.db"))
+    manager.cursor().execute("CREATE TABLE t (n INTEGER)")
+    manager.register_statement("insert_n", "INSERT INTO t VALUES (?)")
+    manager.execute("insert_n", [1])
+
+    manager.close()
+    # Cursor antigo é descartado: a próxima chamada reabre o handle
+    manager.execute("insert_n", [2])
+    assert manager.cursor().execute("SELECT SUM(n) FROM t").fetchone()[0] == 3
@@ -0,0 +1,78 @@
+"""
+Testes do motor de refinos locais (database/followup_engine.py).
+Usa só DuckDB em memória; o fallback via Gemini fica desligado.
+"""
+
+import os
+import sys
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.followup_engine import FollowUpEngine  # noqa: E402
+
+
+def _rows(convert):
+    return [
+        {"produto": "Carro Y", "categoria": "carro", "valor_total": convert("10000.25")},
+        {"produto": "Moto Z", "categoria": "moto", "valor_total": convert("2000")},
+        {"produto": "Moto W", "categoria": "moto", "valor_total": convert("500")},
+    ]
+
+
+@pytest.fixture
+def engine():
+    return FollowUpEngine(use_model=False)
+
+
+# NUMERIC do BigQuery: float, Decimal ou string (após safe_serialize_data)
+@pytest.fixture(params=[float, Decimal, str], ids=["float", "decimal", "str"])
+def rows(request):
+    return _rows(request.param)
+
+
+def _produtos(answer):
+    plan, result = answer
+    return [row["produto"] for row in result]
+
+
+def test_ordena_pela_metrica(engine, rows):
+    assert _produtos(engine.answer("ordene por valor", rows)) == ["Carro Y", "Moto Z", "Moto W"]
+
+
+def test_top_n_pela_metrica(engine, rows):
+    assert _produtos(engine.answer("top 2 desses", rows)) == ["Carro Y", "Moto Z"]
+
+
+def test_filtro_por_valor_e_numero(engine, rows):
+    assert _produtos(engine.answer("só motos acima de 1000", rows)) == ["Moto Z"]
+
+
+def test_numero_nao_usado_pelas_regras(engine, rows):
+    # "2023" não está no resultado anterior: segue o fluxo normal
+    assert engine.answer("só motos de 2023", rows) is None
+
+
+@pytest.mark.parametrize("question", [
+    "agora gere um gráfico desse dado",
+    "exporte desses dados para excel",
+    "qual foi o último mês com vendas de motos",
+    "quais foram as vendas de 2024 por estado",
+])
+def test_nao_refinos_ficam_fora_do_motor(question):
+    assert not FollowUpEngine.is_followup(question)
+
+
+def test_modelo_so_com_refino_explicito(rows):
+    class Model:
+        calls = 0
+
+        def generate_content(self, prompt):
+            Model.calls += 1
+            raise RuntimeError("não deveria ser chamado")
+
+    engine = FollowUpEngine(use_model=True)
+    assert engine.answer("agora mostre as vendas de 2023 por estado", rows, model=Model()) is None
+    assert Model.calls == 0
@@ -0,0 +1,97 @@
+"""
+Testes do governador de cota do Gemini (utils/gemini_quota.py).
+Dois governadores sobre o mesmo arquivo simulam processos diferentes.
+"""
+
+import heapq
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import gemini_quota  # noqa: E402
+from utils.gemini_quota import (  # noqa: E402
+    GeminiQuotaExceeded,
+    GeminiQuotaGovernor,
+    PRIORITY_CRITICAL,
+    PRIORITY_HIGH,
+    PRIORITY_LOW,
+)
+
+
+@pytest.fixture
+def governors(tmp_path):
+    path = str(tmp_path / "rate_limit.db")
+    return (
+        GeminiQuotaGovernor(rpm_limit=10, tpm_limit=100_000, db_path=path, enabled=True, cooldown=60),
+        GeminiQuotaGovernor(rpm_limit=10, tpm_limit=100_000, db_path=path, enabled=True, cooldown=60),
+    )
+
+
+def test_baixa_prioridade_descartada_so_quando_falta_cota(governors):
+    first, second = governors
+    for _ in range(6):
+        first.acquire(100, PRIORITY_CRITICAL)
+
+    # 7 de 10 cabem nos 70% da prioridade baixa
+    assert second.acquire(100, PRIORITY_LOW) is not None
+    with pytest.raises(GeminiQuotaExceeded):
+        second.acquire(100, PRIORITY_LOW)
+
+    # Prioridades maiores ainda têm folga (90% / 100%)
+    second.acquire(100, PRIORITY_HIGH)
+    second.acquire(100, PRIORITY_HIGH)
+    first.acquire(100, PRIORITY_CRITICAL)
+    assert first.get_usage()["requests_per_minute"] == pytest.approx(10, abs=0.1)
+
+
+def test_descarte_nao_depende_da_fila(governors):
+    first, _ = governors
+    # Outra chamada à frente na fila do processo não faz a baixa prioridade ser descartada
+    heapq.heappush(first._waiters, (PRIORITY_CRITICAL, -1))
+    assert first.acquire(100, PRIORITY_LOW) is not None
+    assert first._waiters == [(PRIORITY_CRITICAL, -1)]
+
+
+def test_tokens_contam_e_sao_corrigidos(governors):
+    first, second = governors
+    window = first.acquire(60_000, PRIORITY_CRITICAL)
+    with pytest.raises(GeminiQuotaExceeded):
+        second.acquire(20_000, PRIORITY_LOW)
+
+    first.reconcile(window, 60_000, 1_000)
+    assert second.get_usage()["tokens_per_minute"] == pytest.approx(1_000, abs=20)
+    assert second.acquire(20_000, PRIORITY_LOW) is not None
+
+
+def test_429_abre_cooldown_compartilhado(governors):
+    first, second = governors
+    first.report_throttled()
+    assert second.get_usage()["cooldown_remaining"] > 0
+    with pytest.raises(GeminiQuotaExceeded):
+        second.acquire(100, PRIORITY_LOW)
+
+
+def test_chamada_critica_segue_apos_espera_maxima(governors, monkeypatch):
+    first, second = governors
+    first.report_throttled()
+    monkeypatch.setitem(gemini_quota.PRIORITY_POLICIES, PRIORITY_CRITICAL,
+                        {"headroom": 1.0, "max_wait": 0.0, "shed": False})
+    assert second.acquire(100, PRIORITY_CRITICAL) is not None
+
+
+def test_generate_reporta_429(governors):
+    first, second = governors
+
+    class ResourceExhausted(Exception):
+        pass
+
+    class Model:
+        def generate_content(self, prompt, **kwargs):
+            raise ResourceExhausted("429 quota")
+
+    with pytest.raises(ResourceExhausted):
+        first.generate(Model(), "prompt", priority=PRIORITY_HIGH)
+    assert second.get_usage()["cooldown_remaining"] > 0
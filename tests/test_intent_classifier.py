@@ -0,0 +1,62 @@
+"""
+Testes do classificador de intenção (utils/intent_classifier.py, config/intents.json).
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.intent_classifier import (  # noqa: E402
+    IntentClassifier,
+    INTENT_NEW_QUERY,
+    INTENT_REUSE,
+    INTENT_FOLLOWUP,
+    INTENT_CHART,
+    INTENT_EXPORT,
+)
+
+
+@pytest.fixture(scope="module")
+def classifier():
+    return IntentClassifier.from_file()
+
+
+@pytest.mark.parametrize("question, intent", [
+    ("quais foram as vendas de 2024 por estado", INTENT_NEW_QUERY),
+    ("top 10 modelos mais vendidos no ano", INTENT_NEW_QUERY),
+    ("use os mesmos dados", INTENT_REUSE),
+    ("agora só motos", INTENT_FOLLOWUP),
+    ("exceto São Paulo", INTENT_FOLLOWUP),
+    ("agora gere um gráfico desse dado", INTENT_CHART),
+    ("exporte desses dados para excel", INTENT_EXPORT),
+])
+def test_intencao(classifier, question, intent):
+    assert classifier.classify(question).intent == intent
+
+
+@pytest.mark.parametrize("question", [
+    "e em 2023?",
+    "e o faturamento?",
+    "e por estado?",
+    "e em março?",
+    "e no mês de maio?",
+    "e qual foi o pior?",
+    "e o top 10?",
+    "por estado?",
+    "em março?",
+])
+def test_pergunta_eliptica_nunca_e_nova(classifier, question):
+    result = classifier.classify(question)
+    assert result.has("ellipsis", "fragment")
+    assert not result.is_fresh_question
+
+
+@pytest.mark.parametrize("question", [
+    "quais foram as vendas de 2024 por estado",
+    "vendas de motos em 2024",
+])
+def test_pergunta_completa_e_nova(classifier, question):
+    assert classifier.classify(question).is_fresh_question
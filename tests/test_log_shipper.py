@@ -0,0 +1,106 @@
+"""
+Testes do envio em lote dos logs para o BigQuery (utils/log_shipper.py).
+O cliente BigQuery é substituído por uma função que registra os lotes.
+"""
+
+import os
+import sys
+import json
+import zlib
+import base64
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import log_shipper  # noqa: E402
+from utils.log_shipper import LogShipper, apply_payload_policy  # noqa: E402
+
+
+class FakeBigQuery:
+    """insert_rows_json: `responses` são os erros por linha de cada chamada (None = exceção)"""
+
+    def __init__(self, responses=()):
+        self.responses = list(responses)
+        self.calls = []
+
+    def __call__(self, rows, row_ids):
+        self.calls.append((list(rows), list(row_ids)))
+        if self.responses:
+            response = self.responses.pop(0)
+            if response is None:
+                raise ConnectionError("BigQuery indisponível")
+            return response
+        return []
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(log_shipper, "LOG_SHIPPER_BACKOFF_BASE", 0.0)
+
+
+def _shipper(tmp_path, bigquery, **kwargs):
+    kwargs.setdefault("batch_size", 3)
+    kwargs.setdefault("max_age", 30.0)
+    kwargs.setdefault("max_retries", 2)
+    kwargs.setdefault("enabled", True)
+    return LogShipper(bigquery, lambda **kw: (kw, {}), spool_path=str(tmp_path / "spool.jsonl"), **kwargs)
+
+
+def test_lotes_por_quantidade(tmp_path):
+    bigquery = FakeBigQuery()
+    shipper = _shipper(tmp_path, bigquery)
+    for n in range(7):
+        shipper.submit(n=n)
+    assert shipper.flush(5)
+    shipper.shutdown()
+
+    assert [len(rows) for rows, _ in bigquery.calls] == [3, 3, 1]
+    assert [row["n"] for rows, _ in bigquery.calls for row in rows] == list(range(7))
+    assert shipper.get_stats()["shipped_rows"] == 7
+
+
+def test_reenvia_linhas_barradas_e_rejeita_invalidas(tmp_path):
+    bigquery = FakeBigQuery([[
+        {"index": 0, "errors": [{"reason": "invalid"}]},
+        {"index": 1, "errors": [{"reason": "stopped"}]},
+    ]])
+    shipper = _shipper(tmp_path, bigquery, enabled=False)
+    shipper._ship([({"n": 0}, "id0"), ({"n": 1}, "id1")])
+
+    # Reenvio só da linha barrada, com o mesmo insertId (deduplicação no BigQuery)
+    assert bigquery.calls[1] == ([{"n": 1}], ["id1"])
+    assert shipper.get_stats()["rejected_rows"] == 1
+
+
+def test_lote_que_esgota_tentativas_vai_para_o_spool_e_volta(tmp_path):
+    bigquery = FakeBigQuery([None, None, None])
+    shipper = _shipper(tmp_path, bigquery)
+    assert not shipper._ship([({"n": 0}, "id0")])
+    assert len(bigquery.calls) == 3
+    assert shipper.get_stats()["spooled_rows"] == 1
+
+    assert shipper.replay_spool() == 1
+    assert bigquery.calls[-1] == ([{"n": 0}], ["id0"])
+    assert not os.path.exists(shipper.spool_path)
+
+
+def test_payload_grande_vira_amostra_com_dados_comprimidos(monkeypatch):
+    monkeypatch.setattr(log_shipper, "LOG_PAYLOAD_MAX_BYTES", 1000)
+    raw_data = [{"linha": n, "texto": "x" * 20} for n in range(200)]
+
+    serialized, info = apply_payload_policy({"user_input": "pergunta", "raw_data": raw_data})
+    payload = json.loads(serialized)
+
+    assert info == {"truncated": False, "compressed": True}
+    assert payload["raw_data"] is None
+    assert payload["raw_data_row_count"] == 200
+    assert payload["raw_data_sample"] == raw_data[:log_shipper.LOG_RAW_DATA_SAMPLE_ROWS]
+    assert json.loads(zlib.decompress(base64.b64decode(payload["raw_data_zlib_b64"]))) == raw_data
+
+
+def test_payload_pequeno_fica_intacto():
+    payload = {"user_input": "pergunta", "raw_data": [{"n": 1}]}
+    serialized, info = apply_payload_policy(payload)
+    assert json.loads(serialized) == payload
+    assert info == {"truncated": False, "compressed": False}
@@ -0,0 +1,84 @@
+"""
+Testes do buffer de métricas (utils/metrics.py: AIMetricsCollector).
+O flusher em background fica desligado: os testes chamam flush().
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import metrics  # noqa: E402
+from utils.metrics import AIMetricsCollector, TokenUsageMetric, PerformanceMetric  # noqa: E402
+
+
+@pytest.fixture
+def make_collector(tmp_path, monkeypatch):
+    def make(**kwargs):
+        collector = AIMetricsCollector(db_path=str(tmp_path / "ai_metrics.db"), **kwargs)
+        monkeypatch.setattr(collector, "_start_flusher", lambda: None)
+        return collector
+    return make
+
+
+def _tokens(total=100, cost=0.01):
+    return TokenUsageMetric(total - 10, 10, total, cost, "gemini", "sql", False)
+
+
+def _performance(ms):
+    return PerformanceMetric(ms, 0, 0, 0, 0, 0)
+
+
+def _stored(collector):
+    with collector._db.connection() as conn:
+        return conn.execute("SELECT metric_type, value FROM ai_metrics ORDER BY value").fetchall()
+
+
+def test_registro_so_vai_ao_banco_no_flush(make_collector):
+    collector = make_collector()
+    session_id = collector.start_session("u1")
+    collector.record_token_usage(session_id, "u1", _tokens(100))
+    collector.record_performance(session_id, "u1", _performance(250))
+    assert _stored(collector) == []
+
+    assert collector.flush() == 3
+    assert _stored(collector) == [("token_usage", 100), ("response_time", 250)]
+    assert collector.get_buffer_stats()["buffered"] == 0
+
+
+def test_buffer_cheio_descarta_o_mais_antigo(make_collector):
+    collector = make_collector(buffer_size=3)
+    for ms in (1, 2, 3, 4, 5):
+        collector.record_performance("s", "u1", _performance(ms))
+
+    stats = collector.get_buffer_stats()
+    assert stats["dropped"] == 2
+    assert stats["buffered"] == 3
+    collector.flush()
+    assert [value for _, value in _stored(collector)] == [3, 4, 5]
+
+
+def test_amostragem_nunca_descarta_tokens(make_collector):
+    collector = make_collector(sample_rate=0.0)
+    collector.record_performance("s", "u1", _performance(10))
+    collector.record_token_usage("s", "u1", _tokens(100))
+    collector.flush()
+    assert _stored(collector) == [("token_usage", 100)]
+    assert collector.get_buffer_stats()["sampled_out"] == 1
+
+
+def test_falha_no_flush_devolve_ao_buffer(make_collector, monkeypatch):
+    collector = make_collector()
+    collector.record_token_usage("s", "u1", _tokens(100))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("disco cheio")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(metrics, "execute_values", fail)
+        assert collector.flush() == 0
+    assert collector.get_buffer_stats()["buffered"] == 1
+    assert collector.flush() == 1
+    assert _stored(collector) == [("token_usage", 100)]
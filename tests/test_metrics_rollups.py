@@ -0,0 +1,73 @@
+"""
+Testes dos rollups de métricas (utils/metrics.py: ai_metrics_hourly/daily).
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.metrics import AIMetricsCollector, TokenUsageMetric, PerformanceMetric  # noqa: E402
+
+
+@pytest.fixture
+def collector(tmp_path, monkeypatch):
+    collector = AIMetricsCollector(db_path=str(tmp_path / "ai_metrics.db"))
+    monkeypatch.setattr(collector, "_start_flusher", lambda: None)
+    return collector
+
+
+def _daily(collector):
+    with collector._db.connection() as conn:
+        return conn.execute("""
+            SELECT metric_type, user_id, model, sample_count, sum_value, min_value, max_value, sum_cost
+            FROM ai_metrics_daily ORDER BY metric_type, user_id
+        """).fetchall()
+
+
+def _record(collector, user_id, tokens, cost, latency_ms):
+    collector.record_token_usage("s", user_id, TokenUsageMetric(tokens, 0, tokens, cost, "gemini", "sql", True))
+    collector.record_performance("s", user_id, PerformanceMetric(latency_ms, 0, 0, 0, 0, 0))
+
+
+def test_upsert_acumula_entre_flushes(collector):
+    _record(collector, "u1", 100, 0.25, 200)
+    collector.flush()
+    _record(collector, "u1", 50, 0.5, 800)
+    _record(collector, "u2", 10, 0.0, 100)
+    collector.flush()
+
+    assert _daily(collector) == [
+        ("response_time", "u1", "", 2, 1000, 200, 800, 0.0),
+        ("response_time", "u2", "", 1, 100, 100, 100, 0.0),
+        ("token_usage", "u1", "gemini", 2, 150, 50, 100, 0.75),
+        ("token_usage", "u2", "gemini", 1, 10, 10, 10, 0.0),
+    ]
+
+
+def test_rebuild_reproduz_os_rollups_incrementais(collector):
+    for n in range(5):
+        _record(collector, f"u{n % 2}", 10 * n, 0.01 * n, 100 * (n + 1))
+        collector.flush()
+    incremental = _daily(collector)
+
+    collector.rebuild_rollups()
+    assert _daily(collector) == incremental
+
+
+def test_resumo_diario_lido_dos_rollups(collector):
+    for latency in (100, 200, 300, 400, 5000):
+        _record(collector, "u1", 10, 0.1, latency)
+    summary = collector.get_daily_summary(datetime.now().date())
+
+    assert summary["queries"] == 5
+    assert summary["total_tokens"] == 50
+    assert summary["total_cost_usd"] == pytest.approx(0.5)
+    assert summary["avg_response_time_ms"] == 1200
+    assert summary["max_response_time_ms"] == 5000
+    # Percentil pelo histograma: limite superior do bucket (~19% de resolução)
+    assert 5000 <= summary["p95_response_time_ms"] < 5000 * 1.19
+    assert summary["unique_users"] == 1
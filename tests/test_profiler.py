@@ -0,0 +1,62 @@
+"""
+Testes do profiler por amostragem e do flamegraph (utils/profiler.py, tools/flamegraph.py).
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.flamegraph import parse_collapsed, render_svg, top_self_time  # noqa: E402
+from utils import profiler  # noqa: E402
+from utils.profiler import SamplingProfiler, profile_trigger  # noqa: E402
+
+
+def _busy_loop(seconds):
+    deadline = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < deadline:
+        total += 1
+    return total
+
+
+def test_amostra_a_pilha_da_thread_da_requisicao():
+    with SamplingProfiler(interval_ms=1) as prof:
+        _busy_loop(0.2)
+
+    assert prof.sample_count > 0
+    assert prof.duration_ms >= 200
+    stacks = parse_collapsed(prof.collapsed())
+    assert sum(count for _, count in stacks) == prof.sample_count
+    assert any(frames[-1] == "test_profiler:_busy_loop" for frames, _ in stacks)
+
+
+def test_gatilhos(monkeypatch):
+    assert profile_trigger(query_param=True) == profiler.TRIGGER_QUERY_PARAM
+    assert profile_trigger(admin_toggle=True) == profiler.TRIGGER_ADMIN
+    assert profile_trigger(sample_every=1) == profiler.TRIGGER_SAMPLED
+    assert profile_trigger(sample_every=0) is None
+
+    monkeypatch.setattr(profiler, "PROFILING_ALLOW_QUERY_PARAM", False)
+    assert profile_trigger(query_param=True) is None
+    profiler.set_profiling_forced(True)
+    try:
+        assert profile_trigger() == profiler.TRIGGER_ADMIN
+    finally:
+        profiler.set_profiling_forced(False)
+
+
+def test_perfil_gravado_e_renderizado(cache_store):
+    cache = cache_store
+    stacks = "app:main;db:query 7\napp:main;llm:generate 3\napp:main 2"
+    cache.save_profile("p1", "user@x.com", "vendas por estado", profiler.TRIGGER_ADMIN,
+                       120.0, 5.0, 12, stacks, interaction_id="i1")
+
+    profile = cache.get_profile("i1")
+    assert profile["id"] == "p1"
+    assert profile["stacks"] == stacks
+    assert top_self_time(profile["stacks"], limit=2) == [("db:query", 7), ("llm:generate", 3)]
+    svg = render_svg(profile["stacks"], title="p1")
+    assert svg.startswith("<?xml") or svg.startswith("<svg")
+    assert "db:query" in svg
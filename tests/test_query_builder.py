@@ -0,0 +1,28 @@
+"""
+Testes da montagem de SQL por AST (database/query_builder.py: build_query).
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("sqlglot")
+
+from database.query_builder import build_query  # noqa: E402
+
+CTE = "WITH base AS (SELECT estado, SUM(valor) AS total FROM `proj.ds.vendas` GROUP BY estado)"
+EXPECTED = f"{CTE} SELECT estado, total FROM base ORDER BY total DESC"
+
+
+@pytest.mark.parametrize("from_table", ["base", "proj.ds.base", "`proj.ds.base`"])
+def test_alias_de_cte_com_prefixo_de_projeto(from_table):
+    params = {"cte": CTE, "from_table": from_table, "select": ["estado", "total"], "order_by": ["total DESC"]}
+    assert build_query(params) == EXPECTED
+
+
+def test_cte_com_query_completa_recebe_order_by():
+    params = {"cte": "WITH base AS (SELECT estado FROM `proj.ds.vendas`) SELECT * FROM base", "order_by": ["estado"]}
+    assert build_query(params).endswith("SELECT * FROM base ORDER BY estado")
@@ -0,0 +1,73 @@
+"""
+Testes do rate limiter em SQLite (utils/rate_limit.py). Cada instância abre
+a sua conexão: duas instâncias sobre o mesmo arquivo fazem o papel de dois
+processos.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.rate_limit import RateLimiter, POLICY_TOKEN_BUCKET, POLICY_SLIDING_WINDOW  # noqa: E402
+
+POLICIES = {
+    "free": {"policy": POLICY_TOKEN_BUCKET, "per_minute": 1, "burst": 3},
+    "enterprise": {"policy": POLICY_SLIDING_WINDOW, "per_minute": 2, "burst": 1},
+}
+
+
+@pytest.fixture
+def limiters(tmp_path):
+    def make(max_requests_per_day=None):
+        return RateLimiter(
+            max_requests_per_day=max_requests_per_day,
+            state_file=str(tmp_path / "legacy.json"),
+            db_path=str(tmp_path / "rate_limit.db"),
+            policies=POLICIES,
+        )
+    return make
+
+
+def _allowed(limiter_a, limiter_b, plan_id, n, user_id="u1"):
+    return [
+        (limiter_a if i % 2 == 0 else limiter_b).acquire(user_id, plan_id)["allowed"]
+        for i in range(n)
+    ]
+
+
+def test_token_bucket_entre_conexoes(limiters):
+    a, b = limiters(), limiters()
+    assert _allowed(a, b, "free", 4) == [True, True, True, False]
+    decision = b.acquire("u1", "free")
+    assert decision["reason"] == "user_burst"
+    assert decision["retry_after"] > 0
+    # Outro usuário tem o seu próprio bucket
+    assert a.acquire("u2", "free")["allowed"]
+
+
+def test_janela_deslizante_entre_conexoes(limiters):
+    a, b = limiters(), limiters()
+    assert _allowed(a, b, "enterprise", 4) == [True, True, True, False]
+    assert a.acquire("u1", "enterprise")["reason"] == "user_minute"
+
+
+def test_limite_global_diario_entre_conexoes(limiters):
+    a, b = limiters(max_requests_per_day=3), limiters(max_requests_per_day=3)
+    results = [(a if i % 2 else b).acquire(f"u{i}", "free") for i in range(4)]
+    assert [r["allowed"] for r in results] == [True, True, True, False]
+    assert results[-1]["reason"] == "global_daily"
+    assert a.state["count"] == 3
+
+
+@pytest.mark.parametrize("plan_id", ["free", "enterprise"])
+def test_release_devolve_a_aquisicao(limiters, plan_id):
+    a, b = limiters(max_requests_per_day=3), limiters(max_requests_per_day=3)
+    assert _allowed(a, b, plan_id, 3) == [True, True, True]
+    # Requisição barrada pela cota do plano depois do acquire: nada fica gasto
+    b.release("u1", plan_id)
+    assert a.state["count"] == 2
+    assert a.acquire("u1", plan_id)["allowed"]
+    assert not b.acquire("u1", plan_id)["allowed"]
@@ -0,0 +1,89 @@
+"""
+Testes do cache de resultados compartilhado no tenant (database/result_cache.py).
+"""
+
+import os
+import sys
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import result_cache  # noqa: E402
+from database.result_cache import SharedResultCache, is_cacheable, result_cache_key  # noqa: E402
+
+SQL = "SELECT estado, SUM(valor) AS total FROM `proj.ds.vendas` GROUP BY estado"
+ROWS = [
+    {"estado": "SP", "total": Decimal("1234.50"), "dia": date(2024, 5, 1)},
+    {"estado": "RJ", "total": Decimal("10.01"), "dia": date(2024, 5, 2)},
+]
+
+
+def test_chave_por_sql_canonica_escopo_e_tenant(monkeypatch):
+    key = result_cache_key(SQL)
+    assert result_cache_key(SQL.replace(" ", "\n  ").replace("SUM", "sum") + " -- total") == key
+    assert result_cache_key(SQL, {"filial": "SP"}) != key
+    assert result_cache_key(SQL, {"filial": "SP"}) != result_cache_key(SQL, {"filial": "RJ"})
+
+    monkeypatch.setattr(result_cache, "TENANT", "outro_cliente|proj.ds")
+    assert result_cache_key(SQL) != key
+
+
+def test_current_date_entra_na_chave(monkeypatch):
+    sql = "SELECT COUNT(*) FROM `proj.ds.vendas` WHERE dia = CURRENT_DATE()"
+
+    class Day(datetime):
+        today = datetime(2024, 5, 1, 23, 59)
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.today
+
+    monkeypatch.setattr(result_cache, "datetime", Day)
+    key = result_cache_key(sql)
+    assert result_cache_key(sql) == key
+    Day.today = datetime(2024, 5, 2, 0, 1)
+    assert result_cache_key(sql) != key
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT RAND() AS r",
+    "SELECT CURRENT_TIMESTAMP() AS agora",
+    "SELECT GENERATE_UUID() AS id",
+    "",
+])
+def test_sql_volatil_nao_e_cacheada(sql):
+    assert not is_cacheable(sql)
+    cache = SharedResultCache(shared_store=False)
+    assert not cache.put(sql, ROWS)
+    assert cache.get(sql) is None
+
+
+def test_compartilhado_entre_replicas_com_tipos(cache_store):
+    first, second = SharedResultCache(), SharedResultCache()
+    assert first.put(SQL, ROWS)
+
+    # Outra réplica (sem o resultado em memória) lê da tabela compartilhada
+    assert second.get(SQL, user_id="") == ROWS
+    assert second.get(SQL) == ROWS
+    assert second.get_stats()["hits_store"] == 1
+    assert second.get_stats()["hits_memory"] == 1
+
+    assert second.get(SQL, {"filial": "SP"}) is None
+
+
+def test_expira_pelo_ttl(cache_store):
+    cache = SharedResultCache(ttl=0, shared_store=False)
+    cache.put(SQL, ROWS)
+    assert cache.get(SQL) is None
+    assert cache.get_stats()["misses"] == 1
+
+
+def test_linhas_devolvidas_sao_copias():
+    cache = SharedResultCache(shared_store=False)
+    cache.put(SQL, ROWS)
+    rows = cache.get(SQL)
+    rows[0]["estado"] = "XX"
+    assert cache.get(SQL)[0]["estado"] == "SP"
@@ -0,0 +1,124 @@
+"""
+Testes do validador SQL por AST (database/sql_ast_validator.py).
+Não acessam BigQuery nem Gemini: a config de tabelas é montada aqui.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("sqlglot")
+
+from database.sql_ast_validator import (  # noqa: E402
+    SQLASTValidator,
+    PARSE_ERROR,
+    MISSING_FINAL_SELECT,
+    UNKNOWN_TABLE,
+    UNKNOWN_COLUMN,
+    UNKNOWN_QUALIFIER,
+)
+
+TABLES_CONFIG = {
+    "vendas": {
+        "metadata": {"bigquery_table": "`proj.ds.vendas`"},
+        "fields": {
+            "dimension_fields": [
+                {"name": "estado", "type": "STRING"},
+                {"name": "modelo", "type": "STRING"},
+                {"name": "cliente", "type": "STRUCT"},
+                {"name": "itens", "type": "ARRAY"},
+            ],
+            "metric_fields": [{"name": "valor_total", "type": "NUMERIC"}],
+            "temporal_fields": [{"name": "data_venda", "type": "STRING", "format": "%Y-%m-%d"}],
+        },
+    }
+}
+
+
+@pytest.fixture
+def validator():
+    return SQLASTValidator(TABLES_CONFIG)
+
+
+def _codes(result):
+    return [d.code for d in result.diagnostics]
+
+
+def test_query_valida(validator):
+    result = validator.validate(
+        "SELECT estado, SUM(valor_total) AS total FROM `proj.ds.vendas` GROUP BY estado"
+    )
+    assert result.is_valid
+    assert result.diagnostics == []
+
+
+def test_coluna_desconhecida(validator):
+    result = validator.validate("SELECT estadoo FROM `proj.ds.vendas`")
+    assert not result.is_valid
+    assert _codes(result) == [UNKNOWN_COLUMN]
+
+
+def test_tabela_desconhecida(validator):
+    result = validator.validate("SELECT estado FROM `proj.ds.outra`")
+    assert not result.is_valid
+    assert _codes(result) == [UNKNOWN_TABLE]
+
+
+def test_erro_de_parse(validator):
+    assert _codes(validator.validate("SELECT FROM")) == [PARSE_ERROR]
+
+
+def test_with_sem_select_final(validator):
+    sql = "WITH base AS (SELECT estado FROM `proj.ds.vendas`)"
+    assert _codes(validator.validate(sql)) == [MISSING_FINAL_SELECT]
+    assert validator.complete_final_select(sql) == f"{sql} SELECT * FROM base"
+
+
+def test_validate_and_fix_renomeia_coluna_quase_correta(validator):
+    fixed_sql, result, applied = validator.validate_and_fix("SELECT estadoo FROM `proj.ds.vendas`")
+    assert fixed_sql == "SELECT estado FROM `proj.ds.vendas`"
+    assert result.is_valid
+    assert [d.code for d in applied] == [UNKNOWN_COLUMN]
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT i.nome FROM `proj.ds.vendas` t, UNNEST(itens) AS i",
+    "SELECT i FROM `proj.ds.vendas` t, UNNEST(t.itens) AS i",
+    "SELECT f.a FROM UNNEST([STRUCT(1 AS a)]) AS f",
+])
+def test_alias_de_unnest(validator, sql):
+    result = validator.validate(sql)
+    assert result.is_valid, result.error_messages()
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT cliente.nome FROM `proj.ds.vendas`",
+    "SELECT t.cliente.nome FROM `proj.ds.vendas` t",
+    "SELECT estado FROM `proj.ds.vendas` WHERE cliente.uf = 'SP'",
+])
+def test_acesso_a_campo_de_struct(validator, sql):
+    result = validator.validate(sql)
+    assert result.is_valid, result.error_messages()
+
+
+def test_qualificador_inexistente_continua_reportado(validator):
+    result = validator.validate("SELECT x.estado FROM `proj.ds.vendas` v")
+    assert _codes(result) == [UNKNOWN_QUALIFIER]
+
+
+def test_renomeia_so_no_escopo_e_qualificador_do_diagnostico(validator):
+    # "estadoo" é alias válido da CTE; só a referência à tabela física está errada
+    sql = (
+        "WITH base AS (SELECT v.estadoo AS estadoo FROM `proj.ds.vendas` v) "
+        "SELECT b.estadoo FROM base b"
+    )
+    fixed_sql, result, applied = validator.validate_and_fix(sql)
+    assert [d.fix["scope"] for d in applied] == ["base"]
+    assert fixed_sql == (
+        "WITH base AS (SELECT v.estado AS estadoo FROM `proj.ds.vendas` AS v) "
+        "SELECT b.estadoo FROM base AS b"
+    )
+    assert result.is_valid
@@ -0,0 +1,81 @@
+"""
+Testes das regras determinísticas do auto-fixer (database/sql_autofix.py).
+As mensagens de erro reproduzem o texto devolvido pelo BigQuery.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("sqlglot")
+
+from database.sql_autofix import SQLAutoFixer, EMPTY_RESULT  # noqa: E402
+
+TABLES_CONFIG = {
+    "vendas": {
+        "metadata": {"bigquery_table": "`proj.ds.vendas`"},
+        "fields": {
+            "dimension_fields": [
+                {"name": "estado", "type": "STRING"},
+                {"name": "modelo", "type": "STRING"},
+            ],
+            "metric_fields": [{"name": "valor_total", "type": "NUMERIC"}],
+            "temporal_fields": [{"name": "data_venda", "type": "STRING", "format": "%Y-%m-%d"}],
+        },
+    }
+}
+
+
+@pytest.fixture
+def fixer():
+    return SQLAutoFixer(TABLES_CONFIG)
+
+
+def test_completa_select_final(fixer):
+    sql = "WITH base AS (SELECT estado FROM `proj.ds.vendas`)"
+    result = fixer.repair(sql, 'Syntax error: Expected "(" or keyword SELECT or keyword WITH but got end of script at [1:48]')
+    assert result.rule == "MISSING_FINAL_SELECT"
+    assert result.sql == f"{sql} SELECT * FROM base"
+
+
+def test_referencia_de_tabela(fixer):
+    result = fixer.repair("SELECT estado FROM vendas", "Not found: Table proj:ds.vendas was not found")
+    assert result.rule == "TABLE_REFERENCE"
+    assert "proj.ds.vendas" in result.sql
+
+
+def test_coluna_fora_do_group_by(fixer):
+    result = fixer.repair(
+        "SELECT estado, SUM(valor_total) FROM `proj.ds.vendas` GROUP BY modelo",
+        "SELECT list expression references column estado which is neither grouped nor aggregated at [1:8]"
+    )
+    assert result.rule == "GROUP_BY_MISMATCH"
+    assert result.sql.endswith("GROUP BY modelo, estado")
+
+
+def test_campo_temporal_string(fixer):
+    result = fixer.repair(
+        "SELECT DATE_TRUNC(data_venda, MONTH) FROM `proj.ds.vendas`",
+        "No matching signature for function DATE_TRUNC for argument types: STRING, DATE_TIME_PART"
+    )
+    assert result.rule == "PARSE_TIMESTAMP"
+    assert "SAFE.PARSE_TIMESTAMP('%F', data_venda)" in result.sql
+
+
+def test_renomeia_coluna(fixer):
+    result = fixer.repair("SELECT estadoo FROM `proj.ds.vendas`", "Unrecognized name: estadoo at [1:8]")
+    assert result.rule == "COLUMN_RENAME"
+    assert result.sql == "SELECT estado FROM `proj.ds.vendas`"
+
+
+def test_literal_sem_caixa_em_resultado_vazio(fixer):
+    result = fixer.repair("SELECT estado FROM `proj.ds.vendas` WHERE modelo = 'Moto X'", EMPTY_RESULT)
+    assert result.rule == "LITERAL_CASE"
+    assert "UPPER(modelo) = 'MOTO X'" in result.sql
+
+
+def test_erro_sem_regra(fixer):
+    assert fixer.repair("SELECT 1", "Quota exceeded") is None
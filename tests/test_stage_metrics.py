@@ -0,0 +1,68 @@
+"""
+Testes dos histogramas por etapa e da exposição Prometheus (utils/stage_metrics.py).
+"""
+
+import os
+import sys
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.stage_metrics import (  # noqa: E402
+    LatencyHistogram,
+    StageMetricsRegistry,
+    get_stage_metrics,
+    start_metrics_server,
+)
+
+
+def test_percentis_com_erro_relativo_pequeno():
+    histogram = LatencyHistogram()
+    for ms in range(1, 1001):
+        histogram.record(ms)
+
+    percentiles = histogram.percentiles()
+    for q, expected in ((0.5, 500), (0.95, 950), (0.99, 990)):
+        assert percentiles[q] == pytest.approx(expected, rel=0.03)
+    snapshot = histogram.snapshot()
+    assert snapshot["count"] == 1000
+    assert snapshot["min_ms"] == 1
+    assert snapshot["max_ms"] == 1000
+    assert snapshot["mean_ms"] == pytest.approx(500.5)
+
+
+def test_time_stage_registra_mesmo_com_excecao():
+    registry = StageMetricsRegistry()
+    with pytest.raises(ValueError):
+        with registry.time_stage("bigquery"):
+            raise ValueError("falhou")
+    assert registry.get_stage_summary()["bigquery"]["count"] == 1
+
+
+def test_exposicao_prometheus():
+    registry = StageMetricsRegistry()
+    registry.observe("rag", 12.5)
+    registry.increment("cache_hits", kind='sql "x"')
+    text = registry.render_prometheus()
+
+    assert "# TYPE ai_pipeline_stage_latency_ms summary" in text
+    assert 'ai_pipeline_stage_latency_ms{quantile="0.5",stage="rag"} ' in text
+    assert 'ai_pipeline_stage_latency_ms_sum{stage="rag"} 12.5' in text
+    assert 'ai_pipeline_stage_latency_ms_count{stage="rag"} 1' in text
+    assert "# TYPE ai_pipeline_cache_hits_total counter" in text
+    assert 'ai_pipeline_cache_hits_total{kind="sql \\"x\\""} 1' in text
+
+
+def test_endpoint_http_metrics():
+    get_stage_metrics().observe("teste_endpoint", 3)
+    server = start_metrics_server(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            body = response.read().decode("utf-8")
+            assert response.headers["Content-Type"].startswith("text/plain")
+    finally:
+        server.shutdown()
+    assert 'ai_pipeline_stage_latency_ms_count{stage="teste_endpoint"} 1' in body
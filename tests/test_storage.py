@@ -0,0 +1,84 @@
+"""
+Testes dos backends de armazenamento (utils/storage.py) e da migração entre
+eles (tools/migrate_storage.py), só com DuckDB e SQLite locais.
+"""
+
+import os
+import sys
+import uuid
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.migrate_storage import STORE_TABLES, migrate_store  # noqa: E402
+from utils.storage import get_storage  # noqa: E402
+from utils.user_database import UserDatabase  # noqa: E402
+
+ROWS = [{"estado": f"UF{n}", "total": n * 1.5} for n in range(5)]
+
+
+def _dump(backend, table):
+    rows = backend.cursor().execute(f"SELECT * FROM {table}").fetchall()
+    return sorted((tuple(str(value) for value in row) for row in rows))
+
+
+def test_sqlite_mesmo_comportamento_do_duckdb(tmp_path):
+    for url in (str(tmp_path / "users.db"), f"sqlite:///{tmp_path / 'users.sqlite'}"):
+        db = UserDatabase(url)
+        assert db.create_user("alice", "alice@x.com", "senha")[0]
+        ok, user = db.authenticate_user("alice", "senha")
+        assert ok and user["email"] == "alice@x.com"
+        assert db.get_user_subscription(user["id"])["plan_id"] == "free"
+        assert [db.try_consume_daily_usage(user["id"], 2)[0] for _ in range(3)] == [True, True, False]
+
+
+def test_limite_diario_com_varios_gravadores(tmp_path):
+    # Duas instâncias = dois processos: o contador em memória de cada uma não é autoritativo
+    url = f"sqlite:///{tmp_path / 'users.sqlite'}"
+    first, second = UserDatabase(url), UserDatabase(url)
+    user_id = str(uuid.uuid4())
+
+    admitted = 0
+    for _ in range(6):
+        admitted += first.try_consume_daily_usage(user_id, 7)[0]
+        admitted += second.try_consume_daily_usage(user_id, 7)[0]
+    assert admitted == 7
+    assert first._load_usage(user_id, date.today().isoformat()) == 7
+
+
+def test_migracao_duckdb_sqlite_duckdb(tmp_path, cache_store):
+    cache = cache_store
+    user_id = str(uuid.uuid4())
+    cache.save_interaction(user_id, "vendas por estado", raw_data=ROWS)
+    cache.save_interaction(user_id, "oi")
+    users = UserDatabase(str(tmp_path / "users.db"))
+    assert users.create_user("bob", "bob@x.com", "senha")[0]
+    users.try_consume_daily_usage(users.get_user_by_username("bob")["id"], 10)
+
+    sources = {"cache": cache._db.db_path, "users": str(tmp_path / "users.db")}
+    for store, source in sources.items():
+        sqlite_url = f"sqlite:///{tmp_path / (store + '.sqlite')}"
+        round_trip = str(tmp_path / f"{store}_volta.db")
+        assert migrate_store(store, sqlite_url, source_url=source)
+        assert migrate_store(store, round_trip, source_url=sqlite_url)
+
+        for table in STORE_TABLES[store]:
+            original = _dump(get_storage(source), table)
+            assert _dump(get_storage(round_trip), table) == original, table
+
+    for store, table, expected in (("cache", "user_interactions", 2), ("cache", "interaction_payloads", 1),
+                                   ("users", "users", 1), ("users", "daily_usage", 1)):
+        assert len(_dump(get_storage(str(tmp_path / f"{store}_volta.db")), table)) == expected
+
+
+def test_mesmo_banco_nao_e_migrado(tmp_path):
+    path = str(tmp_path / "users.db")
+    UserDatabase(path)
+    assert not migrate_store("users", path, source_url=path)
+
+
+def test_backend_desconhecido():
+    with pytest.raises(ValueError):
+        get_storage("mysql://localhost/app")
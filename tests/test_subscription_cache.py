@@ -0,0 +1,57 @@
+"""
+Testes do cache de assinaturas (utils/subscription_system_db.py).
+"""
+
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("streamlit")
+
+from utils import subscription_system_db  # noqa: E402
+from utils.subscription_system_db import SubscriptionSystem  # noqa: E402
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Conta as consultas ao banco; `fail` simula o banco indisponível"""
+    state = {"calls": 0, "fail": False, "subscription": None}
+
+    def get_user_subscription(user_id, raise_errors=False):
+        state["calls"] += 1
+        if state["fail"]:
+            raise RuntimeError("banco indisponível")
+        return state["subscription"]
+
+    monkeypatch.setattr(subscription_system_db.db, "get_user_subscription", get_user_subscription)
+    SubscriptionSystem.invalidate_cache()
+    yield state
+    SubscriptionSystem.invalidate_cache()
+
+
+def test_sem_assinatura_confirmada_e_cacheada(lookups):
+    user_id = str(uuid.uuid4())
+    assert SubscriptionSystem.get_user_subscription_info(user_id)["plan_id"] == "free"
+    assert SubscriptionSystem.get_user_subscription_info(user_id)["plan_id"] == "free"
+    assert lookups["calls"] == 1
+
+
+def test_falha_do_banco_nao_cacheia_o_plano_gratuito(lookups):
+    user_id = str(uuid.uuid4())
+    lookups["fail"] = True
+    assert SubscriptionSystem.get_user_subscription_info(user_id)["plan_id"] == "free"
+
+    lookups["fail"] = False
+    lookups["subscription"] = {
+        "subscription_id": "s1", "plan_id": "premium", "plan_name": "Premium",
+        "plan_description": "", "plan_price": 10, "daily_limit": -1, "features": "[]",
+        "priority_support": True, "start_date": None, "end_date": None,
+    }
+    info = SubscriptionSystem.get_user_subscription_info(user_id)
+    assert info["plan_id"] == "premium"
+    assert info["daily_limit"] == -1
+    assert lookups["calls"] == 2
@@ -0,0 +1,58 @@
+"""
+Testes da detecção de tabela do SQLValidatorv2 (database/sql_validator_v2.py).
+"""
+
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.sql_validator_v2 import SQLValidatorv2, SCORE_FROM  # noqa: E402
+
+TABLES_CONFIG = {
+    "vendas": {
+        "metadata": {"bigquery_table": "`proj.ds.vendas`"},
+        "fields": {"dimension_fields": [{"name": "estado", "type": "STRING"}]},
+    },
+    "clientes": {
+        "metadata": {"bigquery_table": "`proj.ds.clientes`"},
+        "fields": {"dimension_fields": [{"name": "nome", "type": "STRING"}]},
+    },
+}
+
+
+@pytest.fixture
+def validator(tmp_path):
+    path = tmp_path / "tables_config.json"
+    path.write_text(json.dumps(TABLES_CONFIG), encoding="utf-8")
+    return SQLValidatorv2(str(path))
+
+
+def test_from_vence_join(validator):
+    sql = "SELECT v.estado FROM `proj.ds.clientes` c JOIN `proj.ds.vendas` v ON v.id = c.id"
+    assert validator.detect_table_from_sql(sql) == ("clientes", SCORE_FROM)
+    # Sem AST: mesma escolha pelo matcher pré-compilado
+    scores = validator._detect_tables_regex(sql)
+    assert scores["clientes"] == SCORE_FROM
+    assert scores["vendas"] < SCORE_FROM
+
+
+def test_nome_de_cte_nao_e_tabela(validator):
+    sql = "WITH clientes AS (SELECT estado FROM `proj.ds.vendas`) SELECT * FROM clientes"
+    assert validator.detect_table_from_sql(sql) == ("vendas", SCORE_FROM)
+
+
+def test_sql_invalida_usa_o_matcher_por_regex(validator):
+    sql = "SELECT estado FROM `proj.ds.vendas` WHERE ("
+    assert validator.detect_table_from_sql(sql) == ("vendas", SCORE_FROM)
+    assert validator.detect_table_from_sql("SELECT 1") == (None, 0)
+
+
+def test_resultado_cacheado_por_sql(validator, monkeypatch):
+    sql = "SELECT estado FROM `proj.ds.vendas`"
+    first = validator.detect_table_from_sql(sql)
+    monkeypatch.setattr(validator, "_detect_tables_ast", lambda sql: pytest.fail("deveria vir do cache"))
+    assert validator.detect_table_from_sql(sql) == first
@@ -0,0 +1,75 @@
+"""
+Testes dos spans aninhados e da exportação Chrome Trace (utils/tracing.py).
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.stage_metrics import get_stage_metrics  # noqa: E402
+from utils.tracing import Tracer  # noqa: E402
+
+
+@pytest.fixture
+def tracer(tmp_path):
+    return Tracer(enabled=True, export_path=str(tmp_path / "traces.json"), slow_ms=0)
+
+
+def _spans_by_name(trace):
+    return {span["name"]: span for span in trace["spans"]}
+
+
+def test_spans_aninhados_e_threads_herdam_o_pai(tracer):
+    def work():
+        with tracer.span("bigquery"):
+            pass
+
+    with tracer.span("request") as root:
+        with tracer.span("rag", table="vendas"):
+            pass
+        tracer.start_thread(work).join()
+        with tracer.span("bigquery.execute"):
+            tracer.set_attribute("bytes_processed", 10)
+        root.set_attribute("retries", 0)
+
+    trace = tracer.get_recent_traces()[-1]
+    spans = _spans_by_name(trace)
+    root_id = spans["request"]["span_id"]
+    assert trace["name"] == "request"
+    assert spans["rag"]["parent_id"] == root_id
+    assert spans["rag"]["attributes"] == {"table": "vendas"}
+    assert spans["bigquery.execute"]["attributes"] == {"bytes_processed": 10}
+    assert spans["bigquery"]["parent_id"] == root_id
+    assert spans["bigquery"]["thread"] != spans["request"]["thread"]
+
+
+def test_excecao_marca_erro_e_exporta(tracer):
+    with pytest.raises(RuntimeError):
+        with tracer.span("request"):
+            with tracer.span("gemini"):
+                raise RuntimeError("cota")
+
+    spans = _spans_by_name(tracer.get_recent_traces()[-1])
+    assert spans["gemini"]["status"] == "error"
+    assert spans["request"]["status"] == "error"
+
+    # JSON Array do Chrome Trace sem o ']' final
+    with open(tracer.export_path, encoding="utf-8") as f:
+        events = json.loads(f.read().rstrip().rstrip(",") + "]")
+    complete = [e for e in events if e["ph"] == "X"]
+    assert {e["name"] for e in complete} == {"request", "gemini"}
+    assert any(e["ph"] == "M" and e["name"] == "thread_name" for e in events)
+
+
+def test_desligado_nao_exporta_mas_alimenta_histograma(tmp_path):
+    tracer = Tracer(enabled=False, export_path=str(tmp_path / "traces.json"))
+    with tracer.span("request", stage="teste_tracing_desligado") as span:
+        span.set_attribute("ignorado", True)
+
+    assert tracer.get_recent_traces() == []
+    assert not os.path.exists(tracer.export_path)
+    assert get_stage_metrics().get_stage_summary()["teste_tracing_desligado"]["count"] == 1
@@ -0,0 +1,69 @@
+"""
+Testes de sessões concorrentes sobre o banco de usuários
+(utils/user_database.py: um cursor por thread sobre o handle do processo).
+"""
+
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.user_database import UserDatabase  # noqa: E402
+
+SESSIONS = 20
+
+
+@pytest.fixture
+def db(tmp_path):
+    return UserDatabase(str(tmp_path / "users.db"))
+
+
+def test_cursor_por_thread(db):
+    assert db.conn is db.conn
+    cursors = {}
+
+    def grab(i):
+        cursors[i] = db.conn
+
+    threads = [threading.Thread(target=grab, args=(i,)) for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len({id(cursor) for cursor in cursors.values()} | {id(db.conn)}) == 4
+
+
+def test_sessoes_concorrentes(db):
+    def session(i):
+        ok, message = db.create_user(f"user{i}", f"user{i}@x.com", "senha")
+        assert ok, message
+        ok, user = db.authenticate_user(f"user{i}@x.com", "senha")
+        assert ok
+        assert db.assign_plan_to_user(user["id"], "basic")
+        return user["id"]
+
+    with ThreadPoolExecutor(max_workers=SESSIONS) as executor:
+        user_ids = list(executor.map(session, range(SESSIONS)))
+
+    assert len(set(user_ids)) == SESSIONS
+    for user_id in user_ids:
+        assert db.get_user_subscription(user_id)["plan_id"] == "basic"
+
+
+def test_troca_de_plano_concorrente_deixa_uma_assinatura_ativa(db):
+    assert db.create_user("alice", "alice@x.com", "senha")[0]
+    user_id = db.get_user_by_username("alice")["id"]
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda plan: db.assign_plan_to_user(user_id, plan),
+                                    ["basic", "premium"] * 4))
+
+    assert any(results)
+    active = db.conn.execute(
+        "SELECT COUNT(*) FROM user_subscriptions WHERE user_id = ? AND status = 'active'", [user_id]
+    ).fetchone()[0]
+    assert active == 1
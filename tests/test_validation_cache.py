@@ -0,0 +1,38 @@
+"""
+Testes do fingerprint de SQL e do cache de validação (database/validation_cache.py).
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.validation_cache import ValidationCache, sql_fingerprint, _scan_tokens  # noqa: E402
+
+LIKE_2023 = "SELECT * FROM t WHERE modelo LIKE '%--%' AND ano = 2023"
+LIKE_2024 = "SELECT * FROM t WHERE modelo LIKE '%--%' AND ano = 2024"
+
+
+@pytest.mark.parametrize("fingerprint", [sql_fingerprint, _scan_tokens])
+def test_literais_diferentes_nao_colidem(fingerprint):
+    assert fingerprint("SELECT 'a  b'") != fingerprint("SELECT 'a b'")
+    assert fingerprint(LIKE_2023) != fingerprint(LIKE_2024)
+
+
+@pytest.mark.parametrize("fingerprint", [sql_fingerprint, _scan_tokens])
+def test_comentarios_e_espacos_ignorados(fingerprint):
+    variant = LIKE_2023.replace(" AND", "  -- filtro\n  AND") + " /* fim */ ;"
+    assert fingerprint(variant) == fingerprint(LIKE_2023)
+
+
+def test_query_cacheada_nao_vaza_para_outro_texto():
+    cache = ValidationCache()
+    cache.put("SELECT 1", "stage", {"valid": True, "query": "SELECT 1"})
+    assert cache.get("SELECT  1 -- x", "stage")["query"] == "SELECT  1 -- x"
+
+    # Correção feita sobre outro texto: miss, nunca a SQL corrigida de outra query
+    cache.put("SELECT 2", "stage", {"valid": True, "query": "SELECT 2 LIMIT 5"})
+    assert cache.get("SELECT 2 ", "stage") is None
+    assert cache.get("SELECT 2", "stage")["query"] == "SELECT 2 LIMIT 5"
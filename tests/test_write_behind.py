@@ -0,0 +1,119 @@
+"""
+Testes da fila write-behind (utils/write_behind.py): journal antes da fila,
+releitura após crash, isolamento de linhas com erro e quarentena.
+"""
+
+import os
+import sys
+import json
+import uuid
+import threading
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.write_behind import WriteBehindQueue  # noqa: E402
+
+
+def _lines(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def _journal(path, payloads, sink="sink"):
+    with open(path, "a", encoding="utf-8") as f:
+        for payload in payloads:
+            f.write(json.dumps({"id": uuid.uuid4().hex, "sink": sink, "payload": payload}) + "\n")
+
+
+@pytest.fixture
+def spool(tmp_path):
+    return str(tmp_path / "spool.jsonl")
+
+
+def test_item_vai_para_o_journal_antes_da_fila_e_sobrevive_a_crash(spool):
+    release = threading.Event()
+    crashed = WriteBehindQueue(spool_path=spool, flush_interval=0.01, enabled=True)
+    crashed.register_sink("sink", lambda payloads: release.wait(5))
+    crashed.enqueue("sink", {"n": 1})
+    assert [e["payload"] for e in _lines(spool) if "sink" in e] == [{"n": 1}]
+
+    # Novo processo sobre o mesmo journal: o item sem ack é regravado
+    written = []
+    restarted = WriteBehindQueue(spool_path=spool, enabled=True)
+    restarted.register_sink("sink", written.extend)
+    assert restarted.replay_spool() == 1
+    assert written == [{"n": 1}]
+    assert restarted.replay_spool() == 0
+    release.set()
+    crashed.shutdown()
+
+
+def test_ack_compacta_o_journal(spool):
+    written = []
+    q = WriteBehindQueue(spool_path=spool, flush_interval=0.01, enabled=True)
+    q.register_sink("sink", written.extend)
+    for n in range(5):
+        q.enqueue("sink", {"n": n})
+    assert q.flush()
+    q.shutdown()
+    assert sorted(p["n"] for p in written) == list(range(5))
+    assert q.replay_spool() == 0
+    assert _lines(spool) == []
+
+
+def test_linha_com_erro_nao_bloqueia_o_lote_e_vai_para_quarentena(spool):
+    written = []
+
+    def sink(payloads):
+        if any(p.get("bad") for p in payloads):
+            raise ValueError("linha inválida")
+        written.extend(payloads)
+
+    _journal(spool, [{"n": 1}, {"n": 2, "bad": True}, {"n": 3}])
+    q = WriteBehindQueue(spool_path=spool, max_attempts=2, enabled=True)
+    q.register_sink("sink", sink)
+
+    q.replay_spool()
+    assert [p["n"] for p in written] == [1, 3]
+    assert q.get_stats()["quarantined"] == 0
+
+    q.replay_spool()
+    assert q.get_stats()["quarantined"] == 1
+    assert [e["payload"]["n"] for e in _lines(q.quarantine_path)] == [2]
+    assert q.replay_spool() == 0
+    assert [p["n"] for p in written] == [1, 3]
+
+
+def test_sink_desconhecido_continua_no_journal(spool):
+    _journal(spool, [{"n": 1}], sink="outro")
+    q = WriteBehindQueue(spool_path=spool, enabled=True)
+    q.register_sink("sink", lambda payloads: None)
+    assert q.replay_spool() == 0
+    assert [e["sink"] for e in _lines(spool)] == ["outro"]
+
+
+def test_modo_sincrono_grava_no_journal_so_o_que_falha(spool):
+    q = WriteBehindQueue(spool_path=spool, enabled=False)
+    q.register_sink("ok", lambda payloads: None)
+    q.register_sink("falha", lambda payloads: 1 / 0)
+    q.enqueue("ok", {"n": 1})
+    q.enqueue("falha", {"n": 2})
+    assert [e["payload"] for e in _lines(spool)] == [{"n": 2}]
+
+
+def test_sinks_do_cache_sao_idempotentes(cache_store):
+    cache = cache_store
+    error_id = str(uuid.uuid4())
+    payload = {"id": error_id, "user_id": "u1", "timestamp": datetime.now().isoformat(),
+               "error_type": "X", "error_message": "m", "context": "c", "traceback": "t"}
+    # Releitura do journal reenvia um item já gravado (ex.: crash antes do ack)
+    cache._write_errors_batch([payload])
+    cache._write_errors_batch([payload, dict(payload, id=str(uuid.uuid4()))])
+    with cache.get_connection() as conn:
+        count = conn.execute("SELECT COUNT(*) FROM log_erros WHERE id = ?", (error_id,)).fetchone()[0]
+    assert count == 1
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+BENCHMARK DO BANCO DE USUÁRIOS (users_new.db)
+Simula N sessões Streamlit concorrentes (uma thread por sessão) fazendo login,
+lendo a assinatura e consumindo consultas do limite diário
+
+Uso:
+    python tools/bench_user_db.py                       # 50 sessões, banco temporário
+    python tools/bench_user_db.py --sessions 100 --queries 40
+    python tools/bench_user_db.py --shared-connection   # uma conexão para todas as threads (modelo antigo)
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run_benchmark(db_path: str, sessions: int, queries: int, daily_limit: int, shared_connection: bool) -> Dict:
+    from utils.user_database import UserDatabase
+    from utils.write_behind import write_behind
+
+    if shared_connection:
+        class SharedConnectionDatabase(UserDatabase):
+            """Todas as threads na mesma conexão, como antes dos cursores por thread"""
+            @property
+            def conn(self):
+                return self._db._root()
+
+        database = SharedConnectionDatabase(db_path)
+        database._db.execute = lambda name, params=(): database.conn.execute(database._db.statements[name], params)
+    else:
+        database = UserDatabase(db_path)
+
+    database.conn.execute(
+        "INSERT INTO subscription_plans (id, name, description, price, daily_limit, features) "
+        "VALUES ('bench', 'Bench', 'Plano do benchmark', 0, ?, '[]') ON CONFLICT DO NOTHING",
+        [daily_limit]
+    )
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    allowed_by_user: Dict[str, int] = {}
+    lock = threading.Lock()
+    barrier = threading.Barrier(sessions)
+
+    def timed(op: str, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as e:
+            with lock:
+                errors[f"{op}: {type(e).__name__}"] += 1
+            return None
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies[op].append(elapsed)
+
+    def session(index: int) -> None:
+        username = f"bench_{index}"
+        barrier.wait()
+
+        created = timed("create_user", database.create_user, username, f"{username}@bench.local", "senha123")
+        if not created or not created[0]:
+            with lock:
+                errors[f"create_user: {created[1] if created else 'erro'}"] += 1
+            return
+        auth = timed("authenticate", database.authenticate_user, username, "senha123")
+        if not auth or not auth[0]:
+            with lock:
+                errors["authenticate: falhou"] += 1
+            return
+        user_id = auth[1]["id"]
+        timed("assign_plan", database.assign_plan_to_user, user_id, "bench")
+
+        allowed = 0
+        for _ in range(queries):
+            timed("get_subscription", database.get_user_subscription, user_id)
+            result = timed("consume_usage", database.try_consume_daily_usage, user_id, daily_limit)
+            if result and result[0]:
+                allowed += 1
+            timed("get_usage", database.get_daily_usage, user_id)
+        with lock:
+            allowed_by_user[user_id] = allowed
+
+    threads = [threading.Thread(target=session, args=(i,), name=f"sessao-{i}") for i in range(sessions)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    write_behind.flush()
+    elapsed = time.perf_counter() - start
+
+    # Confere o que chegou ao banco contra os contadores em memória
+    expected = min(queries, daily_limit)
+    persisted = {
+        row[0]: row[1] for row in database.conn.execute(
+            "SELECT user_id, SUM(query_count) FROM daily_usage GROUP BY user_id"
+        ).fetchall()
+    }
+    active = database.conn.execute("""
+        SELECT COUNT(*) FROM (
+            SELECT user_id FROM user_subscriptions WHERE status = 'active'
+            GROUP BY user_id HAVING COUNT(*) > 1
+        )
+    """).fetchone()[0]
+    mismatches = sum(
+        1 for user_id, allowed in allowed_by_user.items()
+        if allowed != expected or persisted.get(user_id, 0) != allowed
+    )
+    database.close()
+
+    total_ops = sum(len(v) for v in latencies.values())
+    return {
+        "elapsed_s": elapsed,
+        "ops": total_ops,
+        "ops_per_s": total_ops / elapsed if elapsed else 0.0,
+        "latencies": latencies,
+        "errors": dict(errors),
+        "sessions_ok": len(allowed_by_user),
+        "usage_mismatches": mismatches,
+        "duplicate_active_subscriptions": active,
+    }
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark de logins e consumo de uso concorrentes (users_new.db)")
+    parser.add_argument("--sessions", type=int, default=50, help="Sessões concorrentes (padrão: 50)")
+    parser.add_argument("--queries", type=int, default=20, help="Consultas por sessão (padrão: 20)")
+    parser.add_argument("--daily-limit", type=int, default=15, help="Limite diário do plano de teste (padrão: 15)")
+    parser.add_argument("--db", type=str, help="Arquivo do banco (padrão: temporário, removido ao final)")
+    parser.add_argument("--shared-connection", action="store_true",
+                        help="Uma única conexão para todas as threads (modelo anterior)")
+
+    args = parser.parse_args()
+
+    temp_dir = None
+    db_path = args.db
+    if not db_path:
+        temp_dir = tempfile.mkdtemp(prefix="bench_user_db_")
+        db_path = os.path.join(temp_dir, "users_bench.db")
+
+    try:
+        mode = "conexão compartilhada" if args.shared_connection else "cursor por thread"
+        print(f"🏁 {args.sessions} sessões x {args.queries} consultas ({mode}) em {db_path}")
+        result = run_benchmark(db_path, args.sessions, args.queries, args.daily_limit, args.shared_connection)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print(f"\n⏱️  {result['elapsed_s']:.2f}s, {result['ops']} operações ({result['ops_per_s']:.0f} ops/s)")
+    print(f"{'operação':<18}{'n':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}")
+    for op, values in result["latencies"].items():
+        print(f"{op:<18}{len(values):>7}{_percentile(values, 50):>10.2f}"
+              f"{_percentile(values, 95):>10.2f}{max(values):>10.2f}")
+
+    print(f"\n👥 Sessões concluídas: {result['sessions_ok']}/{args.sessions}")
+    print(f"📊 Divergências de uso (memória x banco x limite): {result['usage_mismatches']}")
+    print(f"📋 Usuários com mais de uma assinatura ativa: {result['duplicate_active_subscriptions']}")
+    if result["errors"]:
+        print("❌ Erros:")
+        for error, count in sorted(result["errors"].items(), key=lambda item: -item[1]):
+            print(f"   {count:>5}  {error}")
+    else:
+        print("✅ Nenhum erro")
+
+    failed = result["errors"] or result["usage_mismatches"] or result["duplicate_active_subscriptions"]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
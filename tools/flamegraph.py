@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+FLAMEGRAPH DE PERFIS POR REQUISIÇÃO
+Renderiza os perfis gravados em cache.db (request_profiles) pelo profiler
+por amostragem (utils/profiler.py)
+
+Uso:
+    python tools/flamegraph.py --list
+    python tools/flamegraph.py <profile_id|interaction_id> -o perfil.svg
+    python tools/flamegraph.py <id> --folded > perfil.folded   # flamegraph.pl / speedscope
+    python tools/flamegraph.py <id> --top 20                   # funções com mais tempo próprio
+"""
+
+import os
+import sys
+import html
+from collections import Counter
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SVG_WIDTH = 1200
+FRAME_HEIGHT = 16
+FONT_SIZE = 11
+MIN_WIDTH_PX = 0.3
+
+
+def parse_collapsed(stacks: str) -> List[Tuple[List[str], int]]:
+    """Linhas 'a;b;c N' -> [(['a', 'b', 'c'], N)]"""
+    parsed = []
+    for line in (stacks or "").splitlines():
+        stack, _, count = line.rpartition(" ")
+        if stack and count.isdigit():
+            parsed.append((stack.split(";"), int(count)))
+    return parsed
+
+
+def _build_tree(parsed: List[Tuple[List[str], int]]) -> Dict:
+    root = {"name": "all", "value": 0, "children": {}}
+    for frames, count in parsed:
+        root["value"] += count
+        node = root
+        for name in frames:
+            child = node["children"].setdefault(name, {"name": name, "value": 0, "children": {}})
+            child["value"] += count
+            node = child
+    return root
+
+
+def _color(name: str) -> str:
+    # Cor estável por função (tons quentes, como no flamegraph.pl)
+    h = sum(ord(c) for c in name)
+    return f"rgb({205 + h % 50},{80 + (h * 7) % 130},{40 + (h * 13) % 40})"
+
+
+def render_svg(stacks: str, title: str = "Flame Graph") -> str:
+    """SVG autocontido (tooltip via <title>) das pilhas colapsadas"""
+    root = _build_tree(parse_collapsed(stacks))
+    total = root["value"] or 1
+    scale = (SVG_WIDTH - 20) / total
+
+    rects = []
+    max_depth = 0
+
+    def walk(node: Dict, x: float, depth: int) -> None:
+        nonlocal max_depth
+        width = node["value"] * scale
+        if width < MIN_WIDTH_PX:
+            return
+        max_depth = max(max_depth, depth)
+        rects.append((node["name"], node["value"], x, depth, width))
+        child_x = x
+        for child in sorted(node["children"].values(), key=lambda c: c["name"]):
+            walk(child, child_x, depth + 1)
+            child_x += child["value"] * scale
+
+    walk(root, 10, 0)
+    height = (max_depth + 1) * FRAME_HEIGHT + 50
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_WIDTH}" height="{height}" '
+        f'font-family="monospace" font-size="{FONT_SIZE}">',
+        f'<rect width="100%" height="100%" fill="#f8f8f8"/>',
+        f'<text x="{SVG_WIDTH / 2}" y="20" text-anchor="middle" font-size="14">{html.escape(title)}</text>',
+    ]
+    for name, value, x, depth, width in rects:
+        y = height - 10 - (depth + 1) * FRAME_HEIGHT
+        pct = value * 100 / total
+        label = html.escape(name)
+        chars = int(width / (FONT_SIZE * 0.6))
+        text = label if len(name) <= chars else (html.escape(name[:chars - 2]) + ".." if chars > 3 else "")
+        parts.append(
+            f'<g><title>{label} ({value} amostras, {pct:.1f}%)</title>'
+            f'<rect x="{x:.2f}" y="{y}" width="{width:.2f}" height="{FRAME_HEIGHT - 1}" '
+            f'fill="{_color(name)}" rx="2"/>'
+            + (f'<text x="{x + 3:.2f}" y="{y + FRAME_HEIGHT - 4}">{text}</text>' if text else "")
+            + '</g>'
+        )
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def top_self_time(stacks: str, limit: int = 20) -> List[Tuple[str, int]]:
+    """Funções no topo da pilha com mais amostras (tempo próprio)"""
+    counts = Counter()
+    for frames, count in parse_collapsed(stacks):
+        counts[frames[-1]] += count
+    return counts.most_common(limit)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Flamegraph dos perfis de requisição (cache.db)")
+    parser.add_argument("id", nargs="?", help="Id do perfil ou da interação")
+    parser.add_argument("--list", action="store_true", help="Listar perfis recentes")
+    parser.add_argument("--user", type=str, help="Filtrar --list por usuário")
+    parser.add_argument("--limit", type=int, default=20, help="Quantidade em --list (padrão: 20)")
+    parser.add_argument("-o", "--output", type=str, help="Arquivo SVG de saída (padrão: profile_<id>.svg)")
+    parser.add_argument("--folded", action="store_true", help="Imprimir pilhas colapsadas na saída padrão")
+    parser.add_argument("--top", type=int, help="Mostrar as N funções com mais tempo próprio")
+
+    args = parser.parse_args()
+
+    from utils.cache import init_cache_db, get_profile, list_profiles
+    init_cache_db()
+
+    if args.list or not args.id:
+        profiles = list_profiles(limit=args.limit, user_id=args.user)
+        if not profiles:
+            print("Nenhum perfil encontrado")
+            return
+        for p in profiles:
+            question = (p["question"] or "")[:60]
+            print(f"{p['id']}  {p['timestamp']}  {p['duration_ms'] or 0:>9.1f}ms  "
+                  f"{p['sample_count'] or 0:>5} amostras  [{p['trigger']}]  {p['user_id']}  {question}")
+        return
+
+    profile = get_profile(args.id)
+    if not profile:
+        print(f"❌ Perfil não encontrado: {args.id}")
+        sys.exit(1)
+
+    if args.folded:
+        print(profile["stacks"] or "")
+        return
+
+    if args.top:
+        total = profile["sample_count"] or 1
+        for name, count in top_self_time(profile["stacks"], args.top):
+            print(f"{count:>6}  {count * 100 / total:5.1f}%  {name}")
+        return
+
+    output = args.output or f"profile_{profile['id']}.svg"
+    title = f"{(profile['question'] or '')[:80]} — {profile['duration_ms']}ms, {profile['sample_count']} amostras"
+    with open(output, "w", encoding="utf-8") as f:
+        f.write(render_svg(profile["stacks"], title))
+    print(f"✅ Flamegraph gravado em {output}")
+
+
+if __name__ == "__main__":
+    main()
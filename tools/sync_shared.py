@@ -55,6 +55,7 @@ class SharedFileSyncer:
         "cache.ann",                  # Embeddings
         "cache.meta.json",            # Metadados cache
         "rate_limit_state.json",      # Estado local
+        "rate_limit.db",              # Estado do rate limit
     }
     
     def __init__(self, source: str, targets: List[str]):
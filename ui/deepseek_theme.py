@@ -2425,6 +2425,7 @@ def get_step_display_info(step_name: str) -> tuple[str, str]:
         'preparando_dados_reuso': ('Organizando dados anteriores', '🔄'),
         'refinamento_gemini_reuso': ('Refinando resposta com IA', '✨'),
         'finalizacao_reuso': ('Finalizando processo', '✅'),
+        'refino_local': ('Refinando o resultado anterior', '🔎'),
         
         # Fluxo nova consulta
         'preparando_conversa_gemini': ('Preparando contexto', '💬'),
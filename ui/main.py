@@ -65,7 +65,7 @@ try:
 except Exception as e:
     print(f"❌ Erro ao inicializar cache_db: {e}")
 
-# Configuração do rate limit (100 requisições por dia)
+# Rate limit: MAX_REQUEST_DAY global + limites de rajada por plano (SQLite WAL)
 rate_limiter = RateLimiter(max_requests_per_day=MAX_RATE_LIMIT)
 
 # Configuração inicial
@@ -175,6 +175,12 @@ with st.sidebar:
             from utils.auth_system import logout_user
             if st.button("🚪", key="unique_logout", help="Sair"):
                 logout_user()
+        
+        # 5. PROFILING (apenas admins em PROFILING_ADMIN_EMAILS)
+        from utils.profiler import is_profiling_admin
+        if is_profiling_admin(current_user.get('email')):
+            st.toggle("🔬 Perfilar perguntas", key="admin_profiling",
+                      help="Grava pilhas amostradas de cada pergunta (tools/flamegraph.py)")
     else:
         st.error("❌ Sessão expirada. Faça login novamente.")
         st.stop()
@@ -294,26 +300,35 @@ if prompt:
     # Verifica permissão para nova query
     current_user = get_current_user()
     if current_user:
-        if is_empresarial_mode():
-            # Modo empresarial: verifica limite mas não mostra planos
-            can_proceed, message = SubscriptionSystem.check_query_permission(current_user['id'])
-            if not can_proceed:
-                st.warning("⚠️ Limite diário de consultas atingido. Tente novamente amanhã.")
+        # Ordem: cota diária do plano (só leitura) -> limites de rajada por
+        # usuário/plano e global (consome, compartilhado entre processos) ->
+        # cota diária do plano (consome). Pergunta barrada por um não gasta o outro.
+        can_proceed, message = SubscriptionSystem.check_query_permission(current_user['id'])
+        if can_proceed:
+            rate_decision = rate_limiter.acquire(current_user['id'], subscription_info.get('plan_id'))
+            if not rate_decision['allowed']:
+                if rate_decision['reason'] == "global_daily":
+                    st.warning("⚠️ Limite diário de perguntas do sistema atingido. Tente novamente amanhã.")
+                else:
+                    st.warning(f"⏳ Muitas perguntas em sequência. Tente novamente em {int(rate_decision['retry_after']) + 1}s.")
                 st.stop()
-            # Incrementa uso do usuário
-            SubscriptionSystem.increment_user_usage(current_user['id'])
-        else:
-            # Modo normal: verifica limite e oferece upgrade
-            can_proceed, message = SubscriptionSystem.check_query_permission(current_user['id'])
-            
+
+            # Verifica e consome o limite (atômico)
+            can_proceed, message = SubscriptionSystem.consume_query_permission(current_user['id'])
             if not can_proceed:
+                # Outra sessão levou o último slot do plano entre a verificação e o consumo
+                rate_limiter.release(current_user['id'], subscription_info.get('plan_id'))
+
+        if not can_proceed:
+            if is_empresarial_mode():
+                # Modo empresarial: não mostra planos
+                st.warning("⚠️ Limite diário de consultas atingido. Tente novamente amanhã.")
+            else:
+                # Modo normal: oferece upgrade
                 st.warning(message)
                 if st.button("💎 Ver Planos", key="upgrade_from_chat"):
                     st.switch_page("pages/planos.py")
-                st.stop()
-            
-            # Incrementa uso do usuário
-            SubscriptionSystem.increment_user_usage(current_user['id'])
+            st.stop()
     else:
         st.error("❌ Usuário não autenticado")
         st.stop()
@@ -338,8 +353,13 @@ if prompt:
     print(f"📋 [MAIN] Antes de process_message: temp_response={st.session_state.get('temp_response')}")
     print(f"{'='*80}")
     
-    # Processa a mensagem
-    handler.process_message(prompt, typing_placeholder)
+    # Processa a mensagem (?profile=1 na URL ou toggle de admin ligam o profiler)
+    handler.process_message(
+        prompt,
+        typing_placeholder,
+        profile_requested=st.query_params.get("profile") in ("1", "true"),
+        admin_profiling=st.session_state.get("admin_profiling", False)
+    )
     
     print(f"{'='*80}")
     print(f"🔍 [MAIN] Depois de process_message:")
@@ -68,10 +68,15 @@ def setup_empresarial_plan(user_id):
     except Exception as e:
         print(f"❌ Erro ao configurar plano empresarial: {e}")
 
+_empresarial_user_checked = False
+
 def ensure_empresarial_user():
     """Garante que o usuário empresarial existe (mas não faz login automático)"""
-    if not is_empresarial_mode():
+    global _empresarial_user_checked
+    # Uma verificação por processo (antes: consultas ao banco a cada rerun)
+    if not is_empresarial_mode() or _empresarial_user_checked:
         return
+    _empresarial_user_checked = True
         
     try:
         # Procurar credentials.json em várias localizações
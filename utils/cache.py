@@ -1,23 +1,116 @@
-import duckdb
+import base64
 import json
 import uuid
 import os
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import date, datetime, time as dt_time, timedelta
+from decimal import Decimal
 from typing import Dict, List, Optional, Any
 
+from utils.storage import get_storage, resolve_store_url, describe_storage
+from utils.write_behind import write_behind
+from utils.intent_classifier import classify_intent
+
 # Definir DB_PATH relativo ao diretório do projeto
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DB_PATH = os.path.join(PROJECT_ROOT, "cache.db")
 
+# Backend da store (DuckDB local por padrão; CACHE_DB_URL/STORAGE_URL para SQLite/PostgreSQL)
+_db = get_storage(resolve_store_url("cache", DB_PATH))
+
+# Retenção de histórico por plano (interações OK mantidas por usuário).
+# A poda roda em background (run_cache_compaction), fora do caminho da requisição.
+HISTORY_RETENTION_BY_PLAN = {
+    "free": 15,
+    "basic": 30,
+    "premium": 100,
+    "enterprise": 500,
+}
+DEFAULT_HISTORY_RETENTION = int(os.getenv("CACHE_HISTORY_RETENTION", "15"))
+ERROR_LOG_RETENTION_DAYS = int(os.getenv("CACHE_ERROR_RETENTION_DAYS", "30"))
+PROFILE_RETENTION_DAYS = int(os.getenv("CACHE_PROFILE_RETENTION_DAYS", "14"))
+COMPACTION_INTERVAL_SECONDS = int(os.getenv("CACHE_COMPACTION_INTERVAL", "600"))
+COMPACTION_BATCH_USERS = 50
+
+# Linhas guardadas como amostra no payload (lidas pelo histórico sem tocar nos dados completos)
+SAMPLE_ROWS = 5
+
+# Consultas quentes (registradas uma vez, reutilizadas por nome).
+# Os INSERTs dos sinks write-behind ignoram ids já gravados: a releitura do
+# journal pode reenviar um item que chegou ao banco antes do ack
+_db.register_statement("insert_interaction", """
+    INSERT INTO user_interactions 
+    (id, user_id, timestamp, question, function_params, query_sql, raw_data, 
+     raw_response, refined_response, tech_details, status, reused_from)
+    VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO NOTHING
+""")
+_db.register_statement("insert_payload", """
+    INSERT INTO interaction_payloads (interaction_id, row_count, sample_rows, data)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (interaction_id) DO NOTHING
+""")
+# Histórico: apenas metadados do payload (row_count/sample_rows), nunca a coluna data
+_db.register_statement("user_history", """
+    SELECT i.id, i.timestamp, i.question, i.function_params, i.query_sql, 
+           p.sample_rows, p.row_count, i.refined_response, i.tech_details, i.reused_from
+    FROM user_interactions i
+    LEFT JOIN interaction_payloads p ON p.interaction_id = i.id
+    WHERE i.user_id = ? AND i.status = 'OK'
+    ORDER BY i.timestamp DESC 
+    LIMIT ?
+""")
+_db.register_statement("interaction_full_data", """
+    SELECT p.data FROM interaction_payloads p
+    JOIN user_interactions i ON i.id = p.interaction_id
+    WHERE p.interaction_id = ? AND i.status = 'OK'
+""")
+_db.register_statement("latest_data_interaction", """
+    SELECT i.id, i.question, i.function_params, i.query_sql, p.data, 
+           i.refined_response, i.tech_details, i.timestamp
+    FROM user_interactions i
+    JOIN interaction_payloads p ON p.interaction_id = i.id
+    WHERE i.user_id = ? AND i.status = 'OK'
+    ORDER BY i.timestamp DESC 
+    LIMIT 1
+""")
+_db.register_statement("insert_profile", """
+    INSERT INTO request_profiles
+    (id, interaction_id, user_id, timestamp, question, trigger, duration_ms, interval_ms, sample_count, stacks)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO NOTHING
+""")
+# Resultados compartilhados entre usuários do tenant (database/result_cache.py)
+_db.register_statement("shared_result", """
+    SELECT data, row_count, created_at FROM shared_query_results
+    WHERE cache_key = ? AND expires_at > ?
+""")
+_db.register_statement("upsert_shared_result", """
+    INSERT INTO shared_query_results (cache_key, tenant, query_sql, row_count, data, created_at, expires_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (cache_key) DO UPDATE SET
+        query_sql = EXCLUDED.query_sql,
+        row_count = EXCLUDED.row_count,
+        data = EXCLUDED.data,
+        created_at = EXCLUDED.created_at,
+        expires_at = EXCLUDED.expires_at
+""")
+_db.register_statement("insert_error", """
+    INSERT INTO log_erros 
+    (id, user_id, timestamp, error_type, error_message, context, traceback)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (id) DO NOTHING
+""")
+
 def get_connection():
-    """Retorna conexão com o DuckDB"""
-    # Garantir que o diretório existe
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    return duckdb.connect(DB_PATH)
+    """Retorna o cursor da thread sobre a conexão compartilhada (use com `with`; não fecha o handle)"""
+    return _db.connection()
 
-def init_cache_db():
-    """Inicializa as tabelas do cache"""
-    with get_connection() as conn:
+def init_cache_db(storage=None):
+    """Inicializa as tabelas do cache (no backend da store ou em `storage`, ex.: destino de migração)"""
+    storage = storage or _db
+    with storage.connection() as conn:
         # Tabela de interações do usuário
         conn.execute("""
             CREATE TABLE IF NOT EXISTS user_interactions (
@@ -27,7 +120,7 @@ def init_cache_db():
                 question TEXT NOT NULL,
                 function_params TEXT,
                 query_sql TEXT,
-                raw_data TEXT,
+                raw_data TEXT,  -- legado: resultados ficam em interaction_payloads
                 raw_response TEXT,
                 refined_response TEXT,
                 tech_details TEXT,
@@ -36,6 +129,17 @@ def init_cache_db():
             )
         """)
         
+        # Resultados das interações (separados dos metadados; row_count e
+        # sample_rows pré-calculados para o histórico não ler os dados completos)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS interaction_payloads (
+                interaction_id VARCHAR PRIMARY KEY,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                sample_rows TEXT,
+                data TEXT
+            )
+        """)
+        
         # Tabela de erros
         conn.execute("""
             CREATE TABLE IF NOT EXISTS log_erros (
@@ -48,6 +152,90 @@ def init_cache_db():
                 traceback TEXT
             )
         """)
+        
+        # Perfis de amostragem por requisição (utils.profiler / tools/flamegraph.py)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS request_profiles (
+                id VARCHAR PRIMARY KEY,
+                interaction_id VARCHAR,
+                user_id VARCHAR,
+                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                question TEXT,
+                trigger VARCHAR,
+                duration_ms DOUBLE PRECISION,
+                interval_ms DOUBLE PRECISION,
+                sample_count INTEGER,
+                stacks TEXT  -- formato collapsed: "mod:func;mod:func N" por linha
+            )
+        """)
+        
+        # Resultados de SQL compartilhados entre usuários (chave = tenant + SQL canônica + escopo)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS shared_query_results (
+                cache_key VARCHAR PRIMARY KEY,
+                tenant VARCHAR NOT NULL,
+                query_sql TEXT,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                data TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                expires_at TIMESTAMP NOT NULL
+            )
+        """)
+        
+        # Índices das consultas quentes (histórico por usuário/status/data)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_interactions_user_status_ts
+            ON user_interactions (user_id, status, timestamp)
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_log_erros_user_ts
+            ON log_erros (user_id, timestamp)
+        """)
+
+    _migrate_inline_payloads(storage)
+
+def _build_payload(raw_data) -> tuple:
+    """(row_count, sample_rows_json, data_json) de um resultado"""
+    if isinstance(raw_data, list):
+        row_count = len(raw_data)
+        sample = raw_data[:SAMPLE_ROWS]
+    else:
+        row_count = 0
+        sample = raw_data
+    return row_count, _safe_json_dumps(sample), _safe_json_dumps(raw_data)
+
+def _migrate_inline_payloads(storage=None):
+    """Move resultados antigos (user_interactions.raw_data) para interaction_payloads"""
+    with (storage or _db).connection() as conn:
+        rows = conn.execute("""
+            SELECT id, raw_data FROM user_interactions WHERE raw_data IS NOT NULL
+        """).fetchall()
+        if not rows:
+            return
+        
+        for interaction_id, raw_json in rows:
+            try:
+                raw_data = json.loads(raw_json)
+            except (TypeError, ValueError):
+                raw_data = None
+            row_count, sample_json, _ = _build_payload(raw_data)
+            conn.execute("""
+                INSERT INTO interaction_payloads (interaction_id, row_count, sample_rows, data)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT DO NOTHING
+            """, (interaction_id, row_count, sample_json, raw_json))
+        conn.execute("UPDATE user_interactions SET raw_data = NULL WHERE raw_data IS NOT NULL")
+        print(f"[Cache] ✅ {len(rows)} resultados migrados para interaction_payloads")
+
+# Serialização segura para evitar erros do DuckDB
+def _safe_json_dumps(obj):
+    if obj is None:
+        return None
+    try:
+        return json.dumps(obj)
+    except (TypeError, ValueError) as e:
+        print(f"AVISO: Erro ao serializar {type(obj)}: {e}. Convertendo para string.")
+        return json.dumps({"serialized_as_string": str(obj)})
 
 def save_interaction(
     user_id: str,
@@ -61,189 +249,145 @@ def save_interaction(
     status: str = "OK",
     reused_from: Optional[str] = None
 ) -> str:
-    """Salva uma interação no cache"""
+    """
+    Salva uma interação no cache.
+    
+    A gravação é feita em lote pela fila write-behind (fora do caminho crítico);
+    o id é gerado aqui e retornado imediatamente.
+    """
     interaction_id = str(uuid.uuid4())
     
-    # Serialização segura para evitar erros do DuckDB
-    def safe_json_dumps(obj):
-        if obj is None:
-            return None
-        try:
-            return json.dumps(obj)
-        except (TypeError, ValueError) as e:
-            print(f"AVISO: Erro ao serializar {type(obj)}: {e}. Convertendo para string.")
-            return json.dumps({"serialized_as_string": str(obj)})
+    write_behind.enqueue("cache_interaction", {
+        "id": interaction_id,
+        "user_id": user_id,
+        "timestamp": datetime.now().isoformat(),
+        "question": question,
+        "function_params": function_params,
+        "query_sql": query_sql,
+        "raw_data": raw_data,
+        "raw_response": raw_response,
+        "refined_response": refined_response,
+        "tech_details": tech_details,
+        "status": status,
+        "reused_from": reused_from
+    })
     
-    with get_connection() as conn:
-        conn.execute("""
-            INSERT INTO user_interactions 
-            (id, user_id, question, function_params, query_sql, raw_data, 
-             raw_response, refined_response, tech_details, status, reused_from)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            interaction_id,
-            user_id,
-            question,
-            safe_json_dumps(function_params),
-            query_sql,
-            safe_json_dumps(raw_data),
-            raw_response,
-            refined_response,
-            safe_json_dumps(tech_details),
-            status,
-            reused_from
-        ))
-        
-        # Limita a 15 interações por usuário
-        conn.execute("""
-            DELETE FROM user_interactions 
-            WHERE user_id = ? AND id NOT IN (
-                SELECT id FROM user_interactions 
-                WHERE user_id = ? AND status = 'OK'
-                ORDER BY timestamp DESC 
-                LIMIT 15
-            )
-        """, (user_id, user_id))
+    # Retenção por usuário é aplicada pelo job de compactação em background
     
     return interaction_id
 
+def _write_interactions_batch(payloads: List[Dict]) -> None:
+    """Grava um lote de interações (sink da fila write-behind)"""
+    with get_connection() as conn:
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            for item in payloads:
+                interaction_id = item["id"]
+                conn.execute(_db.statements["insert_interaction"], (
+                    interaction_id,
+                    item["user_id"],
+                    item["timestamp"],
+                    item["question"],
+                    _safe_json_dumps(item.get("function_params")),
+                    item.get("query_sql"),
+                    item.get("raw_response"),
+                    item.get("refined_response"),
+                    _safe_json_dumps(item.get("tech_details")),
+                    item.get("status", "OK"),
+                    item.get("reused_from")
+                ))
+                if item.get("raw_data") is not None:
+                    row_count, sample_json, data_json = _build_payload(item["raw_data"])
+                    conn.execute(_db.statements["insert_payload"], (interaction_id, row_count, sample_json, data_json))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+write_behind.register_sink("cache_interaction", _write_interactions_batch)
+
 def get_user_history(user_id: str, limit: int = 15) -> List[Dict]:
     """Recupera o histórico do usuário com amostra dos dados para eficiência"""
-    with get_connection() as conn:
-        result = conn.execute("""
-            SELECT id, timestamp, question, function_params, query_sql, 
-                   raw_data, refined_response, tech_details, reused_from
-            FROM user_interactions 
-            WHERE user_id = ? AND status = 'OK'
-            ORDER BY timestamp DESC 
-            LIMIT ?
-        """, (user_id, limit)).fetchall()
-        
-        history = []
-        for row in result:
-            # Otimização: para o histórico, inclui apenas amostra dos dados (primeiras 5 linhas)
-            raw_data = json.loads(row[5]) if row[5] else None
-            sample_data = raw_data[:5] if raw_data and isinstance(raw_data, list) else raw_data
-            
-            history.append({
-                'id': row[0],
-                'timestamp': row[1],
-                'question': row[2],
-                'user_prompt': row[2],  # Adiciona o campo user_prompt para compatibilidade
-                'function_params': json.loads(row[3]) if row[3] else None,
-                'query_sql': row[4],
-                'raw_data_sample': sample_data,  # Apenas amostra para análise
-                'raw_data_count': len(raw_data) if raw_data and isinstance(raw_data, list) else 0,
-                'refined_response': row[6],
-                'tech_details': json.loads(row[7]) if row[7] else None,
-                'reused_from': row[8]
-            })
-        
-        return history
+    result = _db.execute("user_history", (user_id, limit)).fetchall()
+    
+    history = []
+    for row in result:
+        # Apenas metadados: amostra e contagem pré-calculadas (dados completos via get_interaction_full_data)
+        history.append({
+            'id': row[0],
+            'timestamp': row[1],
+            'question': row[2],
+            'user_prompt': row[2],  # Adiciona o campo user_prompt para compatibilidade
+            'function_params': json.loads(row[3]) if row[3] else None,
+            'query_sql': row[4],
+            'raw_data_sample': json.loads(row[5]) if row[5] else None,  # Apenas amostra para análise
+            'raw_data_count': row[6] or 0,
+            'refined_response': row[7],
+            'tech_details': json.loads(row[8]) if row[8] else None,
+            'reused_from': row[9]
+        })
+    
+    return history
 
 def get_interaction_full_data(interaction_id: str) -> Optional[List]:
     """Recupera os dados completos de uma interação específica"""
-    with get_connection() as conn:
-        result = conn.execute("""
-            SELECT raw_data FROM user_interactions 
-            WHERE id = ? AND status = 'OK'
-        """, (interaction_id,)).fetchone()
-        
-        if result and result[0]:
-            return json.loads(result[0])
-        return None
+    result = _db.execute("interaction_full_data", (interaction_id,)).fetchone()
+    
+    if result and result[0]:
+        return json.loads(result[0])
+    return None
 
 def get_most_recent_data_interaction(user_id: str) -> Optional[Dict]:
     """Recupera a interação mais recente que retornou dados (para casos como 'gere um gráfico desse dado')"""
-    with get_connection() as conn:
-        result = conn.execute("""
-            SELECT id, timestamp, question, function_params, query_sql, raw_data, 
-                   refined_response, tech_details
-            FROM user_interactions 
-            WHERE user_id = ? AND status = 'OK' AND raw_data IS NOT NULL
-            ORDER BY timestamp DESC 
-            LIMIT 1
-        """, (user_id,)).fetchone()
-        
-        if result:
-            return {
-                'id': result[0],
-                'timestamp': result[1],
-                'question': result[2],
-                'function_params': json.loads(result[3]) if result[3] else None,
-                'query_sql': result[4],
-                'raw_data': json.loads(result[5]) if result[5] else None,
-                'refined_response': result[6],
-                'tech_details': json.loads(result[7]) if result[7] else None
-            }
+    result = _db.execute("latest_data_interaction", (user_id,)).fetchone()
+    
+    if result:
+        return {
+            'id': result[0],
+            'timestamp': result[7],
+            'question': result[1],
+            'function_params': json.loads(result[2]) if result[2] else None,
+            'query_sql': result[3],
+            'raw_data': json.loads(result[4]) if result[4] else None,
+            'refined_response': result[5],
+            'tech_details': json.loads(result[6]) if result[6] else None
+        }
     
     return None
 
 def find_reusable(user_id: str, question: str) -> Optional[Dict]:
     """Busca interações que podem ser reutilizadas - OTIMIZADO para priorizar dados recentes"""
-    # Palavras-chave que indicam reutilização EXPLÍCITA de dados específicos
-    explicit_recent_keywords = [
-        "gráfico", "grafico", "chart", "exportar", "excel", "planilha", "csv",
-        "visualização", "visualizacao", "plotar", "plot"
-    ]
-    
-    # Palavras-chave que indicam reutilização de dados ANTERIORES específicos
-    specific_reference_keywords = [
-        "mesmos dados", "dados anteriores", "última consulta", "último resultado", 
-        "tabela anterior", "consulta anterior", "resultado anterior"
-    ]
-    
-    question_lower = question.lower()
+    intent = classify_intent(question)
     
     # CASO 1: Referência explícita a dados anteriores específicos
-    has_specific_reference = any(keyword in question_lower for keyword in specific_reference_keywords)
+    has_specific_reference = intent.has("reference")
     
     # CASO 2: Pedido de visualização/export (implica usar dados mais recentes)
-    has_visualization_request = any(keyword in question_lower for keyword in explicit_recent_keywords)
+    has_visualization_request = intent.has("visualization", "export")
     
     # CASO 3: Frases que indicam continuidade ("agora", "desse", "destes dados")
-    continuity_keywords = ["agora", "desse", "destes", "dessa", "dessas", "do resultado", "dos dados"]
-    has_continuity = any(keyword in question_lower for keyword in continuity_keywords)
+    has_continuity = intent.has("continuity")
     
     # Se não há indicadores de reutilização, retorna None
     if not (has_specific_reference or has_visualization_request or has_continuity):
         return None
     
-    with get_connection() as conn:
-        # PRIORIDADE: Se é pedido de visualização/export OU tem continuidade, usa dados mais recentes
-        if (has_visualization_request or has_continuity) and not has_specific_reference:
-            # Busca a última interação bem-sucedida com dados (mais recente)
-            result = conn.execute("""
-                SELECT id, question, function_params, query_sql, raw_data, 
-                       refined_response, tech_details, timestamp
-                FROM user_interactions 
-                WHERE user_id = ? AND status = 'OK' AND raw_data IS NOT NULL
-                ORDER BY timestamp DESC 
-                LIMIT 1
-            """, (user_id,)).fetchone()
-        else:
-            # Para referências específicas a dados anteriores, mantém lógica original
-            result = conn.execute("""
-                SELECT id, question, function_params, query_sql, raw_data, 
-                       refined_response, tech_details, timestamp
-                FROM user_interactions 
-                WHERE user_id = ? AND status = 'OK' AND raw_data IS NOT NULL
-                ORDER BY timestamp DESC 
-                LIMIT 1
-            """, (user_id,)).fetchone()
-        
-        if result:
-            return {
-                'id': result[0],
-                'question': result[1],
-                'function_params': json.loads(result[2]) if result[2] else None,
-                'query_sql': result[3],
-                'raw_data': json.loads(result[4]) if result[4] else None,
-                'refined_response': result[5],
-                'tech_details': json.loads(result[6]) if result[6] else None,
-                'timestamp': result[7],
-                'reuse_reason': 'most_recent_data' if (has_visualization_request or has_continuity) else 'specific_reference'
-            }
+    # Visualização/export, continuidade ou referência específica: todos usam a
+    # última interação bem-sucedida com dados (mais recente)
+    result = _db.execute("latest_data_interaction", (user_id,)).fetchone()
+    
+    if result:
+        return {
+            'id': result[0],
+            'question': result[1],
+            'function_params': json.loads(result[2]) if result[2] else None,
+            'query_sql': result[3],
+            'raw_data': json.loads(result[4]) if result[4] else None,
+            'refined_response': result[5],
+            'tech_details': json.loads(result[6]) if result[6] else None,
+            'timestamp': result[7],
+            'reuse_reason': 'most_recent_data' if (has_visualization_request or has_continuity) else 'specific_reference'
+        }
     
     return None
 
@@ -270,24 +414,30 @@ def log_error(
     context: Optional[str] = None,
     traceback: Optional[str] = None
 ) -> str:
-    """Registra um erro no banco de dados"""
+    """Registra um erro no banco de dados (gravação assíncrona via write-behind)"""
     error_id = str(uuid.uuid4())
     
+    write_behind.enqueue("cache_error", {
+        "id": error_id,
+        "user_id": user_id,
+        "timestamp": datetime.now().isoformat(),
+        "error_type": error_type,
+        "error_message": error_message,
+        "context": context,
+        "traceback": traceback
+    })
+    return error_id
+
+def _write_errors_batch(payloads: List[Dict]) -> None:
+    """Grava um lote de erros (sink da fila write-behind)"""
+    rows = [
+        (p["id"], p["user_id"], p["timestamp"], p.get("error_type"),
+         p.get("error_message"), p.get("context"), p.get("traceback"))
+        for p in payloads
+    ]
     try:
         with get_connection() as conn:
-            conn.execute("""
-                INSERT INTO log_erros 
-                (id, user_id, error_type, error_message, context, traceback)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                error_id,
-                user_id,
-                error_type,
-                error_message,
-                context,
-                traceback
-            ))
-        return error_id
+            conn.executemany(_db.statements["insert_error"], rows)
     except Exception as e:
         # Se falhar por tabela inexistente, tenta criar e repetir
         if "log_erros" in str(e) and ("does not exist" in str(e) or "no such table" in str(e)):
@@ -304,25 +454,147 @@ def log_error(
                             traceback TEXT
                         )
                     """)
-                    conn.execute("""
-                        INSERT INTO log_erros 
-                        (id, user_id, error_type, error_message, context, traceback)
-                        VALUES (?, ?, ?, ?, ?, ?)
-                    """, (
-                        error_id,
-                        user_id,
-                        error_type,
-                        error_message,
-                        context,
-                        traceback
-                    ))
-                return error_id
+                    conn.executemany(_db.statements["insert_error"], rows)
             except Exception as e2:
                 print(f"[log_error][FATAL] Falha ao criar tabela log_erros e registrar erro: {e2}")
-                return None
+                raise
         else:
             print(f"[log_error][FATAL] Falha ao registrar erro: {e}")
-            return None
+            raise
+
+write_behind.register_sink("cache_error", _write_errors_batch)
+
+def save_profile(
+    profile_id: str,
+    user_id: str,
+    question: str,
+    trigger: str,
+    duration_ms: float,
+    interval_ms: float,
+    sample_count: int,
+    stacks: str,
+    interaction_id: Optional[str] = None
+) -> str:
+    """Registra o perfil de uma requisição (gravação assíncrona via write-behind)"""
+    write_behind.enqueue("cache_profile", {
+        "id": profile_id,
+        "interaction_id": interaction_id,
+        "user_id": user_id,
+        "timestamp": datetime.now().isoformat(),
+        "question": question,
+        "trigger": trigger,
+        "duration_ms": duration_ms,
+        "interval_ms": interval_ms,
+        "sample_count": sample_count,
+        "stacks": stacks
+    })
+    return profile_id
+
+def _write_profiles_batch(payloads: List[Dict]) -> None:
+    """Grava um lote de perfis (sink da fila write-behind)"""
+    rows = [
+        (p["id"], p.get("interaction_id"), p.get("user_id"), p["timestamp"], p.get("question"),
+         p.get("trigger"), p.get("duration_ms"), p.get("interval_ms"), p.get("sample_count"), p.get("stacks"))
+        for p in payloads
+    ]
+    with get_connection() as conn:
+        conn.executemany(_db.statements["insert_profile"], rows)
+
+write_behind.register_sink("cache_profile", _write_profiles_batch)
+
+def get_profile(profile_or_interaction_id: str) -> Optional[Dict]:
+    """Busca um perfil pelo id do perfil ou da interação"""
+    with get_connection() as conn:
+        row = conn.execute("""
+            SELECT id, interaction_id, user_id, timestamp, question, trigger,
+                   duration_ms, interval_ms, sample_count, stacks
+            FROM request_profiles
+            WHERE id = ? OR interaction_id = ?
+            ORDER BY timestamp DESC
+            LIMIT 1
+        """, (profile_or_interaction_id, profile_or_interaction_id)).fetchone()
+    if not row:
+        return None
+    keys = ["id", "interaction_id", "user_id", "timestamp", "question", "trigger",
+            "duration_ms", "interval_ms", "sample_count", "stacks"]
+    return dict(zip(keys, row))
+
+def list_profiles(limit: int = 20, user_id: Optional[str] = None) -> List[Dict]:
+    """Perfis mais recentes (sem as pilhas)"""
+    where = "WHERE user_id = ?" if user_id else ""
+    params = (user_id, limit) if user_id else (limit,)
+    with get_connection() as conn:
+        rows = conn.execute(f"""
+            SELECT id, interaction_id, user_id, timestamp, question, trigger, duration_ms, sample_count
+            FROM request_profiles
+            {where}
+            ORDER BY timestamp DESC
+            LIMIT ?
+        """, params).fetchall()
+    keys = ["id", "interaction_id", "user_id", "timestamp", "question", "trigger", "duration_ms", "sample_count"]
+    return [dict(zip(keys, row)) for row in rows]
+
+_TYPE_TAG = "__type__"
+
+def _tag_value(value: Any) -> Dict:
+    """json default: DATE/TIMESTAMP/NUMERIC/BYTES viram {"__type__", "value"} (restaurados na leitura)"""
+    if isinstance(value, datetime):
+        return {_TYPE_TAG: "datetime", "value": value.isoformat()}
+    if isinstance(value, date):
+        return {_TYPE_TAG: "date", "value": value.isoformat()}
+    if isinstance(value, dt_time):
+        return {_TYPE_TAG: "time", "value": value.isoformat()}
+    if isinstance(value, Decimal):
+        return {_TYPE_TAG: "decimal", "value": str(value)}
+    if isinstance(value, bytes):
+        return {_TYPE_TAG: "bytes", "value": base64.b64encode(value).decode("ascii")}
+    return str(value)
+
+_TYPE_DECODERS = {
+    "datetime": datetime.fromisoformat,
+    "date": date.fromisoformat,
+    "time": dt_time.fromisoformat,
+    "decimal": Decimal,
+    "bytes": base64.b64decode,
+}
+
+def _untag_value(obj: Dict) -> Any:
+    decoder = _TYPE_DECODERS.get(obj.get(_TYPE_TAG)) if len(obj) == 2 and "value" in obj else None
+    return decoder(obj["value"]) if decoder else obj
+
+def get_shared_result(cache_key: str) -> Optional[Dict]:
+    """Resultado compartilhado ainda válido (gravado por qualquer réplica) ou None, com os tipos originais"""
+    row = _db.execute("shared_result", (cache_key, datetime.now())).fetchone()
+    if not row:
+        return None
+    data = json.loads(row[0], object_hook=_untag_value) if row[0] else []
+    return {"data": data, "row_count": row[1], "created_at": row[2]}
+
+def save_shared_result(cache_key: str, tenant: str, query_sql: str, data: List, ttl_seconds: float) -> None:
+    """Publica um resultado para os demais usuários/réplicas (gravação assíncrona via write-behind)"""
+    now = datetime.now()
+    write_behind.enqueue("cache_shared_result", {
+        "cache_key": cache_key,
+        "tenant": tenant,
+        "query_sql": query_sql,
+        "row_count": len(data),
+        "data": json.dumps(data, default=_tag_value),
+        "created_at": now.isoformat(),
+        "expires_at": (now + timedelta(seconds=ttl_seconds)).isoformat()
+    })
+
+def _write_shared_results_batch(payloads: List[Dict]) -> None:
+    """Grava um lote de resultados compartilhados (sink da fila write-behind)"""
+    latest = {p["cache_key"]: p for p in payloads}  # a mesma chave só uma vez por lote
+    rows = [
+        (p["cache_key"], p["tenant"], p.get("query_sql"), p["row_count"], p["data"],
+         p["created_at"], p["expires_at"])
+        for p in latest.values()
+    ]
+    with get_connection() as conn:
+        conn.executemany(_db.statements["upsert_shared_result"], rows)
+
+write_behind.register_sink("cache_shared_result", _write_shared_results_batch)
 
 def get_recent_errors(user_id: str, hours: int = 24) -> List[Dict]:
     """Recupera erros recentes do usuário"""
@@ -346,10 +618,109 @@ def get_recent_errors(user_id: str, hours: int = 24) -> List[Dict]:
         
         return errors
 
+def _get_history_retention(user_id: str) -> int:
+    """Quantas interações OK manter para o usuário, conforme o plano"""
+    try:
+        from utils.user_database import db
+        subscription = db.get_user_subscription(user_id)
+    except Exception:
+        subscription = None
+    plan_id = subscription['plan_id'] if subscription else 'free'
+    return HISTORY_RETENTION_BY_PLAN.get(plan_id, DEFAULT_HISTORY_RETENTION)
+
+def run_cache_compaction() -> Dict[str, int]:
+    """
+    Compactação em lotes: poda o histórico excedente de cada usuário (retenção
+    por plano), remove payloads órfãos e erros antigos e faz CHECKPOINT.
+    """
+    stats = {"users_trimmed": 0, "interactions_deleted": 0, "payloads_deleted": 0, "errors_deleted": 0,
+             "profiles_deleted": 0, "shared_results_deleted": 0}
+    min_retention = min(list(HISTORY_RETENTION_BY_PLAN.values()) + [DEFAULT_HISTORY_RETENTION])
+    
+    with get_connection() as conn:
+        candidates = conn.execute("""
+            SELECT user_id FROM user_interactions
+            GROUP BY user_id
+            HAVING COUNT(*) > ?
+        """, (min_retention,)).fetchall()
+        
+        for start in range(0, len(candidates), COMPACTION_BATCH_USERS):
+            batch = candidates[start:start + COMPACTION_BATCH_USERS]
+            conn.execute("BEGIN TRANSACTION")
+            try:
+                for (user_id,) in batch:
+                    retention = _get_history_retention(user_id)
+                    # Mantém as N interações OK mais recentes; o resto (inclusive não-OK) sai
+                    deleted = conn.execute("""
+                        DELETE FROM user_interactions
+                        WHERE user_id = ? AND id NOT IN (
+                            SELECT id FROM user_interactions
+                            WHERE user_id = ? AND status = 'OK'
+                            ORDER BY timestamp DESC
+                            LIMIT ?
+                        )
+                        RETURNING id
+                    """, (user_id, user_id, retention)).fetchall()
+                    if deleted:
+                        stats["users_trimmed"] += 1
+                        stats["interactions_deleted"] += len(deleted)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        
+        stats["payloads_deleted"] = len(conn.execute("""
+            DELETE FROM interaction_payloads
+            WHERE interaction_id NOT IN (SELECT id FROM user_interactions)
+            RETURNING interaction_id
+        """).fetchall())
+        
+        stats["errors_deleted"] = len(conn.execute("""
+            DELETE FROM log_erros WHERE timestamp < ? RETURNING id
+        """, (datetime.now() - timedelta(days=ERROR_LOG_RETENTION_DAYS),)).fetchall())
+        
+        stats["profiles_deleted"] = len(conn.execute("""
+            DELETE FROM request_profiles WHERE timestamp < ? RETURNING id
+        """, (datetime.now() - timedelta(days=PROFILE_RETENTION_DAYS),)).fetchall())
+        
+        stats["shared_results_deleted"] = len(conn.execute("""
+            DELETE FROM shared_query_results WHERE expires_at <= ? RETURNING cache_key
+        """, (datetime.now(),)).fetchall())
+    
+    _db.checkpoint()
+    return stats
+
+_compactor_thread: Optional[threading.Thread] = None
+_compactor_stop = threading.Event()
+
+def _compaction_loop():
+    while not _compactor_stop.wait(COMPACTION_INTERVAL_SECONDS):
+        try:
+            stats = run_cache_compaction()
+            if stats["interactions_deleted"] or stats["errors_deleted"]:
+                print(f"[Cache] 🧹 Compactação: {stats}")
+        except Exception as e:
+            print(f"[Cache] ⚠️  Erro na compactação: {e}")
+
+def start_cache_compactor():
+    """Inicia (uma vez por processo) a thread de compactação em background"""
+    global _compactor_thread
+    if _compactor_thread is not None and _compactor_thread.is_alive():
+        return
+    _compactor_stop.clear()
+    _compactor_thread = threading.Thread(target=_compaction_loop, name="cache-compactor", daemon=True)
+    _compactor_thread.start()
+
+def stop_cache_compactor():
+    _compactor_stop.set()
+
 # Inicializa o banco ao importar o módulo
 try:
     init_cache_db()
-    print(f"[Cache] ✅ Banco inicializado: {DB_PATH}")
+    print(f"[Cache] ✅ Banco inicializado: {describe_storage(_db)}")
 except Exception as e:
     print(f"[Cache] ⚠️  Erro ao inicializar banco: {e}")
     raise
+
+if COMPACTION_INTERVAL_SECONDS > 0:
+    start_cache_compactor()
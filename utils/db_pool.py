@@ -0,0 +1,151 @@
+"""
+DuckDB Pool - Conexões DuckDB de longa duração
+==============================================
+
+Abrir um arquivo DuckDB custa muito mais que as consultas minúsculas do cache,
+e várias conexões ao mesmo arquivo no processo geram contenção de lock.
+
+Este módulo mantém UM handle por arquivo por processo e entrega cursores por
+thread (cada sessão Streamlit roda em sua própria thread). As consultas
+quentes são registradas por nome e reutilizadas (`execute(nome, params)`).
+
+Configuração (variáveis de ambiente):
+- DUCKDB_MEMORY_LIMIT (padrão: 512MB)
+- DUCKDB_THREADS (padrão: 2)
+"""
+
+import os
+import atexit
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Sequence
+
+import duckdb
+
+DUCKDB_MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT", "512MB")
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", "2"))
+VALUES_CHUNK_SIZE = 500
+
+
+def execute_values(conn, sql: str, rows: List[Sequence], chunk_size: int = VALUES_CHUNK_SIZE) -> None:
+    """
+    Executa `sql` com um único `VALUES` multi-linha por bloco de linhas.
+
+    `executemany` no DuckDB executa linha a linha (ordem de grandeza mais lento
+    para lotes); aqui `sql` deve conter o marcador `{values}`, ex.:
+    "INSERT INTO t (a, b) VALUES {values}" ou
+    "WITH v(id, x) AS (VALUES {values}) UPDATE t SET x = v.x FROM v WHERE t.id = v.id".
+    """
+    if not rows:
+        return
+    width = len(rows[0])
+    placeholder = "(" + ", ".join(["?"] * width) + ")"
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        params = [value for row in chunk for value in row]
+        conn.execute(sql.format(values=", ".join([placeholder] * len(chunk))), params)
+
+
+class DuckDBConnectionManager:
+    """Handle DuckDB compartilhado por processo + cursores por thread"""
+
+    dialect = "duckdb"
+    # Um único processo grava no arquivo: contadores em memória são autoritativos
+    shared_writers = False
+
+    def __init__(self, db_path: str, memory_limit: str = DUCKDB_MEMORY_LIMIT, threads: int = DUCKDB_THREADS):
+        self.db_path = db_path
+        self.url = db_path if db_path == ":memory:" else f"duckdb:///{db_path}"
+        self.memory_limit = memory_limit
+        self.threads = threads
+        self.statements: Dict[str, str] = {}
+        self._conn: Optional[duckdb.DuckDBPyConnection] = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _root(self) -> duckdb.DuckDBPyConnection:
+        """Conexão raiz (aberta uma única vez)"""
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    if self.db_path != ":memory:":
+                        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+                    self._conn = duckdb.connect(self.db_path, config={
+                        "memory_limit": self.memory_limit,
+                        "threads": self.threads,
+                    })
+                    self._generation += 1
+        return self._conn
+
+    def cursor(self) -> duckdb.DuckDBPyConnection:
+        """Cursor da thread atual (criado na primeira chamada da thread)"""
+        root = self._root()
+        cursor = getattr(self._local, "cursor", None)
+        if cursor is None or getattr(self._local, "generation", None) != self._generation:
+            cursor = root.cursor()
+            self._local.cursor = cursor
+            self._local.generation = self._generation
+        return cursor
+
+    @contextmanager
+    def connection(self):
+        """
+        Compatível com o padrão `with get_connection() as conn:` -
+        entrega o cursor da thread sem fechá-lo ao sair.
+        """
+        yield self.cursor()
+
+    def register_statement(self, name: str, sql: str) -> None:
+        """Registra uma consulta quente por nome"""
+        self.statements[name] = sql
+
+    def execute(self, name: str, params: Sequence = ()):
+        """Executa consulta registrada no cursor da thread"""
+        return self.cursor().execute(self.statements[name], params)
+
+    def table_columns(self, table: str) -> List[str]:
+        """Colunas da tabela (vazio se não existir)"""
+        return [row[0] for row in self.cursor().execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = ? ORDER BY ordinal_position",
+            (table,)
+        ).fetchall()]
+
+    def checkpoint(self) -> None:
+        """Grava o WAL no arquivo principal"""
+        self.cursor().execute("CHECKPOINT")
+
+    def close(self) -> None:
+        """Fecha o handle (cursores das threads são recriados na próxima chamada)"""
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except Exception as e:
+                    print(f"[DuckDBPool] ⚠️  Erro ao fechar {self.db_path}: {e}")
+                self._conn = None
+
+
+_managers: Dict[str, DuckDBConnectionManager] = {}
+_managers_lock = threading.Lock()
+
+
+def get_duckdb_manager(db_path: str, **kwargs) -> DuckDBConnectionManager:
+    """Retorna o gerenciador (singleton por arquivo) do banco DuckDB"""
+    key = os.path.abspath(db_path) if db_path != ":memory:" else db_path
+    with _managers_lock:
+        manager = _managers.get(key)
+        if manager is None:
+            manager = DuckDBConnectionManager(key, **kwargs)
+            _managers[key] = manager
+        return manager
+
+
+def close_all_managers() -> None:
+    """Fecha todos os handles (chamado no encerramento do processo)"""
+    with _managers_lock:
+        for manager in _managers.values():
+            manager.close()
+
+
+atexit.register(close_all_managers)
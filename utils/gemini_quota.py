@@ -0,0 +1,296 @@
+"""
+Gemini Quota - Governador de cota de saída (RPM/TPM) entre processos
+===================================================================
+
+As chamadas ao Gemini (NL→SQL, correção de SQL, análise, validação,
+adaptação da pergunta, geradores) disputam a mesma cota do projeto. Sem
+coordenação, rajadas viram 429 e os retries pioram a latência.
+
+O governador contabiliza requisições e tokens estimados por minuto em
+SQLite WAL (mesmo arquivo do rate limit, tabela `gemini_usage`), visível
+para todas as sessões/processos da máquina, e admite cada chamada conforme a
+prioridade:
+
+- PRIORITY_CRITICAL (NL→SQL): usa 100% da cota; espera e, no limite, segue
+- PRIORITY_HIGH (análise, correção/validação de SQL): até 90%
+- PRIORITY_LOW (reescrita de adaptação): até 70%; se não couber, é
+  descartada na hora (GeminiQuotaExceeded) e o chamador degrada
+- PRIORITY_BATCH (geradores offline): até 60%; espera mais
+
+No processo, as chamadas em espera formam uma fila por prioridade (só a
+primeira tenta reservar). Um 429 recebido abre um cooldown compartilhado.
+Depois da chamada, a estimativa de tokens é corrigida pelo `usage_metadata`.
+
+Configuração (variáveis de ambiente):
+- GEMINI_QUOTA_ENABLED (padrão: true)
+- GEMINI_RPM_LIMIT / GEMINI_TPM_LIMIT
+- GEMINI_429_COOLDOWN (segundos)
+"""
+
+import os
+import time
+import heapq
+import itertools
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from utils.rate_limit import RATE_LIMIT_DB_PATH, open_wal_connection
+from utils.stage_metrics import get_stage_metrics
+from utils.tracing import get_tracer
+
+GEMINI_QUOTA_ENABLED = os.getenv("GEMINI_QUOTA_ENABLED", "true").lower() == "true"
+GEMINI_RPM_LIMIT = int(os.getenv("GEMINI_RPM_LIMIT", "60"))
+GEMINI_TPM_LIMIT = int(os.getenv("GEMINI_TPM_LIMIT", "1000000"))
+GEMINI_429_COOLDOWN = float(os.getenv("GEMINI_429_COOLDOWN", "5"))
+GEMINI_QUOTA_DB_PATH = os.getenv("GEMINI_QUOTA_DB_PATH", RATE_LIMIT_DB_PATH)
+
+PRIORITY_CRITICAL = 0
+PRIORITY_HIGH = 1
+PRIORITY_LOW = 2
+PRIORITY_BATCH = 3
+
+# headroom: fração da cota que a prioridade pode usar; max_wait: espera antes
+# de seguir mesmo assim; shed: descarta em vez de esperar
+PRIORITY_POLICIES = {
+    PRIORITY_CRITICAL: {"headroom": 1.0, "max_wait": 15.0, "shed": False},
+    PRIORITY_HIGH: {"headroom": 0.9, "max_wait": 10.0, "shed": False},
+    PRIORITY_LOW: {"headroom": 0.7, "max_wait": 0.0, "shed": True},
+    PRIORITY_BATCH: {"headroom": 0.6, "max_wait": 120.0, "shed": False},
+}
+
+WINDOW_SECONDS = 60
+CHARS_PER_TOKEN = 4
+DEFAULT_OUTPUT_TOKENS = 500
+MAX_POLL_SECONDS = 0.5
+
+
+class GeminiQuotaExceeded(Exception):
+    """Chamada de baixa prioridade descartada por falta de cota"""
+
+
+def estimate_tokens(prompt: Any, output_tokens: int = DEFAULT_OUTPUT_TOKENS) -> int:
+    """Estimativa barata (~4 caracteres por token) + saída esperada"""
+    return len(str(prompt)) // CHARS_PER_TOKEN + output_tokens
+
+
+def _is_throttled(error: BaseException) -> bool:
+    return type(error).__name__ in ("ResourceExhausted", "TooManyRequests") or "429" in str(error)
+
+
+class GeminiQuotaGovernor:
+    """Admissão por prioridade sobre uma janela deslizante de RPM/TPM compartilhada"""
+
+    def __init__(self, rpm_limit: int = GEMINI_RPM_LIMIT, tpm_limit: int = GEMINI_TPM_LIMIT,
+                 db_path: str = GEMINI_QUOTA_DB_PATH, enabled: bool = GEMINI_QUOTA_ENABLED,
+                 cooldown: float = GEMINI_429_COOLDOWN):
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.db_path = db_path
+        self.enabled = enabled
+        self.cooldown = cooldown
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._initialized = False
+
+    # ------------------------------------------------------------------
+    # Armazenamento compartilhado
+    # ------------------------------------------------------------------
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = open_wal_connection(self.db_path)
+            self._local.conn = conn
+            if not self._initialized:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS gemini_usage (
+                        window_start INTEGER PRIMARY KEY,
+                        requests INTEGER NOT NULL DEFAULT 0,
+                        tokens INTEGER NOT NULL DEFAULT 0
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS gemini_quota_state (
+                        key TEXT PRIMARY KEY,
+                        value REAL NOT NULL
+                    ) WITHOUT ROWID
+                """)
+                self._initialized = True
+        return conn
+
+    def _usage(self, conn, now: float) -> Tuple[float, float]:
+        """(requisições, tokens) na janela deslizante de 60s"""
+        current = int(now // WINDOW_SECONDS) * WINDOW_SECONDS
+        rows = {
+            row[0]: row[1:]
+            for row in conn.execute(
+                "SELECT window_start, requests, tokens FROM gemini_usage WHERE window_start IN (?, ?)",
+                (current, current - WINDOW_SECONDS)
+            ).fetchall()
+        }
+        weight = 1 - (now - current) / WINDOW_SECONDS
+        cur_req, cur_tok = rows.get(current, (0, 0))
+        prev_req, prev_tok = rows.get(current - WINDOW_SECONDS, (0, 0))
+        return cur_req + prev_req * weight, cur_tok + prev_tok * weight
+
+    def _try_reserve(self, tokens: int, headroom: float, force: bool = False) -> Tuple[Optional[int], float]:
+        """
+        Reserva 1 requisição + `tokens` na janela atual se couber no headroom.
+        Retorna (window_start, 0) quando reservou ou (None, segundos para tentar de novo).
+        """
+        now = time.time()
+        window = int(now // WINDOW_SECONDS) * WINDOW_SECONDS
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if not force:
+                row = conn.execute("SELECT value FROM gemini_quota_state WHERE key = 'cooldown_until'").fetchone()
+                if row and row[0] > now:
+                    conn.execute("ROLLBACK")
+                    return None, row[0] - now
+                requests, used_tokens = self._usage(conn, now)
+                if requests + 1 > self.rpm_limit * headroom or used_tokens + tokens > self.tpm_limit * headroom:
+                    conn.execute("ROLLBACK")
+                    return None, window + WINDOW_SECONDS - now
+            conn.execute("""
+                INSERT INTO gemini_usage (window_start, requests, tokens) VALUES (?, 1, ?)
+                ON CONFLICT (window_start) DO UPDATE SET
+                    requests = requests + 1, tokens = tokens + excluded.tokens
+            """, (window, tokens))
+            conn.execute("DELETE FROM gemini_usage WHERE window_start < ?", (window - 2 * WINDOW_SECONDS,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return window, 0.0
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def acquire(self, estimated_tokens: int, priority: int = PRIORITY_HIGH, kind: str = "gemini") -> Optional[int]:
+        """
+        Espera (em ordem de prioridade) por cota para uma chamada. Retorna a janela
+        reservada (para `reconcile`) ou levanta GeminiQuotaExceeded se descartada.
+        """
+        if not self.enabled:
+            return None
+        policy = PRIORITY_POLICIES.get(priority, PRIORITY_POLICIES[PRIORITY_HIGH])
+        start = time.monotonic()
+        deadline = start + policy["max_wait"]
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiters, entry)
+
+        outcome = "admitted"
+        try:
+            while True:
+                with self._cond:
+                    is_head = self._waiters[0] == entry
+                retry_in = MAX_POLL_SECONDS
+                # Quem é descartável não espera a vez: tenta a cota já e só é
+                # descartado se ela de fato faltar (não por haver outra chamada na fila)
+                if is_head or policy["shed"]:
+                    window, retry_in = self._try_reserve(estimated_tokens, policy["headroom"])
+                    if window is not None:
+                        return window
+                if policy["shed"]:
+                    outcome = "shed"
+                    raise GeminiQuotaExceeded(f"Cota do Gemini insuficiente para '{kind}' (prioridade {priority})")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # Chamada necessária: segue mesmo sem folga (o 429 realimenta o cooldown)
+                    outcome = "overflow"
+                    window, _ = self._try_reserve(estimated_tokens, policy["headroom"], force=True)
+                    return window
+                outcome = "waited"
+                with self._cond:
+                    self._cond.wait(min(retry_in, remaining, MAX_POLL_SECONDS))
+        finally:
+            with self._cond:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+            waited_ms = (time.monotonic() - start) * 1000
+            metrics = get_stage_metrics()
+            metrics.increment("gemini_quota", outcome=outcome, kind=kind)
+            if outcome != "admitted":
+                metrics.observe("gemini_quota_wait", waited_ms)
+
+    def reconcile(self, window: Optional[int], estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """Corrige a janela reservada com os tokens reais da resposta"""
+        if window is None or not actual_tokens or actual_tokens == estimated_tokens:
+            return
+        try:
+            self._conn().execute(
+                "UPDATE gemini_usage SET tokens = MAX(0, tokens + ?) WHERE window_start = ?",
+                (actual_tokens - estimated_tokens, window)
+            )
+        except Exception as e:
+            print(f"[GeminiQuota] ⚠️  Falha ao corrigir tokens: {e}")
+
+    def report_throttled(self) -> None:
+        """429 recebido: abre (ou estende) o cooldown para todos os processos"""
+        get_stage_metrics().increment("gemini_quota", outcome="throttled", kind="api")
+        try:
+            self._conn().execute("""
+                INSERT INTO gemini_quota_state (key, value) VALUES ('cooldown_until', ?)
+                ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)
+            """, (time.time() + self.cooldown,))
+        except Exception as e:
+            print(f"[GeminiQuota] ⚠️  Falha ao registrar cooldown: {e}")
+
+    def generate(self, model, prompt, priority: int = PRIORITY_HIGH, kind: str = "gemini",
+                 output_tokens: int = DEFAULT_OUTPUT_TOKENS, **kwargs):
+        """`model.generate_content(prompt)` sob o governador de cota"""
+        estimated = estimate_tokens(prompt, output_tokens)
+        start = time.monotonic()
+        window = self.acquire(estimated, priority, kind)
+        get_tracer().set_attributes(quota_wait_ms=round((time.monotonic() - start) * 1000, 2), quota_priority=priority)
+        try:
+            response = model.generate_content(prompt, **kwargs)
+        except Exception as e:
+            if _is_throttled(e):
+                self.report_throttled()
+            raise
+        usage = getattr(response, "usage_metadata", None)
+        self.reconcile(window, estimated, getattr(usage, "total_token_count", None))
+        return response
+
+    def get_usage(self) -> Dict[str, Any]:
+        """Uso atual da janela deslizante e cooldown"""
+        now = time.time()
+        conn = self._conn()
+        requests, tokens = self._usage(conn, now)
+        row = conn.execute("SELECT value FROM gemini_quota_state WHERE key = 'cooldown_until'").fetchone()
+        with self._cond:
+            waiting = len(self._waiters)
+        return {
+            "requests_per_minute": round(requests, 2),
+            "tokens_per_minute": round(tokens),
+            "rpm_limit": self.rpm_limit,
+            "tpm_limit": self.tpm_limit,
+            "cooldown_remaining": round(max(0.0, row[0] - now), 2) if row else 0.0,
+            "waiting_in_process": waiting,
+        }
+
+
+_governor: Optional[GeminiQuotaGovernor] = None
+_governor_lock = threading.Lock()
+
+
+def get_gemini_governor() -> GeminiQuotaGovernor:
+    """Retorna o governador global (criado sob demanda)"""
+    global _governor
+    if _governor is None:
+        with _governor_lock:
+            if _governor is None:
+                _governor = GeminiQuotaGovernor()
+    return _governor
+
+
+def governed_generate(model, prompt, priority: int = PRIORITY_HIGH, kind: str = "gemini", **kwargs):
+    """Atalho: `get_gemini_governor().generate(...)`"""
+    return get_gemini_governor().generate(model, prompt, priority=priority, kind=kind, **kwargs)
@@ -0,0 +1,253 @@
+"""
+Intent Classifier - Roteamento de perguntas (nova consulta, reuso, refino, gráfico, export)
+===========================================================================================
+
+Substitui as listas de palavras-chave espalhadas pelo fluxo (`find_reusable`,
+`should_reuse_data`, `_check_reuse_opportunity`, `_is_chart_request_incompatible`,
+`_should_use_conversational_analytics`, motor de refinos) por um classificador
+único, compilado uma vez a partir de config/intents.json:
+
+1. Léxico: cada grupo de termos ("signals") vira uma regex sobre o texto
+   normalizado (minúsculas, sem acento), casando token inteiro com plural
+   ("moto" casa "motos"), prefixo ("vend*") ou início da frase ("anchored").
+   Um grupo pode exigir frase curta ("max_words") e ser anulado por outros
+   termos ("unless").
+2. Embedding: vetor de n-gramas de caracteres com feature hashing (sem modelo,
+   microssegundos) comparado aos centróides das frases-exemplo ("exemplars")
+   de cada intenção.
+
+A intenção vem das regras léxicas; o embedding ajusta a confiança (e decide
+sozinho quando nenhum termo casou). `is_fresh_question` permite pular a
+reescrita da pergunta via Gemini quando ela claramente não depende do
+histórico; continuações elípticas ("e em 2023?", "por estado?") nunca são
+consideradas novas.
+
+Configuração (variáveis de ambiente):
+- INTENT_CONFIG_PATH (padrão: config/intents.json)
+- INTENT_FRESH_CONFIDENCE (padrão: 0.7)
+"""
+
+import json
+import os
+import re
+import unicodedata
+import zlib
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Optional, FrozenSet
+
+import numpy as np
+
+INTENT_CONFIG_PATH = os.getenv(
+    "INTENT_CONFIG_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config", "intents.json")
+)
+INTENT_FRESH_CONFIDENCE = float(os.getenv("INTENT_FRESH_CONFIDENCE", "0.7"))
+
+INTENT_NEW_QUERY = "new_query"
+INTENT_REUSE = "reuse"
+INTENT_FOLLOWUP = "followup"
+INTENT_CHART = "chart"
+INTENT_EXPORT = "export"
+
+# Grupos que indicam pergunta incompleta, dependente da anterior
+ELLIPTICAL_SIGNALS = ("ellipsis", "fragment")
+
+EMBEDDING_DIM = 512
+SOFTMAX_TEMPERATURE = 0.05
+
+
+def normalize_text(text: str) -> str:
+    """Minúsculas, sem acentos e com espaços colapsados"""
+    text = unicodedata.normalize("NFKD", str(text or ""))
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join(re.findall(r"\w+", text))
+
+
+def _term_pattern(term: str) -> str:
+    """Termo -> regex: sequência de tokens, plural tolerado, `*` = prefixo"""
+    words = normalize_text(term.rstrip("*")).split()
+    if not words:
+        return ""
+    parts = [re.escape(w) for w in words]
+    parts[-1] += r"\w*" if term.endswith("*") else r"(?:e?s)?"
+    return r"\s+".join(parts)
+
+
+def _compile_signal(config: Dict) -> Optional["re.Pattern"]:
+    alternatives = [p for p in (_term_pattern(t) for t in config.get("terms", [])) if p]
+    alternatives += config.get("patterns", [])
+    if not alternatives:
+        return None
+    body = "|".join(sorted(alternatives, key=len, reverse=True))
+    if config.get("anchored"):
+        return re.compile(rf"^(?:e\s+)?(?:{body})(?!\w)")
+    return re.compile(rf"(?<!\w)(?:{body})(?!\w)")
+
+
+def embed_text(text: str) -> np.ndarray:
+    """Vetor L2-normalizado de trigramas de caracteres + palavras (feature hashing)"""
+    normalized = normalize_text(text)
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    padded = f" {normalized} "
+    features = [padded[i:i + 3] for i in range(len(padded) - 2)] + [f"w:{w}" for w in normalized.split()]
+    for feature in features:
+        vector[zlib.crc32(feature.encode("utf-8")) % EMBEDDING_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+@dataclass(frozen=True)
+class IntentResult:
+    """Intenção, confiança (0-1), grupos léxicos que casaram e similaridade por intenção"""
+    intent: str
+    confidence: float
+    signals: FrozenSet[str]
+    source: str
+    similarities: Dict[str, float]
+
+    def has(self, *signals: str) -> bool:
+        return any(s in self.signals for s in signals)
+
+    @property
+    def is_fresh_question(self) -> bool:
+        """Nova pergunta que não depende do histórico (dispensa a adaptação via Gemini)"""
+        return (self.intent == INTENT_NEW_QUERY and self.confidence >= INTENT_FRESH_CONFIDENCE
+                and not self.has(*ELLIPTICAL_SIGNALS))
+
+    def to_dict(self) -> Dict:
+        return {
+            "intent": self.intent,
+            "confidence": round(self.confidence, 3),
+            "signals": sorted(self.signals),
+            "source": self.source,
+        }
+
+
+class IntentClassifier:
+    """Regras léxicas + centróides de embedding, compilados uma única vez"""
+
+    def __init__(self, config: Dict):
+        self.signals: Dict[str, "re.Pattern"] = {}
+        self._term_patterns: Dict[str, List[tuple]] = {}
+        self._max_words: Dict[str, int] = {}
+        self._unless: Dict[str, "re.Pattern"] = {}
+        for name, signal_config in config.get("signals", {}).items():
+            pattern = _compile_signal(signal_config)
+            if pattern is not None:
+                self.signals[name] = pattern
+                if signal_config.get("max_words"):
+                    self._max_words[name] = int(signal_config["max_words"])
+                unless = _compile_signal({"terms": signal_config.get("unless", [])})
+                if unless is not None:
+                    self._unless[name] = unless
+                self._term_patterns[name] = [
+                    (term, re.compile(rf"(?<!\w){_term_pattern(term)}(?!\w)"))
+                    for term in signal_config.get("terms", []) if _term_pattern(term)
+                ]
+
+        self.intents: List[str] = []
+        centroids = []
+        for intent, phrases in config.get("exemplars", {}).items():
+            if not phrases:
+                continue
+            centroid = np.mean([embed_text(p) for p in phrases], axis=0)
+            centroids.append(centroid / (np.linalg.norm(centroid) or 1.0))
+            self.intents.append(intent)
+        self.centroids = np.vstack(centroids) if centroids else np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+
+    @classmethod
+    def from_file(cls, path: str = INTENT_CONFIG_PATH) -> "IntentClassifier":
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return cls(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"[IntentClassifier] ⚠️  Não foi possível carregar {path}: {e}")
+            return cls({})
+
+    def match_signals(self, text: str) -> FrozenSet[str]:
+        normalized = normalize_text(text)
+        word_count = len(normalized.split())
+        return frozenset(
+            name for name, pattern in self.signals.items()
+            if pattern.search(normalized)
+            and word_count <= self._max_words.get(name, word_count)
+            and not (name in self._unless and self._unless[name].search(normalized))
+        )
+
+    def matched_terms(self, text: str, signal: str) -> List[str]:
+        """Termos do grupo presentes no texto (diagnóstico/logs)"""
+        normalized = normalize_text(text)
+        return [term for term, pattern in self._term_patterns.get(signal, []) if pattern.search(normalized)]
+
+    def similarities(self, text: str) -> Dict[str, float]:
+        if not self.intents:
+            return {}
+        scores = self.centroids @ embed_text(text)
+        return {intent: float(score) for intent, score in zip(self.intents, scores)}
+
+    def classify(self, text: str) -> IntentResult:
+        signals = self.match_signals(text)
+        similarities = self.similarities(text)
+        probabilities = self._softmax(similarities)
+
+        lexical_intent, lexical_confidence = self._lexical_intent(signals)
+        if lexical_intent is None:
+            # Nenhum termo casou: pergunta nova, com a confiança dada pelo embedding
+            intent = INTENT_NEW_QUERY
+            confidence = probabilities.get(INTENT_NEW_QUERY, 0.5)
+            source = "embedding"
+        else:
+            intent = lexical_intent
+            if (intent == INTENT_REUSE and "reference" not in signals
+                    and probabilities.get(INTENT_FOLLOWUP, 0.0) > probabilities.get(INTENT_REUSE, 0.0)):
+                # "top 5 desses": referência ao anterior com cara de refino
+                intent = INTENT_FOLLOWUP
+            agreement = probabilities.get(intent, 0.0)
+            best = max(probabilities, key=probabilities.get) if probabilities else intent
+            confidence = lexical_confidence if best == intent else lexical_confidence * (0.75 + 0.25 * agreement)
+            source = "lexical" if best == intent else "lexical+embedding"
+        return IntentResult(intent, float(confidence), signals, source, similarities)
+
+    @staticmethod
+    def _lexical_intent(signals: FrozenSet[str]):
+        """Intenção determinada pelos grupos léxicos (None se nenhum grupo de roteamento casou)"""
+        refers_back = "reference" in signals or "continuity" in signals
+        if "visualization" in signals and (refers_back or "new_query" not in signals):
+            return INTENT_CHART, 0.9 if refers_back else 0.75
+        if "export" in signals and (refers_back or "new_query" not in signals):
+            return INTENT_EXPORT, 0.9 if refers_back else 0.75
+        if "transform" in signals:
+            return INTENT_FOLLOWUP, 0.85
+        if refers_back:
+            return INTENT_REUSE, 0.9 if "reference" in signals else 0.8
+        if signals & {"visualization", "export", "new_query"}:
+            # Gráfico/export junto com especificação de dados: consulta completa
+            return INTENT_NEW_QUERY, 0.9
+        return None, 0.0
+
+    @staticmethod
+    def _softmax(similarities: Dict[str, float]) -> Dict[str, float]:
+        if not similarities:
+            return {}
+        values = np.array(list(similarities.values())) / SOFTMAX_TEMPERATURE
+        weights = np.exp(values - values.max())
+        weights /= weights.sum()
+        return {intent: float(w) for intent, w in zip(similarities, weights)}
+
+
+_classifier_instance: Optional[IntentClassifier] = None
+
+
+def get_intent_classifier() -> IntentClassifier:
+    """Retorna instância singleton do classificador (config carregada uma vez)"""
+    global _classifier_instance
+    if _classifier_instance is None:
+        _classifier_instance = IntentClassifier.from_file()
+    return _classifier_instance
+
+
+@lru_cache(maxsize=256)
+def classify_intent(text: str) -> IntentResult:
+    """Classifica a pergunta (resultado memoizado: várias etapas consultam a mesma pergunta)"""
+    return get_intent_classifier().classify(text)
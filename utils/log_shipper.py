@@ -0,0 +1,408 @@
+"""
+Log Shipper - Envio em lote dos logs de interação para o BigQuery
+=================================================================
+
+`log_interaction` era uma chamada HTTP `insert_rows_json` por mensagem, com o
+`raw_data` inteiro dentro do full_payload. O shipper:
+
+- agrupa linhas por quantidade (LOG_SHIPPER_BATCH_SIZE), idade do lote
+  (LOG_SHIPPER_MAX_AGE segundos) e tamanho da requisição (LOG_SHIPPER_BATCH_MAX_BYTES)
+- aplica a política de payload (`apply_payload_policy`): payloads grandes têm
+  o raw_data reduzido a uma amostra e o conteúdo completo comprimido (zlib+base64)
+  se couber no limite; senão é descartado e marcado como truncado
+- retenta com backoff exponencial + jitter, usando insertId para deduplicação
+- linhas que esgotam as tentativas vão para um spool JSONL local, reprocessado
+  periodicamente e no start do worker
+- expõe métricas de fila/lote em `get_stats()`
+"""
+
+import os
+import json
+import time
+import zlib
+import uuid
+import queue
+import base64
+import random
+import atexit
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from utils.stage_metrics import get_stage_metrics
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOG_SHIPPER_ENABLED = os.getenv("LOG_SHIPPER_ENABLED", "true").lower() == "true"
+LOG_SHIPPER_QUEUE_SIZE = int(os.getenv("LOG_SHIPPER_QUEUE_SIZE", "2000"))
+LOG_SHIPPER_BATCH_SIZE = int(os.getenv("LOG_SHIPPER_BATCH_SIZE", "100"))
+LOG_SHIPPER_MAX_AGE = float(os.getenv("LOG_SHIPPER_MAX_AGE", "5.0"))
+LOG_SHIPPER_BATCH_MAX_BYTES = int(os.getenv("LOG_SHIPPER_BATCH_MAX_BYTES", str(5 * 1024 * 1024)))
+LOG_SHIPPER_MAX_RETRIES = int(os.getenv("LOG_SHIPPER_MAX_RETRIES", "4"))
+LOG_SHIPPER_BACKOFF_BASE = float(os.getenv("LOG_SHIPPER_BACKOFF_BASE", "0.5"))
+LOG_SHIPPER_BACKOFF_MAX = float(os.getenv("LOG_SHIPPER_BACKOFF_MAX", "8.0"))
+LOG_SHIPPER_SPOOL_PATH = os.getenv("LOG_SHIPPER_SPOOL_PATH", os.path.join(PROJECT_ROOT, "log_shipper_spool.jsonl"))
+LOG_SHIPPER_REPLAY_INTERVAL = float(os.getenv("LOG_SHIPPER_REPLAY_INTERVAL", "60"))
+
+# Política de payload
+LOG_PAYLOAD_MAX_BYTES = int(os.getenv("LOG_PAYLOAD_MAX_BYTES", str(256 * 1024)))
+LOG_COMPRESSED_MAX_BYTES = int(os.getenv("LOG_COMPRESSED_MAX_BYTES", str(1024 * 1024)))
+LOG_RAW_DATA_SAMPLE_ROWS = int(os.getenv("LOG_RAW_DATA_SAMPLE_ROWS", "50"))
+
+_FLUSH = object()
+
+
+def apply_payload_policy(payload: Dict[str, Any]) -> Tuple[str, Dict[str, bool]]:
+    """
+    Serializa o full_payload respeitando LOG_PAYLOAD_MAX_BYTES.
+
+    Acima do limite, `raw_data` vira uma amostra (`raw_data_sample`) com a
+    contagem original; a versão completa vai comprimida em `raw_data_zlib_b64`
+    apenas se couber em LOG_COMPRESSED_MAX_BYTES.
+    Retorna (json, {"truncated": bool, "compressed": bool}).
+    """
+    info = {"truncated": False, "compressed": False}
+    serialized = json.dumps(payload, default=str)
+    if len(serialized) <= LOG_PAYLOAD_MAX_BYTES:
+        return serialized, info
+
+    raw_data = payload.get("raw_data")
+    reduced = dict(payload)
+    if isinstance(raw_data, list):
+        reduced["raw_data"] = None
+        reduced["raw_data_row_count"] = len(raw_data)
+        reduced["raw_data_sample"] = raw_data[:LOG_RAW_DATA_SAMPLE_ROWS]
+
+        raw_json = json.dumps(raw_data, default=str).encode("utf-8")
+        compressed = base64.b64encode(zlib.compress(raw_json, 6)).decode("ascii")
+        if len(compressed) <= LOG_COMPRESSED_MAX_BYTES:
+            reduced["raw_data_zlib_b64"] = compressed
+            info["compressed"] = True
+        else:
+            reduced["raw_data_truncated"] = True
+            info["truncated"] = True
+    else:
+        reduced["raw_data"] = None
+
+    serialized = json.dumps(reduced, default=str)
+    if len(serialized) > LOG_PAYLOAD_MAX_BYTES + LOG_COMPRESSED_MAX_BYTES:
+        # Outros campos enormes (export_data, graph_data...): mantém só o essencial
+        essential = {k: reduced.get(k) for k in ("user_input", "query", "status", "status_msg", "error", "timestamp")}
+        essential.update({"raw_data_row_count": reduced.get("raw_data_row_count"), "payload_truncated": True})
+        serialized = json.dumps(essential, default=str)
+        info["truncated"] = True
+    return serialized, info
+
+
+class LogShipper:
+    """Fila limitada + lotes por quantidade/idade + retry + spool JSONL"""
+
+    def __init__(
+        self,
+        insert_rows: Callable[[List[Dict[str, Any]], List[str]], List[Dict[str, Any]]],
+        build_row: Callable[..., Tuple[Dict[str, Any], Dict[str, bool]]],
+        max_queue: int = LOG_SHIPPER_QUEUE_SIZE,
+        batch_size: int = LOG_SHIPPER_BATCH_SIZE,
+        max_age: float = LOG_SHIPPER_MAX_AGE,
+        batch_max_bytes: int = LOG_SHIPPER_BATCH_MAX_BYTES,
+        max_retries: int = LOG_SHIPPER_MAX_RETRIES,
+        spool_path: str = LOG_SHIPPER_SPOOL_PATH,
+        enabled: bool = LOG_SHIPPER_ENABLED,
+    ):
+        """
+        Args:
+            insert_rows: envia (rows, row_ids) e retorna a lista de erros por linha
+                         (contrato de `bigquery.Client.insert_rows_json`)
+            build_row: monta (row, policy_info) a partir dos kwargs de log
+        """
+        self.insert_rows = insert_rows
+        self.build_row = build_row
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.batch_max_bytes = batch_max_bytes
+        self.max_retries = max_retries
+        self.spool_path = spool_path
+        self.enabled = enabled
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._buffer: List[Tuple[Dict[str, Any], str, int]] = []
+        self._buffer_bytes = 0
+        self._buffer_started: Optional[float] = None
+        self._spool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._last_replay = 0.0
+        self._stats = {
+            "enqueued": 0, "shipped_rows": 0, "batches": 0, "retries": 0,
+            "failed_batches": 0, "rejected_rows": 0, "spooled_rows": 0,
+            "replayed_rows": 0, "truncated_payloads": 0, "compressed_payloads": 0,
+            "last_batch_ms": 0.0, "last_error": None,
+        }
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def submit(self, **log_kwargs) -> None:
+        """Agenda um log; nunca bloqueia a requisição"""
+        self._inc("enqueued")
+        if not self.enabled:
+            row, insert_id, _ = self._build(log_kwargs)
+            self._ship([(row, insert_id)])
+            return
+
+        self._ensure_worker()
+        try:
+            self._queue.put_nowait(log_kwargs)
+        except queue.Full:
+            row, insert_id, _ = self._build(log_kwargs)
+            self._spool([(row, insert_id)])
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """Envia o que estiver na fila/buffer; True se concluiu dentro do timeout"""
+        if self._worker is None or not self._worker.is_alive():
+            return self._queue.empty() and not self._buffer
+        done = threading.Event()
+        try:
+            self._queue.put((_FLUSH, done), timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def shutdown(self, timeout: float = 30.0) -> None:
+        """Drena fila e buffer; o que não for enviado vai para o spool"""
+        if self._worker is None:
+            return
+        self.flush(timeout)
+        self._stop.set()
+        # Acorda o worker parado no get() (espera de até max_age)
+        try:
+            self._queue.put_nowait((_FLUSH, threading.Event()))
+        except queue.Full:
+            pass
+        self._worker.join(timeout=timeout)
+
+        leftovers = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(item, tuple) and item and item[0] is _FLUSH:
+                item[1].set()
+                continue
+            row, insert_id, _ = self._build(item)
+            leftovers.append((row, insert_id))
+        leftovers.extend((row, insert_id) for row, insert_id, _ in self._buffer)
+        self._buffer = []
+        if leftovers:
+            self._spool(leftovers)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Métricas de fila e envio"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["queue_capacity"] = self._queue.maxsize
+        stats["buffered_rows"] = len(self._buffer)
+        stats["buffered_bytes"] = self._buffer_bytes
+        stats["oldest_buffered_age_s"] = round(time.monotonic() - self._buffer_started, 2) if self._buffer_started else 0.0
+        stats["avg_batch_size"] = round(stats["shipped_rows"] / stats["batches"], 1) if stats["batches"] else 0.0
+        stats["spool_exists"] = os.path.exists(self.spool_path)
+        return stats
+
+    # ------------------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------------------
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+            self._worker.start()
+
+    def _run(self) -> None:
+        self.replay_spool()
+        while not self._stop.is_set():
+            if self._buffer_started is not None:
+                timeout = max(0.0, self.max_age - (time.monotonic() - self._buffer_started))
+            else:
+                timeout = self.max_age
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple) and item and item[0] is _FLUSH:
+                self._ship_buffer()
+                item[1].set()
+                continue
+
+            if item is not None:
+                self._add_to_buffer(item)
+
+            if self._buffer and (
+                len(self._buffer) >= self.batch_size
+                or self._buffer_bytes >= self.batch_max_bytes
+                or time.monotonic() - self._buffer_started >= self.max_age
+            ):
+                self._ship_buffer()
+            elif not self._buffer and time.monotonic() - self._last_replay > LOG_SHIPPER_REPLAY_INTERVAL:
+                self.replay_spool()
+
+    def _build(self, log_kwargs: Dict[str, Any]) -> Tuple[Dict[str, Any], str, int]:
+        row, info = self.build_row(**log_kwargs)
+        if info.get("truncated"):
+            self._inc("truncated_payloads")
+        if info.get("compressed"):
+            self._inc("compressed_payloads")
+        size = len(json.dumps(row, default=str))
+        return row, str(uuid.uuid4()), size
+
+    def _add_to_buffer(self, log_kwargs: Dict[str, Any]) -> None:
+        try:
+            row, insert_id, size = self._build(log_kwargs)
+        except Exception as e:
+            print(f"[LogShipper] ⚠️  Log descartado (erro ao montar linha): {e}")
+            return
+        if self._buffer and self._buffer_bytes + size > self.batch_max_bytes:
+            self._ship_buffer()
+        if not self._buffer:
+            self._buffer_started = time.monotonic()
+        self._buffer.append((row, insert_id, size))
+        self._buffer_bytes += size
+
+    def _ship_buffer(self) -> None:
+        if not self._buffer:
+            return
+        batch = [(row, insert_id) for row, insert_id, _ in self._buffer]
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._buffer_started = None
+        self._ship(batch)
+
+    # ------------------------------------------------------------------
+    # Envio com retry
+    # ------------------------------------------------------------------
+
+    def _ship(self, batch: List[Tuple[Dict[str, Any], str]]) -> bool:
+        """Envia um lote com backoff; esgotadas as tentativas, vai para o spool"""
+        pending = batch
+        start = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._inc("retries")
+                get_stage_metrics().increment("retries", kind="log_shipper")
+                delay = min(LOG_SHIPPER_BACKOFF_MAX, LOG_SHIPPER_BACKOFF_BASE * (2 ** (attempt - 1)))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                errors = self.insert_rows([row for row, _ in pending], [insert_id for _, insert_id in pending])
+            except Exception as e:
+                self._set_error(str(e))
+                continue
+
+            pending = self._retryable_rows(pending, errors or [])
+            if not pending:
+                with self._stats_lock:
+                    self._stats["shipped_rows"] += len(batch)
+                    self._stats["batches"] += 1
+                    self._stats["last_batch_ms"] = round((time.perf_counter() - start) * 1000, 1)
+                return True
+
+        self._inc("failed_batches")
+        print(f"[LogShipper] ⚠️  Lote com {len(pending)} linhas falhou após {self.max_retries + 1} tentativas; enviando para o spool")
+        self._spool(pending)
+        return False
+
+    def _retryable_rows(self, pending: List[Tuple[Dict[str, Any], str]], errors: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], str]]:
+        """
+        Separa erros por linha: "stopped" (linha válida barrada por outra) é
+        reenviada; demais erros (schema/valor) são rejeitados definitivamente.
+        """
+        if not errors:
+            return []
+        retry = []
+        for err in errors:
+            index = err.get("index")
+            if index is None or index >= len(pending):
+                continue
+            reasons = {e.get("reason") for e in err.get("errors", [])}
+            if reasons and reasons <= {"stopped", "backendError", "timeout"}:
+                retry.append(pending[index])
+            else:
+                self._inc("rejected_rows")
+                self._set_error(f"linha rejeitada: {err.get('errors')}")
+                print(f"[LogShipper] ❌ Linha de log rejeitada pelo BigQuery: {err.get('errors')}")
+        return retry
+
+    # ------------------------------------------------------------------
+    # Spool
+    # ------------------------------------------------------------------
+
+    def _spool(self, rows: List[Tuple[Dict[str, Any], str]]) -> None:
+        try:
+            with self._spool_lock, open(self.spool_path, "a", encoding="utf-8") as f:
+                for row, insert_id in rows:
+                    f.write(json.dumps({"insert_id": insert_id, "row": row}, default=str) + "\n")
+            with self._stats_lock:
+                self._stats["spooled_rows"] += len(rows)
+        except Exception as e:
+            print(f"[LogShipper] ❌ Falha ao gravar spool ({len(rows)} logs perdidos): {e}")
+
+    def replay_spool(self) -> int:
+        """Reenvia o spool em lotes; falhas voltam para o spool"""
+        self._last_replay = time.monotonic()
+        replay_path = self.spool_path + ".replay"
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return 0
+            os.replace(self.spool_path, replay_path)
+
+        rows = []
+        with open(replay_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    rows.append((entry["row"], entry["insert_id"]))
+                except (ValueError, KeyError):
+                    continue
+        os.remove(replay_path)
+
+        for start in range(0, len(rows), self.batch_size):
+            self._ship(rows[start:start + self.batch_size])
+        with self._stats_lock:
+            self._stats["replayed_rows"] += len(rows)
+        if rows:
+            print(f"[LogShipper] ♻️  {len(rows)} logs do spool reenviados")
+        return len(rows)
+
+    # ------------------------------------------------------------------
+
+    def _inc(self, key: str, amount: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[key] += amount
+
+    def _set_error(self, message: str) -> None:
+        with self._stats_lock:
+            self._stats["last_error"] = message[:500]
+
+
+_shipper_instance: Optional[LogShipper] = None
+
+
+def init_log_shipper(insert_rows, build_row, **kwargs) -> LogShipper:
+    """Cria o shipper singleton (chamado por utils.logger) e registra o flush no encerramento"""
+    global _shipper_instance
+    if _shipper_instance is None:
+        _shipper_instance = LogShipper(insert_rows, build_row, **kwargs)
+        atexit.register(_shipper_instance.shutdown)
+    return _shipper_instance
+
+
+def get_log_shipper() -> Optional[LogShipper]:
+    """Retorna o shipper singleton (None se utils.logger ainda não foi importado)"""
+    return _shipper_instance
@@ -5,6 +5,7 @@ import uuid
 import json
 import os
 from config.settings import DATASET_LOG_ID, CLIENTE_NAME, MAX_RATE_LIMIT
+from utils.log_shipper import init_log_shipper, apply_payload_policy
 
 client = bigquery.Client()
 
@@ -26,12 +27,52 @@ def log_interaction(
     custom_fields=None,
 ):
     """
-    Insere um registro de log na tabela de log do BigQuery, mapeando para o schema correto.
+    Agenda um registro de log na tabela de log do BigQuery, mapeando para o schema correto.
+    O insert é feito em lote pelo log shipper (fora do caminho da resposta).
     """
     if not session_id:
         session_id = str(uuid.uuid4())
 
-    now = datetime.now()
+    log_shipper.submit(**{
+        "user_input": user_input,
+        "function_params": function_params,
+        "query": query,
+        "raw_data": raw_data,
+        "raw_response": raw_response,
+        "refined_response": refined_response,
+        "first_ten_table_lines": first_ten_table_lines,
+        "graph_data": graph_data,
+        "export_data": export_data,
+        "status": status,
+        "status_msg": status_msg,
+        "error": str(error) if error else None,
+        "session_id": session_id,
+        "client_request_count": client_request_count,
+        "custom_fields": custom_fields,
+        "timestamp": datetime.now().isoformat(),
+    })
+
+
+def _build_log_row(
+    user_input,
+    function_params,
+    query,
+    raw_data,
+    raw_response=None,
+    refined_response=None,
+    first_ten_table_lines=None,
+    graph_data=None,
+    export_data=None,
+    status="OK",
+    status_msg=None,
+    error=None,
+    session_id=None,
+    client_request_count=None,
+    custom_fields=None,
+    timestamp=None,
+):
+    """Monta a linha no schema da tabela de log (retorna linha + info da política de payload)"""
+    now = datetime.fromisoformat(timestamp) if timestamp else datetime.now()
     date_input = now.strftime("%Y-%m-%d")
     hour_minute_input = now.strftime("%H:%M")
 
@@ -56,7 +97,7 @@ def log_interaction(
     }
 
     # Prepara o backup completo
-    full_payload = json.dumps({
+    full_payload, policy_info = apply_payload_policy({
         "user_input": user_input,
         "function_params": function_params,
         "query": query,
@@ -72,15 +113,19 @@ def log_interaction(
         "client_request_count": client_request_count,
         "custom_fields": custom_fields,
         "timestamp": now.isoformat(),
-    }, default=str)
+    })
 
-    row = {
+    return {
         "client_id": CLIENTE_NAME,
         "status": "ERROR" if error else status,
         "log_metadata": log_metadata,
         "full_payload": full_payload,
-    }
+    }, policy_info
+
+
+def _insert_log_rows(rows, row_ids):
+    """Streaming insert de um lote (row_ids = insertId para deduplicar retries)"""
+    return client.insert_rows_json(DATASET_LOG_ID, rows, row_ids=row_ids)
+
 
-    errors = client.insert_rows_json(DATASET_LOG_ID, [row])
-    if errors:
-        print("Erro ao inserir log:", errors)
\ No newline at end of file
+log_shipper = init_log_shipper(_insert_log_rows, _build_log_row)
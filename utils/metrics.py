@@ -6,15 +6,29 @@ Tracking completo de custos, performance e qualidade para otimização contínua
 do sistema de IA. Inclui métricas de token usage, tempo de resposta, 
 precisão de queries e satisfação do usuário.
 """
+import os
 import json
+import math
 import time
-import duckdb
+import atexit
+import random
+import threading
+from collections import deque
 from typing import Dict, List, Optional, Any
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
 from enum import Enum
 import uuid
 
+from utils.db_pool import execute_values
+from utils.storage import get_storage, resolve_store_url, dialect_sql
+
+# Buffer em memória (ring buffer) esvaziado em lote por timer
+METRICS_BUFFER_SIZE = int(os.getenv("METRICS_BUFFER_SIZE", "10000"))
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "2.0"))
+# Amostragem (0-1) só para métricas de alto volume; tokens/custo são sempre gravados
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1.0"))
+
 class MetricType(Enum):
     TOKEN_USAGE = "token_usage"
     RESPONSE_TIME = "response_time"
@@ -23,6 +37,21 @@ class MetricType(Enum):
     CACHE_HIT_RATE = "cache_hit_rate"
     ERROR_RATE = "error_rate"
     COST_TRACKING = "cost_tracking"
+    AUTOFIX_HIT_RATE = "autofix_hit_rate"
+
+# Colunas que identificam uma linha de rollup (além do bucket de tempo)
+ROLLUP_DIMENSIONS = ("metric_type", "user_id", "model", "prompt_type", "stage", "optimization")
+
+# Histograma de latência: bucket = ceil(4 * log2(ms)) -> limites com ~19% de resolução
+LATENCY_BUCKETS_PER_OCTAVE = 4
+
+# Tipos sujeitos a amostragem (contabilidade de tokens/custo nunca é amostrada)
+SAMPLED_METRIC_TYPES = {
+    MetricType.RESPONSE_TIME,
+    MetricType.QUERY_ACCURACY,
+    MetricType.CACHE_HIT_RATE,
+    MetricType.AUTOFIX_HIT_RATE,
+}
 
 @dataclass
 class AIMetric:
@@ -71,14 +100,33 @@ class QualityMetric:
 class AIMetricsCollector:
     """Coletor central de métricas do sistema de IA"""
     
-    def __init__(self, db_path: str = "ai_metrics.db"):
+    def __init__(
+        self,
+        db_path: str = "ai_metrics.db",
+        buffer_size: int = METRICS_BUFFER_SIZE,
+        flush_interval: float = METRICS_FLUSH_INTERVAL,
+        sample_rate: float = METRICS_SAMPLE_RATE
+    ):
         self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.sample_rate = sample_rate
+        self._db = get_storage(db_path)
         self.session_cache = {}
+        self._session_lock = threading.Lock()
+        # Ring buffer: deque.append é atômico; cheio, descarta o mais antigo
+        self._buffer = deque(maxlen=buffer_size)
+        self._flush_lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._high_water = max(1, buffer_size // 2)
+        self._stats = {"recorded": 0, "sampled_out": 0, "dropped": 0, "flushed": 0, "flush_errors": 0}
         self._init_database()
+        atexit.register(self.close)
     
     def _init_database(self):
         """Inicializa banco de dados de métricas"""
-        with duckdb.connect(self.db_path) as conn:
+        with self._db.connection() as conn:
             # Tabela principal de métricas
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS ai_metrics (
@@ -87,7 +135,7 @@ class AIMetricsCollector:
                     timestamp TIMESTAMP NOT NULL,
                     user_id VARCHAR NOT NULL,
                     session_id VARCHAR NOT NULL,
-                    value DOUBLE NOT NULL,
+                    value DOUBLE PRECISION NOT NULL,
                     unit VARCHAR NOT NULL,
                     context_json TEXT,
                     tags_json TEXT,
@@ -104,9 +152,9 @@ class AIMetricsCollector:
                     ended_at TIMESTAMP,
                     total_queries INTEGER DEFAULT 0,
                     total_tokens INTEGER DEFAULT 0,
-                    total_cost_usd DOUBLE DEFAULT 0.0,
-                    avg_response_time_ms DOUBLE DEFAULT 0.0,
-                    success_rate DOUBLE DEFAULT 1.0
+                    total_cost_usd DOUBLE PRECISION DEFAULT 0.0,
+                    avg_response_time_ms DOUBLE PRECISION DEFAULT 0.0,
+                    success_rate DOUBLE PRECISION DEFAULT 1.0
                 )
             """)
             
@@ -116,10 +164,54 @@ class AIMetricsCollector:
                     date DATE PRIMARY KEY,
                     total_queries INTEGER DEFAULT 0,
                     total_tokens INTEGER DEFAULT 0,
-                    total_cost_usd DOUBLE DEFAULT 0.0,
-                    avg_tokens_per_query DOUBLE DEFAULT 0.0,
+                    total_cost_usd DOUBLE PRECISION DEFAULT 0.0,
+                    avg_tokens_per_query DOUBLE PRECISION DEFAULT 0.0,
                     unique_users INTEGER DEFAULT 0,
-                    cache_hit_rate DOUBLE DEFAULT 0.0
+                    cache_hit_rate DOUBLE PRECISION DEFAULT 0.0
+                )
+            """)
+            
+            # Colunas tipadas para os campos quentes (antes só em context_json)
+            existing = set(self._db.table_columns("ai_metrics"))
+            typed_columns = {
+                "cost_usd": "DOUBLE PRECISION",
+                "model": "VARCHAR",
+                "prompt_type": "VARCHAR",
+                "stage": "VARCHAR",
+                "optimization": "BOOLEAN",
+            }
+            missing_typed = [col for col in typed_columns if col not in existing]
+            for col in missing_typed:
+                conn.execute(f"ALTER TABLE ai_metrics ADD COLUMN {col} {typed_columns[col]}")
+            
+            # Rollups incrementais (mantidos a cada flush)
+            for table, bucket_type in (("ai_metrics_hourly", "TIMESTAMP"), ("ai_metrics_daily", "DATE")):
+                conn.execute(f"""
+                    CREATE TABLE IF NOT EXISTS {table} (
+                        bucket {bucket_type} NOT NULL,
+                        metric_type VARCHAR NOT NULL,
+                        user_id VARCHAR NOT NULL,
+                        model VARCHAR NOT NULL DEFAULT '',
+                        prompt_type VARCHAR NOT NULL DEFAULT '',
+                        stage VARCHAR NOT NULL DEFAULT '',
+                        optimization BOOLEAN NOT NULL DEFAULT false,
+                        sample_count BIGINT NOT NULL,
+                        sum_value DOUBLE PRECISION NOT NULL,
+                        min_value DOUBLE PRECISION NOT NULL,
+                        max_value DOUBLE PRECISION NOT NULL,
+                        sum_cost DOUBLE PRECISION NOT NULL DEFAULT 0.0,
+                        PRIMARY KEY (bucket, metric_type, user_id, model, prompt_type, stage, optimization)
+                    )
+                """)
+            
+            # Histograma diário de latência (percentis sem varrer a tabela bruta)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS ai_metrics_latency_daily (
+                    bucket DATE NOT NULL,
+                    stage VARCHAR NOT NULL DEFAULT '',
+                    latency_bucket INTEGER NOT NULL,
+                    sample_count BIGINT NOT NULL,
+                    PRIMARY KEY (bucket, stage, latency_bucket)
                 )
             """)
             
@@ -127,24 +219,27 @@ class AIMetricsCollector:
             conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_timestamp ON ai_metrics(timestamp)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_user ON ai_metrics(user_id)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_metrics_type ON ai_metrics(metric_type)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user_started ON user_sessions(user_id, started_at)")
+        
+        if missing_typed and self._db.dialect == "duckdb":
+            # Banco anterior ao schema tipado (só existiu em DuckDB): preenche colunas
+            # e rollups a partir do histórico
+            self.rebuild_rollups(backfill_columns=True)
     
     def start_session(self, user_id: str) -> str:
         """Inicia uma nova sessão de usuário"""
         session_id = str(uuid.uuid4())
         
-        with duckdb.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO user_sessions (session_id, user_id, started_at)
-                VALUES (?, ?, ?)
-            """, (session_id, user_id, datetime.now()))
+        self._push("session_start", (session_id, user_id, datetime.now()))
         
-        self.session_cache[session_id] = {
-            "user_id": user_id,
-            "start_time": time.time(),
-            "queries": 0,
-            "total_tokens": 0,
-            "total_cost": 0.0
-        }
+        with self._session_lock:
+            self.session_cache[session_id] = {
+                "user_id": user_id,
+                "start_time": time.time(),
+                "queries": 0,
+                "total_tokens": 0,
+                "total_cost": 0.0
+            }
         
         return session_id
     
@@ -182,9 +277,11 @@ class AIMetricsCollector:
         self._save_metric(metric)
         
         # Atualiza cache da sessão
-        if session_id in self.session_cache:
-            self.session_cache[session_id]["total_tokens"] += usage.total_tokens
-            self.session_cache[session_id]["total_cost"] += usage.estimated_cost_usd
+        with self._session_lock:
+            session = self.session_cache.get(session_id)
+            if session is not None:
+                session["total_tokens"] += usage.total_tokens
+                session["total_cost"] += usage.estimated_cost_usd
     
     def record_performance(
         self,
@@ -250,8 +347,10 @@ class AIMetricsCollector:
         self._save_metric(metric)
         
         # Atualiza contadores de sessão
-        if session_id in self.session_cache:
-            self.session_cache[session_id]["queries"] += 1
+        with self._session_lock:
+            session = self.session_cache.get(session_id)
+            if session is not None:
+                session["queries"] += 1
     
     def record_cache_hit(
         self,
@@ -310,53 +409,334 @@ class AIMetricsCollector:
         
         self._save_metric(metric)
     
+    def record_autofix(
+        self,
+        session_id: str,
+        user_id: str,
+        rule: str,
+        success: bool,
+        context: Dict[str, Any] = None
+    ):
+        """Registra resultado de uma correção determinística de SQL (sem LLM)"""
+        metric = AIMetric(
+            id=str(uuid.uuid4()),
+            metric_type=MetricType.AUTOFIX_HIT_RATE,
+            timestamp=datetime.now(),
+            user_id=user_id,
+            session_id=session_id,
+            value=1.0 if success else 0.0,
+            unit="hit_rate",
+            context={
+                "rule": rule,
+                **(context or {})
+            },
+            tags={
+                "rule": rule,
+                "success": str(success)
+            }
+        )
+        
+        self._save_metric(metric)
+    
     def end_session(self, session_id: str):
         """Finaliza uma sessão de usuário"""
-        if session_id not in self.session_cache:
+        with self._session_lock:
+            session_data = self.session_cache.pop(session_id, None)
+        if session_data is None:
             return
         
-        session_data = self.session_cache[session_id]
         duration = time.time() - session_data["start_time"]
         
-        with duckdb.connect(self.db_path) as conn:
-            conn.execute("""
-                UPDATE user_sessions 
-                SET 
-                    ended_at = ?,
-                    total_queries = ?,
-                    total_tokens = ?,
-                    total_cost_usd = ?,
-                    avg_response_time_ms = ?
-                WHERE session_id = ?
-            """, (
-                datetime.now(),
-                session_data["queries"],
-                session_data["total_tokens"],
-                session_data["total_cost"],
-                duration * 1000 / max(session_data["queries"], 1),
-                session_id
-            ))
-        
-        del self.session_cache[session_id]
+        self._push("session_end", (
+            datetime.now(),
+            session_data["queries"],
+            session_data["total_tokens"],
+            session_data["total_cost"],
+            duration * 1000 / max(session_data["queries"], 1),
+            session_id
+        ))
     
     def _save_metric(self, metric: AIMetric):
-        """Salva métrica no banco de dados"""
-        with duckdb.connect(self.db_path) as conn:
-            conn.execute("""
-                INSERT INTO ai_metrics 
-                (id, metric_type, timestamp, user_id, session_id, value, unit, context_json, tags_json)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                metric.id,
-                metric.metric_type.value,
-                metric.timestamp,
-                metric.user_id,
-                metric.session_id,
-                metric.value,
-                metric.unit,
-                json.dumps(metric.context) if metric.context else None,
-                json.dumps(metric.tags) if metric.tags else None
-            ))
+        """Coloca a métrica no ring buffer (aplica amostragem nos tipos de alto volume)"""
+        tags = metric.tags
+        if self.sample_rate < 1.0 and metric.metric_type in SAMPLED_METRIC_TYPES:
+            if random.random() >= self.sample_rate:
+                self._stats["sampled_out"] += 1
+                return
+            tags = {**(tags or {}), "sample_rate": str(self.sample_rate)}
+        
+        context = metric.context or {}
+        if metric.metric_type == MetricType.TOKEN_USAGE:
+            cost = context.get("estimated_cost")
+        elif metric.metric_type == MetricType.COST_TRACKING:
+            cost = metric.value
+        else:
+            cost = None
+        
+        # Serialização de context/tags fica para o flush
+        self._push("metric", (
+            metric.id,
+            metric.metric_type.value,
+            metric.timestamp,
+            metric.user_id,
+            metric.session_id,
+            metric.value,
+            metric.unit,
+            cost,
+            context.get("model"),
+            context.get("prompt_type"),
+            context.get("stage"),
+            context.get("optimization_applied"),
+            metric.context,
+            tags
+        ))
+    
+    def _push(self, kind: str, row: tuple):
+        if len(self._buffer) == self._buffer.maxlen:
+            self._stats["dropped"] += 1
+        self._buffer.append((kind, row))
+        self._stats["recorded"] += 1
+        if len(self._buffer) >= self._high_water:
+            # Rajada: antecipa o flush em vez de esperar o timer
+            self._wake.set()
+        if self._flusher is None or not self._flusher.is_alive():
+            self._start_flusher()
+    
+    def _start_flusher(self):
+        with self._flush_lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flusher", daemon=True)
+            self._flusher.start()
+    
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+    
+    def flush(self) -> int:
+        """Grava em lote tudo que está no buffer; retorna a quantidade gravada"""
+        with self._flush_lock:
+            items = []
+            while True:
+                try:
+                    items.append(self._buffer.popleft())
+                except IndexError:
+                    break
+            if not items:
+                return 0
+            
+            metrics, starts, ends = [], [], []
+            for kind, row in items:
+                if kind == "metric":
+                    context, tags = row[12], row[13]
+                    metrics.append(row[:12] + (
+                        json.dumps(context, default=str) if context else None,
+                        json.dumps(tags, default=str) if tags else None
+                    ))
+                elif kind == "session_start":
+                    starts.append(row)
+                else:
+                    ends.append(row)
+            
+            try:
+                with self._db.connection() as conn:
+                    conn.execute("BEGIN TRANSACTION")
+                    try:
+                        if starts:
+                            execute_values(conn, """
+                                INSERT INTO user_sessions (session_id, user_id, started_at)
+                                VALUES {values}
+                            """, starts)
+                        if metrics:
+                            execute_values(conn, """
+                                INSERT INTO ai_metrics 
+                                (id, metric_type, timestamp, user_id, session_id, value, unit,
+                                 cost_usd, model, prompt_type, stage, optimization, context_json, tags_json)
+                                VALUES {values}
+                            """, metrics)
+                            self._update_rollups(conn, metrics)
+                        if ends:
+                            execute_values(conn, """
+                                WITH v(
+                                    ended_at, total_queries, total_tokens,
+                                    total_cost_usd, avg_response_time_ms, session_id
+                                ) AS (VALUES {values})
+                                UPDATE user_sessions 
+                                SET 
+                                    ended_at = v.ended_at,
+                                    total_queries = v.total_queries,
+                                    total_tokens = v.total_tokens,
+                                    total_cost_usd = v.total_cost_usd,
+                                    avg_response_time_ms = v.avg_response_time_ms
+                                FROM v
+                                WHERE user_sessions.session_id = v.session_id
+                            """, ends)
+                        conn.execute("COMMIT")
+                    except Exception:
+                        conn.execute("ROLLBACK")
+                        raise
+            except Exception as e:
+                self._stats["flush_errors"] += 1
+                print(f"[AIMetrics] ⚠️  Falha ao gravar {len(items)} métricas (nova tentativa no próximo ciclo): {e}")
+                # Devolve ao início do buffer (descartando o excedente mais antigo se encher)
+                self._buffer.extendleft(reversed(items))
+                return 0
+            
+            self._stats["flushed"] += len(items)
+            return len(items)
+    
+    @staticmethod
+    def _latency_bucket(value_ms: float) -> int:
+        return math.ceil(LATENCY_BUCKETS_PER_OCTAVE * math.log2(max(value_ms, 1.0)))
+    
+    def _update_rollups(self, conn, metrics: List[tuple]):
+        """Agrega o lote em memória e faz upsert nos rollups horário/diário"""
+        hourly: Dict[tuple, List[float]] = {}
+        daily: Dict[tuple, List[float]] = {}
+        latency: Dict[tuple, int] = {}
+        
+        for row in metrics:
+            metric_type, timestamp, user_id, value = row[1], row[2], row[3], row[5]
+            dims = (metric_type, user_id, row[8] or "", row[9] or "", row[10] or "", bool(row[11]))
+            cost = row[7] or 0.0
+            hour = timestamp.replace(minute=0, second=0, microsecond=0)
+            for target, key in ((hourly, (hour,) + dims), (daily, (timestamp.date(),) + dims)):
+                agg = target.get(key)
+                if agg is None:
+                    target[key] = [1, value, value, value, cost]
+                else:
+                    agg[0] += 1
+                    agg[1] += value
+                    agg[2] = min(agg[2], value)
+                    agg[3] = max(agg[3], value)
+                    agg[4] += cost
+            if metric_type == MetricType.RESPONSE_TIME.value:
+                key = (timestamp.date(), row[10] or "", self._latency_bucket(value))
+                latency[key] = latency.get(key, 0) + 1
+        
+        for table, aggregates in (("ai_metrics_hourly", hourly), ("ai_metrics_daily", daily)):
+            execute_values(conn, f"""
+                INSERT INTO {table}
+                (bucket, metric_type, user_id, model, prompt_type, stage, optimization,
+                 sample_count, sum_value, min_value, max_value, sum_cost)
+                VALUES {{values}}
+                ON CONFLICT (bucket, metric_type, user_id, model, prompt_type, stage, optimization)
+                DO UPDATE SET
+                    sample_count = {table}.sample_count + EXCLUDED.sample_count,
+                    sum_value = {table}.sum_value + EXCLUDED.sum_value,
+                    min_value = CASE WHEN EXCLUDED.min_value < {table}.min_value
+                                     THEN EXCLUDED.min_value ELSE {table}.min_value END,
+                    max_value = CASE WHEN EXCLUDED.max_value > {table}.max_value
+                                     THEN EXCLUDED.max_value ELSE {table}.max_value END,
+                    sum_cost = {table}.sum_cost + EXCLUDED.sum_cost
+            """, [key + tuple(agg) for key, agg in aggregates.items()])
+        
+        execute_values(conn, """
+            INSERT INTO ai_metrics_latency_daily (bucket, stage, latency_bucket, sample_count)
+            VALUES {values}
+            ON CONFLICT (bucket, stage, latency_bucket)
+            DO UPDATE SET sample_count = ai_metrics_latency_daily.sample_count + EXCLUDED.sample_count
+        """, [key + (count,) for key, count in latency.items()])
+    
+    def rebuild_rollups(self, backfill_columns: bool = False):
+        """
+        Recalcula os rollups a partir da tabela bruta (migração/reparo).
+        Com backfill_columns=True também preenche as colunas tipadas a partir do JSON.
+        """
+        self.flush()
+        with self._flush_lock, self._db.connection() as conn:
+            conn.execute("BEGIN TRANSACTION")
+            try:
+                if backfill_columns:
+                    conn.execute("""
+                        UPDATE ai_metrics SET
+                            cost_usd = CASE
+                                WHEN metric_type = 'token_usage'
+                                    THEN TRY_CAST(json_extract_string(context_json, '$.estimated_cost') AS DOUBLE)
+                                WHEN metric_type = 'cost_tracking' THEN value
+                            END,
+                            model = json_extract_string(context_json, '$.model'),
+                            prompt_type = json_extract_string(context_json, '$.prompt_type'),
+                            stage = json_extract_string(context_json, '$.stage'),
+                            optimization = TRY_CAST(json_extract_string(context_json, '$.optimization_applied') AS BOOLEAN)
+                        WHERE context_json IS NOT NULL
+                    """)
+                
+                dialect = self._db.dialect
+                for table, bucket_expr in (
+                    ("ai_metrics_hourly", dialect_sql(dialect, "hour", "timestamp")),
+                    ("ai_metrics_daily", dialect_sql(dialect, "date", "timestamp")),
+                ):
+                    conn.execute(f"DELETE FROM {table}")
+                    conn.execute(f"""
+                        INSERT INTO {table}
+                        SELECT
+                            {bucket_expr}, metric_type, user_id,
+                            COALESCE(model, ''), COALESCE(prompt_type, ''), COALESCE(stage, ''),
+                            COALESCE(optimization, false),
+                            COUNT(*), SUM(value), MIN(value), MAX(value), COALESCE(SUM(cost_usd), 0.0)
+                        FROM ai_metrics
+                        GROUP BY 1, 2, 3, 4, 5, 6, 7
+                    """)
+                
+                conn.execute("DELETE FROM ai_metrics_latency_daily")
+                conn.execute(f"""
+                    INSERT INTO ai_metrics_latency_daily
+                    SELECT
+                        {dialect_sql(dialect, "date", "timestamp")}, COALESCE(stage, ''),
+                        CAST(CEIL({LATENCY_BUCKETS_PER_OCTAVE} * {dialect_sql(
+                            dialect, "log2", "CASE WHEN value > 1.0 THEN value ELSE 1.0 END"
+                        )}) AS INTEGER),
+                        COUNT(*)
+                    FROM ai_metrics
+                    WHERE metric_type = 'response_time'
+                    GROUP BY 1, 2, 3
+                """)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+    
+    def _latency_percentile(self, conn, percentile: float, start_date, end_date, stage: Optional[str] = None) -> float:
+        """Percentil aproximado (limite superior do bucket) a partir do histograma diário"""
+        rows = conn.execute(f"""
+            SELECT latency_bucket, SUM(sample_count)
+            FROM ai_metrics_latency_daily
+            WHERE bucket BETWEEN ? AND ? {"AND stage = ?" if stage is not None else ""}
+            GROUP BY latency_bucket
+            ORDER BY latency_bucket
+        """, (start_date, end_date) + ((stage,) if stage is not None else ())).fetchall()
+        total = sum(count for _, count in rows)
+        if not total:
+            return 0
+        threshold = percentile * total
+        seen = 0
+        for bucket, count in rows:
+            seen += count
+            if seen >= threshold:
+                return 2 ** (bucket / LATENCY_BUCKETS_PER_OCTAVE)
+        return 2 ** (rows[-1][0] / LATENCY_BUCKETS_PER_OCTAVE)
+    
+    def close(self):
+        """Para o timer e grava o que restou no buffer"""
+        self._stop.set()
+        self._wake.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        self.flush()
+    
+    def get_buffer_stats(self) -> Dict[str, Any]:
+        """Estatísticas do buffer de métricas"""
+        stats = dict(self._stats)
+        stats["buffered"] = len(self._buffer)
+        stats["capacity"] = self._buffer.maxlen
+        stats["sample_rate"] = self.sample_rate
+        with self._session_lock:
+            stats["open_sessions"] = len(self.session_cache)
+        return stats
     
     def _classify_performance(self, duration_ms: float) -> str:
         """Classifica performance em tiers"""
@@ -379,90 +759,99 @@ class AIMetricsCollector:
             return "complex"
     
     def get_daily_summary(self, date: datetime = None) -> Dict[str, Any]:
-        """Obtém resumo diário de métricas"""
+        """Obtém resumo diário de métricas (lê os rollups diários)"""
         if not date:
             date = datetime.now().date()
         
-        with duckdb.connect(self.db_path) as conn:
-            # Token usage
-            token_stats = conn.execute("""
+        self.flush()
+        with self._db.connection() as conn:
+            stats = conn.execute("""
                 SELECT 
-                    COUNT(*) as queries,
-                    SUM(value) as total_tokens,
-                    AVG(value) as avg_tokens,
-                    SUM(CAST(JSON_EXTRACT(context_json, '$.estimated_cost') AS DOUBLE)) as total_cost
-                FROM ai_metrics 
-                WHERE metric_type = 'token_usage' 
-                AND DATE(timestamp) = ?
-            """, (date,)).fetchone()
-            
-            # Performance stats
-            perf_stats = conn.execute("""
-                SELECT 
-                    AVG(value) as avg_response_time,
-                    MIN(value) as min_response_time,
-                    MAX(value) as max_response_time,
-                    PERCENTILE_CONT(0.95) WITHIN GROUP (ORDER BY value) as p95_response_time
-                FROM ai_metrics 
-                WHERE metric_type = 'response_time' 
-                AND DATE(timestamp) = ?
-            """, (date,)).fetchone()
-            
-            # Cache hit rate
-            cache_stats = conn.execute("""
-                SELECT AVG(value) as hit_rate
-                FROM ai_metrics 
-                WHERE metric_type = 'cache_hit_rate' 
-                AND DATE(timestamp) = ?
-            """, (date,)).fetchone()
-            
-            # Success rate
-            success_stats = conn.execute("""
-                SELECT AVG(value) as success_rate
-                FROM ai_metrics 
-                WHERE metric_type = 'query_accuracy' 
-                AND DATE(timestamp) = ?
+                    SUM(sample_count) FILTER (WHERE metric_type = 'token_usage') as queries,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'token_usage') as total_tokens,
+                    SUM(sum_cost) FILTER (WHERE metric_type = 'token_usage') as total_cost,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'response_time')
+                        / SUM(sample_count) FILTER (WHERE metric_type = 'response_time') as avg_response_time,
+                    MIN(min_value) FILTER (WHERE metric_type = 'response_time') as min_response_time,
+                    MAX(max_value) FILTER (WHERE metric_type = 'response_time') as max_response_time,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'cache_hit_rate')
+                        / SUM(sample_count) FILTER (WHERE metric_type = 'cache_hit_rate') as hit_rate,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'query_accuracy')
+                        / SUM(sample_count) FILTER (WHERE metric_type = 'query_accuracy') as success_rate,
+                    COUNT(DISTINCT user_id) as unique_users
+                FROM ai_metrics_daily 
+                WHERE bucket = ?
             """, (date,)).fetchone()
             
-            # Unique users
-            user_count = conn.execute("""
-                SELECT COUNT(DISTINCT user_id) as unique_users
-                FROM ai_metrics 
-                WHERE DATE(timestamp) = ?
-            """, (date,)).fetchone()
+            p95 = self._latency_percentile(conn, 0.95, date, date)
             
+            queries = stats[0] or 0
             return {
                 "date": date.isoformat(),
-                "queries": token_stats[0] if token_stats[0] else 0,
-                "total_tokens": token_stats[1] if token_stats[1] else 0,
-                "avg_tokens_per_query": token_stats[2] if token_stats[2] else 0,
-                "total_cost_usd": token_stats[3] if token_stats[3] else 0.0,
-                "avg_response_time_ms": perf_stats[0] if perf_stats[0] else 0,
-                "min_response_time_ms": perf_stats[1] if perf_stats[1] else 0,
-                "max_response_time_ms": perf_stats[2] if perf_stats[2] else 0,
-                "p95_response_time_ms": perf_stats[3] if perf_stats[3] else 0,
-                "cache_hit_rate": cache_stats[0] if cache_stats[0] else 0.0,
-                "success_rate": success_stats[0] if success_stats[0] else 0.0,
-                "unique_users": user_count[0] if user_count[0] else 0
+                "queries": queries,
+                "total_tokens": stats[1] or 0,
+                "avg_tokens_per_query": (stats[1] / queries) if queries else 0,
+                "total_cost_usd": stats[2] or 0.0,
+                "avg_response_time_ms": stats[3] or 0,
+                "min_response_time_ms": stats[4] or 0,
+                "max_response_time_ms": stats[5] or 0,
+                "p95_response_time_ms": p95,
+                "cache_hit_rate": stats[6] or 0.0,
+                "success_rate": stats[7] or 0.0,
+                "unique_users": stats[8] or 0
             }
     
+    def get_hourly_summary(self, date: datetime = None) -> List[Dict[str, Any]]:
+        """Volume, tokens, custo e latência por hora do dia (rollup horário)"""
+        if not date:
+            date = datetime.now().date()
+        start = datetime.combine(date, datetime.min.time())
+        
+        self.flush()
+        with self._db.connection() as conn:
+            results = conn.execute("""
+                SELECT 
+                    bucket,
+                    SUM(sample_count) FILTER (WHERE metric_type = 'token_usage'),
+                    SUM(sum_value) FILTER (WHERE metric_type = 'token_usage'),
+                    SUM(sum_cost),
+                    SUM(sum_value) FILTER (WHERE metric_type = 'response_time')
+                        / SUM(sample_count) FILTER (WHERE metric_type = 'response_time')
+                FROM ai_metrics_hourly 
+                WHERE bucket >= ? AND bucket < ?
+                GROUP BY bucket
+                ORDER BY bucket
+            """, (start, start + timedelta(days=1))).fetchall()
+            
+            return [
+                {
+                    "hour": row[0].isoformat(),
+                    "queries": row[1] or 0,
+                    "total_tokens": row[2] or 0,
+                    "cost_usd": row[3] or 0.0,
+                    "avg_response_time_ms": row[4] or 0
+                }
+                for row in results
+            ]
+    
     def get_cost_trends(self, days: int = 30) -> List[Dict[str, Any]]:
         """Obtém tendências de custo dos últimos N dias"""
         end_date = datetime.now().date()
         start_date = end_date - timedelta(days=days)
         
-        with duckdb.connect(self.db_path) as conn:
+        self.flush()
+        with self._db.connection() as conn:
             results = conn.execute("""
                 SELECT 
-                    DATE(timestamp) as date,
-                    COUNT(*) as queries,
-                    SUM(value) as total_tokens,
-                    SUM(CAST(JSON_EXTRACT(context_json, '$.estimated_cost') AS DOUBLE)) as cost_usd,
-                    AVG(value) as avg_tokens_per_query
-                FROM ai_metrics 
+                    bucket as date,
+                    SUM(sample_count) as queries,
+                    SUM(sum_value) as total_tokens,
+                    SUM(sum_cost) as cost_usd,
+                    SUM(sum_value) / SUM(sample_count) as avg_tokens_per_query
+                FROM ai_metrics_daily 
                 WHERE metric_type = 'token_usage' 
-                AND DATE(timestamp) BETWEEN ? AND ?
-                GROUP BY DATE(timestamp)
+                AND bucket BETWEEN ? AND ?
+                GROUP BY bucket
                 ORDER BY date
             """, (start_date, end_date)).fetchall()
             
@@ -479,33 +868,30 @@ class AIMetricsCollector:
     
     def get_optimization_impact(self) -> Dict[str, Any]:
         """Analisa impacto das otimizações implementadas"""
-        with duckdb.connect(self.db_path) as conn:
-            # Compara antes/depois da otimização
-            optimized_metrics = conn.execute("""
+        self.flush()
+        with self._db.connection() as conn:
+            # Compara antes/depois da otimização (últimos 7 dias)
+            rows = conn.execute("""
                 SELECT 
-                    AVG(value) as avg_tokens,
-                    AVG(CAST(JSON_EXTRACT(context_json, '$.estimated_cost') AS DOUBLE)) as avg_cost,
-                    COUNT(*) as sample_size
-                FROM ai_metrics 
+                    optimization,
+                    SUM(sum_value) / SUM(sample_count) as avg_tokens,
+                    SUM(sum_cost) / SUM(sample_count) as avg_cost,
+                    SUM(sample_count) as sample_size
+                FROM ai_metrics_daily 
                 WHERE metric_type = 'token_usage' 
-                AND JSON_EXTRACT(tags_json, '$.optimization') = 'True'
-                AND timestamp >= DATE_SUB(CURRENT_DATE, INTERVAL 7 DAY)
-            """).fetchone()
-            
-            non_optimized_metrics = conn.execute("""
-                SELECT 
-                    AVG(value) as avg_tokens,
-                    AVG(CAST(JSON_EXTRACT(context_json, '$.estimated_cost') AS DOUBLE)) as avg_cost,
-                    COUNT(*) as sample_size
-                FROM ai_metrics 
-                WHERE metric_type = 'token_usage' 
-                AND JSON_EXTRACT(tags_json, '$.optimization') = 'False'
-                AND timestamp >= DATE_SUB(CURRENT_DATE, INTERVAL 7 DAY)
-            """).fetchone()
+                AND bucket >= ?
+                GROUP BY optimization
+            """, (datetime.now().date() - timedelta(days=7),)).fetchall()
+            by_flag = {row[0]: row[1:] for row in rows}
+            optimized_metrics = by_flag.get(True, (None, None, 0))
+            non_optimized_metrics = by_flag.get(False, (None, None, 0))
             
             if optimized_metrics[0] and non_optimized_metrics[0]:
                 token_savings = (non_optimized_metrics[0] - optimized_metrics[0]) / non_optimized_metrics[0]
-                cost_savings = (non_optimized_metrics[1] - optimized_metrics[1]) / non_optimized_metrics[1]
+                cost_savings = (
+                    (non_optimized_metrics[1] - optimized_metrics[1]) / non_optimized_metrics[1]
+                    if non_optimized_metrics[1] else 0.0
+                )
                 
                 return {
                     "token_reduction_percent": token_savings * 100,
@@ -521,39 +907,48 @@ class AIMetricsCollector:
             return {"status": "insufficient_data"}
     
     def get_user_insights(self, user_id: str, days: int = 30) -> Dict[str, Any]:
-        """Obtém insights específicos de um usuário"""
+        """Obtém insights específicos de um usuário (rollup diário + sessões)"""
         end_date = datetime.now()
         start_date = end_date - timedelta(days=days)
         
-        with duckdb.connect(self.db_path) as conn:
+        self.flush()
+        with self._db.connection() as conn:
             user_stats = conn.execute("""
                 SELECT 
-                    COUNT(DISTINCT session_id) as sessions,
-                    COUNT(*) as total_queries,
-                    SUM(CASE WHEN metric_type = 'token_usage' THEN value ELSE 0 END) as total_tokens,
-                    AVG(CASE WHEN metric_type = 'response_time' THEN value ELSE NULL END) as avg_response_time,
-                    AVG(CASE WHEN metric_type = 'query_accuracy' THEN value ELSE NULL END) as success_rate,
-                    SUM(CASE WHEN metric_type = 'cost_tracking' THEN value ELSE 0 END) as total_cost
-                FROM ai_metrics 
+                    SUM(sample_count) as total_queries,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'token_usage') as total_tokens,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'response_time')
+                        / SUM(sample_count) FILTER (WHERE metric_type = 'response_time') as avg_response_time,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'query_accuracy')
+                        / SUM(sample_count) FILTER (WHERE metric_type = 'query_accuracy') as success_rate,
+                    SUM(sum_value) FILTER (WHERE metric_type = 'cost_tracking') as total_cost
+                FROM ai_metrics_daily 
                 WHERE user_id = ? 
-                AND timestamp BETWEEN ? AND ?
-            """, (user_id, start_date, end_date)).fetchone()
+                AND bucket BETWEEN ? AND ?
+            """, (user_id, start_date.date(), end_date.date())).fetchone()
+            
+            sessions = conn.execute("""
+                SELECT COUNT(*) FROM user_sessions
+                WHERE user_id = ? AND started_at BETWEEN ? AND ?
+            """, (user_id, start_date, end_date)).fetchone()[0]
             
+            total_queries = user_stats[0] or 0
+            total_tokens = user_stats[1] or 0
             return {
                 "user_id": user_id,
                 "period_days": days,
-                "sessions": user_stats[0] or 0,
-                "total_queries": user_stats[1] or 0,
-                "total_tokens": user_stats[2] or 0,
-                "avg_response_time_ms": user_stats[3] or 0,
-                "success_rate": user_stats[4] or 0,
-                "total_cost_usd": user_stats[5] or 0,
-                "avg_queries_per_session": (user_stats[1] / max(user_stats[0], 1)) if user_stats[0] else 0,
-                "avg_tokens_per_query": (user_stats[2] / max(user_stats[1], 1)) if user_stats[1] else 0
+                "sessions": sessions or 0,
+                "total_queries": total_queries,
+                "total_tokens": total_tokens,
+                "avg_response_time_ms": user_stats[2] or 0,
+                "success_rate": user_stats[3] or 0,
+                "total_cost_usd": user_stats[4] or 0,
+                "avg_queries_per_session": (total_queries / max(sessions, 1)) if sessions else 0,
+                "avg_tokens_per_query": (total_tokens / max(total_queries, 1)) if total_queries else 0
             }
 
 # Instância global do coletor de métricas
-metrics_collector = AIMetricsCollector()
+metrics_collector = AIMetricsCollector(resolve_store_url("metrics", "ai_metrics.db"))
 
 # Alias para compatibilidade com imports existentes
 ai_metrics = metrics_collector
\ No newline at end of file
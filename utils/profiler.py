@@ -0,0 +1,139 @@
+"""
+Profiler - Amostragem de pilhas por requisição (sob demanda)
+============================================================
+
+Quando uma pergunta fica lenta, o perfil daquela execução se perde. Este
+módulo liga um profiler por amostragem em volta de
+`MessageHandler.process_message` apenas quando pedido:
+
+- parâmetro de URL `?profile=1` (PROFILING_ALLOW_QUERY_PARAM)
+- toggle de admin (sidebar para e-mails em PROFILING_ADMIN_EMAILS, ou
+  `set_profiling_forced(True)` para o processo inteiro)
+- amostragem de 1 em N requisições (PROFILING_SAMPLE_EVERY, 0 = desligado)
+
+Uma thread lê `sys._current_frames()` da thread da requisição a cada
+PROFILING_INTERVAL_MS (sem instrumentar chamadas, custo fora da thread
+perfilada) e acumula as pilhas no formato "collapsed" do flamegraph
+(`modulo:funcao;modulo:funcao N`). O resultado vai para `request_profiles`
+no cache.db junto do id da interação (utils.cache.save_profile) e pode ser
+renderizado com `python tools/flamegraph.py`.
+"""
+
+import os
+import sys
+import time
+import random
+import threading
+from collections import Counter
+from typing import Dict, Optional
+
+PROFILING_SAMPLE_EVERY = int(os.getenv("PROFILING_SAMPLE_EVERY", "0"))
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "5"))
+PROFILING_MAX_DEPTH = int(os.getenv("PROFILING_MAX_DEPTH", "96"))
+PROFILING_ALLOW_QUERY_PARAM = os.getenv("PROFILING_ALLOW_QUERY_PARAM", "true").lower() == "true"
+PROFILING_ADMIN_EMAILS = {
+    email.strip().lower()
+    for email in os.getenv("PROFILING_ADMIN_EMAILS", "").split(",")
+    if email.strip()
+}
+
+# Gatilhos registrados junto do perfil
+TRIGGER_QUERY_PARAM = "query_param"
+TRIGGER_ADMIN = "admin"
+TRIGGER_SAMPLED = "sampled"
+
+_forced = False
+
+
+def set_profiling_forced(enabled: bool) -> None:
+    """Toggle de admin para o processo: perfila todas as requisições"""
+    global _forced
+    _forced = enabled
+
+
+def is_profiling_admin(email: Optional[str]) -> bool:
+    return bool(email) and email.lower() in PROFILING_ADMIN_EMAILS
+
+
+def profile_trigger(query_param: bool = False, admin_toggle: bool = False,
+                    sample_every: int = PROFILING_SAMPLE_EVERY) -> Optional[str]:
+    """Decide se a requisição será perfilada; retorna o gatilho ou None"""
+    if query_param and PROFILING_ALLOW_QUERY_PARAM:
+        return TRIGGER_QUERY_PARAM
+    if admin_toggle or _forced:
+        return TRIGGER_ADMIN
+    if sample_every > 0 and random.randrange(sample_every) == 0:
+        return TRIGGER_SAMPLED
+    return None
+
+
+class SamplingProfiler:
+    """Amostra periodicamente a pilha de uma thread e agrega em pilhas colapsadas"""
+
+    def __init__(self, interval_ms: float = PROFILING_INTERVAL_MS, max_depth: int = PROFILING_MAX_DEPTH,
+                 thread_id: Optional[int] = None):
+        self.interval = interval_ms / 1000
+        self.max_depth = max_depth
+        self.thread_id = thread_id
+        self.stacks: Counter = Counter()
+        self.sample_count = 0
+        self.started_at: Optional[float] = None
+        self.duration_ms = 0.0
+        self._labels: Dict[object, str] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> "SamplingProfiler":
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self.started_at = time.perf_counter()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> "SamplingProfiler":
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.started_at is not None:
+            self.duration_ms = round((time.perf_counter() - self.started_at) * 1000, 2)
+        return self
+
+    def __enter__(self) -> "SamplingProfiler":
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop()
+
+    def _label(self, code) -> str:
+        # Cache por objeto de código: evita formatar strings a cada amostra
+        label = self._labels.get(code)
+        if label is None:
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            label = f"{module}:{code.co_name}"
+            self._labels[code] = label
+        return label
+
+    def _sample(self) -> None:
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+        labels = []
+        while frame is not None and len(labels) < self.max_depth:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        self.stacks[";".join(labels)] += 1
+        self.sample_count += 1
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self._sample()
+            except Exception:
+                # Amostra perdida não deve derrubar a requisição
+                pass
+
+    def collapsed(self) -> str:
+        """Pilhas no formato collapsed (flamegraph.pl / speedscope)"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
@@ -1,82 +1,332 @@
-import json
-from datetime import datetime, timedelta
+"""
+Rate Limit - Limites por usuário e globais seguros entre processos
+==================================================================
+
+O estado fica em SQLite em modo WAL (RATE_LIMIT_DB_PATH), compartilhado por
+todas as sessões Streamlit e processos workers da máquina:
+
+- `acquire()` verifica e consome todos os limites numa única transação
+  `BEGIN IMMEDIATE` (sem atualização perdida entre processos); `release()`
+  devolve uma aquisição cuja requisição foi barrada depois
+- leituras (`check_limit`, `state`, `get_current_usage`) são um SELECT em
+  conexão por thread, sem lock de escrita
+
+Políticas:
+- global diário (janela fixa por dia, `max_requests_per_day`)
+- global por minuto (janela deslizante, RATE_LIMIT_GLOBAL_PER_MINUTE, 0 = off)
+- por usuário, conforme o plano (RATE_LIMIT_POLICIES):
+  - "token_bucket": capacidade `burst`, reposição de `per_minute`/min
+  - "sliding_window": no máximo `per_minute` + `burst` em qualquer janela de 60s
+    (contador deslizante aproximado com duas janelas fixas)
+"""
+
 import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
 from pathlib import Path
+from typing import Any, Dict, Optional
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", os.path.join(PROJECT_ROOT, "rate_limit.db"))
+RATE_LIMIT_GLOBAL_PER_MINUTE = int(os.getenv("RATE_LIMIT_GLOBAL_PER_MINUTE", "0"))
+RATE_LIMIT_BUSY_TIMEOUT_MS = 5000
+
+POLICY_TOKEN_BUCKET = "token_bucket"
+POLICY_SLIDING_WINDOW = "sliding_window"
+
+# Limites de rajada por plano (os limites diários continuam no SubscriptionSystem)
+RATE_LIMIT_POLICIES = {
+    "free": {"policy": POLICY_TOKEN_BUCKET, "per_minute": 4, "burst": 3},
+    "basic": {"policy": POLICY_TOKEN_BUCKET, "per_minute": 10, "burst": 5},
+    "premium": {"policy": POLICY_TOKEN_BUCKET, "per_minute": 20, "burst": 10},
+    "enterprise": {"policy": POLICY_SLIDING_WINDOW, "per_minute": 60, "burst": 20},
+}
+DEFAULT_PLAN = "free"
+
+WINDOW_SECONDS = 60
+# Remove janelas/buckets antigos a cada N aquisições
+CLEANUP_EVERY = 500
+STALE_AFTER_SECONDS = 2 * 86400
+
+
+def _parse_limit(value) -> Optional[int]:
+    """MAX_REQUEST_DAY vem do ambiente como string ('' = sem limite)"""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return None
+    return limit if limit > 0 else None
+
+
+def open_wal_connection(db_path: str) -> sqlite3.Connection:
+    """Conexão SQLite em WAL/autocommit (transações explícitas com BEGIN IMMEDIATE)"""
+    conn = sqlite3.connect(db_path, timeout=RATE_LIMIT_BUSY_TIMEOUT_MS / 1000,
+                           isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={RATE_LIMIT_BUSY_TIMEOUT_MS}")
+    return conn
+
+
+def _day_start(now: float) -> int:
+    """Início do dia local (epoch) - chave da janela diária"""
+    lt = time.localtime(now)
+    return int(time.mktime((lt.tm_year, lt.tm_mon, lt.tm_mday, 0, 0, 0, 0, 0, -1)))
+
 
 class RateLimiter:
-    def __init__(self, max_requests_per_day=100, state_file='rate_limit_state.json'):
-        self.max_requests = max_requests_per_day
-        self.state_file = Path(state_file)
-        self.state = self._load_state()
+    """Limites globais e por usuário em SQLite WAL (compartilhado entre processos)"""
+
+    GLOBAL_DAY = "global:day"
+    GLOBAL_MINUTE = "global:minute"
+
+    def __init__(self, max_requests_per_day=100, state_file='rate_limit_state.json',
+                 db_path: str = RATE_LIMIT_DB_PATH, policies: Optional[Dict[str, Dict]] = None,
+                 global_per_minute: int = RATE_LIMIT_GLOBAL_PER_MINUTE):
+        self.max_requests = _parse_limit(max_requests_per_day)
+        self.db_path = db_path
+        self.policies = policies or RATE_LIMIT_POLICIES
+        self.global_per_minute = global_per_minute
+        self._local = threading.local()
+        self._acquires = 0
+        self._init_db()
+        self._import_legacy_state(Path(state_file))
+
+    # ------------------------------------------------------------------
+    # Armazenamento
+    # ------------------------------------------------------------------
+
+    def _conn(self) -> sqlite3.Connection:
+        """Conexão por thread (sqlite3 não compartilha conexões entre threads)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = open_wal_connection(self.db_path)
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self) -> None:
+        conn = self._conn()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_windows (
+                scope TEXT NOT NULL,
+                window_start INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (scope, window_start)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                scope TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated_at REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
 
-    def _load_state(self):
-        """Carrega o estado do rate limit do arquivo ou cria um novo"""
+    def _import_legacy_state(self, state_file: Path) -> None:
+        """Aproveita a contagem de hoje do antigo rate_limit_state.json (uma vez)"""
         try:
-            if self.state_file.exists():
-                with open(self.state_file, 'r') as f:
-                    state = json.load(f)
-                    # Verifica se a data salva ainda é hoje
-                    last_date = datetime.strptime(state['date'], '%Y-%m-%d').date()
-                    if last_date == datetime.now().date():
-                        return state
-        except (json.JSONDecodeError, KeyError):
+            if not state_file.exists():
+                return
+            with open(state_file, 'r') as f:
+                state = json.load(f)
+            if state.get('date') != datetime.now().strftime('%Y-%m-%d'):
+                return
+            self._conn().execute(
+                "INSERT OR IGNORE INTO rate_windows (scope, window_start, count) VALUES (?, ?, ?)",
+                (self.GLOBAL_DAY, _day_start(time.time()), int(state.get('count', 0)))
+            )
+        except (OSError, ValueError, sqlite3.Error):
             pass
-        
-        # Se não existir ou for de outro dia, cria novo estado
+
+    def _window_count(self, conn, scope: str, window_start: int) -> int:
+        row = conn.execute(
+            "SELECT count FROM rate_windows WHERE scope = ? AND window_start = ?",
+            (scope, window_start)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _sliding_count(self, conn, scope: str, now: float) -> float:
+        """Contador deslizante: janela atual + fração restante da anterior"""
+        current = int(now // WINDOW_SECONDS) * WINDOW_SECONDS
+        rows = dict(conn.execute(
+            "SELECT window_start, count FROM rate_windows WHERE scope = ? AND window_start IN (?, ?)",
+            (scope, current, current - WINDOW_SECONDS)
+        ).fetchall())
+        weight = 1 - (now - current) / WINDOW_SECONDS
+        return rows.get(current, 0) + rows.get(current - WINDOW_SECONDS, 0) * weight
+
+    def _bump_window(self, conn, scope: str, window_start: int, cost: int) -> None:
+        conn.execute("""
+            INSERT INTO rate_windows (scope, window_start, count) VALUES (?, ?, ?)
+            ON CONFLICT (scope, window_start) DO UPDATE SET count = count + excluded.count
+        """, (scope, window_start, cost))
+
+    def _bucket_tokens(self, conn, scope: str, policy: Dict, now: float) -> float:
+        row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE scope = ?", (scope,)).fetchone()
+        if row is None:
+            return float(policy["burst"])
+        tokens, updated_at = row
+        refill = max(0.0, now - updated_at) * policy["per_minute"] / WINDOW_SECONDS
+        return min(float(policy["burst"]), tokens + refill)
+
+    def _policy_for(self, plan_id: Optional[str]) -> Dict:
+        return self.policies.get(plan_id or DEFAULT_PLAN) or self.policies[DEFAULT_PLAN]
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def acquire(self, user_id: Optional[str] = None, plan_id: Optional[str] = None,
+                cost: int = 1) -> Dict[str, Any]:
+        """
+        Verifica e consome atomicamente (entre processos) os limites global e do
+        usuário. Retorna {'allowed', 'reason', 'retry_after'}; nada é consumido
+        quando algum limite nega.
+        """
+        now = time.time()
+        day = _day_start(now)
+        minute = int(now // WINDOW_SECONDS) * WINDOW_SECONDS
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            denied = None
+            if self.max_requests is not None:
+                if self._window_count(conn, self.GLOBAL_DAY, day) + cost > self.max_requests:
+                    denied = ("global_daily", day + 86400 - now)
+
+            if denied is None and self.global_per_minute:
+                if self._sliding_count(conn, self.GLOBAL_MINUTE, now) + cost > self.global_per_minute:
+                    denied = ("global_minute", minute + WINDOW_SECONDS - now)
+
+            user_scope = f"user:{user_id}" if user_id else None
+            policy = self._policy_for(plan_id) if user_scope else None
+            tokens = None
+            if denied is None and user_scope:
+                if policy["policy"] == POLICY_TOKEN_BUCKET:
+                    tokens = self._bucket_tokens(conn, user_scope, policy, now)
+                    if tokens < cost:
+                        denied = ("user_burst", (cost - tokens) * WINDOW_SECONDS / policy["per_minute"])
+                else:
+                    limit = policy["per_minute"] + policy["burst"]
+                    if self._sliding_count(conn, user_scope, now) + cost > limit:
+                        denied = ("user_minute", minute + WINDOW_SECONDS - now)
+
+            if denied is not None:
+                conn.execute("ROLLBACK")
+                return {"allowed": False, "reason": denied[0], "retry_after": round(max(0.0, denied[1]), 2)}
+
+            self._bump_window(conn, self.GLOBAL_DAY, day, cost)
+            if self.global_per_minute:
+                self._bump_window(conn, self.GLOBAL_MINUTE, minute, cost)
+            if user_scope:
+                if tokens is not None:
+                    conn.execute("""
+                        INSERT INTO rate_buckets (scope, tokens, updated_at) VALUES (?, ?, ?)
+                        ON CONFLICT (scope) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at
+                    """, (user_scope, tokens - cost, now))
+                else:
+                    self._bump_window(conn, user_scope, minute, cost)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._acquires += 1
+        if self._acquires % CLEANUP_EVERY == 0:
+            self.cleanup(now)
+        return {"allowed": True, "reason": None, "retry_after": 0.0}
+
+    def release(self, user_id: Optional[str] = None, plan_id: Optional[str] = None,
+                cost: int = 1) -> None:
+        """
+        Devolve um `acquire()` permitido cuja requisição foi barrada depois
+        (ex.: cota diária do plano). Janelas já encerradas não são alteradas.
+        """
+        now = time.time()
+        day = _day_start(now)
+        minute = int(now // WINDOW_SECONDS) * WINDOW_SECONDS
+        user_scope = f"user:{user_id}" if user_id else None
+        release_window = """
+            UPDATE rate_windows SET count = MAX(0, count - ?) WHERE scope = ? AND window_start = ?
+        """
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(release_window, (cost, self.GLOBAL_DAY, day))
+            if self.global_per_minute:
+                conn.execute(release_window, (cost, self.GLOBAL_MINUTE, minute))
+            if user_scope:
+                policy = self._policy_for(plan_id)
+                if policy["policy"] == POLICY_TOKEN_BUCKET:
+                    tokens = self._bucket_tokens(conn, user_scope, policy, now)
+                    conn.execute("UPDATE rate_buckets SET tokens = ?, updated_at = ? WHERE scope = ?",
+                                 (min(float(policy["burst"]), tokens + cost), now, user_scope))
+                else:
+                    conn.execute(release_window, (cost, user_scope, minute))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def cleanup(self, now: Optional[float] = None) -> None:
+        """Remove janelas e buckets sem uso há mais de STALE_AFTER_SECONDS"""
+        cutoff = (now or time.time()) - STALE_AFTER_SECONDS
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM rate_windows WHERE window_start < ?", (cutoff,))
+            conn.execute("DELETE FROM rate_buckets WHERE updated_at < ?", (cutoff,))
+        except sqlite3.Error as e:
+            print(f"[RateLimit] ⚠️  Falha na limpeza: {e}")
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        """Contagem global do dia (compatível com o antigo estado em JSON)"""
+        now = time.time()
         return {
-            'date': datetime.now().strftime('%Y-%m-%d'),
-            'count': 0
+            'date': datetime.fromtimestamp(now).strftime('%Y-%m-%d'),
+            'count': self._window_count(self._conn(), self.GLOBAL_DAY, _day_start(now)),
         }
 
-    def _save_state(self):
-        """Salva o estado atual no arquivo"""
-        with open(self.state_file, 'w') as f:
-            json.dump(self.state, f)
-
-    def check_limit(self):
-        """Verifica se o limite foi atingido"""
-        current_date = datetime.now().date()
-        saved_date = datetime.strptime(self.state['date'], '%Y-%m-%d').date()
-
-        # Se for um novo dia, reinicia o contador
-        if current_date != saved_date:
-            self.state = {
-                'date': datetime.now().strftime('%Y-%m-%d'),
-                'count': 0
-            }
-
-        return self.state['count'] >= self.max_requests
-
-    def increment(self):
-        """Incrementa o contador de requisições"""
-        current_date = datetime.now().date()
-        saved_date = datetime.strptime(self.state['date'], '%Y-%m-%d').date()
-
-        if current_date != saved_date:
-            self.state = {
-                'date': datetime.now().strftime('%Y-%m-%d'),
-                'count': 1
-            }
-        else:
-            self.state['count'] += 1
-
-        self._save_state()
-    
-    def get_current_usage(self):
-        """Retorna o uso atual e máximo"""
-        current_date = datetime.now().date()
-        saved_date = datetime.strptime(self.state['date'], '%Y-%m-%d').date()
-        
-        # Se for um novo dia, reinicia o contador
-        if current_date != saved_date:
-            self.state = {
-                'date': datetime.now().strftime('%Y-%m-%d'),
-                'count': 0
-            }
-            self._save_state()
-        
-        return {
-            'current': self.state['count'],
+    def check_limit(self, user_id: Optional[str] = None, plan_id: Optional[str] = None) -> bool:
+        """Verifica (sem consumir) se o limite foi atingido"""
+        now = time.time()
+        conn = self._conn()
+        if self.max_requests is not None and \
+                self._window_count(conn, self.GLOBAL_DAY, _day_start(now)) >= self.max_requests:
+            return True
+        if self.global_per_minute and self._sliding_count(conn, self.GLOBAL_MINUTE, now) >= self.global_per_minute:
+            return True
+        if user_id:
+            policy = self._policy_for(plan_id)
+            scope = f"user:{user_id}"
+            if policy["policy"] == POLICY_TOKEN_BUCKET:
+                return self._bucket_tokens(conn, scope, policy, now) < 1
+            return self._sliding_count(conn, scope, now) >= policy["per_minute"] + policy["burst"]
+        return False
+
+    def increment(self, user_id: Optional[str] = None, plan_id: Optional[str] = None) -> bool:
+        """Consome uma requisição; retorna False se algum limite negou"""
+        return self.acquire(user_id, plan_id)["allowed"]
+
+    def get_current_usage(self, user_id: Optional[str] = None, plan_id: Optional[str] = None) -> Dict[str, Any]:
+        """Retorna o uso atual e máximo (global; com user_id, inclui o do usuário)"""
+        current = self.state['count']
+        usage = {
+            'current': current,
             'max': self.max_requests,
-            'percentage': (self.state['count'] / self.max_requests) * 100
-        }
\ No newline at end of file
+            'percentage': (current / self.max_requests) * 100 if self.max_requests else 0,
+        }
+        if user_id:
+            now = time.time()
+            policy = self._policy_for(plan_id)
+            scope = f"user:{user_id}"
+            usage['user'] = {'policy': policy['policy'], 'per_minute': policy['per_minute'], 'burst': policy['burst']}
+            if policy['policy'] == POLICY_TOKEN_BUCKET:
+                usage['user']['tokens'] = round(self._bucket_tokens(self._conn(), scope, policy, now), 2)
+            else:
+                usage['user']['window_count'] = round(self._sliding_count(self._conn(), scope, now), 2)
+        return usage
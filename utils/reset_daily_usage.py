@@ -34,10 +34,7 @@ user_id = user['id']
 def reset_daily_usage(user_id, date=None):
     if not date:
         date = datetime.now().strftime('%Y-%m-%d')
-    db.conn.execute(
-        "DELETE FROM daily_usage WHERE user_id = ? AND usage_date = ?",
-        [user_id, date]
-    )
+    db.reset_daily_usage(user_id, date)
     print(f"Zerado uso diário para {user_id} ({user_email}) em {date}")
 
 reset_daily_usage(user_id)
@@ -0,0 +1,304 @@
+"""
+Stage Metrics - Histogramas de latência por etapa do pipeline
+=============================================================
+
+Registro do processo com um histograma estilo HDR por etapa (RAG, Gemini
+NL→SQL, build_query, validação, BigQuery, análise, persistência...) e
+contadores (hits de cache, retries). Diferente do `timing_info` do
+MessageHandler (uma requisição, descartado depois), aqui os valores acumulam
+durante a vida do processo e permitem acompanhar p50/p95/p99 por etapa.
+
+Exposição em texto no formato Prometheus:
+- `render_prometheus()` / `dump_to_file(path)`
+- STAGE_METRICS_DUMP_PATH: grava o arquivo a cada STAGE_METRICS_DUMP_INTERVAL s
+- STAGE_METRICS_PORT: endpoint HTTP mínimo (GET /metrics) em thread daemon
+
+Uso:
+    from utils.stage_metrics import get_stage_metrics, STAGE_BIGQUERY
+    with get_stage_metrics().time_stage(STAGE_BIGQUERY):
+        ...
+    get_stage_metrics().increment("cache_hits", cache="validation")
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+# Etapas do pipeline
+STAGE_TOTAL = "total"
+STAGE_RAG = "rag"
+STAGE_GEMINI_NL_SQL = "gemini_nl_sql"
+STAGE_GEMINI_ADAPTATION = "gemini_adaptation"
+STAGE_BUILD_QUERY = "build_query"
+STAGE_VALIDATION = "validation"
+STAGE_BIGQUERY = "bigquery"
+STAGE_ANALYSIS = "analysis"
+STAGE_PERSISTENCE = "persistence"
+STAGE_CONVERSATIONAL_ANALYTICS = "conversational_analytics"
+STAGE_FOLLOWUP = "followup_local"
+
+# Etapas do MessageHandler (_start_timing/_end_timing) -> etapa do registro.
+# RAG/NL→SQL/validação/BigQuery são medidos dentro das próprias funções.
+HANDLER_STEP_STAGES = {
+    "processo_completo": STAGE_TOTAL,
+    "processamento_ca": STAGE_CONVERSATIONAL_ANALYTICS,
+    "refino_local": STAGE_FOLLOWUP,
+    "construcao_query": STAGE_BUILD_QUERY,
+    "refinamento_gemini_final": STAGE_ANALYSIS,
+    "salvamento_interacao": STAGE_PERSISTENCE,
+}
+
+QUANTILES = (0.5, 0.95, 0.99)
+METRIC_PREFIX = "ai_pipeline"
+
+STAGE_METRICS_DUMP_PATH = os.getenv("STAGE_METRICS_DUMP_PATH", "")
+STAGE_METRICS_DUMP_INTERVAL = float(os.getenv("STAGE_METRICS_DUMP_INTERVAL", "60"))
+STAGE_METRICS_PORT = int(os.getenv("STAGE_METRICS_PORT", "0"))
+
+
+class LatencyHistogram:
+    """
+    Histograma log-linear (estilo HDR) em microssegundos: 2^SUB_BITS
+    sub-buckets lineares por potência de 2 -> erro relativo <= ~3%,
+    memória proporcional ao número de buckets ocupados.
+    """
+
+    SUB_BITS = 5
+    SUB_COUNT = 1 << SUB_BITS
+
+    def __init__(self):
+        self._counts: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum_us = 0
+        self.min_us: Optional[int] = None
+        self.max_us = 0
+
+    @classmethod
+    def _index(cls, value_us: int) -> int:
+        shift = max(0, value_us.bit_length() - cls.SUB_BITS - 1)
+        return shift * cls.SUB_COUNT + (value_us >> shift)
+
+    @classmethod
+    def _bucket_value(cls, index: int) -> float:
+        """Ponto médio do bucket (em µs)"""
+        if index < 2 * cls.SUB_COUNT:
+            return float(index)
+        shift = index // cls.SUB_COUNT - 1
+        sub = index - shift * cls.SUB_COUNT
+        return ((sub << shift) + ((sub + 1) << shift)) / 2
+
+    def record(self, duration_ms: float) -> None:
+        value_us = max(0, int(duration_ms * 1000))
+        index = self._index(value_us)
+        with self._lock:
+            self._counts[index] = self._counts.get(index, 0) + 1
+            self.count += 1
+            self.sum_us += value_us
+            if self.min_us is None or value_us < self.min_us:
+                self.min_us = value_us
+            if value_us > self.max_us:
+                self.max_us = value_us
+
+    def percentiles(self, quantiles=QUANTILES) -> Dict[float, float]:
+        """Percentis em ms"""
+        with self._lock:
+            items = sorted(self._counts.items())
+            total = self.count
+            max_us = self.max_us
+        result = {}
+        if not total:
+            return {q: 0.0 for q in quantiles}
+        for q in quantiles:
+            threshold = q * total
+            seen = 0
+            value = max_us
+            for index, count in items:
+                seen += count
+                if seen >= threshold:
+                    value = min(self._bucket_value(index), max_us)
+                    break
+            result[q] = round(value / 1000, 3)
+        return result
+
+    def snapshot(self) -> Dict[str, float]:
+        percentiles = self.percentiles()
+        with self._lock:
+            count, sum_us, min_us, max_us = self.count, self.sum_us, self.min_us, self.max_us
+        return {
+            "count": count,
+            "sum_ms": round(sum_us / 1000, 3),
+            "mean_ms": round(sum_us / count / 1000, 3) if count else 0.0,
+            "min_ms": round((min_us or 0) / 1000, 3),
+            "max_ms": round(max_us / 1000, 3),
+            "p50_ms": percentiles[0.5],
+            "p95_ms": percentiles[0.95],
+            "p99_ms": percentiles[0.99],
+        }
+
+
+class StageMetricsRegistry:
+    """Histogramas por etapa + contadores rotulados (thread-safe)"""
+
+    def __init__(self):
+        self._histograms: Dict[str, LatencyHistogram] = {}
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    def observe(self, stage: str, duration_ms: float) -> None:
+        """Registra a duração de uma etapa"""
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(stage, LatencyHistogram())
+        histogram.record(duration_ms)
+
+    @contextmanager
+    def time_stage(self, stage: str):
+        """Mede o bloco e registra na etapa (mesmo se houver exceção)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, (time.perf_counter() - start) * 1000)
+
+    def increment(self, name: str, amount: float = 1, **labels) -> None:
+        """Incrementa um contador (ex.: cache_hits, retries) com rótulos"""
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def get_stage_summary(self) -> Dict[str, Dict[str, float]]:
+        """p50/p95/p99, média, min/max e contagem por etapa"""
+        with self._lock:
+            histograms = dict(self._histograms)
+        return {stage: hist.snapshot() for stage, hist in sorted(histograms.items())}
+
+    def get_counters(self) -> List[Dict]:
+        with self._lock:
+            counters = dict(self._counters)
+        return [
+            {"name": name, "labels": dict(labels), "value": value}
+            for (name, labels), value in sorted(counters.items())
+        ]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+    # ------------------------------------------------------------------
+    # Exposição
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> str:
+        if not labels:
+            return ""
+        def _escape(value) -> str:
+            return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+    def render_prometheus(self) -> str:
+        """Texto no formato de exposição do Prometheus"""
+        lines = []
+        summary = self.get_stage_summary()
+        name = f"{METRIC_PREFIX}_stage_latency_ms"
+        lines.append(f"# HELP {name} Latência por etapa do pipeline (ms)")
+        lines.append(f"# TYPE {name} summary")
+        max_lines = [f"# TYPE {METRIC_PREFIX}_stage_latency_max_ms gauge"]
+        for stage, snap in summary.items():
+            for q in QUANTILES:
+                key = f"p{int(q * 100)}_ms"
+                lines.append(f"{name}{self._labels({'stage': stage, 'quantile': str(q)})} {snap[key]}")
+            lines.append(f"{name}_sum{self._labels({'stage': stage})} {snap['sum_ms']}")
+            lines.append(f"{name}_count{self._labels({'stage': stage})} {snap['count']}")
+            max_lines.append(f"{METRIC_PREFIX}_stage_latency_max_ms{self._labels({'stage': stage})} {snap['max_ms']}")
+        if summary:
+            lines.extend(max_lines)
+
+        typed = set()
+        for counter in self.get_counters():
+            metric = f"{METRIC_PREFIX}_{counter['name']}_total"
+            if metric not in typed:
+                lines.append(f"# TYPE {metric} counter")
+                typed.add(metric)
+            lines.append(f"{metric}{self._labels(counter['labels'])} {counter['value']}")
+
+        lines.append(f"{METRIC_PREFIX}_uptime_seconds {round(time.time() - self.started_at, 1)}")
+        return "\n".join(lines) + "\n"
+
+    def dump_to_file(self, path: str) -> None:
+        """Grava a exposição em arquivo (escrita atômica)"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+
+_registry = StageMetricsRegistry()
+_exporters_started = False
+_exporters_lock = threading.Lock()
+
+
+def get_stage_metrics() -> StageMetricsRegistry:
+    """Retorna o registro global de métricas por etapa"""
+    _start_exporters()
+    return _registry
+
+
+def _start_exporters() -> None:
+    """Inicia (uma vez) o dump periódico e/ou o endpoint HTTP, se configurados"""
+    global _exporters_started
+    if _exporters_started:
+        return
+    with _exporters_lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+
+        if STAGE_METRICS_DUMP_PATH:
+            def _dump_loop():
+                while True:
+                    time.sleep(STAGE_METRICS_DUMP_INTERVAL)
+                    try:
+                        _registry.dump_to_file(STAGE_METRICS_DUMP_PATH)
+                    except Exception as e:
+                        print(f"[StageMetrics] ⚠️  Falha ao gravar {STAGE_METRICS_DUMP_PATH}: {e}")
+            threading.Thread(target=_dump_loop, name="stage-metrics-dump", daemon=True).start()
+
+        if STAGE_METRICS_PORT:
+            try:
+                start_metrics_server(STAGE_METRICS_PORT)
+            except OSError as e:
+                # Vários processos Streamlit na mesma máquina: só o primeiro expõe
+                print(f"[StageMetrics] ⚠️  Porta {STAGE_METRICS_PORT} indisponível: {e}")
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.rstrip("/") not in ("", "/metrics"):
+            self.send_error(404)
+            return
+        body = _registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """Sobe o endpoint GET /metrics em thread daemon"""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="stage-metrics-http", daemon=True).start()
+    print(f"[StageMetrics] 📈 Endpoint de métricas em http://{host}:{port}/metrics")
+    return server
@@ -3,32 +3,82 @@
 
 import streamlit as st
 import json
+import os
+import time
+import threading
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 from utils.user_database import db
 from utils.auth_system import get_current_user
 from ui.deepseek_theme import fix_alert_visibility
 
+# Assinatura/plano mudam raramente: cache por usuário com TTL, invalidado pela
+# versão do UserDatabase (assign_plan_to_user / create_plan)
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "300"))
+
+# Mapeamento de features por plano (conjuntos pré-computados)
+PLAN_FEATURE_ACCESS = {
+    'free': frozenset(['basic_queries']),
+    'basic': frozenset(['basic_queries', 'excel_export', 'basic_charts']),
+    'premium': frozenset(['basic_queries', 'excel_export', 'basic_charts', 'advanced_charts', 'priority_support']),
+    'enterprise': frozenset(['basic_queries', 'excel_export', 'basic_charts', 'advanced_charts', 'priority_support', 'api_access', 'custom_reports'])
+}
+
+_subscription_cache: Dict[str, Tuple[float, Tuple[int, int], Dict]] = {}
+_plans_cache: Dict[str, Tuple[float, int, List[Dict]]] = {}
+_cache_lock = threading.Lock()
+
+def _parse_features(features) -> List:
+    try:
+        return json.loads(features) if features else []
+    except:
+        return []
+
 class SubscriptionSystem:
     
     @staticmethod
     def get_user_subscription_info(user_id: str = None) -> Dict:
-        """Obtém informações da assinatura do usuário"""
+        """Obtém informações da assinatura do usuário (cache com TTL por usuário)"""
         if not user_id:
             current_user = get_current_user()
             if not current_user:
                 return SubscriptionSystem._get_default_plan()
             user_id = current_user['id']
         
-        subscription = db.get_user_subscription(user_id)
+        version = db.subscription_version(user_id)
+        now = time.monotonic()
+        cached = _subscription_cache.get(user_id)
+        if cached and cached[0] > now and cached[1] == version:
+            return dict(cached[2])
+        
+        try:
+            info = SubscriptionSystem._load_subscription_info(user_id)
+        except Exception as e:
+            # Falha do banco: plano gratuito só nesta chamada, sem cachear
+            print(f"Erro ao obter assinatura: {e}")
+            return SubscriptionSystem._get_default_plan()
+        with _cache_lock:
+            _subscription_cache[user_id] = (now + SUBSCRIPTION_CACHE_TTL, version, info)
+        return dict(info)
+    
+    @staticmethod
+    def invalidate_cache(user_id: str = None) -> None:
+        """Descarta o cache de assinatura (de um usuário ou de todos) e de planos"""
+        with _cache_lock:
+            if user_id is None:
+                _subscription_cache.clear()
+            else:
+                _subscription_cache.pop(user_id, None)
+            _plans_cache.clear()
+    
+    @staticmethod
+    def _load_subscription_info(user_id: str) -> Dict:
+        """Assinatura do banco ou plano gratuito (sem assinatura); falhas do banco são propagadas"""
+        subscription = db.get_user_subscription(user_id, raise_errors=True)
         
         if subscription:
-            # Converte features de JSON string para lista
-            features = []
-            try:
-                features = json.loads(subscription['features']) if subscription['features'] else []
-            except:
-                features = []
+            # Converte features de JSON string para lista (uma vez por carga do cache)
+            features = _parse_features(subscription['features'])
             
             return {
                 'subscription_id': subscription['subscription_id'],
@@ -42,7 +92,8 @@ class SubscriptionSystem:
                 'priority_support': subscription['priority_support'],
                 'start_date': subscription['start_date'],
                 'end_date': subscription['end_date'],
-                'user_id': user_id
+                'user_id': user_id,
+                'feature_access': PLAN_FEATURE_ACCESS.get(subscription['plan_id'], frozenset())
             }
         
         return SubscriptionSystem._get_default_plan()
@@ -62,7 +113,8 @@ class SubscriptionSystem:
             'priority_support': False,
             'start_date': None,
             'end_date': None,
-            'user_id': None
+            'user_id': None,
+            'feature_access': PLAN_FEATURE_ACCESS['free']
         }
     
     @staticmethod
@@ -82,7 +134,7 @@ class SubscriptionSystem:
         if daily_limit == -1:
             return True, "Consultas ilimitadas"
         
-        # Verifica uso diário
+        # Verifica uso diário (contador em memória, sem ida ao banco)
         daily_usage = db.get_daily_usage(user_id)
         
         if daily_usage >= daily_limit:
@@ -90,6 +142,27 @@ class SubscriptionSystem:
         
         return True, f"Consulta autorizada ({daily_usage + 1}/{daily_limit})"
     
+    @staticmethod
+    def consume_query_permission(user_id: str = None) -> Tuple[bool, str]:
+        """
+        Verifica e consome uma consulta atomicamente (evita que duas sessões do
+        mesmo usuário passem juntas pelo último slot do limite diário)
+        """
+        if not user_id:
+            current_user = get_current_user()
+            if not current_user:
+                return False, "Usuário não autenticado"
+            user_id = current_user['id']
+        
+        daily_limit = SubscriptionSystem.get_user_subscription_info(user_id)['daily_limit']
+        allowed, daily_usage = db.try_consume_daily_usage(user_id, daily_limit)
+        
+        if daily_limit == -1:
+            return True, "Consultas ilimitadas"
+        if not allowed:
+            return False, f"Limite diário atingido ({daily_usage}/{daily_limit}). Faça upgrade do seu plano!"
+        return True, f"Consulta autorizada ({daily_usage}/{daily_limit})"
+    
     @staticmethod
     def increment_user_usage(user_id: str = None) -> int:
         """Incrementa uso do usuário"""
@@ -115,39 +188,36 @@ class SubscriptionSystem:
     @staticmethod
     def change_user_plan(user_id: str, plan_id: str, payment_data: Dict = None) -> bool:
         """Altera plano do usuário"""
-        return db.assign_plan_to_user(user_id, plan_id, payment_data)
+        try:
+            return db.assign_plan_to_user(user_id, plan_id, payment_data)
+        finally:
+            SubscriptionSystem.invalidate_cache(user_id)
     
     @staticmethod
     def get_available_plans() -> List[Dict]:
-        """Retorna planos disponíveis"""
+        """Retorna planos disponíveis (cache com TTL)"""
+        version = db.subscription_version("")[0]
+        now = time.monotonic()
+        cached = _plans_cache.get("plans")
+        if cached and cached[0] > now and cached[1] == version:
+            return [dict(plan) for plan in cached[2]]
+        
         plans = db.get_available_plans()
         
         # Converte features de JSON para lista
         for plan in plans:
-            try:
-                plan['features'] = json.loads(plan['features']) if plan['features'] else []
-            except:
-                plan['features'] = []
+            plan['features'] = _parse_features(plan['features'])
         
-        return plans
+        with _cache_lock:
+            _plans_cache["plans"] = (now + SUBSCRIPTION_CACHE_TTL, version, plans)
+        return [dict(plan) for plan in plans]
     
     @staticmethod
     def check_feature_permission(feature: str, user_id: str = None) -> Tuple[bool, str]:
         """Verifica se usuário tem acesso a funcionalidade específica"""
         subscription = SubscriptionSystem.get_user_subscription_info(user_id)
-        plan_id = subscription['plan_id']
-        
-        # Mapeamento de features por plano
-        feature_access = {
-            'free': ['basic_queries'],
-            'basic': ['basic_queries', 'excel_export', 'basic_charts'],
-            'premium': ['basic_queries', 'excel_export', 'basic_charts', 'advanced_charts', 'priority_support'],
-            'enterprise': ['basic_queries', 'excel_export', 'basic_charts', 'advanced_charts', 'priority_support', 'api_access', 'custom_reports']
-        }
-        
-        allowed_features = feature_access.get(plan_id, [])
         
-        if feature in allowed_features:
+        if feature in subscription['feature_access']:
             return True, f"Funcionalidade '{feature}' disponível no seu plano"
         else:
             return False, f"Funcionalidade '{feature}' requer upgrade de plano"
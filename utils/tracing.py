@@ -0,0 +1,317 @@
+"""
+Tracing - Spans aninhados para o pipeline NL→SQL
+================================================
+
+Substitui o `flow_path` em string por spans com início/fim, atributos
+(tabela escolhida, tokens, bytes processados, retries...) e relação
+pai/filho. O span corrente vive em um `contextvars.ContextVar`, então:
+
+- spans abertos dentro de outro viram filhos automaticamente
+- `wrap(fn)` / `start_thread(...)` levam o contexto para threads de trabalho
+  (o trabalho em paralelo aparece sobreposto na linha do tempo)
+
+Quando o span raiz e todos os filhos terminam, o trace é exportado no formato
+Chrome Trace Event (JSON array, aberto em chrome://tracing ou ui.perfetto.dev).
+
+Configuração (variáveis de ambiente):
+- TRACING_ENABLED (padrão: false)
+- TRACE_EXPORT_PATH (padrão: PROJECT_ROOT/traces.json)
+- TRACE_SLOW_MS: só exporta traces com raiz >= N ms (padrão: 0 = todos)
+
+Uso:
+    from utils.tracing import get_tracer
+    tracer = get_tracer()
+    with tracer.span("bigquery.execute", stage=STAGE_BIGQUERY) as span:
+        ...
+        span.set_attribute("bytes_processed", job.total_bytes_processed)
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from utils.stage_metrics import get_stage_metrics
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", os.path.join(PROJECT_ROOT, "traces.json"))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+RECENT_TRACES = 50
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+def _now_us() -> int:
+    return time.time_ns() // 1000
+
+
+class Span:
+    """Intervalo de trabalho com atributos; pertence a um trace"""
+
+    __slots__ = ("name", "trace", "span_id", "parent", "start_us", "end_us",
+                 "attributes", "thread_id", "thread_name", "status")
+
+    def __init__(self, name: str, trace: "_Trace", parent: Optional["Span"], attributes: Dict[str, Any]):
+        thread = threading.current_thread()
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent = parent
+        self.start_us = _now_us()
+        self.end_us: Optional[int] = None
+        self.attributes = dict(attributes)
+        self.thread_id = thread.ident
+        self.thread_name = thread.name
+        self.status = "ok"
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_us if self.end_us is not None else _now_us()
+        return (end - self.start_us) / 1000
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def set_attributes(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = "error"
+        self.attributes["error"] = f"{type(error).__name__}: {error}"[:500]
+
+    def to_chrome_event(self) -> Dict[str, Any]:
+        args = {k: v if isinstance(v, (int, float, bool, str)) or v is None else str(v)
+                for k, v in self.attributes.items()}
+        args.update({
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "status": self.status,
+        })
+        return {
+            "name": self.name,
+            "cat": "pipeline",
+            "ph": "X",
+            "ts": self.start_us,
+            "dur": max(0, (self.end_us or self.start_us) - self.start_us),
+            "pid": os.getpid(),
+            "tid": self.thread_id,
+            "args": args,
+        }
+
+
+class _NoopSpan:
+    """Span usado com tracing desligado (não aloca nada)"""
+
+    name = ""
+    duration_ms = 0.0
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_attributes(self, **attributes):
+        pass
+
+    def record_error(self, error):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Trace:
+    """Spans de uma requisição; exportado quando o último span aberto termina"""
+
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.root: Optional[Span] = None
+        self.spans: List[Span] = []
+        self.open_spans = set()
+        self.lock = threading.Lock()
+
+
+class Tracer:
+    """Cria spans, propaga contexto entre threads e exporta traces concluídos"""
+
+    def __init__(self, enabled: bool = TRACING_ENABLED, export_path: str = TRACE_EXPORT_PATH,
+                 slow_ms: float = TRACE_SLOW_MS):
+        self.enabled = enabled
+        self.export_path = export_path
+        self.slow_ms = slow_ms
+        self._export_lock = threading.Lock()
+        self._recent = deque(maxlen=RECENT_TRACES)
+        self._named_threads = set()
+
+    # ------------------------------------------------------------------
+    # Spans
+    # ------------------------------------------------------------------
+
+    def start_span(self, name: str, **attributes):
+        """Abre um span filho do span corrente (ou raiz de um novo trace)"""
+        if not self.enabled:
+            return _NOOP_SPAN
+        parent = _current_span.get()
+        trace = parent.trace if isinstance(parent, Span) else _Trace()
+        span = Span(name, trace, parent if isinstance(parent, Span) else None, attributes)
+        with trace.lock:
+            if trace.root is None:
+                trace.root = span
+            trace.open_spans.add(span)
+        _current_span.set(span)
+        return span
+
+    def end_span(self, span) -> None:
+        """Fecha o span; se era o último aberto do trace, exporta o trace"""
+        if not isinstance(span, Span) or span.end_us is not None:
+            return
+        span.end_us = _now_us()
+        # Volta o contexto para o pai (também quando um filho ficou aberto)
+        current = _current_span.get()
+        while isinstance(current, Span):
+            if current is span:
+                _current_span.set(span.parent)
+                break
+            current = current.parent
+
+        trace = span.trace
+        finished = False
+        with trace.lock:
+            trace.open_spans.discard(span)
+            trace.spans.append(span)
+            if span is trace.root:
+                # Filhos esquecidos abertos (ex.: exceção antes do _end_timing)
+                for orphan in list(trace.open_spans):
+                    if orphan.thread_id == span.thread_id:
+                        orphan.end_us = span.end_us
+                        orphan.attributes["unfinished"] = True
+                        trace.open_spans.discard(orphan)
+                        trace.spans.append(orphan)
+            finished = trace.root is not None and trace.root.end_us is not None and not trace.open_spans
+        if finished:
+            self._finish(trace)
+
+    @contextmanager
+    def span(self, name: str, stage: Optional[str] = None, **attributes):
+        """
+        Context manager de span. Com `stage`, a duração também alimenta o
+        histograma da etapa (utils.stage_metrics) mesmo com tracing desligado.
+        """
+        start = time.perf_counter()
+        previous = _current_span.get()
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            self.end_span(span)
+            _current_span.set(previous)
+            if stage:
+                get_stage_metrics().observe(stage, (time.perf_counter() - start) * 1000)
+
+    def current_span(self):
+        span = _current_span.get()
+        return span if span is not None else _NOOP_SPAN
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Atributo no span corrente (no-op sem span)"""
+        self.current_span().set_attribute(key, value)
+
+    def set_attributes(self, **attributes) -> None:
+        self.current_span().set_attributes(**attributes)
+
+    # ------------------------------------------------------------------
+    # Propagação para threads
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def wrap(fn: Callable) -> Callable:
+        """Envolve `fn` para rodar com o contexto (span corrente) de quem chamou"""
+        ctx = contextvars.copy_context()
+
+        def _run(*args, **kwargs):
+            return ctx.run(fn, *args, **kwargs)
+        return _run
+
+    def start_thread(self, target: Callable, *args, name: Optional[str] = None, daemon: bool = True, **kwargs) -> threading.Thread:
+        """Inicia uma thread que herda o span corrente"""
+        thread = threading.Thread(target=self.wrap(target), args=args, kwargs=kwargs, name=name, daemon=daemon)
+        thread.start()
+        return thread
+
+    def submit(self, executor, fn: Callable, *args, **kwargs):
+        """`executor.submit` propagando o span corrente"""
+        return executor.submit(self.wrap(fn), *args, **kwargs)
+
+    # ------------------------------------------------------------------
+    # Exportação
+    # ------------------------------------------------------------------
+
+    def _finish(self, trace: _Trace) -> None:
+        root = trace.root
+        summary = {
+            "trace_id": trace.trace_id,
+            "name": root.name,
+            "duration_ms": round(root.duration_ms, 2),
+            "spans": [
+                {
+                    "name": s.name,
+                    "span_id": s.span_id,
+                    "parent_id": s.parent.span_id if s.parent else None,
+                    "start_offset_ms": round((s.start_us - root.start_us) / 1000, 2),
+                    "duration_ms": round(s.duration_ms, 2),
+                    "thread": s.thread_name,
+                    "status": s.status,
+                    "attributes": dict(s.attributes),
+                }
+                for s in sorted(trace.spans, key=lambda s: s.start_us)
+            ],
+        }
+        self._recent.append(summary)
+        if root.duration_ms >= self.slow_ms and self.export_path:
+            try:
+                self._export(trace.spans)
+            except Exception as e:
+                print(f"[Tracing] ⚠️  Falha ao exportar trace {trace.trace_id}: {e}")
+
+    def _export(self, spans: List[Span]) -> None:
+        """
+        Acrescenta eventos ao arquivo no formato JSON Array do Chrome Trace
+        (o formato aceita o array sem o ']' final, permitindo append).
+        """
+        events = []
+        for span in spans:
+            key = (os.getpid(), span.thread_id)
+            if key not in self._named_threads:
+                self._named_threads.add(key)
+                events.append({"name": "thread_name", "ph": "M", "pid": key[0], "tid": key[1],
+                               "args": {"name": span.thread_name}})
+            events.append(span.to_chrome_event())
+
+        with self._export_lock:
+            new_file = not os.path.exists(self.export_path) or os.path.getsize(self.export_path) == 0
+            with open(self.export_path, "a", encoding="utf-8") as f:
+                if new_file:
+                    f.write("[\n")
+                for event in events:
+                    f.write(json.dumps(event, default=str) + ",\n")
+
+    def get_recent_traces(self) -> List[Dict[str, Any]]:
+        """Últimos traces concluídos (mais recente por último)"""
+        return list(self._recent)
+
+
+_tracer = Tracer()
+
+
+def get_tracer() -> Tracer:
+    """Retorna o tracer global"""
+    return _tracer
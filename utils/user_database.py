@@ -1,32 +1,125 @@
 #!/usr/bin/env python3
-"""Sistema de banco de dados para usuários e assinaturas usando DuckDB"""
+"""
+Sistema de banco de dados para usuários e assinaturas usando DuckDB
+
+Um handle DuckDB por arquivo no processo (utils.db_pool) e um cursor por
+thread: cada sessão Streamlit roda em sua própria thread e conexões DuckDB
+não são seguras para uso concorrente. `self.conn` devolve o cursor da thread
+atual; gravações de uso diário vão em lote pela fila write-behind.
+
+Com USERS_DB_URL/STORAGE_URL apontando para SQLite ou PostgreSQL (utils.storage)
+várias réplicas gravam no mesmo banco: o limite diário passa a ser consumido
+com um upsert condicional no banco em vez do contador em memória.
+"""
 
 import duckdb
 import hashlib
 import uuid
+import threading
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 import os
 
+from utils.db_pool import get_duckdb_manager, execute_values
+from utils.storage import get_storage, resolve_store_url, describe_storage
+from utils.write_behind import write_behind
+
+# A poucas consultas do limite diário o uso é gravado na hora (não só pela
+# fila write-behind): a contagem do banco nunca fica atrás perto do limite
+USAGE_SYNC_MARGIN = int(os.getenv("USAGE_SYNC_MARGIN", "3"))
+
 class UserDatabase:
     def __init__(self, db_path: str = "users_new.db"):
         """Inicializa conexão com DuckDB"""
         self.db_path = db_path
+        self._db = None
+        
+        # Uso diário em memória por (user_id, data). O DuckDB admite um único
+        # processo escritor, então o contador do processo é autoritativo; o
+        # banco recebe a contagem total em lote pela fila write-behind (upsert
+        # que só aumenta o valor: regravar um item do journal não soma de novo).
+        self._usage_lock = threading.Lock()
+        self._usage: Dict[Tuple[str, str], int] = {}
+        # Worker da fila e gravação síncrona perto do limite upsertam a mesma linha
+        self._usage_write_lock = threading.Lock()
+        write_behind.register_sink("daily_usage", self._write_usage_batch)
+        
+        # Versões das assinaturas/planos: caches de leitura (SubscriptionSystem)
+        # comparam a versão para invalidar sem consultar o banco
+        self._subscription_versions: Dict[str, int] = {}
+        self._plans_version = 0
         
         # Garante que o diretório existe apenas se não for arquivo na raiz
         if os.path.dirname(db_path):
             os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
         
         try:
-            self.conn = duckdb.connect(db_path)
-            print(f"✅ Banco conectado: {os.path.abspath(db_path)}")
+            self._db = get_storage(db_path)
+            self._db.cursor()
+            print(f"✅ Banco conectado: {describe_storage(self._db)}")
             self._create_tables()
         except Exception as e:
             print(f"❌ Erro ao conectar com banco: {e}")
             # Fallback para banco em memória
             print("🔄 Usando banco em memória como fallback")
-            self.conn = duckdb.connect(":memory:")
+            self._db = get_duckdb_manager(":memory:")
             self._create_tables()
+        
+        self._register_statements()
+        
+        # Contagens gravadas no journal e não confirmadas (crash) entram no
+        # banco antes da primeira leitura de uso
+        write_behind.replay_spool(sinks=["daily_usage"])
+
+    @property
+    def conn(self) -> duckdb.DuckDBPyConnection:
+        """Cursor da thread atual sobre o handle compartilhado"""
+        return self._db.cursor()
+
+    def _register_statements(self):
+        """Consultas quentes (login, assinatura)"""
+        user_columns = "SELECT id, username, email, created_at, is_active FROM users"
+        self._db.register_statement("user_by_username", f"{user_columns} WHERE username = ? AND is_active = true")
+        self._db.register_statement("user_by_email", f"{user_columns} WHERE email = ? AND is_active = true")
+        self._db.register_statement("authenticate", f"""
+            {user_columns}
+            WHERE (username = ? OR email = ?) AND password_hash = ? AND is_active = true
+        """)
+        self._db.register_statement("active_subscription", """
+            SELECT 
+                us.id, us.plan_id, us.status, us.start_date, us.end_date,
+                sp.name, sp.description, sp.price, sp.daily_limit, 
+                sp.features, sp.priority_support
+            FROM user_subscriptions us
+            JOIN subscription_plans sp ON us.plan_id = sp.id
+            WHERE us.user_id = ? AND us.status = 'active'
+            ORDER BY us.created_at DESC
+            LIMIT 1
+        """)
+        self._db.register_statement("usage_for_day", """
+            SELECT query_count FROM daily_usage
+            WHERE user_id = ? AND usage_date = ?
+        """)
+        # Consumo atômico no banco (backends com vários processos gravando)
+        self._db.register_statement("consume_usage", """
+            INSERT INTO daily_usage (id, user_id, usage_date, query_count, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, usage_date) DO UPDATE SET
+                query_count = daily_usage.query_count + EXCLUDED.query_count,
+                updated_at = EXCLUDED.updated_at
+            WHERE ? = -1 OR daily_usage.query_count + EXCLUDED.query_count <= ?
+            RETURNING query_count
+        """)
+
+    @staticmethod
+    def _user_row_to_dict(user) -> Dict:
+        return {
+            'id': user[0],
+            'username': user[1],
+            'email': user[2],
+            'created_at': user[3],
+            'is_active': user[4]
+        }
 
     def _create_tables(self):
         """Cria as tabelas necessárias"""
@@ -179,20 +272,10 @@ class UserDatabase:
         try:
             password_hash = self._hash_password(password)
             
-            user = self.conn.execute("""
-                SELECT id, username, email, created_at, is_active
-                FROM users 
-                WHERE (username = ? OR email = ?) AND password_hash = ? AND is_active = true
-            """, [username_or_email, username_or_email, password_hash]).fetchone()
+            user = self._db.execute("authenticate", [username_or_email, username_or_email, password_hash]).fetchone()
             
             if user:
-                return True, {
-                    'id': user[0],
-                    'username': user[1],
-                    'email': user[2],
-                    'created_at': user[3],
-                    'is_active': user[4]
-                }
+                return True, self._user_row_to_dict(user)
             else:
                 return False, None
                 
@@ -202,20 +285,10 @@ class UserDatabase:
     def get_user_by_username(self, username: str) -> Optional[Dict]:
         """Obtém usuário pelo username"""
         try:
-            user = self.conn.execute("""
-                SELECT id, username, email, created_at, is_active
-                FROM users 
-                WHERE username = ? AND is_active = true
-            """, [username]).fetchone()
+            user = self._db.execute("user_by_username", [username]).fetchone()
             
             if user:
-                return {
-                    'id': user[0],
-                    'username': user[1],
-                    'email': user[2],
-                    'created_at': user[3],
-                    'is_active': user[4]
-                }
+                return self._user_row_to_dict(user)
             return None
         except:
             return None
@@ -223,29 +296,22 @@ class UserDatabase:
     def get_user_by_email(self, email: str) -> Optional[Dict]:
         """Obtém usuário pelo email"""
         try:
-            user = self.conn.execute("""
-                SELECT id, username, email, created_at, is_active
-                FROM users 
-                WHERE email = ? AND is_active = true
-            """, [email]).fetchone()
+            user = self._db.execute("user_by_email", [email]).fetchone()
             
             if user:
-                return {
-                    'id': user[0],
-                    'username': user[1],
-                    'email': user[2],
-                    'created_at': user[3],
-                    'is_active': user[4]
-                }
+                return self._user_row_to_dict(user)
             return None
         except:
             return None
 
     def assign_plan_to_user(self, user_id: str, plan_id: str, payment_data: Dict = None) -> bool:
         """Atribui plano a um usuário"""
+        conn = self.conn
         try:
-            # Cancela assinatura ativa atual
-            self.conn.execute("""
+            # Cancela a assinatura ativa e cria a nova na mesma transação
+            # (nunca duas assinaturas ativas com sessões concorrentes)
+            conn.execute("BEGIN TRANSACTION")
+            conn.execute("""
                 UPDATE user_subscriptions 
                 SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
                 WHERE user_id = ? AND status = 'active'
@@ -255,30 +321,41 @@ class UserDatabase:
             subscription_id = str(uuid.uuid4())
             payment_json = str(payment_data) if payment_data else None
             
-            self.conn.execute("""
+            conn.execute("""
                 INSERT INTO user_subscriptions (id, user_id, plan_id, payment_data)
                 VALUES (?, ?, ?, ?)
             """, [subscription_id, user_id, plan_id, payment_json])
+            conn.execute("COMMIT")
             
             return True
         except Exception as e:
+            try:
+                conn.execute("ROLLBACK")
+            except Exception:
+                pass
             print(f"Erro ao atribuir plano: {e}")
             return False
+        finally:
+            self.invalidate_subscription(user_id)
 
-    def get_user_subscription(self, user_id: str) -> Optional[Dict]:
-        """Obtém assinatura ativa do usuário"""
+    def invalidate_subscription(self, user_id: str = None) -> None:
+        """Invalida caches de assinatura do usuário (ou de todos, com None)"""
+        if user_id is None:
+            self._plans_version += 1
+        else:
+            self._subscription_versions[user_id] = self._subscription_versions.get(user_id, 0) + 1
+
+    def subscription_version(self, user_id: str) -> Tuple[int, int]:
+        """(versão dos planos, versão da assinatura do usuário)"""
+        return self._plans_version, self._subscription_versions.get(user_id, 0)
+
+    def get_user_subscription(self, user_id: str, raise_errors: bool = False) -> Optional[Dict]:
+        """
+        Obtém assinatura ativa do usuário (None = sem assinatura). Com
+        raise_errors=True, falhas do banco são propagadas em vez de virar None.
+        """
         try:
-            result = self.conn.execute("""
-                SELECT 
-                    us.id, us.plan_id, us.status, us.start_date, us.end_date,
-                    sp.name, sp.description, sp.price, sp.daily_limit, 
-                    sp.features, sp.priority_support
-                FROM user_subscriptions us
-                JOIN subscription_plans sp ON us.plan_id = sp.id
-                WHERE us.user_id = ? AND us.status = 'active'
-                ORDER BY us.created_at DESC
-                LIMIT 1
-            """, [user_id]).fetchone()
+            result = self._db.execute("active_subscription", [user_id]).fetchone()
             
             if result:
                 return {
@@ -296,56 +373,148 @@ class UserDatabase:
                 }
             return None
         except Exception as e:
+            if raise_errors:
+                raise
             print(f"Erro ao obter assinatura: {e}")
             return None
 
-    def get_daily_usage(self, user_id: str, date: str = None) -> int:
-        """Obtém uso diário do usuário"""
-        if not date:
-            date = datetime.now().strftime('%Y-%m-%d')
-        
+    def _load_usage(self, user_id: str, date: str) -> int:
+        """Contagem do banco (só no primeiro acesso do usuário no dia)"""
         try:
-            result = self.conn.execute("""
-                SELECT query_count FROM daily_usage
-                WHERE user_id = ? AND usage_date = ?
-            """, [user_id, date]).fetchone()
-            
+            result = self._db.execute("usage_for_day", [user_id, date]).fetchone()
             return result[0] if result else 0
         except:
             return 0
 
+    def _cached_usage(self, user_id: str, date: str) -> int:
+        """Contagem em memória (chamar com _usage_lock); descarta dias anteriores"""
+        key = (user_id, date)
+        count = self._usage.get(key)
+        if count is None:
+            stale = [k for k in self._usage if k[1] != date]
+            for k in stale:
+                del self._usage[k]
+            count = self._usage[key] = self._load_usage(user_id, date)
+        return count
+
+    def get_daily_usage(self, user_id: str, date: str = None) -> int:
+        """Obtém uso diário do usuário (dia corrente em memória)"""
+        today = datetime.now().strftime('%Y-%m-%d')
+        if (date and date != today) or self._db.shared_writers:
+            return self._load_usage(user_id, date or today)
+        with self._usage_lock:
+            return self._cached_usage(user_id, today)
+
     def increment_daily_usage(self, user_id: str, increment: int = 1) -> int:
-        """Incrementa uso diário e retorna total"""
+        """Incrementa uso diário e retorna total (gravação em lote, sem ida ao banco)"""
+        return self.try_consume_daily_usage(user_id, -1, increment)[1]
+
+    def try_consume_daily_usage(self, user_id: str, daily_limit: int, increment: int = 1) -> Tuple[bool, int]:
+        """
+        Verifica e consome o limite diário de forma atômica no processo
+        (-1 = ilimitado). Retorna (permitido, total após a operação).
+        """
         date = datetime.now().strftime('%Y-%m-%d')
-        current_time = datetime.now().isoformat()
+        if self._db.shared_writers:
+            return self._consume_usage_shared(user_id, date, daily_limit, increment)
         
-        try:
-            # Verifica se registro já existe
-            existing = self.conn.execute("""
-                SELECT query_count FROM daily_usage
-                WHERE user_id = ? AND usage_date = ?
-            """, [user_id, date]).fetchone()
+        with self._usage_lock:
+            count = self._cached_usage(user_id, date)
+            if daily_limit != -1 and count + increment > daily_limit:
+                return False, count
+            count += increment
+            self._usage[(user_id, date)] = count
             
-            if existing:
-                # Atualiza registro existente
-                new_count = existing[0] + increment
-                self.conn.execute("""
-                    UPDATE daily_usage 
-                    SET query_count = ?, updated_at = ?
-                    WHERE user_id = ? AND usage_date = ?
-                """, [new_count, current_time, user_id, date])
-                return new_count
+            # Agendado ainda com o lock: um reset/invalidação não pode ficar
+            # entre a contagem em memória e o item na fila
+            payload = {
+                "user_id": user_id,
+                "usage_date": date,
+                "count": count,
+                "updated_at": datetime.now().isoformat()
+            }
+            if daily_limit != -1 and count >= daily_limit - USAGE_SYNC_MARGIN:
+                try:
+                    self._write_usage_batch([payload])
+                    return True, count
+                except Exception as e:
+                    print(f"Erro ao gravar uso diário (segue pela fila): {e}")
+            try:
+                write_behind.enqueue("daily_usage", payload)
+            except Exception as e:
+                print(f"Erro ao agendar gravação de uso: {e}")
+        return True, count
+
+    def _consume_usage_shared(self, user_id: str, date: str, daily_limit: int, increment: int) -> Tuple[bool, int]:
+        """Outras réplicas gravam no mesmo banco: verifica e soma num único upsert"""
+        if daily_limit != -1 and increment > daily_limit:
+            return False, self._load_usage(user_id, date)
+        try:
+            row = self._db.execute("consume_usage", [
+                str(uuid.uuid4()), user_id, date, increment, datetime.now(), daily_limit, daily_limit
+            ]).fetchone()
+        except Exception as e:
+            print(f"Erro ao consumir uso diário: {e}")
+            return False, self._load_usage(user_id, date)
+        if row is None:
+            return False, self._load_usage(user_id, date)
+        return True, row[0]
+
+    def invalidate_usage_cache(self, user_id: str = None) -> None:
+        """Força recarregar a contagem do banco (ex.: após reset manual)"""
+        with self._usage_lock:
+            self._settle_usage_writes()
+            if user_id is None:
+                self._usage.clear()
             else:
-                # Insere novo registro
-                self.conn.execute("""
+                for key in [k for k in self._usage if k[0] == user_id]:
+                    del self._usage[key]
+
+    @staticmethod
+    def _settle_usage_writes() -> None:
+        """Grava as contagens ainda na fila ou só no journal (chamar com _usage_lock)"""
+        write_behind.flush()
+        write_behind.replay_spool(sinks=["daily_usage"])
+
+    def reset_daily_usage(self, user_id: str, date: str = None) -> None:
+        """Zera o uso do dia (esvazia a fila antes: nenhuma contagem antiga regrava o valor)"""
+        date = date or datetime.now().strftime('%Y-%m-%d')
+        with self._usage_lock:
+            self._settle_usage_writes()
+            self.conn.execute(
+                "DELETE FROM daily_usage WHERE user_id = ? AND usage_date = ?",
+                [user_id, date]
+            )
+            self._usage.pop((user_id, date), None)
+
+    def _write_usage_batch(self, payloads: List[Dict]) -> None:
+        """Grava a maior contagem de cada usuário/dia do lote (sink da fila write-behind)"""
+        totals: Dict[Tuple[str, str], List] = {}
+        for p in payloads:
+            entry = totals.setdefault((p["user_id"], p["usage_date"]), [0, p["updated_at"]])
+            entry[0] = max(entry[0], p["count"])
+            entry[1] = max(entry[1], p["updated_at"])
+        
+        rows = [
+            [str(uuid.uuid4()), user_id, date, count, updated_at]
+            for (user_id, date), (count, updated_at) in totals.items()
+        ]
+        # INSERT multi-linha por bloco (executemany no DuckDB grava linha a linha)
+        conn = self.conn
+        with self._usage_write_lock:
+            conn.execute("BEGIN TRANSACTION")
+            try:
+                execute_values(conn, """
                     INSERT INTO daily_usage (id, user_id, usage_date, query_count, updated_at)
-                    VALUES (?, ?, ?, ?, ?)
-                """, [str(uuid.uuid4()), user_id, date, increment, current_time])
-                return increment
-                
-        except Exception as e:
-            print(f"Erro ao incrementar uso: {e}")
-            return 0
+                    VALUES {values}
+                    ON CONFLICT (user_id, usage_date) DO UPDATE SET
+                        query_count = GREATEST(daily_usage.query_count, EXCLUDED.query_count),
+                        updated_at = EXCLUDED.updated_at
+                """, rows)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
 
     def get_available_plans(self) -> List[Dict]:
         """Retorna todos os planos disponíveis"""
@@ -381,6 +550,7 @@ class UserDatabase:
                 INSERT INTO subscription_plans (id, name, description, price, daily_limit, features, priority_support)
                 VALUES (?, ?, ?, ?, ?, ?, ?)
             """, [plan_id, name, description, price, daily_limit, features, priority_support])
+            self.invalidate_subscription()
             return True
         except Exception as e:
             print(f"Erro ao criar plano: {e}")
@@ -388,8 +558,8 @@ class UserDatabase:
 
     def close(self):
         """Fecha conexão com banco"""
-        if self.conn:
-            self.conn.close()
+        if self._db:
+            self._db.close()
 
 # Instância global do banco
-db = UserDatabase()
\ No newline at end of file
+db = UserDatabase(resolve_store_url("users", "users_new.db"))
\ No newline at end of file
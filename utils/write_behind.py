@@ -0,0 +1,354 @@
+"""
+Write-Behind - Persistência assíncrona fora do caminho crítico
+==============================================================
+
+Gravações de interação, erro e métricas não precisam acontecer
+antes de o usuário receber a resposta. Este módulo oferece:
+
+- journal JSONL (write-ahead): cada item é gravado no arquivo ANTES de entrar
+  na fila, e marcado como concluído ("ack") depois de gravado no destino.
+  Um crash perde no máximo o que não chegou ao journal; no próximo start (e
+  periodicamente) os itens sem ack são regravados
+- fila em memória limitada (WRITE_BEHIND_QUEUE_SIZE); com a fila cheia o item
+  fica só no journal e é gravado na próxima releitura
+- uma thread worker que agrupa itens por destino ("sink") e grava em lote;
+  se o lote falhar, cada linha é regravada sozinha e só as que falharem
+  voltam ao journal. Após WRITE_BEHIND_MAX_ATTEMPTS falhas a linha vai para
+  a quarentena (<journal>.quarantine) e deixa de ser reprocessada
+- flush no encerramento do processo (atexit)
+
+Um mesmo item pode ser gravado mais de uma vez (crash entre a gravação e o
+ack, releitura): os sinks devem ser idempotentes (ex.: INSERT ... ON
+CONFLICT (id) DO NOTHING). Cada processo deve usar o seu próprio journal
+(WRITE_BEHIND_SPOOL_PATH).
+
+Cada módulo dono de uma gravação registra seu sink:
+
+    write_behind.register_sink("cache_interaction", _write_interactions_batch)
+    write_behind.enqueue("cache_interaction", {...})
+
+O handler recebe a lista de payloads (dicts serializáveis em JSON) do lote.
+Com WRITE_BEHIND_ENABLED=false a gravação é síncrona (scripts/testes).
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from utils.tracing import get_tracer
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WRITE_BEHIND_ENABLED = os.getenv("WRITE_BEHIND_ENABLED", "true").lower() == "true"
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", "1000"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "50"))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", "0.5"))
+WRITE_BEHIND_SPOOL_PATH = os.getenv("WRITE_BEHIND_SPOOL_PATH", os.path.join(PROJECT_ROOT, "write_behind_spool.jsonl"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "5"))
+WRITE_BEHIND_FSYNC = os.getenv("WRITE_BEHIND_FSYNC", "false").lower() == "true"
+SPOOL_REPLAY_INTERVAL = 30.0
+
+
+class WriteBehindQueue:
+    """Journal JSONL (write-ahead) + fila limitada + worker em lote"""
+
+    def __init__(
+        self,
+        max_size: int = WRITE_BEHIND_QUEUE_SIZE,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+        spool_path: str = WRITE_BEHIND_SPOOL_PATH,
+        enabled: bool = WRITE_BEHIND_ENABLED,
+        max_attempts: int = WRITE_BEHIND_MAX_ATTEMPTS,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path
+        self.quarantine_path = spool_path + ".quarantine"
+        self.enabled = enabled
+        self.max_attempts = max_attempts
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_size)
+        self._sinks: Dict[str, Callable[[List[Dict[str, Any]]], None]] = {}
+        self._spool_lock = threading.Lock()
+        self._spool_file = None
+        self._state_lock = threading.Lock()
+        self._inflight: set = set()
+        self._attempts: Dict[str, int] = {}
+        self._start_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._last_replay = 0.0
+        self._stats = {"enqueued": 0, "written": 0, "failed": 0, "spooled": 0, "replayed": 0, "quarantined": 0}
+
+    # ------------------------------------------------------------------
+    # API
+    # ------------------------------------------------------------------
+
+    def register_sink(self, name: str, handler: Callable[[List[Dict[str, Any]]], None]) -> None:
+        """Registra o gravador em lote de um destino"""
+        self._sinks[name] = handler
+
+    def enqueue(self, sink: str, payload: Dict[str, Any]) -> None:
+        """Registra no journal e agenda a gravação; nunca espera o destino"""
+        if sink not in self._sinks:
+            raise KeyError(f"Sink não registrado: {sink}")
+        entry_id = uuid.uuid4().hex
+
+        if not self.enabled:
+            if not self._write(sink, [payload]):
+                # Síncrono: só o que falhou vai para o journal (regravado depois)
+                self._journal([{"id": entry_id, "sink": sink, "payload": payload}])
+            return
+
+        self._ensure_worker()
+        with self._state_lock:
+            self._inflight.add(entry_id)
+        self._journal([{"id": entry_id, "sink": sink, "payload": payload}])
+        self._count("enqueued")
+        try:
+            self._queue.put_nowait((entry_id, sink, payload))
+        except queue.Full:
+            # Backpressure sem bloquear a requisição: fica no journal para a próxima releitura
+            with self._state_lock:
+                self._inflight.discard(entry_id)
+            self._count("spooled")
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Espera a fila esvaziar (True se esvaziou dentro do timeout)"""
+        deadline = time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        """Drena a fila; o que não for gravado continua no journal sem ack"""
+        if self._worker is not None:
+            self.flush(timeout)
+            self._stop.set()
+            self._worker.join(timeout=timeout)
+            while True:
+                try:
+                    entry_id, _, _ = self._queue.get_nowait()
+                    self._queue.task_done()
+                except queue.Empty:
+                    break
+                with self._state_lock:
+                    self._inflight.discard(entry_id)
+        with self._spool_lock:
+            self._close_spool()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._state_lock:
+            stats = dict(self._stats)
+            stats["inflight"] = len(self._inflight)
+        stats["queue_depth"] = self._queue.qsize()
+        stats["spool_exists"] = os.path.exists(self.spool_path)
+        return stats
+
+    # ------------------------------------------------------------------
+    # Worker
+    # ------------------------------------------------------------------
+
+    def _ensure_worker(self) -> None:
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._start_lock:
+            if self._worker is not None and self._worker.is_alive():
+                return
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._worker.start()
+
+    def _run(self) -> None:
+        self.replay_spool()
+        while not self._stop.is_set():
+            try:
+                first = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if time.monotonic() - self._last_replay > SPOOL_REPLAY_INTERVAL:
+                    self.replay_spool()
+                continue
+
+            batch = [first]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self._process(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            # Sob carga contínua a fila nunca fica vazia: relê/compacta o journal mesmo assim
+            if time.monotonic() - self._last_replay > SPOOL_REPLAY_INTERVAL:
+                self.replay_spool()
+
+    def _process(self, items: List[tuple]) -> None:
+        """Agrupa por sink (mantendo a ordem), grava cada grupo e registra o resultado no journal"""
+        grouped: Dict[str, List[tuple]] = {}
+        for entry_id, sink, payload in items:
+            grouped.setdefault(sink, []).append((entry_id, payload))
+
+        done, failed = [], []
+        for sink, entries in grouped.items():
+            if self._write(sink, [payload for _, payload in entries]):
+                done.extend(entry_id for entry_id, _ in entries)
+                continue
+            if len(entries) == 1:
+                failed.append((entries[0][0], sink, entries[0][1]))
+                continue
+            # Lote falhou: isola a(s) linha(s) com problema gravando uma a uma
+            for entry_id, payload in entries:
+                if self._write(sink, [payload]):
+                    done.append(entry_id)
+                else:
+                    failed.append((entry_id, sink, payload))
+        self._settle(done, failed)
+
+    def _write(self, sink: str, payloads: List[Dict[str, Any]]) -> bool:
+        try:
+            with get_tracer().span(f"write_behind.{sink}", items=len(payloads)):
+                self._sinks[sink](payloads)
+            self._count("written", len(payloads))
+            return True
+        except Exception as e:
+            self._count("failed", len(payloads))
+            print(f"[WriteBehind] ⚠️  Falha ao gravar {len(payloads)} itens em '{sink}': {e}")
+            return False
+
+    def _settle(self, done: List[str], failed: List[tuple]) -> None:
+        """Ack dos gravados; falhas contam tentativa e, no limite, vão para a quarentena"""
+        records: List[Dict[str, Any]] = []
+        quarantined = []
+        with self._state_lock:
+            for entry_id in done:
+                self._attempts.pop(entry_id, None)
+            for entry_id, sink, payload in failed:
+                attempts = self._attempts.get(entry_id, 0) + 1
+                if attempts >= self.max_attempts:
+                    self._attempts.pop(entry_id, None)
+                    quarantined.append({"id": entry_id, "sink": sink, "payload": payload, "attempts": attempts})
+                else:
+                    self._attempts[entry_id] = attempts
+                    records.append({"fail": entry_id})
+            self._inflight.difference_update(done)
+            self._inflight.difference_update(entry_id for entry_id, _, _ in failed)
+
+        if quarantined:
+            self._quarantine(quarantined)
+        acked = done + [entry["id"] for entry in quarantined]
+        if acked:
+            records.append({"ack": acked})
+        if records:
+            self._journal(records)
+        if failed:
+            self._count("spooled", len(failed) - len(quarantined))
+
+    # ------------------------------------------------------------------
+    # Journal
+    # ------------------------------------------------------------------
+
+    def _journal(self, records: Iterable[Dict[str, Any]]) -> None:
+        lines = "".join(json.dumps(record, default=str) + "\n" for record in records)
+        try:
+            with self._spool_lock:
+                if self._spool_file is None:
+                    self._spool_file = open(self.spool_path, "a", encoding="utf-8")
+                self._spool_file.write(lines)
+                self._spool_file.flush()
+                if WRITE_BEHIND_FSYNC:
+                    os.fsync(self._spool_file.fileno())
+        except Exception as e:
+            print(f"[WriteBehind] ❌ Falha ao gravar journal: {e}")
+
+    def _close_spool(self) -> None:
+        """Fecha o handle do journal (chamar com _spool_lock)"""
+        if self._spool_file is not None:
+            self._spool_file.close()
+            self._spool_file = None
+
+    def _quarantine(self, entries: List[Dict[str, Any]]) -> None:
+        try:
+            with self._spool_lock, open(self.quarantine_path, "a", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry, default=str) + "\n")
+        except Exception as e:
+            print(f"[WriteBehind] ❌ Falha ao gravar quarentena: {e}")
+            return
+        self._count("quarantined", len(entries))
+        print(f"[WriteBehind] 🚫 {len(entries)} itens em quarentena após {self.max_attempts} falhas: {self.quarantine_path}")
+
+    def replay_spool(self, sinks: Optional[Iterable[str]] = None) -> int:
+        """
+        Compacta o journal (descarta itens com ack) e regrava os pendentes que
+        não estão na fila deste processo. `sinks` restringe a releitura (ex.:
+        carregar o uso diário antes de ler o banco).
+        """
+        self._last_replay = time.monotonic()
+        sinks = set(sinks) if sinks is not None else None
+        with self._spool_lock:
+            if not os.path.exists(self.spool_path):
+                return 0
+            self._close_spool()
+            entries: Dict[str, Dict[str, Any]] = {}
+            acked, failures = set(), {}
+            with open(self.spool_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "ack" in record:
+                        acked.update(record["ack"])
+                    elif "fail" in record:
+                        failures[record["fail"]] = failures.get(record["fail"], 0) + 1
+                    elif record.get("sink"):
+                        # Spool antigo não tinha id
+                        entries[record.get("id") or uuid.uuid4().hex] = record
+            pending = {entry_id: e for entry_id, e in entries.items() if entry_id not in acked}
+
+            compacted = self.spool_path + ".compact"
+            with open(compacted, "w", encoding="utf-8") as f:
+                for entry_id, entry in pending.items():
+                    f.write(json.dumps({"id": entry_id, "sink": entry["sink"], "payload": entry.get("payload")}) + "\n")
+                    for _ in range(failures.get(entry_id, 0)):
+                        f.write(json.dumps({"fail": entry_id}) + "\n")
+            os.replace(compacted, self.spool_path)
+
+            with self._state_lock:
+                for entry_id in pending:
+                    self._attempts[entry_id] = max(self._attempts.get(entry_id, 0), failures.get(entry_id, 0))
+                # Sink ainda não registrado neste processo: fica no journal
+                items = [
+                    (entry_id, entry["sink"], entry.get("payload"))
+                    for entry_id, entry in pending.items()
+                    if entry_id not in self._inflight and entry["sink"] in self._sinks
+                    and (sinks is None or entry["sink"] in sinks)
+                ]
+                self._inflight.update(entry_id for entry_id, _, _ in items)
+
+        for start in range(0, len(items), self.batch_size):
+            self._process(items[start:start + self.batch_size])
+        self._count("replayed", len(items))
+        if items:
+            print(f"[WriteBehind] ♻️  {len(items)} itens do journal reprocessados")
+        return len(items)
+
+    def _count(self, name: str, value: int = 1) -> None:
+        with self._state_lock:
+            self._stats[name] += value
+
+
+write_behind = WriteBehindQueue()
+atexit.register(write_behind.shutdown)